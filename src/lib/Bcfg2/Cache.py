@@ -1,14 +1,382 @@
-""" An implementation of a simple memory-backed cache. Right now this
-doesn't provide many features, but more (time-based expiration, etc.)
-can be added as necessary. """
+""" An implementation of a memory-backed cache, with optional limits
+on the number and total size of cached items, per-item expiration
+times, least-recently-used eviction, reverse indexes of the cached
+items, and hit/miss/eviction counters. """
+
+import time
+import threading
+import Bcfg2.Statistics
+
+#: Mapping of cache event names, as reported to
+#: :attr:`Bcfg2.Statistics.stats`, to the :class:`Cache` attributes
+#: that count them
+COUNTERS = dict(hit="hits", miss="misses", eviction="evictions",
+                expiration="expirations")
 
 
 class Cache(dict):
-    """ an implementation of a simple memory-backed cache """
+    """ A memory-backed cache.  With no arguments, this behaves like
+    a dict with an :func:`expire` method.  Optionally, it can be
+    bounded by the number of items it holds and/or by the total size
+    of those items, in which case the least recently used items are
+    evicted when either limit is exceeded; items can expire a given
+    number of seconds after they are cached; and the cache can keep
+    reverse indexes of the items it holds, so that the keys of all
+    items with a given property can be looked up or expired without
+    examining every item.
+
+    Expired items are removed when they are next accessed, when
+    :func:`purge` is called, or when they are the least recently used
+    items in the cache as another item is added; until then, they are
+    still included in :func:`len`, :func:`keys`, etc. """
+
+    def __init__(self, max_entries=0, max_size=0, sizeof=len, ttl=0,
+                 indexes=None, name=None):
+        """
+        :param max_entries: The maximum number of items to keep in
+                            the cache, or 0 for no limit
+        :type max_entries: int
+        :param max_size: The maximum total size of all items in the
+                         cache, as determined by ``sizeof``, or 0 for
+                         no limit
+        :type max_size: int
+        :param sizeof: A callable that returns the size of a single
+                       item.  By default this is :func:`len`, which
+                       makes ``max_size`` a limit in bytes for caches
+                       of strings.  It is only used if ``max_size``
+                       is set.
+        :type sizeof: callable
+        :param ttl: The default number of seconds after which items
+                    expire, or 0 for no expiration.  This can be
+                    overridden for individual items with :func:`set`.
+        :type ttl: int or float
+        :param indexes: A dict of <index name> -> <callable>.  Each
+                        callable is given an item, and returns an
+                        iterable of the values under which that item
+                        is indexed.  See :func:`lookup` and
+                        :func:`expire_by`.
+        :type indexes: dict
+        :param name: The name of the cache.  If this is given, cache
+                     hits, misses, evictions, and expirations are
+                     reported to :attr:`Bcfg2.Statistics.stats` as
+                     ``Cache:<name>:hit``, ``Cache:<name>:miss``,
+                     ``Cache:<name>:eviction``, and
+                     ``Cache:<name>:expiration``.
+        :type name: string
+        """
+        dict.__init__(self)
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.name = name
+        if indexes is None:
+            indexes = dict()
+        self.indexes = indexes
+
+        #: The total size of all items currently in the cache, if
+        #: ``max_size`` is set
+        self.size = 0
+
+        #: The number of successful lookups of items in the cache
+        self.hits = 0
+
+        #: The number of lookups of items that were not in the cache
+        #: or had expired
+        self.misses = 0
+
+        #: The number of items that have been evicted from the cache
+        #: to stay within the size limits
+        self.evictions = 0
+
+        #: The number of items that have been removed from the cache
+        #: because they expired
+        self.expirations = 0
+
+        # doubly-linked list of [prev, next, key] links in order of
+        # use, with the least recently used item at the head
+        self._root = []
+        self._root[:] = [self._root, self._root, None]
+        self._links = dict()
+        self._sizes = dict()
+
+        # mapping of <key> -> <time the item expires>
+        self._expires = dict()
+
+        # mapping of <index name> -> <value> -> set of keys
+        self._index = dict([(iname, dict()) for iname in indexes])
+
+        # mapping of <key> -> <index name> -> values the item with
+        # that key is indexed under, so it can be removed from the
+        # indexes even if it has been modified since it was added
+        self._indexed = dict()
+        self._lock = threading.RLock()
+
+    def _count(self, event):
+        """ increment the counter for the given event, one of
+        ``hit``, ``miss``, ``eviction``, or ``expiration``, and report
+        it to :attr:`Bcfg2.Statistics.stats` if this cache is named """
+        attr = COUNTERS[event]
+        setattr(self, attr, getattr(self, attr) + 1)
+        if self.name:
+            Bcfg2.Statistics.stats.add_value("Cache:%s:%s" %
+                                             (self.name, event), 1)
+
+    def _expired(self, key, now=None):
+        """ return True if the item with the given key has expired """
+        if key not in self._expires:
+            return False
+        if now is None:
+            now = time.time()
+        return self._expires[key] <= now
+
+    def _unlink(self, key):
+        """ remove the given key from the usage list """
+        link = self._links.pop(key)
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, key):
+        """ add the given key to the usage list as the most recently
+        used item """
+        last = self._root[0]
+        link = [last, self._root, key]
+        last[1] = link
+        self._root[0] = link
+        self._links[key] = link
+
+    def _unindex(self, key):
+        """ remove the item with the given key from all indexes """
+        for iname, values in self._indexed.pop(key, dict()).items():
+            index = self._index[iname]
+            for value in values:
+                index[value].discard(key)
+                if not index[value]:
+                    del index[value]
+
+    def __getitem__(self, key):
+        self._lock.acquire()
+        try:
+            if not dict.__contains__(self, key):
+                self._count("miss")
+                raise KeyError(key)
+            if self._expired(key):
+                del self[key]
+                self._count("expiration")
+                self._count("miss")
+                raise KeyError(key)
+            self._unlink(key)
+            self._append(key)
+            self._count("hit")
+            return dict.__getitem__(self, key)
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            if not dict.__contains__(self, key):
+                return False
+            if self._expired(key):
+                del self[key]
+                self._count("expiration")
+                return False
+            return True
+        finally:
+            self._lock.release()
+
+    has_key = __contains__
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        """ Add an item to the cache.
+
+        :param key: The key of the item
+        :param value: The item
+        :param ttl: The number of seconds after which the item
+                    expires, 0 for no expiration, or None to use the
+                    default given when the cache was created
+        :type ttl: int or float
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self._lock.acquire()
+        try:
+            if dict.__contains__(self, key):
+                del self[key]
+            now = time.time()
+            dict.__setitem__(self, key, value)
+            if ttl:
+                self._expires[key] = now + ttl
+            if self.max_size:
+                self._sizes[key] = self.sizeof(value)
+                self.size += self._sizes[key]
+            self._append(key)
+            if self.indexes:
+                indexed = dict()
+                for iname, func in self.indexes.items():
+                    indexed[iname] = set(func(value))
+                    index = self._index[iname]
+                    for ival in indexed[iname]:
+                        index.setdefault(ival, set()).add(key)
+                self._indexed[key] = indexed
+
+            # drop expired items from the head of the usage list,
+            # then evict the least recently used items until the
+            # cache is within its limits
+            while (self._root[1] is not self._root and
+                   self._expired(self._root[1][2], now)):
+                del self[self._root[1][2]]
+                self._count("expiration")
+            while (len(self) and
+                   ((self.max_entries and len(self) > self.max_entries) or
+                    (self.max_size and self.size > self.max_size))):
+                del self[self._root[1][2]]
+                self._count("eviction")
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            dict.__delitem__(self, key)
+            self._unlink(key)
+            self._expires.pop(key, None)
+            self.size -= self._sizes.pop(key, 0)
+            self._unindex(key)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, *args):
+        self._lock.acquire()
+        try:
+            if dict.__contains__(self, key):
+                value = dict.__getitem__(self, key)
+                del self[key]
+                return value
+            return dict.pop(self, key, *args)
+        finally:
+            self._lock.release()
+
+    def popitem(self):
+        """ Remove and return the least recently used item """
+        self._lock.acquire()
+        try:
+            if not len(self):
+                raise KeyError("popitem(): cache is empty")
+            key = self._root[1][2]
+            return (key, self.pop(key))
+        finally:
+            self._lock.release()
+
+    def setdefault(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                return self[key]
+            except KeyError:
+                self[key] = default
+                return default
+        finally:
+            self._lock.release()
+
+    def copy(self):
+        """ Get a plain dict of the unexpired items in the cache,
+        without counting hits or changing their order of use """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            return dict([(key, value)
+                         for key, value in dict.items(self)
+                         if not self._expired(key, now)])
+        finally:
+            self._lock.release()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            dict.clear(self)
+            self._root[:] = [self._root, self._root, None]
+            self._links.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            for index in self._index.values():
+                index.clear()
+            self._indexed.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
 
     def expire(self, key=None):
         """ expire all items, or a specific item, from the cache """
-        if key is None:
-            self.clear()
-        elif key in self:
-            del self[key]
+        self._lock.acquire()
+        try:
+            if key is None:
+                self.clear()
+            elif dict.__contains__(self, key):
+                del self[key]
+        finally:
+            self._lock.release()
+
+    def expire_by(self, index, value):
+        """ Expire all items that are indexed under the given value in
+        the given index, e.g., the metadata of all clients in a given
+        group.
+
+        :param index: The name of the index
+        :type index: string
+        :param value: The value to look up
+        """
+        self._lock.acquire()
+        try:
+            for key in list(self._index[index].get(value, ())):
+                del self[key]
+        finally:
+            self._lock.release()
+
+    def lookup(self, index, value):
+        """ Get the keys of all unexpired items in the cache that are
+        indexed under the given value in the given index.
+
+        :param index: The name of the index
+        :type index: string
+        :param value: The value to look up
+        :returns: set - The keys of the matching items
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            rv = set()
+            for key in list(self._index[index].get(value, ())):
+                if self._expired(key, now):
+                    del self[key]
+                    self._count("expiration")
+                else:
+                    rv.add(key)
+            return rv
+        finally:
+            self._lock.release()
+
+    def purge(self):
+        """ Remove all expired items from the cache """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            for key in list(self._expires.keys()):
+                if self._expired(key, now):
+                    del self[key]
+                    self._count("expiration")
+        finally:
+            self._lock.release()
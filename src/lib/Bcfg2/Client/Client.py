@@ -1,23 +1,82 @@
 """ The main Bcfg2 client class """
 
 import os
+import re
 import sys
 import stat
 import time
 import fcntl
+import signal
 import socket
 import logging
 import tempfile
+import threading
 import Bcfg2.Proxy
 import Bcfg2.Logger
 import Bcfg2.Options
 import Bcfg2.Client.XML
 import Bcfg2.Client.Frame
 import Bcfg2.Client.Tools
-from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Compat import xmlrpclib, md5
 from Bcfg2.version import __version__
 from subprocess import Popen, PIPE
 
+try:
+    import Bcfg2.Delta
+    HAS_DELTA = True
+except ImportError:
+    HAS_DELTA = False
+
+# the response to GetConfig when the configuration has not changed
+# since the one the client has cached (see
+# Bcfg2.Server.Core.NOT_MODIFIED)
+NOT_MODIFIED = "<NotModified/>"
+
+# the fault string of the fault an older server, whose GetConfig does
+# not accept a digest, returns when it is sent one
+SIGNATURE_FAULT = re.compile(r'takes .*argument.*given')
+
+# characters in probe names that are not allowed in the names of the
+# OpStamps attributes that probe timings are reported as
+TIMES_KEY_INVALID = re.compile(r'[^\w.-]')
+
+# probes are run from worker threads, where it is not safe to run
+# Python code in the child between fork and exec, as Popen does with
+# preexec_fn.  so each probe is started in its own session (and so
+# its own process group) either by Popen itself, or, on older
+# versions of Python, by a new interpreter that calls setsid() and
+# then execs the probe.
+if sys.hexversion >= 0x03020000:
+    def popen_session(args, **kwargs):
+        """ Start a process in a new session with
+        :class:`subprocess.Popen`.
+
+        :param args: The program to run and its arguments
+        :type args: list of strings
+        :param kwargs: Additional keyword arguments to
+                       :class:`subprocess.Popen`
+        :returns: subprocess.Popen
+        """
+        return Popen(args, start_new_session=True, **kwargs)
+else:
+    #: The wrapper that starts a process in a new session on
+    #: versions of Python whose Popen cannot do so itself
+    SETSID_WRAPPER = "import os, sys; os.setsid(); " + \
+        "os.execv(sys.argv[1], sys.argv[1:])"
+
+    def popen_session(args, **kwargs):
+        """ Start a process in a new session with
+        :class:`subprocess.Popen`.
+
+        :param args: The program to run and its arguments
+        :type args: list of strings
+        :param kwargs: Additional keyword arguments to
+                       :class:`subprocess.Popen`
+        :returns: subprocess.Popen
+        """
+        return Popen([sys.executable, "-c", SETSID_WRAPPER] + list(args),
+                     **kwargs)
+
 
 class Client(object):
     """ The main Bcfg2 client class """
@@ -75,10 +134,31 @@ class Client(object):
         else:
             self.logger.error(message)
 
-    def run_probe(self, probe):
-        """Execute probe."""
+    def _kill_probe(self, name, proc, killed):
+        """ kill a probe that has run for too long, along with any
+        processes it started """
+        self.logger.error("Probe %s timed out after %s seconds, killing it" %
+                          (name, self.setup['probe_timeout']))
+        killed.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            # the probe has not started its own session yet, or it
+            # finished in the meantime
+            try:
+                os.kill(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def run_probe(self, probe, times=None):
+        """ Execute probe.  If ``times`` is given, the times at which
+        the probe started and finished are recorded in it as
+        ``probe.<name>.start`` and ``probe.<name>.end``, with any
+        characters in the name that are not allowed in XML attribute
+        names replaced by ``_``. """
         name = probe.get('name')
         self.logger.info("Running probe %s" % name)
+        start = time.time()
         ret = Bcfg2.Client.XML.Element("probe-data",
                                        name=name,
                                        source=probe.get('source'))
@@ -94,22 +174,92 @@ class Client(object):
                          stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH |
                          stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH |
                          stat.S_IWUSR)  # 0755
-                proc = Popen(scriptname, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-                ret.text, err = proc.communicate()
-                rv = proc.wait()
-                if err:
-                    self.logger.warning("Probe %s has error output: %s" %
-                                        (name, err))
-                if rv:
-                    self._probe_failure(name, "Return value %s" % rv)
-                self.logger.info("Probe %s has result:" % name)
-                self.logger.info(ret.text)
+                # run the probe in its own process group, so that it
+                # can be killed along with any children if it times
+                # out
+                proc = popen_session([scriptname], stdin=PIPE, stdout=PIPE,
+                                     stderr=PIPE)
+                killed = []
+                timer = None
+                if self.setup['probe_timeout']:
+                    timer = threading.Timer(self.setup['probe_timeout'],
+                                            self._kill_probe,
+                                            args=[name, proc, killed])
+                    timer.setDaemon(True)
+                    timer.start()
+                try:
+                    output, err = proc.communicate()
+                    rv = proc.wait()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                if killed:
+                    # don't send partial output
+                    self._probe_failure(name, "Timed out after %s seconds" %
+                                        self.setup['probe_timeout'])
+                else:
+                    ret.text = output
+                    if err:
+                        self.logger.warning("Probe %s has error output: %s" %
+                                            (name, err))
+                    if rv:
+                        self._probe_failure(name, "Return value %s" % rv)
+                    self.logger.info("Probe %s has result:" % name)
+                    self.logger.info(ret.text)
             finally:
                 os.unlink(scriptname)
+        except SystemExit:
+            raise
         except:  # pylint: disable=W0702
             self._probe_failure(name, sys.exc_info()[1])
+        if times is not None:
+            key = "probe.%s" % TIMES_KEY_INVALID.sub('_', name)
+            times['%s.start' % key] = start
+            times['%s.end' % key] = time.time()
         return ret
 
+    def _run_probes_parallel(self, probes, results, times):
+        """ Run probes in a pool of ``probe_workers`` threads.
+
+        :param probes: A list of (<index>, <probe>) tuples
+        :type probes: list
+        :param results: A dict that the result of each probe is added
+                        to, keyed by its index
+        :type results: dict
+        :param times: The times dict that probe timings are added to
+        :type times: dict
+        """
+        lock = threading.Lock()
+        pending = list(probes)
+        errors = []
+
+        def worker():
+            """ run probes until there are none left, or until one
+            has failed fatally """
+            while True:
+                lock.acquire()
+                try:
+                    if errors or not pending:
+                        return
+                    idx, probe = pending.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    results[idx] = self.run_probe(probe, times=times)
+                except SystemExit:
+                    errors.append(sys.exc_info()[1])
+
+        threads = []
+        for _ in range(min(self.setup['probe_workers'], len(pending))):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
     def fatal_error(self, message):
         """Signal a fatal error."""
         self.logger.error("Fatal error: %s" % (message))
@@ -152,12 +302,28 @@ class Client(object):
 
         times['probe_download'] = time.time()
 
-        # execute probes
+        # execute probes.  probes that are not marked serial run in
+        # parallel first; serial probes then run one at a time, with
+        # nothing else running
+        probelist = probes.findall(".//probe")
+        parallel = []
+        serial = []
+        for idx, probe in enumerate(probelist):
+            if (self.setup['probe_workers'] > 1 and
+                probe.get("serial", "false").lower() != "true"):
+                parallel.append((idx, probe))
+            else:
+                serial.append((idx, probe))
+        results = dict()
+        if parallel:
+            self._run_probes_parallel(parallel, results, times)
+        for idx, probe in serial:
+            results[idx] = self.run_probe(probe, times=times)
         probedata = Bcfg2.Client.XML.Element("ProbeData")
-        for probe in probes.findall(".//probe"):
-            probedata.append(self.run_probe(probe))
+        for idx in range(len(probelist)):
+            probedata.append(results[idx])
 
-        if len(probes.findall(".//probe")) > 0:
+        if len(probelist) > 0:
             try:
                 # upload probe responses
                 self.proxy.RecvProbeData(Bcfg2.Client.XML.tostring(
@@ -224,7 +390,7 @@ class Client(object):
                     self.fatal_error("Failed to get decision list: %s" % err)
 
             try:
-                rawconfig = self.proxy.GetConfig().encode('UTF-8')
+                rawconfig = self._download_config()
             except Bcfg2.Proxy.ProxyError:
                 err = sys.exc_info()[1]
                 self.fatal_error("Failed to download configuration from "
@@ -233,6 +399,61 @@ class Client(object):
             times['config_download'] = time.time()
         return rawconfig
 
+    def _download_config(self):
+        """ Download the configuration from the server.  If the
+        configuration is cached (-c), the server is sent the digest
+        of the cached copy, and the cached copy is used if the server
+        reports that the configuration has not changed.  If lxml is
+        available, the server may also send only the changes to the
+        cached copy, which are applied to it with
+        :func:`Bcfg2.Delta.apply_delta`. """
+        cached = None
+        if self.setup['cache'] and os.path.exists(self.setup['cache']):
+            try:
+                cached = open(self.setup['cache'], 'rb').read()
+            except IOError:
+                err = sys.exc_info()[1]
+                self.logger.warning("Failed to read config cache file %s: %s"
+                                    % (self.setup['cache'], err))
+        if not cached:
+            return self.proxy.GetConfig().encode('UTF-8')
+
+        try:
+            if HAS_DELTA:
+                rawconfig = self.proxy.GetConfig(
+                    Bcfg2.Delta.digest(cached), True).encode('UTF-8')
+            else:
+                rawconfig = self.proxy.GetConfig(
+                    md5(cached).hexdigest()).encode('UTF-8')
+        except Bcfg2.Proxy.ProxyError:
+            # older servers do not accept a digest.  any other failure
+            # -- e.g., the server being too busy -- is not retried
+            # here, since that would just add to the server's load.
+            err = sys.exc_info()[1]
+            if (not isinstance(err.error, xmlrpclib.Fault) or
+                not SIGNATURE_FAULT.search(err.error.faultString)):
+                raise
+            self.logger.debug("Server does not accept a configuration "
+                              "digest, retrying without it")
+            return self.proxy.GetConfig().encode('UTF-8')
+        if rawconfig == NOT_MODIFIED.encode('UTF-8'):
+            self.logger.info("Configuration is unchanged, using cached "
+                             "configuration from %s" % self.setup['cache'])
+            return cached
+        if HAS_DELTA and rawconfig.startswith("<Delta ".encode('UTF-8')):
+            try:
+                rawconfig = Bcfg2.Delta.apply_delta(cached, rawconfig)
+                self.logger.info("Applied configuration changes to cached "
+                                 "configuration from %s" %
+                                 self.setup['cache'])
+            except (ValueError, Bcfg2.Client.XML.ParseError):
+                err = sys.exc_info()[1]
+                self.logger.warning("Failed to apply configuration changes, "
+                                    "downloading full configuration: %s" %
+                                    err)
+                rawconfig = self.proxy.GetConfig().encode('UTF-8')
+        return rawconfig
+
     def run(self):
         """Perform client execution phase."""
         times = {}
@@ -22,11 +22,13 @@ try:
     from urlparse import urljoin, urlparse
     from urllib2 import HTTPBasicAuthHandler, \
         HTTPPasswordMgrWithDefaultRealm, build_opener, install_opener, \
-        urlopen, HTTPError, URLError
+        urlopen, Request, HTTPError, URLError
+    from urllib import getproxies
 except ImportError:
     from urllib.parse import urljoin, urlparse
     from urllib.request import HTTPBasicAuthHandler, \
-        HTTPPasswordMgrWithDefaultRealm, build_opener, install_opener, urlopen
+        HTTPPasswordMgrWithDefaultRealm, build_opener, install_opener, \
+        urlopen, Request, getproxies
     from urllib.error import HTTPError, URLError
 
 try:
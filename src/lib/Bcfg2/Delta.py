@@ -0,0 +1,196 @@
+""" Build and apply deltas between two client configurations, so that
+a client that already has one configuration can be sent only the
+differences between it and a new one.
+
+A delta is an XML document like this:
+
+.. code-block:: xml
+
+    <Delta base="<digest of old config>" digest="<digest of new config>">
+      <Configuration version="2.0" revision="..."/>
+      <Remove tag="Bundle" name="removed-bundle"/>
+      <Change>
+        <Bundle name="changed-bundle"/>
+        <Remove tag="Path" name="/etc/removed"/>
+        <Add index="3"><Path name="/etc/added-or-changed" .../></Add>
+      </Change>
+      <Add index="5"><Bundle name="added-bundle">...</Bundle></Add>
+    </Delta>
+
+The first child holds the attributes of the new configuration.  The
+remaining children change the structures of the configuration, which
+are keyed by ``(<tag>, <name>)``: ``Remove`` removes a structure,
+``Add`` inserts a structure at the given position, and ``Change``
+replaces the attributes of a structure with those of its first child
+and then changes the entries in the structure, which are likewise
+keyed by ``(<tag>, <name>)``, in the same way.  All removals are done
+before any additions, and additions are done in order of position.
+
+Deltas are only built if the structures of both configurations, and
+the entries of each structure, have unique keys, and if the
+structures that are in both configurations are in the same order.
+Entries that have been reordered within a structure cause the whole
+structure to be replaced.  The digests are the MD5 hex digests of the
+configurations serialized with :func:`lxml.etree.tostring`, which a
+client can use to check that it has rebuilt the new configuration
+correctly. """
+
+import copy
+import lxml.etree
+from Bcfg2.Compat import md5
+
+
+def digest(config):
+    """ Get the digest of a serialized configuration.
+
+    :param config: The serialized configuration
+    :type config: bytes
+    :returns: string - The MD5 hex digest of the configuration
+    """
+    return md5(config).hexdigest()
+
+
+def _key(elem):
+    """ Get the key of a structure or entry """
+    return (elem.tag, elem.get("name"))
+
+
+def _copy_attrs(src, dest):
+    """ Replace the attributes of ``dest`` with those of ``src``,
+    preserving their order """
+    dest.attrib.clear()
+    for key, val in src.items():
+        dest.set(key, val)
+
+
+def _index(parent):
+    """ Get a dict of <key> -> <child> for the children of an
+    element, or None if their keys are not unique """
+    rv = dict()
+    for child in parent:
+        key = _key(child)
+        if key in rv:
+            return None
+        rv[key] = child
+    return rv
+
+
+def _add_remove(parent, key):
+    """ Add a ``Remove`` element for the given key to a delta """
+    remove = lxml.etree.SubElement(parent, "Remove", tag=key[0])
+    if key[1] is not None:
+        remove.set("name", key[1])
+
+
+def _diff(old, new, delta, depth):
+    """ Add the operations that turn the children of ``old`` into
+    the children of ``new`` to ``delta``.
+
+    :returns: bool - False if no delta could be built because the
+              keys of the children are not unique, or because
+              children that are in both ``old`` and ``new`` are not
+              in the same order
+    """
+    old_children = _index(old)
+    if old_children is None or _index(new) is None:
+        return False
+    new_keys = set(_key(c) for c in new)
+    # children are only removed and inserted, never moved, so the
+    # children that are kept must already be in the right order
+    if ([k for k in (_key(c) for c in old) if k in new_keys] !=
+        [k for k in (_key(c) for c in new) if k in old_children]):
+        return False
+    for key in old_children:
+        if key not in new_keys:
+            _add_remove(delta, key)
+    for idx, child in enumerate(new):
+        key = _key(child)
+        old_child = old_children.get(key)
+        if old_child is not None:
+            if (lxml.etree.tostring(old_child) ==
+                lxml.etree.tostring(child)):
+                continue
+            if depth > 0 and old_child.text == child.text:
+                change = lxml.etree.SubElement(delta, "Change")
+                attrs = lxml.etree.SubElement(change, child.tag)
+                _copy_attrs(child, attrs)
+                if _diff(old_child, child, change, depth - 1):
+                    continue
+                delta.remove(change)
+            _add_remove(delta, key)
+        add = lxml.etree.SubElement(delta, "Add", index=str(idx))
+        add.append(copy.deepcopy(child))
+    return True
+
+
+def make_delta(old, new):
+    """ Build a delta between two configurations.
+
+    :param old: The serialized configuration the client has
+    :type old: bytes
+    :param new: The serialized configuration to send to the client
+    :type new: bytes
+    :returns: bytes - The serialized delta, or None if no delta can
+              be built
+    """
+    old_config = lxml.etree.XML(old)
+    new_config = lxml.etree.XML(new)
+    delta = lxml.etree.Element("Delta", base=digest(old), digest=digest(new))
+    attrs = lxml.etree.SubElement(delta, new_config.tag)
+    _copy_attrs(new_config, attrs)
+    if (old_config.tag != new_config.tag or
+        not _diff(old_config, new_config, delta, 1)):
+        return None
+    return lxml.etree.tostring(delta, xml_declaration=False)
+
+
+def _apply(parent, ops):
+    """ Apply the operations of a delta to the children of an
+    element """
+    children = dict((_key(c), c) for c in parent)
+    adds = []
+    for op in ops:
+        if op.tag == "Remove":
+            parent.remove(children.pop((op.get("tag"), op.get("name"))))
+        elif op.tag == "Change":
+            child = children[_key(op[0])]
+            _copy_attrs(op[0], child)
+            _apply(child, op[1:])
+        elif op.tag == "Add":
+            adds.append((int(op.get("index")), op[0]))
+        else:
+            raise ValueError("Unknown delta operation %s" % op.tag)
+    adds.sort(key=lambda a: a[0])
+    for idx, child in adds:
+        parent.insert(idx, child)
+
+
+def apply_delta(old, delta):
+    """ Apply a delta to a configuration.
+
+    :param old: The serialized configuration the delta was built
+                from
+    :type old: bytes
+    :param delta: The serialized delta
+    :type delta: bytes
+    :returns: bytes - The serialized new configuration
+    :raises: ValueError if the delta cannot be applied, or if the
+             resulting configuration does not match the digest in the
+             delta
+    """
+    delta = lxml.etree.XML(delta)
+    if delta.get("base") != digest(old):
+        raise ValueError("Delta is not based on the given configuration")
+    config = lxml.etree.XML(old)
+    if not len(delta) or delta[0].tag != config.tag:
+        raise ValueError("Malformed delta")
+    _copy_attrs(delta[0], config)
+    try:
+        _apply(config, delta[1:])
+    except (KeyError, IndexError):
+        raise ValueError("Delta does not match the given configuration")
+    rv = lxml.etree.tostring(config, xml_declaration=False)
+    if digest(rv) != delta.get("digest"):
+        raise ValueError("Configuration built from delta does not match "
+                         "its digest")
+    return rv
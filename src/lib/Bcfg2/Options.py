@@ -343,7 +343,7 @@ def get_size(value):
     if not mat:
         raise ValueError
     rvalue = int(mat.group(1))
-    mult = mat.group(2).lower()
+    mult = (mat.group(2) or '').lower()
     if mult == 'k':
         return rvalue * 1024
     elif mult == 'm':
@@ -562,6 +562,14 @@ SERVER_BACKEND = \
     Option('Server Backend',
            default='best',
            cf=('server', 'backend'))
+SERVER_CHILDREN = \
+    Option('Number of build worker processes to start',
+           default=None,
+           cmd='--children',
+           odesc='<children>',
+           cf=('server', 'children'),
+           cook=int,
+           long_arg=True)
 SERVER_DAEMON_USER = \
     Option('User to run the server daemon as',
            default=0,
@@ -798,6 +806,23 @@ CLIENT_EXIT_ON_PROBE_FAILURE = \
            long_arg=True,
            cf=('client', 'exit_on_probe_failure'),
            cook=get_bool)
+CLIENT_PROBE_WORKERS = \
+    Option("The number of probes to run at the same time",
+           default=4,
+           cmd='--probe-workers',
+           odesc='<number>',
+           long_arg=True,
+           cf=('client', 'probe_workers'),
+           cook=int)
+CLIENT_PROBE_TIMEOUT = \
+    Option("The time in seconds a probe may run before it is killed, "
+           "or 0 for no limit",
+           default=300,
+           cmd='--probe-timeout',
+           odesc='<timeout>',
+           long_arg=True,
+           cf=('client', 'probe_timeout'),
+           cook=float)
 
 # bcfg2-test and bcfg2-lint options
 TEST_NOSEOPTS = \
@@ -1084,6 +1109,7 @@ SERVER_COMMON_OPTIONS = dict(repo=SERVER_REPOSITORY,
                              protocol=SERVER_PROTOCOL,
                              web_configfile=WEB_CFILE,
                              backend=SERVER_BACKEND,
+                             children=SERVER_CHILDREN,
                              vcs_root=SERVER_VCS_ROOT)
 
 CRYPT_OPTIONS = dict(encrypt=ENCRYPT,
@@ -1158,7 +1184,9 @@ CLIENT_COMMON_OPTIONS = \
          serverCN=CLIENT_SCNS,
          timeout=CLIENT_TIMEOUT,
          decision_list=CLIENT_DECISION_LIST,
-         probe_exit=CLIENT_EXIT_ON_PROBE_FAILURE)
+         probe_exit=CLIENT_EXIT_ON_PROBE_FAILURE,
+         probe_workers=CLIENT_PROBE_WORKERS,
+         probe_timeout=CLIENT_PROBE_TIMEOUT)
 CLIENT_COMMON_OPTIONS.update(DRIVER_OPTIONS)
 CLIENT_COMMON_OPTIONS.update(CLI_COMMON_OPTIONS)
 
@@ -1,4 +1,5 @@
 import logging
+import errno
 import re
 import socket
 
@@ -18,6 +19,8 @@ except ImportError:
 
 import sys
 import time
+import zlib
+import random
 
 # Compatibility imports
 from Bcfg2.Compat import httplib, xmlrpclib, urlparse
@@ -25,6 +28,42 @@ from Bcfg2.Compat import httplib, xmlrpclib, urlparse
 version = sys.version_info[:2]
 has_py26 = version >= (2, 6)
 
+# the content encodings that responses may be compressed with, and
+# the zlib wbits argument for each
+CONTENT_ENCODINGS = dict(gzip=16 + zlib.MAX_WBITS, deflate=zlib.MAX_WBITS)
+
+# requests smaller than this many bytes are never compressed
+MIN_COMPRESS_SIZE = 1024
+
+# the XML-RPC fault code with which the server refuses requests when
+# it is too busy to handle them (see Bcfg2.Server.Core.ServerBusy)
+SERVER_BUSY = 503
+
+
+def closed_before_response(err):
+    """ Determine whether an error raised while waiting for the
+    response to a request that was sent on a reused connection shows
+    that the server had closed the connection before it got the
+    request, i.e., that it closed the connection without sending any
+    of a response.  Only then can the request be sent again without
+    the risk of the server handling it twice.
+
+    :param err: The error
+    :type err: Exception
+    :returns: bool
+    """
+    if isinstance(err, socket.timeout):
+        # the server may still be handling the request
+        return False
+    if isinstance(err, httplib.BadStatusLine):
+        # python 3 raises RemoteDisconnected, and python 2 raises
+        # BadStatusLine with an empty status line, if the connection
+        # was closed before the status line was read
+        return (isinstance(err, getattr(httplib, "RemoteDisconnected", ())) or
+                err.line in ["", "''"])
+    return getattr(err, "errno", None) == errno.ECONNRESET
+
+
 __all__ = ["ComponentProxy",
            "RetryMethod",
            "SSLHTTPConnection",
@@ -36,6 +75,8 @@ class ProxyError(Exception):
     the various xmlrpclib errors that might arise (mainly
     ProtocolError and Fault) """
     def __init__(self, err):
+        # the error that this ProxyError reports
+        self.error = err
         msg = None
         if isinstance(err, xmlrpclib.ProtocolError):
             # cut out the password in the URL
@@ -61,10 +102,24 @@ class CertificateError(Exception):
 _orig_Method = xmlrpclib._Method
 
 class RetryMethod(xmlrpclib._Method):
-    """Method with error handling and retries built in."""
+    """Method with error handling and retries built in.  Most failures
+    are retried after a fixed delay; when the server is too busy to
+    handle a request, it is retried with jittered exponential
+    backoff, starting no sooner than the server asked."""
     log = logging.getLogger('xmlrpc')
     max_retries = 3
     retry_delay = 1
+    max_backoff = 300
+
+    def backoff(self, retry, retry_after=0):
+        """ Get the number of seconds to wait before retrying a
+        request that the server was too busy to handle.  The delay
+        doubles with each retry, and is randomized so that clients
+        that were refused at the same time do not all retry at the
+        same time. """
+        delay = min(max(retry_after, self.retry_delay) * 2 ** retry,
+                    self.max_backoff)
+        return random.uniform(delay, delay * 1.5)
 
     def __call__(self, *args):
         for retry in range(self.max_retries):
@@ -73,6 +128,7 @@ class RetryMethod(xmlrpclib._Method):
             else:
                 final = False
             msg = None
+            delay = self.retry_delay
             try:
                 return _orig_Method.__call__(self, *args)
             except xmlrpclib.ProtocolError:
@@ -80,7 +136,15 @@ class RetryMethod(xmlrpclib._Method):
                 msg = "Server failure: Protocol Error: %s %s" % \
                     (err.errcode, err.errmsg)
             except xmlrpclib.Fault:
-                msg = sys.exc_info()[1]
+                err = sys.exc_info()[1]
+                msg = err
+                if err.faultCode == SERVER_BUSY:
+                    match = re.search(r'retry after (\d+) seconds',
+                                      err.faultString)
+                    if match:
+                        delay = self.backoff(retry, int(match.group(1)))
+                    else:
+                        delay = self.backoff(retry)
             except socket.error:
                 err = sys.exc_info()[1]
                 if hasattr(err, 'errno') and err.errno == 336265218:
@@ -99,6 +163,10 @@ class RetryMethod(xmlrpclib._Method):
             except ProxyError:
                 err = sys.exc_info()[1]
                 msg = err
+                if (isinstance(err.error, xmlrpclib.ProtocolError) and
+                    err.error.errcode == 503):
+                    # the server's request queue is full
+                    delay = self.backoff(retry)
             except:
                 raise
                 etype, err = sys.exc_info()[:2]
@@ -109,7 +177,7 @@ class RetryMethod(xmlrpclib._Method):
                     raise ProxyError(msg)
                 else:
                     self.log.info(msg)
-                    time.sleep(self.retry_delay)
+                    time.sleep(delay)
 
 xmlrpclib._Method = RetryMethod
 
@@ -279,6 +347,15 @@ class SSLHTTPConnection(httplib.HTTPConnection):
 
 
 class XMLRPCTransport(xmlrpclib.Transport):
+    """ XML-RPC transport over SSL.  A single connection is kept open
+    and reused for successive requests to the same host, as long as
+    the server allows it (with HTTP/1.1 keep-alive), so that a client
+    run only performs one SSL handshake.
+
+    The transport accepts gzip- and deflate-compressed responses, and
+    compresses large requests with gzip once the server has shown that
+    it accepts compressed requests. """
+
     def __init__(self, key=None, cert=None, ca=None,
                  scns=None, use_datetime=0, timeout=90):
         if hasattr(xmlrpclib.Transport, '__init__'):
@@ -288,47 +365,179 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.ca = ca
         self.scns = scns
         self.timeout = timeout
+        # tuple of (<host>, <connection>) for the persistent connection
+        self._connection = (None, None)
+        # whether or not the current request was sent on a socket
+        # that was already open
+        self._reused = False
+        # whether or not the server accepts gzip-compressed requests
+        self._compress_requests = False
 
     def make_connection(self, host):
         host, self._extra_headers = self.get_host_info(host)[0:2]
-        return SSLHTTPConnection(host,
-                                 key=self.key,
-                                 cert=self.cert,
-                                 ca=self.ca,
-                                 scns=self.scns,
-                                 timeout=self.timeout)
+        if self._connection[0] == host:
+            conn = self._connection[1]
+        else:
+            self.close()
+            conn = SSLHTTPConnection(host,
+                                     key=self.key,
+                                     cert=self.cert,
+                                     ca=self.ca,
+                                     scns=self.scns,
+                                     timeout=self.timeout)
+            self._connection = (host, conn)
+        # if the server closed the connection after the last
+        # response, then httplib will reconnect automatically
+        self._reused = conn.sock is not None
+        return conn
+
+    def close(self):
+        """ Close the persistent connection, if any """
+        if self._connection[1] is not None:
+            self._connection[1].close()
+        self._connection = (None, None)
 
     def request(self, host, handler, request_body, verbose=0):
         """Send request to server and return response."""
+        try:
+            return self.single_request(host, handler, request_body, verbose)
+        except (socket.error, SSL_ERROR, httplib.HTTPException):
+            # the server closed the persistent connection while it
+            # was idle, so reconnect and try again
+            return self.single_request(host, handler, request_body, verbose)
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        """ Send a single request to the server and return the
+        response.  If the request was sent on a socket that was reused
+        from a previous request, and it failed before the server can
+        have handled it -- i.e., while it was being sent, or because
+        the server closed the connection before sending any of the
+        response (see :func:`closed_before_response`) -- the error is
+        raised as-is, so that :func:`request` can retry the request
+        on a new connection.  All other errors, including timeouts,
+        are raised as :class:`ProxyError`. """
         try:
             conn = self.send_request(host, handler, request_body, False)
+        except (socket.error, SSL_ERROR, httplib.HTTPException):
+            err = sys.exc_info()[1]
+            self._request_failed(host, handler, err,
+                                 not isinstance(err, socket.timeout))
+
+        try:
             response = conn.getresponse()
             errcode = response.status
             errmsg = response.reason
             headers = response.msg
-        except (socket.error, SSL_ERROR):
+        except (socket.error, SSL_ERROR, httplib.HTTPException):
             err = sys.exc_info()[1]
-            raise ProxyError(xmlrpclib.ProtocolError(host + handler,
-                                                     408,
-                                                     str(err),
-                                                     self._extra_headers))
+            self._request_failed(host, handler, err,
+                                 closed_before_response(err))
 
         if errcode != 200:
+            # read the error message so that the connection can be
+            # reused
+            response.read()
             raise ProxyError(xmlrpclib.ProtocolError(host + handler,
                                                      errcode,
                                                      errmsg,
                                                      headers))
 
+        accept = headers.get("Accept-Encoding")
+        self._compress_requests = bool(accept) and "gzip" in accept.lower()
+
         self.verbose = verbose
-        return self.parse_response(response)
+        try:
+            return self.parse_response(response)
+        except (socket.error, SSL_ERROR, httplib.HTTPException):
+            # the server has started to respond, so it has handled
+            # the request
+            self._request_failed(host, handler, sys.exc_info()[1], False)
+
+    def _request_failed(self, host, handler, err, retry):
+        """ Close the connection after a request failed, and raise
+        the error.
+
+        :param host: The host the request was sent to
+        :type host: string
+        :param handler: The handler the request was sent to
+        :type handler: string
+        :param err: The error the request failed with
+        :type err: Exception
+        :param retry: Whether the request can safely be sent again on
+                      a new connection if it failed on a reused one
+        :type retry: bool
+        :raises: The given error if the request can be retried,
+                 :class:`ProxyError` otherwise
+        """
+        self.close()
+        if retry and self._reused:
+            raise err
+        raise ProxyError(xmlrpclib.ProtocolError(host + handler,
+                                                 408,
+                                                 str(err),
+                                                 self._extra_headers))
+
+    def parse_response(self, response):
+        """ Read and unmarshal a response, decompressing it as it is
+        read if necessary. """
+        encoding = response.getheader("Content-Encoding", "").lower()
+        if encoding in CONTENT_ENCODINGS:
+            decompressor = zlib.decompressobj(CONTENT_ENCODINGS[encoding])
+        else:
+            decompressor = None
+        parser, unmarshaller = self.getparser()
+        while True:
+            data = response.read(1024 * 16)
+            if not data:
+                break
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            if self.verbose:
+                print("body: %s" % repr(data))
+            parser.feed(data)
+        if decompressor is not None:
+            parser.feed(decompressor.flush())
+        parser.close()
+        return unmarshaller.close()
+
+    def send_content(self, connection, request_body):
+        """ Send the request body, compressing it if the server
+        accepts compressed requests. """
+        connection.putheader("Accept-Encoding",
+                             ", ".join(CONTENT_ENCODINGS.keys()))
+        if self._compress_requests and len(request_body) >= MIN_COMPRESS_SIZE:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          CONTENT_ENCODINGS['gzip'])
+            request_body = compressor.compress(request_body) + \
+                compressor.flush()
+            connection.putheader("Content-Encoding", "gzip")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders()
+        connection.send(request_body)
 
     if sys.hexversion < 0x03000000:
         def send_request(self, host, handler, request_body, debug):
             """ send_request() changed significantly in py3k."""
             conn = self.make_connection(host)
-            xmlrpclib.Transport.send_request(self, conn, handler, request_body)
+            # Accept-Encoding is sent by send_content()
+            conn.putrequest("POST", handler, skip_accept_encoding=True)
             self.send_host(conn, host)
             self.send_user_agent(conn)
+            conn.putheader("Content-Type", "text/xml")
+            self.send_content(conn, request_body)
+            return conn
+    else:
+        def send_request(self, host, handler, request_body, debug):
+            conn = self.make_connection(host)
+            headers = list(getattr(self, "_headers", [])) + \
+                self._extra_headers
+            if debug:
+                conn.set_debuglevel(1)
+            # Accept-Encoding is sent by send_content()
+            conn.putrequest("POST", handler, skip_accept_encoding=True)
+            headers.append(("Content-Type", "text/xml"))
+            headers.append(("User-Agent", self.user_agent))
+            self.send_headers(conn, headers)
             self.send_content(conn, request_body)
             return conn
 
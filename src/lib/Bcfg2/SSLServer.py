@@ -9,10 +9,115 @@ import select
 import signal
 import logging
 import ssl
+import zlib
 import threading
 import time
+import Bcfg2.Statistics
+from Bcfg2.Cache import Cache
 from Bcfg2.Compat import xmlrpclib, SimpleXMLRPCServer, SocketServer, \
-    b64decode
+    b64decode, md5
+
+#: A dict of the content encodings that can be used to compress
+#: requests and responses, and the ``wbits`` argument to
+#: :func:`zlib.compressobj` and :func:`zlib.decompressobj` for each
+CONTENT_ENCODINGS = dict(gzip=16 + zlib.MAX_WBITS, deflate=zlib.MAX_WBITS)
+
+#: Responses smaller than this many bytes are never compressed
+MIN_COMPRESS_SIZE = 1024
+
+#: Compressed responses are only cached if they are at least this
+#: many bytes before compression
+MIN_CACHE_SIZE = 64 * 1024
+
+#: The number of bytes of a response to compress at once when
+#: streaming a compressed response
+COMPRESS_CHUNK_SIZE = 64 * 1024
+
+#: The maximum number of bytes of a request to read or decompress at
+#: once
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class RequestTooLarge(Exception):
+    """ Raised when the body of a request is larger than the maximum
+    allowed request size """
+    pass
+
+
+def get_decompressor(encoding):
+    """ Get a decompressor for a request body with the given
+    ``Content-Encoding``.
+
+    :param encoding: The content encoding, or None
+    :type encoding: string
+    :returns: A :func:`zlib.decompressobj` object, or None if the
+              body is not encoded
+    :raises: ValueError if the encoding is not supported
+    """
+    if not encoding or encoding.lower() == "identity":
+        return None
+    try:
+        return zlib.decompressobj(CONTENT_ENCODINGS[encoding.lower()])
+    except KeyError:
+        raise ValueError("Unsupported content encoding %s" % encoding)
+
+
+class RequestParser(object):
+    """ Incrementally parse the body of an XML-RPC request as it is
+    read, so that the whole body never has to be held in memory,
+    decompressing it if necessary. """
+
+    def __init__(self, encoding=None, max_size=0):
+        """
+        :param encoding: The ``Content-Encoding`` of the request
+        :type encoding: string
+        :param max_size: The maximum size of the request body, after
+                         it has been decompressed, or 0 for no limit
+        :type max_size: int
+        :raises: ValueError if the encoding is not supported
+        """
+        self.decompressor = get_decompressor(encoding)
+        self.max_size = max_size
+
+        #: The number of bytes of (uncompressed) XML parsed so far
+        self.size = 0
+
+        self._parser, self._unmarshaller = xmlrpclib.getparser()
+
+    def feed(self, data):
+        """ Parse a chunk of the request body.
+
+        :param data: The chunk of the request, as it was received
+        :type data: bytes
+        :raises: :exc:`RequestTooLarge`
+        """
+        if self.decompressor is None:
+            self._feed(data)
+        else:
+            # limit the amount of data decompressed at once, so that
+            # a small compressed request cannot use a lot of memory
+            while data:
+                self._feed(self.decompressor.decompress(data,
+                                                        READ_CHUNK_SIZE))
+                data = self.decompressor.unconsumed_tail
+
+    def _feed(self, data):
+        """ Parse a chunk of the uncompressed request body """
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise RequestTooLarge("Request is larger than %s bytes" %
+                                  self.max_size)
+        self._parser.feed(data)
+
+    def close(self):
+        """ Finish parsing the request.
+
+        :returns: tuple of ``(<params>, <method name>)``
+        """
+        if self.decompressor is not None:
+            self._feed(self.decompressor.flush())
+        self._parser.close()
+        return self._unmarshaller.close(), self._unmarshaller.getmethodname()
 
 
 class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
@@ -34,6 +139,20 @@ class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
 
     def _marshaled_dispatch(self, address, data):
         params, method = xmlrpclib.loads(data)
+        return self._unmarshaled_dispatch(address, params, method)
+
+    def _unmarshaled_dispatch(self, address, params, method):
+        """ Dispatch a request that has already been parsed, e.g., by
+        a :class:`RequestParser`.
+
+        :param address: The address of the client
+        :type address: tuple
+        :param params: The parameters of the XML-RPC call
+        :type params: tuple
+        :param method: The name of the XML-RPC method to call
+        :type method: string
+        :returns: string - The marshaled response
+        """
         try:
             if '.' not in method:
                 params = (address, ) + params
@@ -180,11 +299,48 @@ class SSLServer(SocketServer.TCPServer, object):
 class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     """ XML-RPC request handler.
 
-    Adds support for HTTP authentication.
+    Adds support for HTTP authentication, and for persistent
+    connections with HTTP/1.1 keep-alive.
     """
 
     logger = logging.getLogger("Bcfg2.SSLServer.XMLRPCRequestHandler")
 
+    #: Speak HTTP/1.1, so that clients can keep a connection open
+    #: for all of the requests of a client run
+    protocol_version = "HTTP/1.1"
+
+    #: The number of seconds to wait for another request on a
+    #: persistent connection before closing it
+    keepalive_timeout = 5
+
+    def handle(self):
+        """ Handle requests on the connection until the client closes
+        it, asks for it to be closed, or does not send another request
+        within :attr:`keepalive_timeout` seconds. """
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            # XML-RPC clients wait for each response before sending
+            # the next request, so no data for the next request can
+            # be buffered yet, and it is safe to wait on the socket
+            try:
+                if (not self.request.pending() and
+                    not select.select([self.request], [], [],
+                                      self.keepalive_timeout)[0]):
+                    break
+            except select.error:
+                break
+            try:
+                self.handle_one_request()
+            except socket.error:
+                # the client closed the connection without saying so
+                # (e.g., because it exited) instead of sending
+                # another request
+                err = sys.exc_info()[1]
+                self.logger.debug("Persistent connection from %s closed: %s"
+                                  % (self.client_address[0], err))
+                break
+
     def authenticate(self):
         try:
             header = self.headers['Authorization']
@@ -228,27 +384,66 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     ### need to override do_POST here
     def do_POST(self):
         try:
-            max_chunk_size = 10 * 1024 * 1024
-            size_remaining = int(self.headers["content-length"])
-            L = []
+            try:
+                size_remaining = int(self.headers["content-length"])
+            except (KeyError, ValueError):
+                self.send_error(411)
+                return
+            max_size = self.server.max_request_size
+            if max_size and size_remaining > max_size:
+                self.logger.error("Request from %s is larger than %s bytes" %
+                                  (self.client_address[0], max_size))
+                self.send_error(413)
+                return
+            try:
+                parser = RequestParser(self.headers.get("content-encoding"),
+                                       max_size=max_size)
+            except ValueError:
+                self.send_error(415, str(sys.exc_info()[1]))
+                return
+
+            # read the request into a single preallocated buffer and
+            # parse it as it is read, rather than collecting,
+            # decoding, and joining the chunks of the request
+            readinto = getattr(self.rfile, "readinto", None)
+            if readinto is not None:
+                buf = memoryview(bytearray(min(size_remaining,
+                                               READ_CHUNK_SIZE)))
             while size_remaining:
                 try:
                     select.select([self.rfile.fileno()], [], [], 3)
                 except select.error:
                     print("got select timeout")
                     raise
-                chunk_size = min(size_remaining, max_chunk_size)
-                L.append(self.rfile.read(chunk_size).decode('utf-8'))
-                size_remaining -= len(L[-1])
-            data = ''.join(L)
-            response = self.server._marshaled_dispatch(self.client_address,
-                                                       data)
+                chunk_size = min(size_remaining, READ_CHUNK_SIZE)
+                if readinto is None:
+                    chunk = self.rfile.read(chunk_size)
+                else:
+                    chunk = buf[:readinto(buf[:chunk_size])]
+                if not len(chunk):
+                    raise socket.error("Client closed connection with %s "
+                                       "bytes of request unread" %
+                                       size_remaining)
+                size_remaining -= len(chunk)
+                try:
+                    parser.feed(chunk)
+                except RequestTooLarge:
+                    err = sys.exc_info()[1]
+                    self.logger.error("Rejecting request from %s: %s" %
+                                      (self.client_address[0], err))
+                    self.send_error(413)
+                    return
+            params, method = parser.close()
+            response = self.server._unmarshaled_dispatch(self.client_address,
+                                                         params, method)
             if sys.hexversion >= 0x03000000:
                 response = response.encode('utf-8')
         except:  # pylint: disable=W0702
             try:
                 self.send_response(500)
+                self.send_header("Content-length", "0")
                 self.end_headers()
+                self.close_connection = 1
             except:
                 (etype, msg) = sys.exc_info()[:2]
                 self.logger.error("Error sending 500 response (%s): %s" %
@@ -257,25 +452,34 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         else:
             # got a valid XML RPC response
             try:
+                encoding = self.server.get_encoding(
+                    self.headers.get("accept-encoding"), response)
                 self.send_response(200)
                 self.send_header("Content-type", "text/xml")
-                self.send_header("Content-length", str(len(response)))
-                self.end_headers()
-                failcount = 0
-                while True:
-                    try:
-                        # If we hit SSL3_WRITE_PENDING here try to resend.
-                        self.wfile.write(response)
-                        break
-                    except ssl.SSLError:
-                        e = sys.exc_info()[1]
-                        if str(e).find("SSL3_WRITE_PENDING") < 0:
-                            raise
-                        self.logger.error("SSL3_WRITE_PENDING")
-                        failcount += 1
-                        if failcount < 5:
-                            continue
-                        raise
+                self.send_header("Accept-Encoding",
+                                 ", ".join(CONTENT_ENCODINGS.keys()))
+                if encoding is None:
+                    self.send_header("Content-length", str(len(response)))
+                    self.end_headers()
+                    self._write(response)
+                elif (self.request_version == "HTTP/1.1" and
+                      not self.server.is_cacheable(response)):
+                    # compress the response as it is sent
+                    self.send_header("Content-Encoding", encoding)
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    compressor = self.server.get_compressor(encoding)
+                    for i in range(0, len(response), COMPRESS_CHUNK_SIZE):
+                        self._write_chunk(compressor.compress(
+                            response[i:i + COMPRESS_CHUNK_SIZE]))
+                    self._write_chunk(compressor.flush())
+                    self._write("0\r\n\r\n".encode('utf-8'))
+                else:
+                    response = self.server.compress(response, encoding)
+                    self.send_header("Content-Encoding", encoding)
+                    self.send_header("Content-length", str(len(response)))
+                    self.end_headers()
+                    self._write(response)
             except socket.error:
                 err = sys.exc_info()[1]
                 if err[0] == 32:
@@ -298,6 +502,31 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                                   (self.client_address[0], err,
                                    etype.__name__))
 
+    def _write(self, data):
+        """ Write data to the client """
+        failcount = 0
+        while True:
+            try:
+                # If we hit SSL3_WRITE_PENDING here try to resend.
+                self.wfile.write(data)
+                break
+            except ssl.SSLError:
+                e = sys.exc_info()[1]
+                if str(e).find("SSL3_WRITE_PENDING") < 0:
+                    raise
+                self.logger.error("SSL3_WRITE_PENDING")
+                failcount += 1
+                if failcount < 5:
+                    continue
+                raise
+
+    def _write_chunk(self, data):
+        """ Write a chunk of a response sent with chunked transfer
+        encoding """
+        if data:
+            self._write(("%x\r\n" % len(data)).encode('utf-8') + data +
+                        "\r\n".encode('utf-8'))
+
     def finish(self):
         # shut down the connection
         if not self.wfile.closed:
@@ -317,7 +546,9 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
     def __init__(self, listen_all, server_address, RequestHandlerClass=None,
                  keyfile=None, certfile=None, ca=None, protocol='xmlrpc/ssl',
                  timeout=10, logRequests=False,
-                 register=True, allow_none=True, encoding=None):
+                 register=True, allow_none=True, encoding=None,
+                 compression_level=6, compression_cache=0,
+                 max_request_size=0):
         """
         :param listen_all: Listen on all interfaces
         :type listen_all: bool
@@ -336,6 +567,20 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         :param allow_none: Allow None values in XML-RPC
         :type allow_non: bool
         :param encoding: Encoding to use for XML-RPC
+        :param compression_level: The zlib compression level (1-9)
+                                  to compress responses with, for
+                                  clients that accept compressed
+                                  responses, or 0 to never compress
+                                  responses
+        :type compression_level: int
+        :param compression_cache: The maximum total size of
+                                  compressed responses to cache, in
+                                  bytes, or 0 to disable the cache
+        :type compression_cache: int
+        :param max_request_size: The maximum size, in bytes, of the
+                                 body of a request, after it has been
+                                 decompressed, or 0 for no limit
+        :type max_request_size: int
         """
 
         XMLRPCDispatcher.__init__(self, allow_none, encoding)
@@ -363,6 +608,18 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         self.register_function(self.ping)
         self.logger.info("service available at %s" % self.url)
         self.timeout = timeout
+        self.compression_level = compression_level
+        self.max_request_size = max_request_size
+
+        #: A :class:`Bcfg2.Cache.Cache` of compressed responses,
+        #: or None if compressed responses are not cached.  Keys are
+        #: tuples of ``(<content encoding>, <MD5 digest of the
+        #: uncompressed response>)``, so that responses that are sent
+        #: repeatedly (e.g., cached client configurations) are only
+        #: compressed once.
+        self.compressed_responses = None
+        if compression_cache:
+            self.compressed_responses = Cache(max_size=compression_cache)
 
     def _tasks_thread(self):
         try:
@@ -380,6 +637,90 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         SSLServer.server_close(self)
         self.logger.info("server_close()")
 
+    def get_encoding(self, accept, response):
+        """ Choose the content encoding to compress a response with.
+
+        :param accept: The ``Accept-Encoding`` header of the request
+        :type accept: string
+        :param response: The uncompressed response
+        :type response: bytes
+        :returns: string - The content encoding, or None if the
+                  response should not be compressed
+        """
+        if (not accept or not self.compression_level or
+            len(response) < MIN_COMPRESS_SIZE):
+            return None
+        accepted = []
+        for item in accept.split(","):
+            params = item.split(";")
+            quality = 1.0
+            for param in params[1:]:
+                param = param.strip()
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0
+            if quality > 0:
+                accepted.append(params[0].strip().lower())
+        for encoding in ["gzip", "deflate"]:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def get_compressor(self, encoding):
+        """ Get a compressor for a response.
+
+        :param encoding: The content encoding
+        :type encoding: string
+        :returns: A :func:`zlib.compressobj` object
+        """
+        return zlib.compressobj(self.compression_level, zlib.DEFLATED,
+                                CONTENT_ENCODINGS[encoding])
+
+    def is_cacheable(self, response):
+        """ Determine if the compressed form of a response would be
+        cached by :func:`compress`.
+
+        :param response: The uncompressed response
+        :type response: bytes
+        :returns: bool
+        """
+        return (self.compressed_responses is not None and
+                len(response) >= MIN_CACHE_SIZE)
+
+    def compress(self, response, encoding):
+        """ Compress a response, or get the compressed form of it from
+        :attr:`compressed_responses`.
+
+        :param response: The uncompressed response
+        :type response: bytes
+        :param encoding: The content encoding
+        :type encoding: string
+        :returns: bytes - The compressed response
+        """
+        start = time.time()
+        if self.is_cacheable(response):
+            key = (encoding, md5(response).hexdigest())
+            rv = self.compressed_responses.get(key)
+            if rv is not None:
+                Bcfg2.Statistics.stats.add_value(
+                    "XMLRPCServer:compressed_responses:hit",
+                    time.time() - start)
+                return rv
+        else:
+            key = None
+        compressor = self.get_compressor(encoding)
+        rv = compressor.compress(response) + compressor.flush()
+        if key is not None:
+            self.compressed_responses[key] = rv
+            Bcfg2.Statistics.stats.add_value(
+                "XMLRPCServer:compressed_responses:miss",
+                time.time() - start)
+        Bcfg2.Statistics.stats.add_value("XMLRPCServer:compress",
+                                         time.time() - start)
+        return rv
+
     def _get_require_auth(self):
         return getattr(self.RequestHandlerClass, "require_auth", False)
 
@@ -7,15 +7,35 @@ from Bcfg2.Server.Plugin import MetadataConsistencyError
 
 class Client(Bcfg2.Server.Admin.MetadataCore):
     """ Create, delete, or list client entries """
-    __usage__ = "[options] [add|del|list] [attr=val]"
+    __usage__ = "[options] [add|del|list] [<client> ...] [attr=val ...]"
 
     def __call__(self, args):
         if len(args) == 0:
             self.errExit("No argument specified.\n"
                          "Usage: %s" % self.__usage__)
         if args[0] == 'add':
+            clients = []
+            attrs = dict()
+            for arg in args[1:]:
+                if '=' in arg:
+                    attr, val = arg.split('=', 1)
+                    attrs[attr] = val
+                elif arg == '-':
+                    # read client names from stdin, one per line
+                    clients.extend([l.strip() for l in sys.stdin
+                                    if l.strip()])
+                else:
+                    clients.append(arg)
+            if not clients:
+                self.errExit("No client specified.\n"
+                             "Usage: %s" % self.__usage__)
             try:
-                self.metadata.add_client(args[1])
+                if len(clients) == 1:
+                    self.metadata.add_client(clients[0], attrs)
+                else:
+                    # add all clients with a single write of clients.xml
+                    self.metadata.add_clients(
+                        dict([(c, attrs.copy()) for c in clients]))
             except MetadataConsistencyError:
                 err = sys.exc_info()[1]
                 print("Error in adding client: %s" % err)
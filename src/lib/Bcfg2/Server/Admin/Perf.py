@@ -4,13 +4,18 @@ import sys
 import Bcfg2.Options
 import Bcfg2.Proxy
 import Bcfg2.Server.Admin
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Statistics import PERCENTILES, WINDOWS
 
 
 class Perf(Bcfg2.Server.Admin.Mode):
-    """ Get performance data from server """
+    """ Get performance data from server.  By default, percentiles
+    are shown over the lifetime of the server, along with rates over
+    recent time windows; if a window is given, percentiles and rates
+    are shown over only that window. """
+    __usage__ = "[%s]" % "|".join([w[0] for w in WINDOWS])
 
     def __call__(self, args):
-        output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
         optinfo = {
             'ca': Bcfg2.Options.CLIENT_CA,
             'certificate': Bcfg2.Options.CLIENT_CERT,
@@ -22,6 +27,11 @@ class Perf(Bcfg2.Server.Admin.Mode):
             }
         setup = Bcfg2.Options.OptionParser(optinfo)
         setup.parse(sys.argv[1:])
+        window = None
+        if args:
+            window = args[0]
+            if window not in [w[0] for w in WINDOWS]:
+                self.errExit("Unknown time window %s" % window)
         proxy = Bcfg2.Proxy.ComponentProxy(setup['server'],
                                            setup['user'],
                                            setup['password'],
@@ -29,7 +39,43 @@ class Perf(Bcfg2.Server.Admin.Mode):
                                            cert=setup['certificate'],
                                            ca=setup['ca'],
                                            timeout=setup['timeout'])
-        data = proxy.get_statistics()
+        try:
+            data = proxy.get_statistics(True)
+        except xmlrpclib.Fault:
+            # older servers do not support detailed statistics
+            if window is not None:
+                self.errExit("Server does not support time windows")
+            self.print_basic(proxy.get_statistics())
+            return
+
+        pnames = [p[0] for p in PERCENTILES]
+        if window is None:
+            output = [tuple(['Name', 'Count', 'Mean'] + pnames + ['Max'] +
+                            ["%s/s" % w[0] for w in WINDOWS])]
+            for key in sorted(data.keys()):
+                stat = data[key]
+                output.append(
+                    tuple([key, stat['count']] +
+                          ["%.06f" % stat[k]
+                           for k in ['mean'] + pnames + ['max']] +
+                          ["%.03f" % stat['windows'][w[0]]['rate']
+                           for w in WINDOWS]))
+        else:
+            output = [tuple(['Name', 'Count', 'Rate/s', 'Mean'] + pnames)]
+            for key in sorted(data.keys()):
+                stat = data[key]['windows'][window]
+                if not stat['count']:
+                    continue
+                output.append(
+                    tuple([key, stat['count'], "%.03f" % stat['rate']] +
+                          ["%.06f" % stat[k] for k in ['mean'] + pnames]))
+        self.print_table(output)
+
+    def print_basic(self, data):
+        """ Print the minimum, maximum, average, and count of each
+        statistic, as returned by servers that do not support
+        detailed statistics. """
+        output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
         for key in sorted(data.keys()):
             output.append((key, ) +
                           tuple(["%.06f" % item
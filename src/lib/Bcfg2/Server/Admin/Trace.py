@@ -0,0 +1,105 @@
+""" Get traces of recent and slow client runs from the server """
+
+import sys
+import time
+import Bcfg2.Options
+import Bcfg2.Proxy
+import Bcfg2.Server.Admin
+from Bcfg2.Compat import xmlrpclib
+
+
+class Trace(Bcfg2.Server.Admin.Mode):
+    """ Get traces of client runs from the server.  With no client,
+    the most recent and slowest traces are listed; with a client, the
+    work done for each of its traces is shown in detail. """
+    __usage__ = "[<client>]"
+
+    def __call__(self, args):
+        optinfo = {
+            'ca': Bcfg2.Options.CLIENT_CA,
+            'certificate': Bcfg2.Options.CLIENT_CERT,
+            'key': Bcfg2.Options.SERVER_KEY,
+            'password': Bcfg2.Options.SERVER_PASSWORD,
+            'server': Bcfg2.Options.SERVER_LOCATION,
+            'user': Bcfg2.Options.CLIENT_USER,
+            'timeout': Bcfg2.Options.CLIENT_TIMEOUT,
+            }
+        setup = Bcfg2.Options.OptionParser(optinfo)
+        setup.parse(sys.argv[1:])
+        client = None
+        if args:
+            client = args[0]
+        proxy = Bcfg2.Proxy.ComponentProxy(setup['server'],
+                                           setup['user'],
+                                           setup['password'],
+                                           key=setup['key'],
+                                           cert=setup['certificate'],
+                                           ca=setup['ca'],
+                                           timeout=setup['timeout'])
+        try:
+            if client is None:
+                traces = proxy.get_traces()
+            else:
+                traces = proxy.get_traces(client)
+        except xmlrpclib.Fault:
+            self.errExit("Server does not support tracing")
+
+        if client is None:
+            for key in ['recent', 'slowest']:
+                print("%s traces:" % key.title())
+                self.print_summary(traces[key])
+                print("")
+        else:
+            if not traces['recent'] and not traces['slowest']:
+                self.errExit("No traces recorded for %s" % client)
+            # a slow trace may also be one of the most recent traces
+            seen = set()
+            for trace in traces['recent'] + traces['slowest']:
+                key = (trace['name'], trace['time'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                self.print_trace(trace)
+
+    def print_summary(self, traces):
+        """ Print a table listing the given traces """
+        if not traces:
+            print("  None recorded")
+            return
+        output = [('Time', 'Client', 'Name', 'Duration')]
+        for trace in traces:
+            output.append((self._format_time(trace['time']),
+                           trace['client'], trace['name'],
+                           "%.06f" % trace['duration']))
+        self.print_table(output)
+
+    def print_trace(self, trace):
+        """ Print the spans of a single trace as a tree, followed by
+        the number of entries bound by and the time spent in each
+        generator """
+        print("%s %s for %s: %.06f" % (self._format_time(trace['time']),
+                                       trace['name'], trace['client'],
+                                       trace['duration']))
+        for span in trace['spans']:
+            self._print_span(span, 1)
+        if trace['generators']:
+            output = [('Generator', 'Entries', 'Time')]
+            for name in sorted(trace['generators'].keys()):
+                gen = trace['generators'][name]
+                output.append((name, gen['count'], "%.06f" % gen['time']))
+            self.print_table(output)
+        print("")
+
+    def _print_span(self, span, depth):
+        """ Print a span and all of the spans within it """
+        attrs = " ".join(["%s=%s" % (k, v)
+                          for k, v in sorted(span['attrs'].items())])
+        print(("%s+%.06f %.06f %s %s" % ("  " * depth, span['start'],
+                                         span['duration'], span['name'],
+                                         attrs)).rstrip())
+        for child in span['spans']:
+            self._print_span(child, depth + 1)
+
+    def _format_time(self, stamp):
+        """ Format the start time of a trace """
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp))
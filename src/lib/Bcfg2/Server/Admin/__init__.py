@@ -13,6 +13,7 @@ __all__ = [
         'Query',
         'Reports',
         'Snapshots',
+        'Trace',
         'Syncdb',
         'Tidy',
         'Viz',
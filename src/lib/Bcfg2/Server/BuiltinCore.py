@@ -7,6 +7,7 @@ import daemon
 import Bcfg2.Statistics
 from Bcfg2.Server.Core import BaseCore, NoExposedMethod
 from Bcfg2.Compat import xmlrpclib, urlparse
+from Bcfg2.Options import get_size
 from Bcfg2.SSLServer import XMLRPCServer
 
 # pylint: disable=E0611
@@ -28,6 +29,29 @@ class Core(BaseCore):
         #: this server core
         self.server = None
 
+        #: The zlib compression level used to compress responses to
+        #: clients that accept compressed responses, or 0 to never
+        #: compress responses
+        self.compression_level = int(setup.cfp.get("server",
+                                                   "compression_level",
+                                                   default="6"))
+
+        #: The maximum size, in bytes, of the body of a request, after
+        #: it has been decompressed, or 0 for no limit
+        self.max_request_size = get_size(setup.cfp.get("server",
+                                                       "max_request_size",
+                                                       default="100m"))
+
+        #: The maximum total size, in bytes, of compressed responses
+        #: cached by the XML-RPC server, or 0 if compressed responses
+        #: are not cached
+        self.compression_cache = 0
+        if setup.cfp.getboolean("caching", "compressed_responses",
+                                default=False):
+            self.compression_cache = get_size(
+                setup.cfp.get("caching", "compressed_responses_memory",
+                              default="64m"))
+
         if self.setup['daemon']:
             #: The :class:`daemon.DaemonContext` used to drop
             #: privileges, write the PID file (with :class:`PidFile`),
@@ -94,14 +118,7 @@ class Core(BaseCore):
                                             socket.AF_UNSPEC,
                                             socket.SOCK_STREAM)[0][4]
         try:
-            self.server = XMLRPCServer(self.setup['listen_all'],
-                                       server_address,
-                                       keyfile=self.setup['key'],
-                                       certfile=self.setup['cert'],
-                                       register=False,
-                                       timeout=1,
-                                       ca=self.setup['ca'],
-                                       protocol=self.setup['protocol'])
+            self.server = self._create_server(server_address)
         except:  # pylint: disable=W0702
             err = sys.exc_info()[1]
             self.logger.error("Server startup failed: %s" % err)
@@ -110,6 +127,26 @@ class Core(BaseCore):
         self.server.register_instance(self)
         return True
 
+    def _create_server(self, server_address):
+        """ Create the XML-RPC server that will power this core.
+
+        :param server_address: The address to bind to, as returned by
+                               :func:`socket.getaddrinfo`
+        :type server_address: tuple
+        :returns: :class:`Bcfg2.SSLServer.XMLRPCServer`
+        """
+        return XMLRPCServer(self.setup['listen_all'],
+                            server_address,
+                            keyfile=self.setup['key'],
+                            certfile=self.setup['cert'],
+                            register=False,
+                            timeout=1,
+                            ca=self.setup['ca'],
+                            protocol=self.setup['protocol'],
+                            compression_level=self.compression_level,
+                            compression_cache=self.compression_cache,
+                            max_request_size=self.max_request_size)
+
     def _block(self):
         """ Enter the blocking infinite loop. """
         try:
@@ -15,9 +15,12 @@ import Bcfg2.settings
 import Bcfg2.Server
 import Bcfg2.Logger
 import Bcfg2.Server.FileMonitor
+import Bcfg2.Server.Dependencies
 from Bcfg2.Cache import Cache
 import Bcfg2.Statistics
-from Bcfg2.Compat import xmlrpclib, reduce  # pylint: disable=W0622
+from Bcfg2.Options import get_size
+from Bcfg2.Compat import xmlrpclib, wraps
+from Bcfg2.Delta import digest as config_digest, make_delta
 from Bcfg2.Server.Plugin import PluginInitError, PluginExecutionError, \
     track_statistics
 
@@ -29,6 +32,10 @@ except ImportError:
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'Bcfg2.settings'
 
+#: The response to :func:`BaseCore.GetConfig` when the client already
+#: has the configuration that was built for it
+NOT_MODIFIED = "<NotModified/>"
+
 
 def exposed(func):
     """ Decorator that sets the ``exposed`` attribute of a function to
@@ -43,6 +50,26 @@ def exposed(func):
     return func
 
 
+def traced(func):
+    """ Decorator that records a trace of each call to a core method
+    with :attr:`Bcfg2.Statistics.tracer`, if tracing is enabled.  The
+    trace is named after the method.
+
+    :param func: The function to decorate
+    :type func: callable
+    :returns: callable - the decorated function"""
+    @wraps(func)
+    def inner(self, *args, **kwargs):
+        """ The decorated function """
+        started = Bcfg2.Statistics.tracer.start(func.__name__)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            if started:
+                Bcfg2.Statistics.tracer.finish()
+    return inner
+
+
 def sort_xml(node, key=None):
     """ Recursively sort an XML document in a deterministic fashion.
     This shouldn't be used to perform a *useful* sort, merely to put
@@ -75,6 +102,142 @@ class NoExposedMethod (Exception):
     method exposed with the given name. """
 
 
+class ServerBusy(xmlrpclib.Fault):
+    """ XML-RPC fault raised when a client configuration cannot be
+    built because the server is already building as many as it is
+    allowed to.  The fault string tells the client how long to wait
+    before retrying; :class:`Bcfg2.Proxy.RetryMethod` honors it. """
+
+    #: The XML-RPC fault code of the fault
+    code = 503
+
+    def __init__(self, retry_after):
+        """
+        :param retry_after: The number of seconds after which the
+                            client should retry the request
+        :type retry_after: int
+        """
+        xmlrpclib.Fault.__init__(self, self.code,
+                                 "Server busy, retry after %d seconds" %
+                                 retry_after)
+        self.retry_after = retry_after
+
+
+class AdmissionControl(object):
+    """ Limit the number of client configurations that are built at
+    once.  Requests beyond the limit wait in a bounded queue for a
+    build to finish; requests that find the queue full, or that wait
+    longer than the timeout, are refused with :exc:`ServerBusy`, so
+    that clients back off instead of all timing out together when the
+    server is overloaded. """
+
+    logger = logging.getLogger("Bcfg2.Server.Core.AdmissionControl")
+
+    def __init__(self, concurrency=0, queue_size=0, timeout=30):
+        """
+        :param concurrency: The maximum number of configurations to
+                            build at once, or 0 for no limit
+        :type concurrency: int
+        :param queue_size: The maximum number of requests waiting to
+                           start building a configuration
+        :type queue_size: int
+        :param timeout: The maximum number of seconds a request waits
+                        to start building a configuration
+        :type timeout: float
+        """
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        #: The number of configurations being built
+        self.running = 0
+
+        #: The number of requests waiting to start building a
+        #: configuration
+        self.waiting = 0
+
+        #: A moving average of the time it takes to build a
+        #: configuration, used to tell refused clients when to retry
+        self.build_time = 1.0
+
+        self._cond = threading.Condition()
+
+    def retry_after(self):
+        """ Estimate how long it will take for the builds that are
+        running and waiting now to finish.
+
+        :returns: int - The number of seconds
+        """
+        pending = self.running + self.waiting
+        return max(1, int(self.build_time * pending / self.concurrency + 0.5))
+
+    def acquire(self, client):
+        """ Wait until a configuration can be built.
+
+        :param client: The hostname of the client the configuration
+                       is for
+        :type client: string
+        :returns: float - The time the build was admitted, which must
+                  be passed to :func:`release`, or None if there is no
+                  limit on concurrent builds
+        :raises: :exc:`ServerBusy`
+        """
+        if not self.concurrency:
+            return None
+        start = time.time()
+        self._cond.acquire()
+        try:
+            if self.running >= self.concurrency:
+                if self.waiting >= self.queue_size:
+                    self._refuse(client, "build queue is full")
+                deadline = start + self.timeout
+                self.waiting += 1
+                try:
+                    while self.running >= self.concurrency:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._refuse(client, "timed out waiting to "
+                                         "build configuration")
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+        finally:
+            self._cond.release()
+        admitted = time.time()
+        Bcfg2.Statistics.stats.add_value("AdmissionControl:wait",
+                                         admitted - start)
+        return admitted
+
+    def _refuse(self, client, reason):
+        """ Refuse a request with :exc:`ServerBusy`.  Must be called
+        with the condition held. """
+        retry_after = self.retry_after()
+        self.logger.warning("Refusing configuration request from %s: %s; "
+                            "retry in %d seconds" %
+                            (client, reason, retry_after))
+        Bcfg2.Statistics.stats.add_value("AdmissionControl:refused",
+                                         retry_after)
+        raise ServerBusy(retry_after)
+
+    def release(self, admitted):
+        """ Record that a build has finished.
+
+        :param admitted: The value returned by :func:`acquire`
+        :type admitted: float
+        """
+        if admitted is None:
+            return
+        self._cond.acquire()
+        try:
+            self.build_time = (0.8 * self.build_time +
+                               0.2 * (time.time() - admitted))
+            self.running -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+
 # pylint: disable=W0702
 # in core we frequently want to catch all exceptions, regardless of
 # type, so disable the pylint rule that catches that.
@@ -247,6 +410,37 @@ class BaseCore(object):
         #: :class:`Bcfg2.Server.Plugin.interfaces.Generator` plugins
         self.generators = self.plugins_by_type(Bcfg2.Server.Plugin.Generator)
 
+        #: An index of the :attr:`generators` that list each entry in
+        #: their ``Entries`` dicts, keyed by ``(<tag>, <name>)``.  This
+        #: is maintained by :func:`_update_generator_index`.
+        self.generator_index = dict()
+
+        #: A cache of the results of
+        #: :func:`Bcfg2.Server.Plugin.interfaces.Generator.HandlesEntry`
+        #: for generators that set
+        #: :attr:`Bcfg2.Server.Plugin.interfaces.Generator.handles_entry_by_name`.
+        #: Keys are ``(<tag>, <name>)`` and values are lists of the
+        #: generators that handle the entry, which may be empty.  This
+        #: is expired along with :attr:`generator_index`.
+        self.handles_entry_cache = dict()
+
+        # the (<fam generation>, <Entries fingerprint>) tuple that
+        # generator_index was built from
+        self._generator_index_key = None
+
+        # (<generator>, <tag>) tuples for Entries dicts that cannot be
+        # indexed by name, e.g., FuzzyDicts
+        self._unindexed_entries = []
+
+        # dict of (<generator>, <tag>) -> frozenset of the keys of each
+        # unindexed Entries dict, used to tell whether it has changed
+        self._unindexed_keys = dict()
+
+        # generators whose HandlesEntry results can and cannot be
+        # cached, respectively
+        self._cacheable_generators = []
+        self._uncacheable_generators = []
+
         #: The list of plugins that handle
         #: :class:`Bcfg2.Server.Plugin.interfaces.Structure`
         #: generation
@@ -270,8 +464,82 @@ class BaseCore(object):
         self.lock = threading.Lock()
 
         #: A :class:`Bcfg2.Cache.Cache` object for caching client
-        #: metadata
-        self.metadata_cache = Cache()
+        #: metadata, indexed by group, bundle, and profile so that the
+        #: Metadata plugin can find clients by those without building
+        #: the metadata for every client
+        self.metadata_cache = Cache(
+            max_entries=int(setup.cfp.get("caching",
+                                          "client_metadata_entries",
+                                          default="0")),
+            ttl=float(setup.cfp.get("caching", "client_metadata_ttl",
+                                    default="0")),
+            indexes=dict(groups=lambda m: m.groups,
+                         bundles=lambda m: m.bundles,
+                         profile=lambda m: [m.profile]),
+            name="client_metadata")
+
+        #: The :class:`AdmissionControl` object that limits the
+        #: number of client configurations built at once
+        self.admission = AdmissionControl(
+            concurrency=int(setup.cfp.get("server", "max_builds",
+                                          default="0")),
+            queue_size=int(setup.cfp.get("server", "build_queue",
+                                         default="100")),
+            timeout=float(setup.cfp.get("server", "build_timeout",
+                                        default="30")))
+
+        tracer = Bcfg2.Statistics.tracer
+        tracer.enabled = setup.cfp.getboolean("tracing", "enabled",
+                                              default=False)
+        tracer.recent_size = int(setup.cfp.get("tracing", "recent",
+                                               default="100"))
+        tracer.slowest_size = int(setup.cfp.get("tracing", "slowest",
+                                                default="10"))
+
+        #: A :class:`Bcfg2.Cache.Cache` object for caching fully
+        #: bound client configurations, or None if configuration
+        #: caching is disabled.  Keys are client hostnames; values
+        #: are tuples of ``(<cache key>, <serialized configuration>)``,
+        #: where the cache key is produced by
+        #: :func:`_config_cache_key`.  See :ref:`server-caching` for
+        #: more details.
+        self.config_cache = None
+        if setup.cfp.getboolean("caching", "client_config", default=False):
+            self.config_cache = Cache(
+                max_entries=int(setup.cfp.get("caching",
+                                              "client_config_entries",
+                                              default="0")),
+                max_size=get_size(setup.cfp.get("caching",
+                                                "client_config_memory",
+                                                default="256m")),
+                sizeof=lambda v: len(v[1]),
+                name="client_config")
+            Bcfg2.Server.Dependencies.graph.listeners.append(
+                self._expire_dependents)
+            self.fam.listeners.append(
+                Bcfg2.Server.Dependencies.graph.handled_event)
+
+        #: The number of configurations sent to each client that are
+        #: kept in :attr:`config_history`
+        self.config_history_size = int(setup.cfp.get("caching",
+                                                     "config_history",
+                                                     default="0"))
+
+        #: A :class:`Bcfg2.Cache.Cache` of the configurations most
+        #: recently sent to each client, used to send clients only
+        #: the changes to their configurations, or None if deltas are
+        #: disabled.  Keys are client hostnames; values are tuples of
+        #: ``(<digest>, <serialized configuration>)`` tuples, most
+        #: recent first.  See :ref:`server-caching-deltas` for more
+        #: details.
+        self.config_history = None
+        if self.config_history_size:
+            self.config_history = Cache(
+                max_size=get_size(setup.cfp.get("caching",
+                                                "config_history_memory",
+                                                default="64m")),
+                sizeof=lambda v: sum([len(h[1]) for h in v]),
+                name="config_history")
 
     def plugins_by_type(self, base_cls):
         """ Return a list of loaded plugins that match the passed type.
@@ -468,9 +736,16 @@ class BaseCore(object):
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: list of :class:`lxml.etree._Element` objects
         """
-        structures = reduce(lambda x, y: x + y,
-                            [struct.BuildStructures(metadata)
-                             for struct in self.structures], [])
+        structures = []
+        for struct in self.structures:
+            span = None
+            if Bcfg2.Statistics.tracer.enabled:
+                span = Bcfg2.Statistics.tracer.begin(
+                    "%s:BuildStructures" % struct.name)
+            try:
+                structures.extend(struct.BuildStructures(metadata))
+            finally:
+                Bcfg2.Statistics.tracer.end(span)
         sbundles = [b.get('name') for b in structures if b.tag == 'Bundle']
         missing = [b for b in metadata.bundles if b not in sbundles]
         if missing:
@@ -491,6 +766,9 @@ class BaseCore(object):
                        structures to. Modified in-place.
         :type config: lxml.etree._Element
         """
+        # plugins may change their Entries outside of file monitor
+        # events, so check for changes once per configuration
+        self._update_generator_index()
         for astruct in structures:
             try:
                 self.BindStructure(astruct, metadata)
@@ -507,10 +785,17 @@ class BaseCore(object):
         :param metadata: Client metadata to bind structure for
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         """
+        tracing = Bcfg2.Statistics.tracer.enabled
+        span = None
         for entry in structure.getchildren():
             if entry.tag.startswith("Bound"):
                 entry.tag = entry.tag[5:]
                 continue
+            Bcfg2.Server.Dependencies.graph.set_entry((entry.tag,
+                                                       entry.get('name')))
+            if tracing:
+                span = Bcfg2.Statistics.tracer.begin(
+                    "Bind", entry="%s:%s" % (entry.tag, entry.get('name')))
             try:
                 self.Bind(entry, metadata)
             except PluginExecutionError:
@@ -525,6 +810,9 @@ class BaseCore(object):
                     entry.set('failure', 'bind error: %s' % format_exc())
                 self.logger.error("Unexpected failure in BindStructure: %s %s"
                                   % (entry.tag, entry.get('name')), exc_info=1)
+            if tracing:
+                Bcfg2.Statistics.tracer.end(span)
+        Bcfg2.Server.Dependencies.graph.set_entry(None)
 
     def Bind(self, entry, metadata):
         """ Bind a single entry using the appropriate generator.
@@ -553,19 +841,37 @@ class BaseCore(object):
                 self.logger.error("Falling back to %s:%s" %
                                   (entry.tag, entry.get('name')))
 
-        glist = [gen for gen in self.generators if
-                 entry.get('name') in gen.Entries.get(entry.tag, {})]
+        if (self._generator_index_key is None or
+            self._generator_index_key[0] != self.fam.generation):
+            self._update_generator_index()
+        key = (entry.tag, entry.get('name'))
+        glist = self.generator_index.get(key, [])
+        if self._unindexed_entries:
+            glist = glist + [gen for gen, tag in self._unindexed_entries
+                             if tag == entry.tag and
+                             entry.get('name') in gen.Entries[tag]]
         if len(glist) == 1:
+            if Bcfg2.Statistics.tracer.enabled:
+                Bcfg2.Statistics.tracer.annotate(generator=glist[0].name)
             return glist[0].Entries[entry.tag][entry.get('name')](entry,
                                                                   metadata)
         elif len(glist) > 1:
             generators = ", ".join([gen.name for gen in glist])
             self.logger.error("%s %s served by multiple generators: %s" %
                               (entry.tag, entry.get('name'), generators))
-        g2list = [gen for gen in self.generators if
-                  gen.HandlesEntry(entry, metadata)]
+        try:
+            g2list = self.handles_entry_cache[key]
+        except KeyError:
+            g2list = [gen for gen in self._cacheable_generators
+                      if gen.HandlesEntry(entry, metadata)]
+            self.handles_entry_cache[key] = g2list
+        if self._uncacheable_generators:
+            g2list = g2list + [gen for gen in self._uncacheable_generators
+                               if gen.HandlesEntry(entry, metadata)]
         try:
             if len(g2list) == 1:
+                if Bcfg2.Statistics.tracer.enabled:
+                    Bcfg2.Statistics.tracer.annotate(generator=g2list[0].name)
                 return g2list[0].HandleEntry(entry, metadata)
             entry.set('failure', 'no matching generator')
             raise PluginExecutionError("No matching generator: %s:%s" %
@@ -576,15 +882,174 @@ class BaseCore(object):
                                               entry.tag),
                                              time.time() - start)
 
+    def _update_generator_index(self):
+        """ Rebuild :attr:`generator_index` and expire
+        :attr:`handles_entry_cache` if any file monitor events have
+        been handled, or if the ``Entries`` dicts of any generators
+        have been replaced or changed size, since the index was last
+        built.  Clients that have entries whose generators have
+        changed are invalidated with
+        :func:`Bcfg2.Server.Dependencies.DependencyGraph.entries_changed`. """
+        generation = self.fam.generation
+        fingerprint = []
+        for gen in self.generators:
+            for tag, entries in list(gen.Entries.items()):
+                fingerprint.append((id(gen), tag, id(entries), len(entries)))
+        key = (generation, tuple(fingerprint))
+        if key == self._generator_index_key:
+            return
+
+        index = dict()
+        unindexed = []
+        unindexed_keys = dict()
+        for gen in self.generators:
+            for tag, entries in list(gen.Entries.items()):
+                if type(entries) is not dict:
+                    # subclasses of dict (e.g., FuzzyDict) may
+                    # contain names that are not keys
+                    unindexed.append((gen, tag))
+                    unindexed_keys[(gen, tag)] = frozenset(entries.keys())
+                    continue
+                for name in list(entries.keys()):
+                    index.setdefault((tag, name), []).append(gen)
+
+        if self._generator_index_key is not None:
+            # entries that are now bound by different generators than
+            # before.  the clients that have them may not have
+            # recorded a dependency on the files that now bind them,
+            # so they must be invalidated explicitly.
+            old = self.generator_index
+            changed = [k for k in set(old.keys()) | set(index.keys())
+                       if old.get(k) != index.get(k)]
+            tags = set(gt[1] for gt in set(self._unindexed_keys.keys()) ^
+                       set(unindexed_keys.keys()))
+            tags.update(gt[1] for gt, keys in unindexed_keys.items()
+                        if self._unindexed_keys.get(gt, keys) != keys)
+            if changed or tags:
+                Bcfg2.Server.Dependencies.graph.entries_changed(changed,
+                                                                tags)
+        self._cacheable_generators = [gen for gen in self.generators
+                                      if gen.handles_entry_by_name]
+        self._uncacheable_generators = [gen for gen in self.generators
+                                        if not gen.handles_entry_by_name]
+        self._unindexed_entries = unindexed
+        self._unindexed_keys = unindexed_keys
+        self.handles_entry_cache = dict()
+        self.generator_index = index
+        self._generator_index_key = key
+
+    def _config_cache_key(self, metadata):
+        """ Get the key that a cached configuration for a client
+        must match in order to be used.  This includes the repository
+        revision and the parts of the client metadata that determine
+        which structures and entries it gets.  Changes to the files
+        the configuration was built from are handled by
+        :func:`_expire_dependents`.
+
+        :param metadata: The client metadata to get a cache key for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: tuple
+        """
+        return (self.revision, metadata.profile,
+                metadata.version, tuple(sorted(metadata.groups)),
+                tuple(sorted(metadata.bundles)))
+
+    def _get_cached_config(self, metadata, key):
+        """ Get a cached configuration for a client from
+        :attr:`config_cache`, if a valid one exists.  Hits and misses
+        are tracked with :mod:`Bcfg2.Statistics`.
+
+        :param metadata: The client metadata to get the cached
+                         configuration for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :param key: The cache key the cached configuration must
+                    match, as returned by :func:`_config_cache_key`
+        :type key: tuple
+        :returns: bytes - The serialized configuration, or None
+        """
+        start = time.time()
+        config = None
+        cached = self.config_cache.get(metadata.hostname)
+        if cached is not None:
+            if cached[0] == key:
+                config = cached[1]
+            else:
+                self.config_cache.expire(metadata.hostname)
+        if config is None:
+            result = "miss"
+        else:
+            result = "hit"
+        Bcfg2.Statistics.stats.add_value("%s:config_cache:%s" %
+                                         (self.__class__.__name__, result),
+                                         time.time() - start)
+        return config
+
+    def _expire_dependents(self, dependents):
+        """ Expire the cached configurations of clients that
+        depend on data that has changed.  This is registered as a
+        :attr:`Bcfg2.Server.Dependencies.DependencyGraph.listeners`
+        callback when configuration caching is enabled.
+
+        :param dependents: A set of ``(<client>, <tag>, <name>)``
+                           tuples, or None to expire all cached
+                           configurations
+        :type dependents: set
+        :returns: None
+        """
+        if dependents is None:
+            self.config_cache.expire()
+        else:
+            for client in set(d[0] for d in dependents):
+                self.config_cache.expire(client)
+
     def BuildConfiguration(self, client):
-        """ Build the complete configuration for a client.
+        """ Build the complete configuration for a client.  If
+        configuration caching is enabled, a cached configuration will
+        be returned if one exists that is still valid.
 
         :param client: The hostname of the client to build the
                        configuration for
         :type client: string
         :returns: :class:`lxml.etree._Element` - A complete Bcfg2
                   configuration document """
+        config, serialized = self._build_config(client)
+        if config is None:
+            config = lxml.etree.XML(serialized)
+        return config
+
+    def BuildSerializedConfiguration(self, client):
+        """ Build the complete configuration for a client, serialized
+        as XML.  If configuration caching is enabled, a cached
+        configuration will be returned, without being parsed and
+        serialized again, if one exists that is still valid.
+
+        :param client: The hostname of the client to build the
+                       configuration for
+        :type client: string
+        :returns: bytes - A complete Bcfg2 configuration document """
+        config, serialized = self._build_config(client)
+        if serialized is None:
+            serialized = lxml.etree.tostring(config, xml_declaration=False)
+        return serialized
+
+    def _build_config(self, client):
+        """ Do the work of :func:`BuildConfiguration` and
+        :func:`BuildSerializedConfiguration`.
+
+        :param client: The hostname of the client to build the
+                       configuration for
+        :type client: string
+        :returns: tuple of ``(<configuration>, <serialized
+                  configuration>)``.  Either may be None, but not
+                  both: a cached configuration is only returned
+                  serialized, and a configuration that has just been
+                  built is only returned serialized if it was cached.
+        """
         start = time.time()
+        # the FAM generation must be recorded before any data is
+        # read, so that changes made during the build invalidate the
+        # cached configuration
+        generation = self.fam.generation
         config = lxml.etree.Element("Configuration", version='2.0',
                                     revision=self.revision)
         try:
@@ -592,15 +1057,32 @@ class BaseCore(object):
         except Bcfg2.Server.Plugin.MetadataConsistencyError:
             self.logger.error("Metadata consistency error for client %s" %
                               client)
-            return lxml.etree.Element("error", type='metadata error')
+            return (lxml.etree.Element("error", type='metadata error'), None)
 
         self.client_run_hook("start_client_run", meta)
 
+        if self.config_cache is not None:
+            # a new file may have changed the generator that binds
+            # an entry without invalidating the clients that have it,
+            # so bring the generator index up to date first
+            self._update_generator_index()
+            cache_key = self._config_cache_key(meta)
+            cached = self._get_cached_config(meta, cache_key)
+            if cached is not None:
+                self.client_run_hook("end_client_run", meta)
+                self.logger.info("Got cached config for %s in %.03f seconds"
+                                 % (client, time.time() - start))
+                return (None, cached)
+            # record the files this configuration is built from, so
+            # that it is expired when any of them change
+            Bcfg2.Server.Dependencies.graph.start(client)
+
         try:
             structures = self.GetStructures(meta)
         except:
+            Bcfg2.Server.Dependencies.graph.finish()
             self.logger.error("error in GetStructures", exc_info=1)
-            return lxml.etree.Element("error", type='structure error')
+            return (lxml.etree.Element("error", type='structure error'), None)
 
         self.validate_structures(meta, structures)
 
@@ -617,7 +1099,10 @@ class BaseCore(object):
                     esrcs[key] = entry.get('altsrc', None)
         del esrcs
 
-        self.BindStructures(structures, meta, config)
+        try:
+            self.BindStructures(structures, meta, config)
+        finally:
+            Bcfg2.Server.Dependencies.graph.finish()
 
         self.validate_goals(meta, config)
 
@@ -625,9 +1110,22 @@ class BaseCore(object):
 
         sort_xml(config, key=lambda e: e.get('name'))
 
+        serialized = None
+        if self.config_cache is not None:
+            # configurations with bind failures are not cached, since
+            # the failures may well be transient.  configurations that
+            # were built while file monitor events were handled are
+            # not cached either, since they may have been built from
+            # data that was changing, and the dependencies they
+            # recorded may already have been expired.
+            if (self.fam.generation == generation and
+                not config.xpath("//*[@failure]")):
+                serialized = lxml.etree.tostring(config, xml_declaration=False)
+                self.config_cache[meta.hostname] = (cache_key, serialized)
+
         self.logger.info("Generated config for %s in %.03f seconds" %
                          (client, time.time() - start))
-        return config
+        return (config, serialized)
 
     def HandleEvent(self, event):
         """ Handle a change in the Bcfg2 config file.
@@ -666,14 +1164,23 @@ class BaseCore(object):
             if not self._daemonize():
                 return False
 
+        # monitor the config file before _run() is called so that
+        # the monitor is in place before a server core that forks
+        # child processes (e.g., the multiprocessing core) does so
+        try:
+            self.fam.AddMonitor(self.cfile, self)
+        except:
+            self.shutdown()
+            raise
+
         if not self._run():
             self.shutdown()
             return False
 
         try:
-            self.fam.start()
+            if not self.fam.started:
+                self.fam.start()
             self.fam_thread.start()
-            self.fam.AddMonitor(self.cfile, self)
         except:
             self.shutdown()
             raise
@@ -735,11 +1242,20 @@ class BaseCore(object):
             imd = self.metadata_cache.get(client_name, None)
         if not imd:
             imd = self.metadata.get_initial_metadata(client_name)
+            tracer = Bcfg2.Statistics.tracer
             for conn in self.connectors:
-                grps = conn.get_additional_groups(imd)
+                span = tracer.begin("%s:get_additional_groups" % conn.name)
+                try:
+                    grps = conn.get_additional_groups(imd)
+                finally:
+                    tracer.end(span)
                 self.metadata.merge_additional_groups(imd, grps)
             for conn in self.connectors:
-                data = conn.get_additional_data(imd)
+                span = tracer.begin("%s:get_additional_data" % conn.name)
+                try:
+                    data = conn.get_additional_data(imd)
+                finally:
+                    tracer.end(span)
                 self.metadata.merge_additional_data(imd, conn.name, data)
             imd.query.by_name = self.build_metadata
             if self.metadata_cache_mode in ['cautious', 'aggressive']:
@@ -796,6 +1312,7 @@ class BaseCore(object):
         try:
             client = self.metadata.resolve_client(address,
                                                   cleanup_cache=cleanup_cache)
+            Bcfg2.Statistics.tracer.set_client(client)
             if metadata:
                 meta = self.build_metadata(client)
             else:
@@ -847,6 +1364,21 @@ class BaseCore(object):
             raise NoExposedMethod(method_name)
         return func
 
+    def _get_probes(self, metadata):
+        """ Collect probes for a client from all
+        :class:`Bcfg2.Server.Plugin.interfaces.Probing` plugins.
+
+        :param metadata: The client metadata to get probes for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: string - The serialized XML document describing
+                  probes for the client
+        """
+        resp = lxml.etree.Element('probes')
+        for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.Probing):
+            for probe in plugin.GetProbes(metadata):
+                resp.append(probe)
+        return lxml.etree.tostring(resp, xml_declaration=False).decode('UTF-8')
+
     # XMLRPC handlers start here
 
     @exposed
@@ -901,6 +1433,7 @@ class BaseCore(object):
         return True
 
     @exposed
+    @traced
     def GetProbes(self, address):
         """ Fetch probes for the client.
 
@@ -910,20 +1443,16 @@ class BaseCore(object):
                   this client
         :raises: :exc:`xmlrpclib.Fault`
         """
-        resp = lxml.etree.Element('probes')
         client, metadata = self.resolve_client(address, cleanup_cache=True)
         try:
-            for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.Probing):
-                for probe in plugin.GetProbes(metadata):
-                    resp.append(probe)
-            return lxml.etree.tostring(resp,
-                                       xml_declaration=False).decode('UTF-8')
+            return self._get_probes(metadata)
         except:
             err = sys.exc_info()[1]
             self.critical_error("Error determining probes for %s: %s" %
                                 (client, err))
 
     @exposed
+    @traced
     def RecvProbeData(self, address, probedata):
         """ Receive probe data from clients.
 
@@ -941,6 +1470,10 @@ class BaseCore(object):
             # I.e., the next metadata object that's built, after probe
             # data is processed, is cached.
             self.metadata_cache.expire(client)
+        if self.config_cache is not None:
+            # new probe data may change the configuration even if it
+            # doesn't change the client's groups
+            self.config_cache.expire(client)
         try:
             xpdata = lxml.etree.XML(probedata.encode('utf-8'),
                                     parser=Bcfg2.Server.XMLParser)
@@ -989,25 +1522,111 @@ class BaseCore(object):
         return True
 
     @exposed
-    def GetConfig(self, address):
+    @traced
+    def GetConfig(self, address, digest=None, delta=False):
         """ Build config for a client by calling
-        :func:`BuildConfiguration`.
+        :func:`BuildSerializedConfiguration`.
 
         :param address: Client (address, hostname) pair
         :type address: tuple
-        :returns: lxml.etree._Element - The full configuration
-                  document for the client
-        :raises: :exc:`xmlrpclib.Fault`
+        :param digest: The MD5 hex digest of the last configuration
+                       the client received, if it has kept it
+        :type digest: string
+        :param delta: Whether or not the client accepts a
+                      :mod:`Bcfg2.Delta` delta from the configuration
+                      with the given digest instead of the full
+                      configuration
+        :type delta: bool
+        :returns: string - The full configuration document for the
+                  client, a delta, or :attr:`NOT_MODIFIED` if it is
+                  the same as the one the client already has
+        :raises: :exc:`xmlrpclib.Fault`, :exc:`ServerBusy`
         """
         client = self.resolve_client(address)[0]
+        admitted = self.admission.acquire(client)
         try:
-            config = self.BuildConfiguration(client)
-            return lxml.etree.tostring(config,
-                                       xml_declaration=False).decode('UTF-8')
-        except Bcfg2.Server.Plugin.MetadataConsistencyError:
-            self.critical_error("Metadata consistency failure for %s" % client)
+            try:
+                return self._config_response(
+                    client, self.BuildSerializedConfiguration(client),
+                    digest, delta)
+            except Bcfg2.Server.Plugin.MetadataConsistencyError:
+                self.critical_error("Metadata consistency failure for %s" %
+                                    client)
+        finally:
+            self.admission.release(admitted)
+
+    def _config_response(self, client, config, digest, delta=False):
+        """ Get the response to a :func:`GetConfig` call.
+
+        :param client: The hostname of the client
+        :type client: string
+        :param config: The serialized configuration for the client
+        :type config: bytes
+        :param digest: The MD5 hex digest of the last configuration
+                       the client received, or None
+        :type digest: string
+        :param delta: Whether or not the client accepts a delta
+        :type delta: bool
+        :returns: string - The configuration, a delta, or
+                  :attr:`NOT_MODIFIED`
+        """
+        new_digest = config_digest(config)
+        if digest is not None and new_digest == digest:
+            self.logger.debug("Configuration for %s is unchanged" % client)
+            Bcfg2.Statistics.stats.add_value(
+                "%s:config_not_modified" % self.__class__.__name__,
+                len(config))
+            return NOT_MODIFIED
+        if self.config_history is None:
+            return config.decode('UTF-8')
+
+        history = self.config_history.get(client, ())
+        rv = None
+        if delta and digest is not None:
+            for old_digest, old_config in history:
+                if old_digest == digest:
+                    rv = self._config_delta(client, old_config, config)
+                    break
+        self.config_history[client] = \
+            (((new_digest, config), ) +
+             tuple([h for h in history
+                    if h[0] != new_digest])[:self.config_history_size - 1])
+        if rv is None:
+            return config.decode('UTF-8')
+        return rv.decode('UTF-8')
+
+    def _config_delta(self, client, old, new):
+        """ Build a delta between two configurations for a client
+        with :func:`Bcfg2.Delta.make_delta`.
+
+        :param client: The hostname of the client
+        :type client: string
+        :param old: The serialized configuration the client has
+        :type old: bytes
+        :param new: The serialized new configuration
+        :type new: bytes
+        :returns: bytes - The serialized delta, or None if no delta
+                  could be built or if it is no smaller than the new
+                  configuration
+        """
+        start = time.time()
+        try:
+            rv = make_delta(old, new)
+        except lxml.etree.XMLSyntaxError:
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to build configuration delta for %s: "
+                              "%s" % (client, err))
+            return None
+        if rv is None or len(rv) >= len(new):
+            return None
+        self.logger.debug("Sending configuration delta of %d bytes to %s "
+                          "instead of %d bytes" % (len(rv), client, len(new)))
+        Bcfg2.Statistics.stats.add_value(
+            "%s:config_delta" % self.__class__.__name__, time.time() - start)
+        return rv
 
     @exposed
+    @traced
     def RecvStats(self, address, stats):
         """ Act on statistics upload with :func:`process_statistics`.
 
@@ -1063,7 +1682,35 @@ class BaseCore(object):
         return self._database_available
 
     @exposed
-    def get_statistics(self, _):
+    def get_statistics(self, _, detailed=False):
         """ Get current statistics about component execution from
-        :attr:`Bcfg2.Statistics.stats`. """
+        :attr:`Bcfg2.Statistics.stats`.
+
+        :param detailed: Return percentiles and rates over the
+                         lifetime of each statistic and over recent
+                         time windows, as returned by
+                         :func:`Bcfg2.Statistics.Statistics.display_details`,
+                         instead of just the minimum, maximum,
+                         average, and count.
+        :type detailed: bool
+        :returns: dict
+        """
+        if detailed:
+            return Bcfg2.Statistics.stats.display_details()
         return Bcfg2.Statistics.stats.display()
+
+    @exposed
+    def get_traces(self, _, client=None):
+        """ Get the traces of recent and slow client runs recorded
+        by :attr:`Bcfg2.Statistics.tracer`.  See
+        :func:`Bcfg2.Statistics.Tracer.get_traces` for the format of
+        the return value.
+
+        :param client: Get the full traces of runs of the named
+                       client.  If this is not given, only a summary
+                       of each trace is returned.
+        :type client: string
+        :returns: dict
+        """
+        return Bcfg2.Statistics.tracer.get_traces(client=client,
+                                                  spans=client is not None)
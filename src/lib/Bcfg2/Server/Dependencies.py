@@ -0,0 +1,305 @@
+""" Module for tracking which files in the Bcfg2 repository each
+client's configuration was built from, so that a change to a file
+only invalidates the cached data that depends on it.
+
+While a client configuration is being built (see
+:func:`Bcfg2.Server.Core.BaseCore.BuildConfiguration`), plugins call
+:func:`DependencyGraph.record` with the paths of the files and
+directories they read.  Each path is recorded as a dependency of the
+entry currently being bound, or of the client as a whole if no entry
+is being bound (e.g., during structure generation).  When a file
+changes, the plugin that handles the change calls
+:func:`DependencyGraph.changed`, which notifies
+:attr:`DependencyGraph.listeners` of the entries and clients that
+must be rebuilt.
+
+Dependencies can only be tracked precisely for paths under a
+directory that has been declared with :func:`DependencyGraph.track`;
+the plugin that declares a directory promises to record every file
+under it that it reads during a build.  A change to any other path
+invalidates everything.
+
+The entries each client has are recorded as well, so that a change
+to which generator binds an entry -- which a client cannot have
+recorded a dependency on -- can be handled with
+:func:`DependencyGraph.entries_changed`. """
+
+import os
+import threading
+
+
+class DependencyGraph(object):
+    """ A graph of the dependencies between repository paths and the
+    client entries that were built from them. """
+
+    def __init__(self):
+        #: The set of directories under which all dependencies are
+        #: recorded.  See :func:`track`.
+        self.tracked = set()
+
+        #: A dict of ``<path> -> set of (<client>, <tag>, <name>)``.
+        #: ``<tag>`` and ``<name>`` are None for dependencies of a
+        #: client's configuration as a whole.
+        self.dependents = dict()
+
+        #: A list of callables that are called with the set of
+        #: ``(<client>, <tag>, <name>)`` tuples that have been
+        #: invalidated by a change, or with None if everything has
+        #: been invalidated.
+        self.listeners = []
+
+        # dict of <client> -> set of paths recorded for that client,
+        # used to forget stale dependencies when a client is rebuilt
+        self._client_paths = dict()
+
+        # dict of (<tag>, <name>) -> set of clients that have that
+        # entry, and of <client> -> set of (<tag>, <name>) entries the
+        # client has, used to invalidate entries whose generator has
+        # changed.  see entries_changed().
+        self._entry_clients = dict()
+        self._client_entries = dict()
+        self._lock = threading.Lock()
+
+        # the client and entry being built in the current thread, and
+        # whether or not changed() has been called in this thread
+        # since the last call to handled_event()
+        self._local = threading.local()
+
+    def track(self, path):
+        """ Declare that all dependencies on files under the given
+        directory will be recorded with :func:`record`, so that
+        changes to those files can be handled precisely.
+
+        :param path: The directory to track
+        :type path: string
+        :returns: None
+        """
+        self.tracked.add(os.path.normpath(path))
+
+    def is_tracked(self, path):
+        """ Determine if dependencies on the given path are tracked,
+        i.e., if it is in a directory declared with :func:`track`.
+
+        :param path: The path to check
+        :type path: string
+        :returns: bool
+        """
+        while True:
+            if path in self.tracked:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def start(self, client):
+        """ Start recording dependencies for a client in the current
+        thread.  Any dependencies previously recorded for the client
+        are forgotten.
+
+        :param client: The hostname of the client being built
+        :type client: string
+        :returns: None
+        """
+        self.forget(client)
+        self._local.client = client
+        self._local.entry = None
+
+    def finish(self):
+        """ Stop recording dependencies in the current thread.
+
+        :returns: None
+        """
+        self._local.client = None
+        self._local.entry = None
+
+    def set_entry(self, entry):
+        """ Set the entry that is currently being bound in this
+        thread.  Dependencies recorded afterwards are dependencies of
+        that entry.
+
+        :param entry: A tuple of ``(<tag>, <name>)``, or None to
+                      record subsequent dependencies for the client
+                      as a whole
+        :type entry: tuple
+        :returns: None
+        """
+        self._local.entry = entry
+        client = getattr(self._local, "client", None)
+        if client is None or entry is None:
+            return
+        self._lock.acquire()
+        try:
+            self._entry_clients.setdefault(entry, set()).add(client)
+            self._client_entries.setdefault(client, set()).add(entry)
+        finally:
+            self._lock.release()
+
+    def record(self, path):
+        """ Record that the entry currently being bound in this thread
+        (or the client as a whole) depends on the given path.  This
+        does nothing if no client is being built in this thread.
+
+        :param path: The file or directory that was read
+        :type path: string
+        :returns: None
+        """
+        client = getattr(self._local, "client", None)
+        if client is None:
+            return
+        entry = self._local.entry or (None, None)
+        path = os.path.normpath(path)
+        self._lock.acquire()
+        try:
+            self.dependents.setdefault(path, set()).add((client,) + entry)
+            self._client_paths.setdefault(client, set()).add(path)
+        finally:
+            self._lock.release()
+
+    def forget(self, client=None):
+        """ Forget all dependencies recorded for a client.
+
+        :param client: The hostname of the client, or None to forget
+                       all recorded dependencies
+        :type client: string
+        :returns: None
+        """
+        self._lock.acquire()
+        try:
+            if client is None:
+                self.dependents.clear()
+                self._client_paths.clear()
+                self._entry_clients.clear()
+                self._client_entries.clear()
+                return
+            for entry in self._client_entries.pop(client, []):
+                if entry in self._entry_clients:
+                    self._entry_clients[entry].discard(client)
+                    if not self._entry_clients[entry]:
+                        del self._entry_clients[entry]
+            for path in self._client_paths.pop(client, []):
+                if path in self.dependents:
+                    self.dependents[path] = \
+                        set(d for d in self.dependents[path]
+                            if d[0] != client)
+                    if not self.dependents[path]:
+                        del self.dependents[path]
+        finally:
+            self._lock.release()
+
+    def changed(self, path=None):
+        """ Handle a change to a file or directory.  If the path is
+        tracked, then everything that depends on it, on anything
+        below it, or on any directory above it is invalidated;
+        otherwise, everything is invalidated.
+
+        :param path: The path that changed, or None to invalidate
+                     everything (e.g., after a change to data that is
+                     not in the repository)
+        :type path: string
+        :returns: None
+        """
+        self._local.changed = True
+        if path is not None:
+            path = os.path.normpath(path)
+        if path is None or not self.is_tracked(path):
+            self.forget()
+            self._notify(None)
+            return
+
+        affected = set()
+        self._lock.acquire()
+        try:
+            if not os.path.isfile(path):
+                # a deleted directory does not produce events for the
+                # files that were in it, so look for dependencies on
+                # paths below it
+                prefix = os.path.join(path, "")
+                for key in list(self.dependents.keys()):
+                    if key.startswith(prefix):
+                        affected.update(self.dependents.pop(key))
+            while True:
+                affected.update(self.dependents.pop(path, []))
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+        finally:
+            self._lock.release()
+        if affected:
+            self._notify(affected)
+
+    def entries_changed(self, entries=None, tags=None):
+        """ Handle a change to the generators that handle some
+        entries, e.g., a new file that makes a generator handle an
+        entry that was previously handled by another generator, or
+        not at all.  Every client that has one of the entries is
+        invalidated, since the client may not have recorded a
+        dependency on the files that now determine how the entry is
+        bound.
+
+        :param entries: The ``(<tag>, <name>)`` tuples of the entries
+                        whose generators have changed
+        :type entries: iterable
+        :param tags: Entry tags for which all entries are invalidated,
+                     for generators whose changes cannot be tracked
+                     per entry
+        :type tags: iterable
+        :returns: None
+        """
+        if entries is None:
+            entries = []
+        if tags is None:
+            tags = []
+        tags = set(tags)
+        affected = set()
+        self._lock.acquire()
+        try:
+            keys = set(entries)
+            if tags:
+                keys.update(e for e in self._entry_clients if e[0] in tags)
+            for entry in keys:
+                for client in self._entry_clients.pop(entry, []):
+                    affected.add((client,) + tuple(entry))
+                    self._client_entries[client].discard(entry)
+        finally:
+            self._lock.release()
+        if affected:
+            self._notify(affected)
+
+    def unchanged(self):
+        """ Note that a file monitor event has been handled without
+        changing any data, so that :func:`handled_event` does not
+        invalidate everything.
+
+        :returns: None
+        """
+        self._local.changed = True
+
+    def handled_event(self, event):  # pylint: disable=W0613
+        """ Check that a file monitor event has been handled in a way
+        that accounts for dependencies, i.e., that :func:`changed` was
+        called while it was handled.  If not, everything is
+        invalidated, since it is impossible to tell what the event
+        affected.  This is suitable for use as a
+        :attr:`Bcfg2.Server.FileMonitor.FileMonitor.listeners`
+        callback.
+
+        :param event: The event that was handled
+        :type event: Bcfg2.Server.FileMonitor.Event
+        :returns: None
+        """
+        if not getattr(self._local, "changed", False):
+            self.changed(None)
+        self._local.changed = False
+
+    def _notify(self, affected):
+        """ Call all :attr:`listeners` with the given set of
+        invalidated dependents. """
+        for listener in self.listeners:
+            listener(affected)
+
+
+#: A module-level :class:`DependencyGraph` object used to track the
+#: dependencies of all client configurations.
+graph = DependencyGraph()  # pylint: disable=C0103
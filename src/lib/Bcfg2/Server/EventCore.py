@@ -0,0 +1,744 @@
+""" The event-driven Bcfg2 server core.  This is like the builtin core
+(:mod:`Bcfg2.Server.BuiltinCore`), but instead of starting a new
+thread for every connection, a single thread runs an event loop that
+accepts connections, performs the SSL handshake, reads requests and
+writes responses for all clients, using ``epoll``, ``poll``, or
+``select``, whichever is available.  Complete requests are put on a
+bounded queue and dispatched by a fixed-size pool of worker threads,
+so the number of threads does not grow with the number of clients,
+and worker threads never wait on slow clients.
+
+If the request queue is full, new requests are refused with an HTTP
+503 error, which clients retry after a short delay.
+
+The number of worker threads and the size of the request queue are
+set with the ``workers`` and ``request_queue`` options in the
+``[server]`` section of ``bcfg2.conf``.
+
+The depth of the request queue, the time requests spend waiting in
+it, and the fraction of worker threads that are busy are reported by
+:func:`Bcfg2.Server.Core.BaseCore.get_statistics` as
+``EventServer:queue_depth``, ``EventServer:queue_wait``, and
+``EventServer:worker_utilization``, respectively. """
+
+import os
+import sys
+import ssl
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import threading
+from collections import deque
+import Bcfg2.Statistics
+from Bcfg2.Compat import Queue, Full, httplib, b64decode, formatdate
+from Bcfg2.SSLServer import XMLRPCServer, CONTENT_ENCODINGS, \
+    RequestParser, RequestTooLarge
+from Bcfg2.Server.BuiltinCore import Core as BuiltinCore
+
+#: The maximum size of the request line and headers of a request
+MAX_HEADER_SIZE = 64 * 1024
+
+#: The amount of data to read from or write to a socket at once
+CHUNK_SIZE = 64 * 1024
+
+# errors that indicate that a non-blocking operation would block
+_WOULDBLOCK = [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]
+
+
+class Poller(object):
+    """ A minimal wrapper around :func:`select.epoll`,
+    :func:`select.poll`, or :func:`select.select`, whichever is
+    available. """
+
+    def __init__(self):
+        # dict of <file descriptor> -> <whether or not to poll for
+        # writability instead of readability>
+        self.fds = dict()
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._scale = 1
+        elif hasattr(select, "poll"):
+            self._poller = select.poll()
+            self._scale = 1000
+        else:
+            self._poller = None
+
+    def set(self, fd, write=False):
+        """ Start polling a file descriptor, or change the events
+        polled for.
+
+        :param fd: The file descriptor
+        :type fd: int
+        :param write: Poll for writability instead of readability
+        :type write: bool
+        """
+        if fd in self.fds:
+            if self.fds[fd] == write:
+                return
+            method = "modify"
+        else:
+            method = "register"
+        self.fds[fd] = write
+        if self._poller is not None:
+            if write:
+                mask = select.POLLOUT
+            else:
+                mask = select.POLLIN
+            getattr(self._poller, method)(fd, mask)
+
+    def remove(self, fd):
+        """ Stop polling a file descriptor.
+
+        :param fd: The file descriptor
+        :type fd: int
+        """
+        if fd in self.fds:
+            del self.fds[fd]
+            if self._poller is not None:
+                self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        """ Wait for events.
+
+        :param timeout: The maximum number of seconds to wait
+        :type timeout: float
+        :returns: list of file descriptors that are ready, or that
+                  have encountered an error
+        """
+        try:
+            if self._poller is not None:
+                return [e[0]
+                        for e in self._poller.poll(timeout * self._scale)]
+            rlist = [fd for fd, write in self.fds.items() if not write]
+            wlist = [fd for fd, write in self.fds.items() if write]
+            ready = select.select(rlist, wlist, [], timeout)
+            return ready[0] + ready[1]
+        except (select.error, IOError, OSError):
+            if sys.exc_info()[1].args[0] == errno.EINTR:
+                # interrupted by a signal
+                return []
+            raise
+
+    def close(self):
+        """ Release the resources used by the poller. """
+        if hasattr(self._poller, "close"):
+            self._poller.close()
+
+
+class Connection(object):
+    """ A client connection handled by :class:`EventXMLRPCServer`.
+    Each connection moves through the states ``handshake``, ``read``,
+    ``dispatch`` (while a worker thread handles the request), and
+    ``write``.  If the client asked for the connection to be kept
+    alive, it then returns to ``read`` for the next request;
+    otherwise, it is ``closed``. """
+
+    def __init__(self, sock, address, max_length=0):
+        """
+        :param sock: The non-blocking SSL socket of the connection,
+                     whose handshake has not yet been done
+        :type sock: ssl.SSLSocket
+        :param address: The address of the client
+        :type address: tuple
+        :param max_length: The maximum ``Content-Length`` of a
+                           request, or 0 for no limit
+        :type max_length: int
+        """
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.max_length = max_length
+        self.state = "handshake"
+
+        #: Whether or not the connection is waiting for its socket to
+        #: become writable, rather than readable
+        self.want_write = False
+
+        #: The time of the last I/O on the connection
+        self.last_active = time.time()
+
+        #: The certificate presented by the client, if any
+        self.cert = None
+
+        #: The HTTP method of the request
+        self.method = None
+
+        #: A dict of the request headers, with lowercased names, or
+        #: None if they have not all been read yet
+        self.headers = None
+
+        #: The body of the request, as a list of the chunks in which
+        #: it was received
+        self.body = None
+
+        #: Whether or not to keep the connection open after the
+        #: response to the current request has been sent
+        self.keep_alive = False
+
+        self._inbuf = []
+        self._inlen = 0
+        self._length = 0
+        self._outbuf = None
+        self._outpos = 0
+
+    def handle_io(self):
+        """ Make as much progress as possible on the connection
+        without blocking. """
+        self.last_active = time.time()
+        try:
+            if self.state == "handshake":
+                self._handshake()
+            if self.state == "read":
+                self._read()
+            if self.state == "write":
+                self._write()
+        except (ssl.SSLError, socket.error):
+            err = sys.exc_info()[1]
+            if (self.state == "read" and self.headers is None and
+                not self._inlen):
+                # the client closed a persistent connection without
+                # saying so (e.g., because it exited) instead of
+                # sending another request
+                log = EventXMLRPCServer.logger.debug
+            else:
+                log = EventXMLRPCServer.logger.warning
+            log("Error handling client %s: %s" % (self.address[0], err))
+            self.close()
+
+    def _would_block(self, err):
+        """ Determine if an exception raised by a non-blocking socket
+        operation means that the operation must be retried once the
+        socket is ready, and set :attr:`want_write` accordingly. """
+        if isinstance(err, ssl.SSLError):
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.want_write = False
+                return True
+            elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.want_write = True
+                return True
+            return False
+        return err.args[0] in _WOULDBLOCK
+
+    def _handshake(self):
+        """ Perform the SSL handshake """
+        try:
+            self.sock.do_handshake()
+        except (ssl.SSLError, socket.error):
+            if self._would_block(sys.exc_info()[1]):
+                return
+            raise
+        self.cert = self.sock.getpeercert()
+        self.want_write = False
+        self.state = "read"
+
+    def _read(self):
+        """ Read as much of the request as is available """
+        while self.state == "read":
+            try:
+                data = self.sock.recv(CHUNK_SIZE)
+            except (ssl.SSLError, socket.error):
+                if self._would_block(sys.exc_info()[1]):
+                    return
+                raise
+            if not data:
+                # the client closed the connection
+                self.close()
+                return
+            self._received(data)
+
+    def _received(self, data):
+        """ Add data to the request that has been read, and parse it
+        if enough of it has been read """
+        self._inbuf.append(data)
+        self._inlen += len(data)
+        self._parse()
+
+    def _parse(self):
+        """ Parse as much of the request as has been read """
+        if self.headers is None:
+            buf = "".encode("latin-1").join(self._inbuf)
+            end = buf.find("\r\n\r\n".encode("latin-1"))
+            if end < 0:
+                self._inbuf = [buf]
+                if len(buf) > MAX_HEADER_SIZE:
+                    self.respond(400)
+                return
+            if not self._parse_headers(buf[:end].decode("latin-1")):
+                return
+            self._inbuf = [buf[end + 4:]]
+            self._inlen = len(self._inbuf[0])
+        if self._inlen >= self._length:
+            # split off anything read beyond the end of the body
+            # without joining the chunks of the body together
+            extra = self._inlen - self._length
+            self.body = self._inbuf
+            if extra:
+                last = self.body[-1]
+                self.body[-1] = last[:len(last) - extra]
+                self._inbuf = [last[len(last) - extra:]]
+            else:
+                self._inbuf = []
+            self._inlen = extra
+            self.state = "dispatch"
+
+    def _parse_headers(self, data):
+        """ Parse the request line and headers of the request.
+
+        :returns: bool - Whether or not the request is valid
+        """
+        lines = data.split("\r\n")
+        words = lines[0].split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            self.respond(400)
+            return False
+        self.method = words[0]
+        self.headers = dict()
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                self.headers[name.strip().lower()] = value.strip()
+        connection = self.headers.get("connection", "").lower()
+        if words[2] == "HTTP/1.0":
+            self.keep_alive = connection == "keep-alive"
+        else:
+            self.keep_alive = connection != "close"
+        if self.method != "POST":
+            self.respond(501)
+            return False
+        try:
+            self._length = int(self.headers["content-length"])
+        except (KeyError, ValueError):
+            self.respond(411)
+            return False
+        if self.max_length and self._length > self.max_length:
+            EventXMLRPCServer.logger.error(
+                "Request from %s is larger than %s bytes" %
+                (self.address[0], self.max_length))
+            self.respond(413)
+            return False
+        return True
+
+    def respond(self, code, body=None, content_type="text/html",
+                content_encoding=None):
+        """ Start sending a response to the client.  This is only
+        safe to call from the event loop thread; worker threads use
+        :func:`EventXMLRPCServer.complete`.
+
+        :param code: The HTTP status code
+        :type code: int
+        :param body: The body of the response.  If this is None, a
+                     short HTML error message is sent.
+        :type body: bytes
+        :param content_type: The MIME type of the body
+        :type content_type: string
+        :param content_encoding: The encoding the body has been
+                                 compressed with, if any
+        :type content_encoding: string
+
+        The connection is only kept alive after successful responses.
+        """
+        message = httplib.responses.get(code, "")
+        if body is None:
+            body = ("<html><body><h1>%d %s</h1></body></html>" %
+                    (code, message)).encode("utf-8")
+        if code != 200:
+            self.keep_alive = False
+        if self.keep_alive:
+            connection = "keep-alive"
+        else:
+            connection = "close"
+        headers = ["HTTP/1.1 %d %s" % (code, message),
+                   "Server: Bcfg2",
+                   "Date: %s" % formatdate(usegmt=True),
+                   "Content-Type: %s" % content_type,
+                   "Content-Length: %d" % len(body),
+                   "Connection: %s" % connection,
+                   "Accept-Encoding: %s" %
+                   ", ".join(CONTENT_ENCODINGS.keys())]
+        if content_encoding:
+            headers.append("Content-Encoding: %s" % content_encoding)
+        headers.extend(["", ""])
+        self._outbuf = "\r\n".join(headers).encode("latin-1") + body
+        self._outpos = 0
+        self.want_write = True
+        self.state = "write"
+
+    def _write(self):
+        """ Write as much of the response as possible """
+        while self._outpos < len(self._outbuf):
+            # an SSL write that would block must be retried with the
+            # same data, so always write the same chunk from a given
+            # position
+            chunk = self._outbuf[self._outpos:self._outpos + CHUNK_SIZE]
+            try:
+                self._outpos += self.sock.send(chunk)
+            except (ssl.SSLError, socket.error):
+                if self._would_block(sys.exc_info()[1]):
+                    return
+                raise
+        if self.keep_alive:
+            self._reset()
+        else:
+            self.close()
+
+    def _reset(self):
+        """ Get ready to read the next request on a persistent
+        connection """
+        self.method = None
+        self.headers = None
+        self.body = None
+        self.keep_alive = False
+        self._length = 0
+        self._outbuf = None
+        self._outpos = 0
+        self.want_write = False
+        self.state = "read"
+        if self._inlen:
+            self._parse()
+
+    def close(self):
+        """ Close the connection """
+        self.state = "closed"
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class EventXMLRPCServer(XMLRPCServer):
+    """ An XML-RPC server that handles all connections in a single
+    event loop and dispatches requests to a fixed-size pool of worker
+    threads. """
+
+    #: The size of the listen backlog
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, listen_all, server_address, workers=8,
+                 queue_size=1024, idle_timeout=30, **kwargs):
+        """
+        :param listen_all: Listen on all interfaces
+        :type listen_all: bool
+        :param server_address: Address to bind to the server
+        :param workers: The number of worker threads to start
+        :type workers: int
+        :param queue_size: The maximum number of requests waiting
+                           for a worker thread
+        :type queue_size: int
+        :param idle_timeout: The number of seconds after which a
+                             connection on which no I/O has happened
+                             is closed
+        :type idle_timeout: int
+
+        All other keyword arguments are passed to
+        :class:`Bcfg2.SSLServer.XMLRPCServer`.
+        """
+        XMLRPCServer.__init__(self, listen_all, server_address, **kwargs)
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+
+        #: The queue of requests waiting for a worker thread, as
+        #: tuples of ``(<connection>, <time queued>)``
+        self.requests = Queue(queue_size)
+
+        #: A dict of <file descriptor> -> :class:`Connection` for
+        #: all open connections
+        self.connections = dict()
+
+        self._poller = None
+        self._threads = []
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+
+        # responses that have been built by worker threads and that
+        # the event loop must start sending, as tuples of
+        # (<connection>, <HTTP status code>, <body>, <content encoding>)
+        self._completed = deque()
+
+        # a pipe that worker threads write to to wake up the event
+        # loop when they have completed a request
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in [self._wake_read, self._wake_write]:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def serve_forever(self):
+        """ Run the event loop until :func:`shutdown` is called. """
+        self.serve = True
+        self.task_thread = threading.Thread(target=self._tasks_thread)
+        self.task_thread.start()
+        for i in range(self.workers):
+            thread = threading.Thread(name="Worker-%s" % i,
+                                      target=self._worker)
+            thread.start()
+            self._threads.append(thread)
+        self.logger.info("serve_forever() [start]")
+        signal.signal(signal.SIGINT, self._handle_shutdown_signal)
+        signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
+
+        self.socket.setblocking(0)
+        self._poller = Poller()
+        self._poller.set(self.socket.fileno())
+        self._poller.set(self._wake_read)
+        last_sample = time.time()
+        try:
+            while self.serve:
+                try:
+                    self._loop()
+                except:  # pylint: disable=W0702
+                    self.logger.error("Got unexpected error in event loop",
+                                      exc_info=1)
+                now = time.time()
+                if now - last_sample >= 1:
+                    self._sample()
+                    self._expire(now)
+                    last_sample = now
+        finally:
+            self.logger.info("serve_forever() [stop]")
+            for _ in self._threads:
+                self.requests.put(None)
+            for thread in self._threads:
+                thread.join()
+            for conn in list(self.connections.values()):
+                conn.close()
+            self.connections.clear()
+            self._poller.close()
+
+    def _loop(self):
+        """ Run a single iteration of the event loop """
+        for fd in self._poller.poll(self.timeout):
+            if fd == self.socket.fileno():
+                self._accept()
+            elif fd == self._wake_read:
+                try:
+                    while os.read(self._wake_read, 4096):
+                        pass
+                except OSError:
+                    pass
+            elif fd in self.connections:
+                conn = self.connections[fd]
+                conn.handle_io()
+                self._update(conn)
+        while self._completed:
+            conn, code, body, encoding = self._completed.popleft()
+            if code == 200:
+                conn.respond(code, body, content_type="text/xml",
+                             content_encoding=encoding)
+            else:
+                conn.respond(code)
+            conn.handle_io()
+            self._update(conn)
+
+    def _accept(self):
+        """ Accept all pending connections """
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error:
+                err = sys.exc_info()[1]
+                if err.args[0] not in _WOULDBLOCK:
+                    self.logger.error("Failed to accept connection: %s" % err)
+                return
+            sock.setblocking(0)
+            try:
+                sslsock = ssl.wrap_socket(sock,
+                                          server_side=True,
+                                          certfile=self.certfile,
+                                          keyfile=self.keyfile,
+                                          cert_reqs=self.mode,
+                                          ca_certs=self.ca,
+                                          ssl_version=self.ssl_protocol,
+                                          do_handshake_on_connect=False)
+            except (ssl.SSLError, socket.error):
+                err = sys.exc_info()[1]
+                self.logger.warning("Failed to set up SSL for %s: %s" %
+                                    (address[0], err))
+                sock.close()
+                continue
+            conn = Connection(sslsock, address,
+                              max_length=self.max_request_size)
+            self.connections[conn.fd] = conn
+            self._update(conn)
+
+    def _update(self, conn):
+        """ Update the events polled for on a connection, and hand it
+        to the worker threads if a request has been read from it. """
+        if conn.state == "dispatch":
+            self._poller.remove(conn.fd)
+            try:
+                self.requests.put_nowait((conn, time.time()))
+            except Full:
+                self.logger.warning("Request queue full, refusing request "
+                                    "from %s" % conn.address[0])
+                conn.respond(503)
+                conn.handle_io()
+        if conn.state == "closed":
+            self._poller.remove(conn.fd)
+            del self.connections[conn.fd]
+        elif conn.state != "dispatch":
+            self._poller.set(conn.fd, conn.want_write)
+
+    def _expire(self, now):
+        """ Close connections that have been idle for too long """
+        for conn in list(self.connections.values()):
+            if (conn.state != "dispatch" and
+                now - conn.last_active > self.idle_timeout):
+                self.logger.debug("Closing idle connection from %s" %
+                                  conn.address[0])
+                conn.close()
+                self._update(conn)
+
+    def _sample(self):
+        """ Record the depth of the request queue and the utilization
+        of the worker threads """
+        Bcfg2.Statistics.stats.add_value("EventServer:queue_depth",
+                                         self.requests.qsize())
+        Bcfg2.Statistics.stats.add_value("EventServer:worker_utilization",
+                                         float(self._busy) / self.workers)
+
+    def _worker(self):
+        """ The main loop of a worker thread """
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            conn, queued = item
+            Bcfg2.Statistics.stats.add_value("EventServer:queue_wait",
+                                             time.time() - queued)
+            self._busy_lock.acquire()
+            self._busy += 1
+            self._busy_lock.release()
+            try:
+                self.complete(conn, *self._handle(conn))
+            finally:
+                self._busy_lock.acquire()
+                self._busy -= 1
+                self._busy_lock.release()
+
+    def _handle(self, conn):
+        """ Authenticate and dispatch a request.
+
+        :returns: tuple of ``(<HTTP status code>, <body>, <content
+                  encoding>)``
+        """
+        try:
+            if not self._authenticate(conn):
+                self.logger.error("Authentication Failure")
+                return (401, None, None)
+        except:  # pylint: disable=W0702
+            self.logger.error("Unexpected Authentication Failure", exc_info=1)
+            return (401, None, None)
+        try:
+            parser = RequestParser(conn.headers.get("content-encoding"),
+                                   max_size=self.max_request_size)
+        except ValueError:
+            err = sys.exc_info()[1]
+            self.logger.error("Rejecting request from %s: %s" %
+                              (conn.address[0], err))
+            return (415, None, None)
+        try:
+            for chunk in conn.body:
+                parser.feed(chunk)
+            params, method = parser.close()
+        except RequestTooLarge:
+            err = sys.exc_info()[1]
+            self.logger.error("Rejecting request from %s: %s" %
+                              (conn.address[0], err))
+            return (413, None, None)
+        except:  # pylint: disable=W0702
+            self.logger.error("Failed to parse request from %s" %
+                              conn.address[0], exc_info=1)
+            return (400, None, None)
+        conn.body = None
+        try:
+            response = self._unmarshaled_dispatch(conn.address, params,
+                                                  method)
+            if sys.hexversion >= 0x03000000:
+                response = response.encode('utf-8')
+            encoding = self.get_encoding(conn.headers.get("accept-encoding"),
+                                         response)
+            if encoding is not None:
+                response = self.compress(response, encoding)
+            return (200, response, encoding)
+        except:  # pylint: disable=W0702
+            self.logger.error("Unexpected error dispatching request from %s"
+                              % conn.address[0], exc_info=1)
+            return (500, None, None)
+
+    def _authenticate(self, conn):
+        """ Check the HTTP authentication and certificate of a
+        request """
+        try:
+            header = conn.headers['authorization']
+        except KeyError:
+            self.logger.error("No authentication data presented")
+            return False
+        auth_content = b64decode(header.split()[1])
+        if not isinstance(auth_content, str):
+            auth_content = auth_content.decode('utf-8')
+        try:
+            username, password = auth_content.split(":", 1)
+        except ValueError:
+            username = auth_content
+            password = ""
+        return self.instance.authenticate(conn.cert, username, password,
+                                          conn.address)
+
+    def complete(self, conn, code, body=None, encoding=None):
+        """ Hand a response back to the event loop to be sent.  This
+        is safe to call from any thread.
+
+        :param conn: The connection to respond on
+        :type conn: Bcfg2.Server.EventCore.Connection
+        :param code: The HTTP status code
+        :type code: int
+        :param body: The XML-RPC response, if ``code`` is 200
+        :type body: bytes
+        :param encoding: The encoding the response has been
+                         compressed with, if any
+        :type encoding: string
+        """
+        self._completed.append((conn, code, body, encoding))
+        try:
+            os.write(self._wake_write, "x".encode("latin-1"))
+        except OSError:
+            # the pipe is full, so the event loop will wake up anyway
+            pass
+
+    def server_close(self):
+        XMLRPCServer.server_close(self)
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+
+class Core(BuiltinCore):
+    """ The event-driven server core """
+
+    def __init__(self, setup):
+        BuiltinCore.__init__(self, setup)
+
+        #: The number of worker threads that dispatch requests
+        self.workers = int(setup.cfp.get("server", "workers", default="8"))
+
+        #: The maximum number of requests waiting for a worker thread
+        self.request_queue = int(setup.cfp.get("server", "request_queue",
+                                               default="1024"))
+    __init__.__doc__ = BuiltinCore.__init__.__doc__
+
+    def _create_server(self, server_address):
+        return EventXMLRPCServer(self.setup['listen_all'],
+                                 server_address,
+                                 workers=self.workers,
+                                 queue_size=self.request_queue,
+                                 keyfile=self.setup['key'],
+                                 certfile=self.setup['cert'],
+                                 register=False,
+                                 timeout=1,
+                                 ca=self.setup['ca'],
+                                 protocol=self.setup['protocol'],
+                                 compression_level=self.compression_level,
+                                 compression_cache=self.compression_cache,
+                                 max_request_size=self.max_request_size)
+    _create_server.__doc__ = BuiltinCore._create_server.__doc__
@@ -94,11 +94,7 @@ class Fam(FileMonitor):
                     collapsed += 1
         for event in unique:
             if event.requestID in self.users:
-                try:
-                    self.users[event.requestID].HandleEvent(event)
-                except:  # pylint: disable=W0702
-                    LOGGER.error("Handling event for file %s" % event.filename,
-                                 exc_info=1)
+                self.dispatch_event(self.users[event.requestID], event)
         end = time()
         LOGGER.info("Processed %s fam events in %03.03f seconds. "
                     "%s coalesced" % (count, (end - start), collapsed))
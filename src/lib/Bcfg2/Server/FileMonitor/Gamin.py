@@ -77,6 +77,10 @@ class Gamin(FileMonitor):
             handle = self.counter
             self.counter += 1
 
+        if self.relayed:
+            self.handles[handle] = obj
+            return handle
+
         if not self.started:
             self.add_q.append((path, obj, handle))
             return handle
@@ -148,6 +148,10 @@ class Inotify(Pseudo, pyinotify.ProcessEvent):
         # strip trailing slashes
         path = path.rstrip("/")
 
+        if self.relayed:
+            self.handles[path] = obj
+            return path
+
         if not self.started:
             self.add_q.append((path, obj))
             return path
@@ -17,6 +17,9 @@ class Pseudo(FileMonitor):
     def AddMonitor(self, path, obj, handleID=None):
         if handleID is None:
             handleID = len(list(self.handles.keys()))
+        if self.relayed:
+            self.handles[handleID] = obj
+            return handleID
         self.events.append(Event(handleID, path, 'exists'))
         if os.path.isdir(path):
             dirlist = os.listdir(path)
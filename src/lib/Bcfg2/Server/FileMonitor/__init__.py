@@ -149,6 +149,29 @@ class FileMonitor(object):
         #: Whether or not the FAM has been started.  See :func:`start`.
         self.started = False
 
+        #: A counter that is incremented every time an event has been
+        #: handled.  Consumers can record the generation before
+        #: reading data that is maintained by FAM event handlers and
+        #: compare it later to determine whether or not that data may
+        #: have changed in the meantime.
+        self.generation = 0
+
+        #: A list of callables that are each called with every event
+        #: after it has been handled.  This can be used, for
+        #: instance, to relay events to other processes that share
+        #: the same data.
+        self.listeners = []
+
+        #: If ``relayed`` is True, this file monitor does not monitor
+        #: any paths itself; instead, events are relayed to it from
+        #: another file monitor and handled with
+        #: :func:`handle_one_event`.  Adding a monitor only
+        #: registers the object that will handle events on the path,
+        #: under the same handle ID that the monitor would have had
+        #: otherwise.  This is used by
+        #: :class:`Bcfg2.Server.MultiprocessingCore.Core`.
+        self.relayed = False
+
     def __str__(self):
         return "%s: %s" % (__name__, self.__class__.__name__)
 
@@ -232,15 +255,35 @@ class FileMonitor(object):
             LOGGER.info("Got event for unexpected id %s, file %s" %
                         (event.requestID, event.filename))
             return
+        self.dispatch_event(self.handles[event.requestID], event)
+
+    def dispatch_event(self, obj, event):
+        """ Dispatch an event to the object that handles it, then
+        increment :attr:`generation` and call all :attr:`listeners`.
+        Backends that look up the handling object themselves, rather
+        than using :func:`handle_one_event`, must dispatch events
+        with this method.
+
+        :param obj: The object that handles the event
+        :type obj: object
+        :param event: The event to handle.
+        :type event: Bcfg2.Server.FileMonitor.Event
+        :returns: None
+        """
         self.debug_log("Dispatching event %s %s to obj %s" %
-                       (event.code2str(), event.filename,
-                        self.handles[event.requestID]))
+                       (event.code2str(), event.filename, obj))
         try:
-            self.handles[event.requestID].HandleEvent(event)
+            obj.HandleEvent(event)
         except:  # pylint: disable=W0702
             err = sys.exc_info()[1]
             LOGGER.error("Error in handling of event %s for %s: %s" %
                          (event.code2str(), event.filename, err))
+        # increment the generation only after the event has been
+        # handled, so that anything built from data that was in the
+        # middle of being updated is considered stale
+        self.generation += 1
+        for listener in self.listeners:
+            listener(event)
 
     def handle_event_set(self, lock=None):
         """ Handle all pending events.
@@ -0,0 +1,433 @@
+""" The multiprocessing server core is a reimplementation of the
+:mod:`Bcfg2.Server.BuiltinCore` that uses the Python
+:mod:`multiprocessing` library to offload work to multiple child
+processes.  As such, it requires Python 2.6+.
+
+The parent process loads the Bcfg2 repository and then forks a number
+of build worker processes, which share the parsed repository data
+with the parent copy-on-write.  The parent handles all XML-RPC
+requests itself, except for :func:`GetConfig` and :func:`GetProbes`,
+which are handed off to an idle child.
+
+Children do not monitor any files themselves.  Instead, every file
+monitor event that the parent handles is relayed to each child, in
+order, and handled there as well, so that the children stay in sync
+with the parent.  Probe data received by the parent is sent to each
+child along with the client's new groups, so the children do not have
+to reload it from ``probed.xml`` or the database.  Plugin XML-RPC
+calls listed in a plugin's
+:attr:`Bcfg2.Server.Plugin.base.Plugin.__child_rmi__` are also run in
+each child.
+
+A few caveats apply:
+
+* The ``fam`` file monitor cannot be used, since the handle IDs it
+  produces cannot be predicted by the children.
+* Changes to ``bcfg2.conf`` that require a server restart under the
+  builtin core also require a restart under the multiprocessing core.
+* Statistics reported by :func:`Bcfg2.Server.Core.BaseCore.get_statistics`
+  only include the work done in the parent process, plus the total
+  time spent on each XML-RPC call.  Traces of client runs do include
+  the work done in the children.
+"""
+
+import sys
+import signal
+import threading
+import multiprocessing
+import Bcfg2.Statistics
+import Bcfg2.Server.Plugin
+from Bcfg2.Compat import xmlrpclib, Queue, Empty
+from Bcfg2.Server.Core import exposed, traced, CoreInitError
+from Bcfg2.Server.BuiltinCore import Core as BuiltinCore
+
+
+class ChildProcess(object):
+    """ The parent process's handle on a single build worker
+    process.  Messages are sent to the child by a dedicated thread, so
+    that sending a message (e.g., relaying a file monitor event) never
+    blocks on a busy child. """
+
+    def __init__(self, name, target):
+        """
+        :param name: The name of the child process
+        :type name: string
+        :param target: The function to run in the child process.  It
+                       will be called with two arguments: the
+                       :class:`multiprocessing.Connection` from which
+                       messages from the parent are read, and the
+                       connection to which replies are written.
+        :type target: callable
+        """
+        self.name = name
+
+        child_reader, self.writer = multiprocessing.Pipe(False)
+        self.reader, child_writer = multiprocessing.Pipe(False)
+
+        #: The :class:`multiprocessing.Process` object for this child
+        self.process = multiprocessing.Process(target=target,
+                                               args=(child_reader,
+                                                     child_writer),
+                                               name=name)
+        self.process.daemon = True
+        self.process.start()
+
+        # close our copies of the child's ends of the pipes so that
+        # we notice if the child dies
+        child_reader.close()
+        child_writer.close()
+
+        #: Whether or not the child is believed to be alive
+        self.alive = True
+
+        #: Queue of messages waiting to be sent to the child
+        self.queue = Queue()
+
+        #: The thread that sends messages from :attr:`queue` to the
+        #: child.  It is not started until :func:`start` is called.
+        self.sender = threading.Thread(name="%sSender" % name,
+                                       target=self._send_messages)
+        self.sender.daemon = True
+
+    def start(self):
+        """ Start the thread that sends messages to the child """
+        self.sender.start()
+
+    def _send_messages(self):
+        """ Send messages from :attr:`queue` to the child until
+        ``None`` is received or the child dies. """
+        while True:
+            msg = self.queue.get()
+            if msg is None:
+                break
+            try:
+                self.writer.send(msg)
+            except (IOError, OSError, EOFError):
+                self.alive = False
+                break
+
+    def send(self, msg):
+        """ Queue a message to be sent to the child.
+
+        :param msg: The message to send
+        :type msg: tuple
+        """
+        if self.alive:
+            self.queue.put(msg)
+
+    def call(self, *args):
+        """ Ask the child to do some work and wait for the result.
+
+        :param args: The arguments to pass to
+                     :func:`Bcfg2.Server.MultiprocessingCore.Core._build`
+                     in the child
+        :returns: tuple - The return value of
+                  :func:`Bcfg2.Server.MultiprocessingCore.Core._build`
+        :raises: :exc:`EOFError` or :exc:`IOError` if the child has
+                 died
+        """
+        self.send(("call", ) + args)
+        try:
+            return self.reader.recv()
+        except:
+            self.alive = False
+            raise
+
+    def close(self):
+        """ Close the parent's ends of the pipes to the child """
+        self.writer.close()
+        self.reader.close()
+
+    def shutdown(self):
+        """ Ask the child to exit, and stop the sender thread """
+        self.send(("shutdown", ))
+        self.queue.put(None)
+
+
+class Core(BuiltinCore):
+    """ A multiprocessing server core that builds client
+    configurations and probes in a pool of child processes. """
+    name = 'bcfg2-server'
+
+    #: How long, in seconds, to wait for children to exit on
+    #: shutdown before terminating them
+    shutdown_timeout = 10.0
+
+    def __init__(self, setup):
+        BuiltinCore.__init__(self, setup)
+        if setup['children'] is None:
+            setup['children'] = multiprocessing.cpu_count()
+        if setup['children'] < 1:
+            raise CoreInitError("At least one child process is required "
+                                "by the multiprocessing server core")
+        if self.fam.__class__.__name__ == 'Fam':
+            raise CoreInitError("The fam file monitor cannot be used with "
+                                "the multiprocessing server core")
+
+        #: A list of :class:`ChildProcess` objects, one for each build
+        #: worker process
+        self.children = []
+
+        #: A :class:`Queue.Queue` of :class:`ChildProcess` objects
+        #: that are not currently doing any work
+        self.available_children = Queue()
+
+        #: A dict of plugin XML-RPC method names that should also be
+        #: called in each child, and the names of the methods to call
+        #: there.  See
+        #: :attr:`Bcfg2.Server.Plugin.base.Plugin.__child_rmi__`.
+        self.child_rmi = dict()
+    __init__.__doc__ = BuiltinCore.__init__.__doc__.split('.. -----')[0]
+
+    def _run(self):
+        """ Load the repository, fork the children, and create
+        :attr:`server` to start the server listening. """
+        if not BuiltinCore._run(self):
+            return False
+
+        # handle the initial flood of events before forking, so that
+        # the parsed repository is shared with the children
+        self.fam.start()
+        self.fam.handle_events_in_interval(1)
+
+        for pname, pinst in self.plugins.items():
+            for crmi in pinst.__child_rmi__:
+                if isinstance(crmi, tuple):
+                    mname, cname = crmi
+                else:
+                    mname = cname = crmi
+                self.child_rmi["%s.%s" % (pname, mname)] = \
+                    "%s.%s" % (pname, cname)
+
+        for i in range(self.setup['children']):
+            self.children.append(ChildProcess("Child-%s" % i,
+                                              self._child_main))
+        for child in self.children:
+            child.start()
+            self.available_children.put(child)
+        self.fam.listeners.append(self._relay_event)
+        self.logger.info("Started %s build worker processes" %
+                         len(self.children))
+        return True
+
+    def shutdown(self):
+        BuiltinCore.shutdown(self)
+        for child in self.children:
+            child.shutdown()
+        for child in self.children:
+            child.process.join(self.shutdown_timeout)
+            if child.process.is_alive():
+                self.logger.error("%s did not exit, terminating" %
+                                  child.name)
+                child.process.terminate()
+    shutdown.__doc__ = BuiltinCore.shutdown.__doc__
+
+    def _dispatch(self, method, args, dispatch_dict):
+        rv = BuiltinCore._dispatch(self, method, args, dispatch_dict)
+        if method in self.child_rmi:
+            self._broadcast(("rmi", self.child_rmi[method], args))
+        return rv
+    _dispatch.__doc__ = BuiltinCore._dispatch.__doc__
+
+    def _broadcast(self, msg):
+        """ Send a message to every child.
+
+        :param msg: The message to send
+        :type msg: tuple
+        """
+        for child in self.children:
+            child.send(msg)
+
+    def _relay_event(self, event):
+        """ Relay a file monitor event that has been handled by the
+        parent to every child.  This is registered in
+        :attr:`Bcfg2.Server.FileMonitor.FileMonitor.listeners`.
+
+        :param event: The event to relay
+        :type event: Bcfg2.Server.FileMonitor.Event
+        """
+        self._broadcast(("event", event))
+
+    def _call_child(self, method, client):
+        """ Hand off work for a client to an idle child and wait for
+        the result.  If no children are alive, the work is done in the
+        parent process instead.
+
+        :param method: The name of the method whose work will be done
+        :type method: string
+        :param client: The name of the client to do the work for
+        :type client: string
+        :returns: string - The serialized result of the call
+        :raises: :exc:`xmlrpclib.Fault`
+        """
+        # make sure that any pending file monitor events -- e.g.,
+        # the clients.xml change that resulted from adding a new
+        # client earlier in this client run -- are handled and
+        # relayed to the children before the work is handed off
+        self.fam.handle_event_set(self.lock)
+
+        result = None
+        while result is None:
+            if not [c for c in self.children if c.alive]:
+                result = self._build(method, client)
+                break
+            try:
+                child = self.available_children.get(True, 1)
+            except Empty:
+                continue
+            if not child.alive:
+                continue
+            try:
+                result = child.call(method, client, self.revision)
+            except (EOFError, IOError, OSError):
+                self.logger.error("%s died while processing %s for %s" %
+                                  (child.name, method, client))
+            else:
+                self.available_children.put(child)
+
+        success, rv, trace = result
+        if trace is not None:
+            Bcfg2.Statistics.tracer.add(trace)
+        if not success:
+            raise xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                  "Critical failure: %s" % rv)
+        return rv
+
+    def _build(self, method, client):
+        """ Do the work of a :func:`GetConfig` or :func:`GetProbes`
+        call for a client.  In normal operation, this is only called
+        in a child process.
+
+        :param method: The name of the method whose work will be done
+        :type method: string
+        :param client: The name of the client to do the work for
+        :type client: string
+        :returns: tuple of ``(<success>, <result>, <trace>)``.  On
+                  success, ``<result>`` is the serialized result of
+                  the call; on failure, it is an error message.
+                  ``<trace>`` is the root
+                  :class:`Bcfg2.Statistics.Span` of the trace of the
+                  work done, or None if tracing is disabled or the
+                  work was done in the parent process.
+        """
+        tracer = Bcfg2.Statistics.tracer
+        started = tracer.start(multiprocessing.current_process().name,
+                               client)
+        try:
+            if method == "GetConfig":
+                rv = (True, self.BuildSerializedConfiguration(client))
+            else:
+                rv = (True, self._get_probes(self.build_metadata(client)))
+        except Bcfg2.Server.Plugin.MetadataConsistencyError:
+            msg = "Metadata consistency failure for %s" % client
+            self.logger.error(msg, exc_info=1)
+            rv = (False, msg)
+        except:  # pylint: disable=W0702
+            err = sys.exc_info()[1]
+            msg = "Failed to process %s for %s: %s" % (method, client, err)
+            self.logger.error(msg, exc_info=1)
+            rv = (False, msg)
+        if started:
+            return rv + (tracer.finish(keep=False), )
+        return rv + (None, )
+
+    def _child_main(self, reader, writer):
+        """ The main loop of a child process.  Messages from the parent
+        are read from ``reader`` and handled in order until the parent
+        asks the child to shut down or goes away.
+
+        :param reader: The connection to read messages from the
+                       parent from
+        :type reader: multiprocessing.Connection
+        :param writer: The connection to write replies to the parent
+                       to
+        :type writer: multiprocessing.Connection
+        """
+        # the parent handles signals and shuts the children down
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        # drop the resources inherited from the parent that belong
+        # to it or to other children
+        self.server.socket.close()
+        for child in self.children:
+            child.close()
+        self.children = []
+        self.fam.relayed = True
+
+        while True:
+            try:
+                msg = reader.recv()
+            except (EOFError, IOError, KeyboardInterrupt):
+                break
+            if msg[0] == "shutdown":
+                break
+            elif msg[0] == "call":
+                method, client, self.revision = msg[1:]
+                writer.send(self._build(method, client))
+            elif msg[0] == "event":
+                self.fam.handle_one_event(msg[1])
+            elif msg[0] == "probedata":
+                self._reload_probe_data(*msg[1:])
+            elif msg[0] == "rmi":
+                pname, mname = msg[1].split(".", 1)
+                try:
+                    getattr(self.plugins[pname], mname)(*msg[2])
+                except:  # pylint: disable=W0702
+                    self.logger.error("Failed to call %s in child process" %
+                                      msg[1], exc_info=1)
+
+    def _reload_probe_data(self, client, data=None):
+        """ Reload probe data for a client after it has been received
+        by the parent.
+
+        :param client: The name of the client
+        :type client: string
+        :param data: The probe data and groups of the client, as
+                     returned by
+                     :func:`Bcfg2.Server.Plugins.Probes.Probes.get_client_data`.
+                     If this is None, the data is loaded from where
+                     the parent stored it.
+        :type data: tuple
+        """
+        self.metadata_cache.expire(client)
+        if self.config_cache is not None:
+            self.config_cache.expire(client)
+        if 'Probes' in self.plugins:
+            if data is None:
+                self.plugins['Probes'].load_data(client=client)
+            else:
+                self.plugins['Probes'].set_client_data(client, data)
+
+    @exposed
+    @traced
+    def GetProbes(self, address):
+        client = self.resolve_client(address, cleanup_cache=True)[0]
+        return self._call_child("GetProbes", client)
+    GetProbes.__doc__ = BuiltinCore.GetProbes.__doc__
+
+    @exposed
+    def RecvProbeData(self, address, probedata):
+        rv = BuiltinCore.RecvProbeData(self, address, probedata)
+        client = self.resolve_client(address, metadata=False)[0]
+        # the data is sent to the children rather than loaded by
+        # them, since it may not have been stored yet (e.g., with
+        # [probes] write_interval)
+        data = None
+        if 'Probes' in self.plugins:
+            data = self.plugins['Probes'].get_client_data(client)
+        self._broadcast(("probedata", client, data))
+        return rv
+    RecvProbeData.__doc__ = BuiltinCore.RecvProbeData.__doc__
+
+    @exposed
+    @traced
+    def GetConfig(self, address, digest=None, delta=False):
+        client = self.resolve_client(address)[0]
+        admitted = self.admission.acquire(client)
+        try:
+            return self._config_response(
+                client, self._call_child("GetConfig", client), digest, delta)
+        finally:
+            self.admission.release(admitted)
+    GetConfig.__doc__ = BuiltinCore.GetConfig.__doc__
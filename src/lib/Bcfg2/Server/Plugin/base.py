@@ -93,6 +93,14 @@ class Plugin(Debuggable):
     #: List of names of methods to be exposed as XML-RPC functions
     __rmi__ = Debuggable.__rmi__
 
+    #: List of names of XML-RPC methods that must also be called in
+    #: each child process when the
+    #: :mod:`Bcfg2.Server.MultiprocessingCore` is in use, after they
+    #: have been called in the parent process.  Each item may either
+    #: be a method name, or a tuple of ``(<XML-RPC method name>,
+    #: <name of the method to call in the children>)``.
+    __child_rmi__ = Debuggable.__rmi__
+
     def __init__(self, core, datastore):
         """
         :param core: The Bcfg2.Server.Core initializing the plugin
@@ -103,6 +111,7 @@ class Plugin(Debuggable):
         :raises: :class:`Bcfg2.Server.Plugin.exceptions.PluginInitError`
 
         .. autoattribute:: Bcfg2.Server.Plugin.base.Debuggable.__rmi__
+        .. autoattribute:: Bcfg2.Server.Plugin.base.Plugin.__child_rmi__
         """
         self.Entries = {}
         self.core = core
@@ -11,6 +11,7 @@ import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Options
 import Bcfg2.Statistics
+import Bcfg2.Server.Dependencies
 from Bcfg2.Compat import CmpMixin, wraps
 from Bcfg2.Server.Plugin.base import Debuggable, Plugin
 from Bcfg2.Server.Plugin.interfaces import Generator
@@ -82,7 +83,9 @@ def bind_info(entry, metadata, infoxml=None, default=DEFAULT_FILE_METADATA):
 class track_statistics(object):  # pylint: disable=C0103
     """ Decorator that tracks execution time for the given
     :class:`Plugin` method with :mod:`Bcfg2.Statistics` for reporting
-    via ``bcfg2-admin perf`` """
+    via ``bcfg2-admin perf``.  If a client run is being traced, each
+    call is also recorded as a span of the trace for reporting via
+    ``bcfg2-admin trace``. """
 
     def __init__(self, name=None):
         """
@@ -104,11 +107,15 @@ class track_statistics(object):  # pylint: disable=C0103
             """ The decorated function """
             name = "%s:%s" % (obj.__class__.__name__, self.name)
 
+            span = None
+            if Bcfg2.Statistics.tracer.enabled:
+                span = Bcfg2.Statistics.tracer.begin(name)
             start = time.time()
             try:
                 return func(obj, *args, **kwargs)
             finally:
                 Bcfg2.Statistics.stats.add_value(name, time.time() - start)
+                Bcfg2.Statistics.tracer.end(span)
 
         return inner
 
@@ -362,6 +369,7 @@ class DirectoryBacked(object):
 
         # Exclude events for actions we don't care about
         if action == 'endExist':
+            Bcfg2.Server.Dependencies.graph.unchanged()
             return
 
         if event.requestID not in self.handles:
@@ -377,6 +385,7 @@ class DirectoryBacked(object):
 
         if self.ignore and self.ignore.search(event.filename):
             LOGGER.debug("Ignoring event %s" % event.filename)
+            Bcfg2.Server.Dependencies.graph.unchanged()
             return
 
         # Calculate the absolute and relative paths this event refers to
@@ -445,6 +454,7 @@ class DirectoryBacked(object):
         else:
             LOGGER.warn("Could not process filename %s; ignoring" %
                         event.filename)
+        Bcfg2.Server.Dependencies.graph.changed(abspath)
 
 
 class XMLFileBacked(FileBacked):
@@ -859,6 +869,9 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         Plugin.__init__(self, core, datastore)
         Generator.__init__(self)
         XMLDirectoryBacked.__init__(self, self.data, self.core.fam)
+        # any file in a PrioDir can affect any entry it binds, so each
+        # bound entry is recorded as depending on the whole directory
+        Bcfg2.Server.Dependencies.graph.track(self.data)
     __init__.__doc__ = Plugin.__init__.__doc__
 
     def HandleEvent(self, event):
@@ -922,6 +935,7 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         :returns: dict of <attr name>:<attr value>
         :raises: :class:`Bcfg2.Server.Plugin.exceptions.PluginExecutionError`
         """
+        Bcfg2.Server.Dependencies.graph.record(self.data)
         for src in self.entries.values():
             src.Cache(metadata)
 
@@ -1405,6 +1419,7 @@ class EntrySet(Debuggable):
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: lxml.etree._Element - the fully-bound entry
         """
+        Bcfg2.Server.Dependencies.graph.record(self.path)
         self.bind_info_to_entry(entry, metadata)
         return self.best_matching(metadata).bind_entry(entry, metadata)
 
@@ -1457,6 +1472,10 @@ class GroupSpool(Plugin, Generator):
         self.handles = {}
         self.AddDirectoryMonitor('')
         self.encoding = core.setup['encoding']
+
+        # the bind_entry method of each es_cls object records the
+        # entry set directory as a dependency of the entry it binds
+        Bcfg2.Server.Dependencies.graph.track(self.data)
     __init__.__doc__ = Plugin.__init__.__doc__
 
     def add_entry(self, event):
@@ -1548,8 +1567,10 @@ class GroupSpool(Plugin, Generator):
         """
         action = event.code2str()
         if event.filename[0] == '/':
+            Bcfg2.Server.Dependencies.graph.unchanged()
             return
         ident = self.event_id(event)
+        Bcfg2.Server.Dependencies.graph.changed(self.event_path(event))
 
         if action in ['exists', 'created']:
             self.add_entry(event)
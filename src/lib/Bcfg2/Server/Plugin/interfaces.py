@@ -30,8 +30,22 @@ class Generator(object):
     #. If the entry is not listed in ``Entries``, the Bcfg2 core calls
        :func:`HandlesEntry`; if that returns True, then it calls
        :func:`HandleEntry`.
+
+    The core keeps an index of the entries listed in each generator's
+    ``Entries`` dict, which is rebuilt whenever a file monitor event
+    is handled, or when an ``Entries`` dict is replaced or changes
+    size.
     """
 
+    #: If True, the return value of :func:`HandlesEntry` depends only
+    #: on the tag and name of the entry and on the data held by the
+    #: plugin, not on other attributes of the entry or on the client
+    #: metadata.  This lets the core cache the result for each
+    #: ``(<tag>, <name>)`` pair until the next file monitor event is
+    #: handled, so that :func:`HandlesEntry` is called at most once
+    #: per entry rather than once per entry per client.
+    handles_entry_by_name = False
+
     def HandlesEntry(self, entry, metadata):  # pylint: disable=W0613
         """ HandlesEntry is the slow path method for routing
         configuration binding requests.  It is called if the
@@ -10,6 +10,7 @@ import sys
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
 import Bcfg2.Server.Lint
+import Bcfg2.Server.Dependencies
 
 try:
     import genshi.template.base
@@ -95,6 +96,7 @@ class Bundler(Bcfg2.Server.Plugin.Plugin,
         except OSError:
             self.logger.error("Failed to load Bundle repository")
             raise Bcfg2.Server.Plugin.PluginInitError
+        Bcfg2.Server.Dependencies.graph.track(self.data)
 
     def template_dispatch(self, name, _):
         """ Add the correct child entry type to Bundler depending on
@@ -132,7 +134,12 @@ class Bundler(Bcfg2.Server.Plugin.Plugin,
             except KeyError:
                 self.logger.error("Bundler: Bundle %s does not exist" %
                                   bundlename)
+                # the bundle may be created later, anywhere in the
+                # Bundler directory
+                Bcfg2.Server.Dependencies.graph.record(self.data)
                 continue
+            for item in entries:
+                Bcfg2.Server.Dependencies.graph.record(item.name)
             try:
                 bundleset.append(entries[0].get_xml_value(metadata))
             except genshi.template.base.TemplateError:
@@ -10,6 +10,7 @@ import lxml.etree
 import Bcfg2.Options
 import Bcfg2.Server.Plugin
 import Bcfg2.Server.Lint
+import Bcfg2.Server.Dependencies
 # pylint: disable=W0622
 from Bcfg2.Compat import u_str, unicode, b64encode, walk_packages, any
 # pylint: enable=W0622
@@ -428,6 +429,7 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
             self.entries[event.filename].handle_event(event)
 
     def bind_entry(self, entry, metadata):
+        Bcfg2.Server.Dependencies.graph.record(self.path)
         self.bind_info_to_entry(entry, metadata)
         data = self._generate_data(entry, metadata)
 
@@ -3,6 +3,7 @@
 import lxml.etree
 
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Dependencies
 
 
 class DNode(Bcfg2.Server.Plugin.INode):
@@ -49,6 +50,7 @@ class Deps(Bcfg2.Server.Plugin.PrioDir,
         """Examine the passed structures and append any additional
         prerequisite entries as defined by the files in Deps.
         """
+        Bcfg2.Server.Dependencies.graph.record(self.data)
         entries = []
         for structure in structures:
             for entry in structure.getchildren():
@@ -1,4 +1,5 @@
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Dependencies
 import re
 import lxml.etree
 
@@ -36,6 +37,7 @@ class EditEntrySet(Bcfg2.Server.Plugin.EntrySet):
         self.inputs = dict()
 
     def bind_entry(self, entry, metadata):
+        Bcfg2.Server.Dependencies.graph.record(self.path)
         client = metadata.hostname
         filename = entry.get('name')
         permdata = {'owner': 'root',
@@ -6,16 +6,19 @@ import os
 import sys
 import time
 import copy
-import errno
-import fcntl
+import stat
+import heapq
 import socket
+import difflib
 import logging
+import tempfile
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Lint
 import Bcfg2.Server.Plugin
 import Bcfg2.Server.FileMonitor
-from Bcfg2.Compat import MutableMapping, all, wraps  # pylint: disable=W0622
+from Bcfg2.Compat import MutableMapping, wraps
 from Bcfg2.version import Bcfg2VersionInfo
 
 try:
@@ -27,15 +30,6 @@ except ImportError:
 LOGGER = logging.getLogger(__name__)
 
 
-def locked(fd):
-    """ Acquire a lock on a file """
-    try:
-        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError:
-        return True
-    return False
-
-
 if HAS_DJANGO:
     class MetadataClientModel(models.Model,
                               Bcfg2.Server.Plugin.PluginDatabaseModel):
@@ -96,7 +90,7 @@ if HAS_DJANGO:
 class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
     """Handles xml config files and all XInclude statements"""
 
-    def __init__(self, metadata, watch_clients, basefile):
+    def __init__(self, metadata, watch_clients, basefile, write_interval=0):
         # we tell XMLFileBacked _not_ to add a monitor for this file,
         # because the main Metadata plugin has already added one.
         # then we immediately set should_monitor to the proper value,
@@ -115,6 +109,24 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
         self.pseudo_monitor = isinstance(metadata.core.fam,
                                          Bcfg2.Server.FileMonitor.Pseudo)
 
+        #: The number of seconds to wait after a change before writing
+        #: it to disk, so that changes made in quick succession are
+        #: written at once.  If this is 0, changes are written
+        #: immediately.
+        self.write_interval = write_interval
+
+        #: The journal of changes that have not been written to disk
+        #: yet.  Changes are recorded here by :func:`record` so that
+        #: they are not lost if the server stops before they are
+        #: written, and are replayed by :func:`load_xml`.
+        self.journal = os.path.join(self.basedir, ".%s.journal" % basefile)
+
+        # mapping of filename -> XML tree that has changes that have
+        # not been written to disk yet
+        self._pending = dict()
+        self._timer = None
+        self._lock = threading.RLock()
+
     def _get_xdata(self):
         """ getter for xdata property """
         if not self.data:
@@ -156,79 +168,227 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
                 self.logger.error("Failed to process XInclude for file %s" %
                                   self.basefile)
         self.data = xdata
+        if os.path.exists(self.journal):
+            self._replay_journal()
 
     def write(self):
         """Write changes to xml back to disk."""
         self.write_xml(os.path.join(self.basedir, self.basefile),
                        self.basedata)
 
-    def write_xml(self, fname, xmltree):
-        """Write changes to xml back to disk."""
-        tmpfile = "%s.new" % fname
-        datafile = None
-        fd = None
-        i = 0  # counter to avoid flooding logs with lock messages
-        while datafile is None:
+    def record(self, action, element, fname=None):
+        """ Record a change to an element in the :attr:`journal`, if
+        writes are deferred, so that it is not lost if the server
+        stops before the change is written.  This must be called
+        after the change is made in memory and before it is written
+        with :func:`write` or :func:`write_xml`.
+
+        :param action: ``set`` to record the attributes of an
+                       element that was added or modified, or
+                       ``remove`` to record the removal of an element
+        :type action: string
+        :param element: The element that was changed
+        :type element: lxml.etree._Element
+        :param fname: The file the element is in.  Defaults to the
+                      base file.
+        :type fname: string
+        """
+        if not self.write_interval:
+            return
+        if fname is None:
+            fname = os.path.join(self.basedir, self.basefile)
+        change = lxml.etree.Element("Change", action=action, file=fname)
+        entry = lxml.etree.SubElement(change, element.tag)
+        if action == "set":
+            for key, val in element.attrib.items():
+                entry.set(key, val)
+        else:
+            entry.set("name", element.get("name"))
+        data = lxml.etree.tostring(change, xml_declaration=False) + \
+            "\n".encode('UTF-8')
+        self._lock.acquire()
+        try:
             try:
-                fd = os.open(tmpfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                datafile = os.fdopen(fd, 'w')
+                fd = os.open(self.journal,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 384)
+                try:
+                    os.write(fd, data)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
             except OSError:
-                err = sys.exc_info()[1]
-                if err.errno == errno.EEXIST:
-                    # note: not a real lock.  this is here to avoid
-                    # the scenario where two threads write to the file
-                    # at the same-ish time, and one writes to
-                    # foo.xml.new, then the other one writes to it
-                    # (losing the first thread's changes), then the
-                    # first renames it, then the second tries to
-                    # rename it and borks.
-                    if (i % 10) == 0:
-                        self.logger.info("%s is locked, waiting" % fname)
-                    i += 1
-                    time.sleep(0.1)
+                msg = "Metadata: Failed to record change to %s in %s: %s" % \
+                    (fname, self.journal, sys.exc_info()[1])
+                self.logger.error(msg)
+                raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
+        finally:
+            self._lock.release()
+
+    def _replay_journal(self):
+        """ Apply the changes in the :attr:`journal` to the data
+        just loaded from disk, and write them """
+        try:
+            changes = [lxml.etree.XML(line)
+                       for line in open(self.journal, 'rb').read().splitlines()
+                       if line.strip()]
+        except (IOError, lxml.etree.XMLSyntaxError):
+            self.logger.error("Metadata: Failed to read journal %s: %s" %
+                              (self.journal, sys.exc_info()[1]))
+            return
+        self.logger.info("Metadata: Replaying %d changes from %s" %
+                         (len(changes), self.journal))
+        basefile = os.path.join(self.basedir, self.basefile)
+        self._lock.acquire()
+        try:
+            # any pending trees were replaced by the data just loaded,
+            # so the journal is applied to the new data instead
+            self._pending = dict()
+            for change in changes:
+                fname = change.get("file")
+                if fname == basefile:
+                    xmltree = self.basedata
+                elif fname in self._pending:
+                    xmltree = self._pending[fname]
                 else:
-                    msg = "Failed to write %s: %s" % (tmpfile, err)
-                    self.logger.error(msg)
-                    raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
-        # prep data
-        dataroot = xmltree.getroot()
-        newcontents = lxml.etree.tostring(dataroot, xml_declaration=False,
-                                          pretty_print=True).decode('UTF-8')
-
-        while locked(fd) == True:
-            pass
+                    try:
+                        xmltree = lxml.etree.parse(
+                            fname, parser=Bcfg2.Server.XMLParser)
+                    except (IOError, lxml.etree.XMLSyntaxError):
+                        self.logger.error("Metadata: Failed to parse %s" %
+                                          fname)
+                        continue
+                self._apply_change(xmltree, change)
+                if self.data.getroot() is not xmltree.getroot():
+                    # the base data shares its elements with the
+                    # data, but changes to included files must be
+                    # applied to the data separately
+                    self._apply_change(self.data, change)
+                self._pending[fname] = xmltree
+            if self.write_interval:
+                self._schedule()
+            else:
+                self.flush()
+        finally:
+            self._lock.release()
+
+    def _apply_change(self, xmltree, change):
+        """ Apply a single change from the :attr:`journal` to an XML
+        tree.  Like the change it was recorded from, this only
+        changes the first matching element. """
+        entry = change[0]
+        nodes = xmltree.xpath('.//%s[@name=$name]' % entry.tag,
+                              name=entry.get("name"))
+        if change.get("action") == "remove":
+            if nodes:
+                nodes[0].getparent().remove(nodes[0])
+        elif nodes:
+            for key, val in entry.attrib.items():
+                nodes[0].set(key, val)
+        else:
+            xmltree.getroot().append(copy.copy(entry))
+
+    def write_xml(self, fname, xmltree):
+        """Write changes to xml back to disk.  If :attr:`write_interval`
+        is set, the write is deferred and coalesced with other writes
+        made in the meantime."""
+        if not self.write_interval:
+            self._write_xml(fname, xmltree)
+            return
+        self._lock.acquire()
+        try:
+            self._pending[fname] = xmltree
+            self._schedule()
+        finally:
+            self._lock.release()
+
+    def _schedule(self):
+        """ Schedule a :func:`flush` of pending writes, unless one is
+        already scheduled """
+        if self._timer is None:
+            self._timer = threading.Timer(self.write_interval, self.flush)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def flush(self):
+        """ Write all pending changes to disk now, and clear the
+        :attr:`journal` """
+        self._lock.acquire()
         try:
-            datafile.write(newcontents)
-        except:
-            fcntl.lockf(fd, fcntl.LOCK_UN)
-            msg = "Metadata: Failed to write new xml data to %s: %s" % \
-                (tmpfile, sys.exc_info()[1])
-            self.logger.error(msg, exc_info=1)
-            os.unlink(tmpfile)
-            raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
-        datafile.close()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = self._pending
+            self._pending = dict()
+            for fname, xmltree in list(pending.items()):
+                try:
+                    self._write_xml(fname, xmltree)
+                except Bcfg2.Server.Plugin.MetadataRuntimeError:
+                    # keep the journal, and try again later
+                    self._pending.update(pending)
+                    if self.write_interval:
+                        self._schedule()
+                    return
+                del pending[fname]
+            if os.path.exists(self.journal):
+                try:
+                    os.unlink(self.journal)
+                except OSError:
+                    self.logger.error("Metadata: Failed to remove journal "
+                                      "%s: %s" % (self.journal,
+                                                  sys.exc_info()[1]))
+        finally:
+            self._lock.release()
+
+    def _write_xml(self, fname, xmltree):
+        """ Write an XML tree to disk.  The data is written to a new
+        temporary file that is then renamed over the old file, so
+        readers never see a partially written file. """
         # check if clients.xml is a symlink
         if os.path.islink(fname):
             fname = os.readlink(fname)
-
+        newcontents = lxml.etree.tostring(xmltree.getroot(),
+                                          xml_declaration=False,
+                                          pretty_print=True)
+        self._lock.acquire()
         try:
-            os.rename(tmpfile, fname)
-        except:  # pylint: disable=W0702
             try:
-                os.unlink(tmpfile)
+                fd, tmpfile = \
+                    tempfile.mkstemp(prefix=".%s." % os.path.basename(fname),
+                                     dir=os.path.dirname(fname))
+                datafile = os.fdopen(fd, 'wb')
+            except OSError:
+                msg = "Failed to write %s: %s" % (fname, sys.exc_info()[1])
+                self.logger.error(msg)
+                raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
+            try:
+                datafile.write(newcontents)
+                datafile.close()
+                if os.path.exists(fname):
+                    mode = stat.S_IMODE(os.stat(fname).st_mode)
+                else:
+                    mode = 420  # 0644
+                os.chmod(tmpfile, mode)
+                os.rename(tmpfile, fname)
             except:  # pylint: disable=W0702
-                pass
-            msg = "Metadata: Failed to rename %s: %s" % (tmpfile,
-                                                         sys.exc_info()[1])
-            self.logger.error(msg)
-            raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
-
-    def find_xml_for_xpath(self, xpath):
-        """Find and load xml file containing the xpath query"""
+                msg = "Metadata: Failed to write new xml data to %s: %s" % \
+                    (fname, sys.exc_info()[1])
+                self.logger.error(msg)
+                try:
+                    os.unlink(tmpfile)
+                except:  # pylint: disable=W0702
+                    pass
+                raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
+        finally:
+            self._lock.release()
+
+    def find_xml_for_xpath(self, xpath, **variables):
+        """Find and load xml file containing the xpath query.  Any
+        keyword arguments are passed to the query as XPath
+        variables."""
         if self.pseudo_monitor:
             # Reload xml if we don't have a real monitor
             self.load_xml()
-        cli = self.basedata.xpath(xpath)
+        cli = self.basedata.xpath(xpath, **variables)
         if len(cli) > 0:
             return {'filename': os.path.join(self.basedir, self.basefile),
                     'xmltree': self.basedata,
@@ -237,9 +397,14 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
             # Try to find the data in included files
             for included in self.extras:
                 try:
-                    xdata = lxml.etree.parse(included,
-                                             parser=Bcfg2.Server.XMLParser)
-                    cli = xdata.xpath(xpath)
+                    if included in self._pending:
+                        # changes to this file have not been written
+                        # yet
+                        xdata = self._pending[included]
+                    else:
+                        xdata = lxml.etree.parse(
+                            included, parser=Bcfg2.Server.XMLParser)
+                    cli = xdata.xpath(xpath, **variables)
                     if len(cli) > 0:
                         return {'filename': included,
                                 'xmltree': xdata,
@@ -392,6 +557,167 @@ class MetadataGroup(tuple):
         return hash(self.name)
 
 
+class MetadataGroupRule(object):
+    """ A single group membership declaration from ``groups.xml``,
+    i.e., a Group tag with no children nested in Group and Client
+    tags, compiled into a list of the conditions of the tags it is
+    nested in. """
+
+    def __init__(self, group, conditions, negate=False):
+        """
+        :param group: The group the declaration adds the client to or
+                      removes the client from
+        :type group: Bcfg2.Server.Plugins.Metadata.MetadataGroup
+        :param conditions: The Group and Client tags the declaration
+                           is nested in, innermost first
+        :type conditions: list of lxml.etree._Element
+        :param negate: Whether the declaration removes the client
+                       from the group rather than adding it
+        :type negate: bool
+        """
+        #: The group the declaration adds the client to or removes
+        #: the client from
+        self.group = group
+
+        #: Whether the declaration removes the client from the group
+        self.negate = negate
+
+        #: A list of ``(<is group>, <name>, <negate>)`` tuples, one
+        #: for each Group or Client tag the declaration is nested
+        #: in, innermost first
+        self.conditions = []
+        for cond in conditions:
+            if cond.tag in ['Group', 'Client']:
+                self.conditions.append(
+                    (cond.tag == 'Group', cond.get("name"),
+                     cond.get('negate', 'false').lower() == 'true'))
+
+        #: The names of all groups whose membership the result of
+        #: the conditions depends on
+        self.groups = set([name for is_group, name, _ in self.conditions
+                           if is_group])
+
+    def matches(self, client, groups):
+        """ Return True if the given client meets all conditions of
+        this declaration.
+
+        :param client: The hostname of the client
+        :type client: string
+        :param groups: The groups the client is currently a member of
+        :type groups: set
+        :returns: bool
+        """
+        for is_group, name, negate in self.conditions:
+            if is_group:
+                if negate == (name in groups):
+                    return False
+            elif negate == (name == client):
+                return False
+        return True
+
+    def __repr__(self):
+        return "%s %s %s (conditions=%s)" % \
+            (self.__class__.__name__, self.negate and "-" or "+",
+             self.group.name, self.conditions)
+
+
+class MetadataGroupPlan(object):
+    """ All group membership declarations in ``groups.xml``, indexed
+    by the groups and clients they test, so that
+    :func:`Metadata._merge_groups` only evaluates the declarations
+    that a client could possibly meet, and only re-evaluates a
+    declaration when the membership of a group it depends on has
+    changed. """
+
+    def __init__(self, rules):
+        """
+        :param rules: All group membership declarations, in the order
+                      in which they are evaluated
+        :type rules: list of
+                     :class:`Bcfg2.Server.Plugins.Metadata.MetadataGroupRule`
+        """
+        #: All group membership declarations, in the order in which
+        #: they are evaluated
+        self.rules = rules
+
+        #: Indexes of declarations that may apply to any client
+        self.unkeyed = []
+
+        #: Mapping of group name -> indexes of declarations that can
+        #: only apply to members of that group
+        self.by_group = dict()
+
+        #: Mapping of client name -> indexes of declarations that can
+        #: only apply to that client
+        self.by_client = dict()
+
+        #: Mapping of group name -> indexes of declarations whose
+        #: result depends on membership in that group
+        self.dependents = dict()
+
+        #: Mapping of category -> indexes of declarations whose
+        #: result depends on membership in a group in that category
+        self.category_dependents = dict()
+
+        for idx, rule in enumerate(rules):
+            for group in rule.groups | set([rule.group.name]):
+                self.dependents.setdefault(group, []).append(idx)
+            if rule.group.category and not rule.negate:
+                self.category_dependents.setdefault(rule.group.category,
+                                                    []).append(idx)
+
+            # a declaration can only apply if all of its conditions
+            # are met, so it only needs to be indexed by one of them
+            # that requires membership in a group or a given client
+            # name.  a negated declaration can additionally only
+            # apply to members of the group it removes.
+            for is_group, name, negate in rule.conditions:
+                if is_group and not negate:
+                    self.by_group.setdefault(name, []).append(idx)
+                    break
+            else:
+                for is_group, name, negate in rule.conditions:
+                    if not is_group and not negate:
+                        self.by_client.setdefault(name, []).append(idx)
+                        break
+                else:
+                    if rule.negate:
+                        self.by_group.setdefault(rule.group.name,
+                                                 []).append(idx)
+                    else:
+                        self.unkeyed.append(idx)
+
+    def candidates(self, client, groups):
+        """ Get the indexes of all declarations that could apply to
+        the given client, given its current group membership.
+
+        :param client: The hostname of the client
+        :type client: string
+        :param groups: The groups the client is currently a member of
+        :type groups: set
+        :returns: set of ints
+        """
+        rv = set(self.unkeyed)
+        rv.update(self.by_client.get(client, []))
+        for group in groups:
+            rv.update(self.by_group.get(group, []))
+        return rv
+
+    def affected(self, group):
+        """ Get the indexes of all declarations whose result may
+        change when a client is added to or removed from the given
+        group.
+
+        :param group: The group
+        :type group: Bcfg2.Server.Plugins.Metadata.MetadataGroup
+        :returns: list of ints
+        """
+        rv = self.dependents.get(group.name, [])
+        if group.category:
+            rv = rv + self.category_dependents.get(group.category, [])
+        return rv
+
+
 class Metadata(Bcfg2.Server.Plugin.Metadata,
                Bcfg2.Server.Plugin.Statistics,
                Bcfg2.Server.Plugin.DatabaseBacked):
@@ -407,6 +733,13 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.states = dict()
         self.extra = dict()
         self.handlers = dict()
+        # the number of seconds to wait before writing changes to
+        # clients.xml and groups.xml, so that changes made in quick
+        # succession (e.g., when many new clients are added at once)
+        # are written at once
+        self.write_interval = float(core.setup.cfp.get("metadata",
+                                                       "write_interval",
+                                                       default="0"))
         self.groups_xml = self._handle_file("groups.xml")
         if (self._use_db and
             os.path.exists(os.path.join(self.data, "clients.xml"))):
@@ -434,9 +767,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.raliases = {}
         # mapping of groupname -> MetadataGroup object
         self.groups = {}
-        # mappings of predicate -> MetadataGroup object
+        # mappings of MetadataGroupRule -> MetadataGroup object
         self.group_membership = dict()
         self.negated_groups = dict()
+        # all group membership declarations, indexed for _merge_groups
+        self.group_plan = MetadataGroupPlan([])
         # mapping of hostname -> version string
         if self._use_db:
             self.versions = ClientVersions(core, datastore)
@@ -445,6 +780,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.uuid = {}
         self.session_cache = {}
         self.default = None
+        # the data from clients.xml and groups.xml that client
+        # metadata was built from when they were last read, so that
+        # only the cached metadata of clients that a change affects
+        # is expired
+        self._metadata_state = None
         self.pdirty = False
         self.password = core.setup['password']
         self.query = MetadataQuery(core.build_metadata,
@@ -465,6 +805,18 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 open(os.path.join(repo, cls.name, fname),
                      "w").write(kwargs[aname])
 
+    def shutdown(self):
+        """ Write any changes to clients.xml and groups.xml that have
+        not been written yet """
+        Bcfg2.Server.Plugin.Metadata.shutdown(self)
+        for config in [getattr(self, 'groups_xml', None),
+                       getattr(self, 'clients_xml', None)]:
+            if config is not None:
+                try:
+                    config.flush()
+                except Bcfg2.Server.Plugin.MetadataRuntimeError:
+                    pass
+
     def _handle_file(self, fname):
         """ set up the necessary magic for handling a metadata file
         (clients.xml or groups.xml, e.g.) """
@@ -477,7 +829,8 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 self.logger.error(msg)
                 raise Bcfg2.Server.Plugin.PluginInitError(msg)
             self.states[fname] = False
-        xmlcfg = XMLMetadataConfig(self, self.watch_clients, fname)
+        xmlcfg = XMLMetadataConfig(self, self.watch_clients, fname,
+                                   write_interval=self.write_interval)
         aname = re.sub(r'[^A-z0-9_]', '_', os.path.basename(fname))
         self.handlers[xmlcfg.HandleEvent] = getattr(self,
                                                     "_handle_%s_event" % aname)
@@ -508,9 +861,20 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         """ find a client in the given XML tree """
         return self._search_xdata("Client", client_name, tree, alias=True)
 
-    def _add_xdata(self, config, tag, name, attribs=None, alias=False):
-        """ Generic method to add XML data (group, client, etc.) """
+    def _search_config(self, config, tag, name, alias=False):
+        """ Find XML data (group, client, etc.) in a config file,
+        including data that has been added but not yet written to
+        disk and reloaded """
         node = self._search_xdata(tag, name, config.xdata, alias=alias)
+        if node is None:
+            node = self._search_xdata(tag, name, config.base_xdata,
+                                      alias=alias)
+        return node
+
+    def _add_xdata(self, config, tag, name, attribs=None, alias=False,
+                   write=True):
+        """ Generic method to add XML data (group, client, etc.) """
+        node = self._search_config(config, tag, name, alias=alias)
         if node != None:
             raise Bcfg2.Server.Plugin.MetadataConsistencyError("%s \"%s\" "
                                                                "already exists"
@@ -520,7 +884,9 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         if attribs:
             for key, val in list(attribs.items()):
                 element.set(key, val)
-        config.write()
+        config.record("set", element)
+        if write:
+            config.write()
         return element
 
     def add_group(self, group_name, attribs):
@@ -565,23 +931,61 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 # already exists
                 err = sys.exc_info()[1]
                 self.logger.info(err)
-                return self._search_xdata("Client", client_name,
-                                          self.clients_xml.xdata, alias=True)
+                return self._search_config(self.clients_xml, "Client",
+                                           client_name, alias=True)
+
+    @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
+    def add_clients(self, clients):
+        """ Add several clients at once.  With clients.xml, this only
+        writes clients.xml once.
+
+        :param clients: A dict of <client name> -> <dict of attributes
+                        of the new client>
+        :type clients: dict
+        :returns: list of the new (or existing) clients """
+        if self._use_db:
+            rv = []
+            for client_name in clients:
+                try:
+                    client = MetadataClientModel.objects.get(
+                        hostname=client_name)
+                except MetadataClientModel.DoesNotExist:
+                    client = MetadataClientModel(hostname=client_name)
+                    client.save()
+                rv.append(client)
+            self.clients = self.list_clients()
+            return rv
+        else:
+            rv = []
+            for client_name, attribs in clients.items():
+                try:
+                    rv.append(self._add_xdata(self.clients_xml, "Client",
+                                              client_name, attribs=attribs,
+                                              alias=True, write=False))
+                except Bcfg2.Server.Plugin.MetadataConsistencyError:
+                    # already exists
+                    err = sys.exc_info()[1]
+                    self.logger.info(err)
+                    rv.append(self._search_config(self.clients_xml, "Client",
+                                                  client_name, alias=True))
+            self.clients_xml.write()
+            return rv
 
     def _update_xdata(self, config, tag, name, attribs, alias=False):
         """ Generic method to modify XML data (group, client, etc.) """
-        node = self._search_xdata(tag, name, config.xdata, alias=alias)
+        node = self._search_config(config, tag, name, alias=alias)
         if node == None:
             self.logger.error("%s \"%s\" does not exist" % (tag, name))
             raise Bcfg2.Server.Plugin.MetadataConsistencyError
-        xdict = config.find_xml_for_xpath('.//%s[@name="%s"]' %
-                                          (tag, node.get('name')))
+        xdict = config.find_xml_for_xpath('.//%s[@name=$name]' % tag,
+                                          name=node.get('name'))
         if not xdict:
             self.logger.error("Unexpected error finding %s \"%s\"" %
                               (tag, name))
             raise Bcfg2.Server.Plugin.MetadataConsistencyError
         for key, val in list(attribs.items()):
             xdict['xquery'][0].set(key, val)
+        config.record("set", xdict['xquery'][0], fname=xdict['filename'])
         config.write_xml(xdict['filename'], xdict['xmltree'])
 
     def update_group(self, group_name, attribs):
@@ -615,17 +1019,18 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
     def _remove_xdata(self, config, tag, name):
         """ Generic method to remove XML data (group, client, etc.) """
-        node = self._search_xdata(tag, name, config.xdata)
+        node = self._search_config(config, tag, name)
         if node == None:
             self.logger.error("%s \"%s\" does not exist" % (tag, name))
             raise Bcfg2.Server.Plugin.MetadataConsistencyError
-        xdict = config.find_xml_for_xpath('.//%s[@name="%s"]' %
-                                          (tag, node.get('name')))
+        xdict = config.find_xml_for_xpath('.//%s[@name=$name]' % tag,
+                                          name=node.get('name'))
         if not xdict:
             self.logger.error("Unexpected error finding %s \"%s\"" %
                               (tag, name))
             raise Bcfg2.Server.Plugin.MetadataConsistencyError
         xdict['xquery'][0].getparent().remove(xdict['xquery'][0])
+        config.record("remove", xdict['xquery'][0], fname=xdict['filename'])
         config.write_xml(xdict['filename'], xdict['xmltree'])
 
     def remove_group(self, group_name):
@@ -735,47 +1140,6 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         """ re-read groups.xml on any event on it """
         self.groups = {}
 
-        # these three functions must be separate functions in order to
-        # ensure that the scope is right for the closures they return
-        def get_condition(element):
-            """ Return a predicate that returns True if a client meets
-            the condition specified in the given Group or Client
-            element """
-            negate = element.get('negate', 'false').lower() == 'true'
-            pname = element.get("name")
-            if element.tag == 'Group':
-                return lambda c, g, _: negate != (pname in g)
-            elif element.tag == 'Client':
-                return lambda c, g, _: negate != (pname == c)
-
-        def get_category_condition(category, gname):
-            """ get a predicate that returns False if a client is
-            already a member of a group in the given category, True
-            otherwise """
-            def in_cat(client, groups, categories):  # pylint: disable=W0613
-                """ return True if the client is already a member of a
-                group in the category given in the enclosing function,
-                False otherwise """
-                if category in categories:
-                    if (gname not in self.groups or
-                        client not in self.groups[gname].warned):
-                        self.logger.warning("%s: Group %s suppressed by "
-                                            "category %s; %s already a member "
-                                            "of %s" %
-                                            (self.name, gname, category,
-                                             client, categories[category]))
-                        if gname in self.groups:
-                            self.groups[gname].warned.append(client)
-                    return False
-                return True
-            return in_cat
-
-        def aggregate_conditions(conditions):
-            """ aggregate all conditions on a given group declaration
-            into a single predicate """
-            return lambda client, groups, cats: \
-                all(cond(client, groups, cats) for cond in conditions)
-
         # first, we get a list of all of the groups declared in the
         # file.  we do this in two stages because the old way of
         # parsing groups.xml didn't support nested groups; in the old
@@ -810,40 +1174,37 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         # since there doesn't seem to be a way to get Group elements
         # of arbitrary depth with particular ultimate ancestors in
         # XPath.  We do the same thing for Client tags.
+        membership = []
+        negated = []
         for el in self.groups_xml.xdata.xpath("//Groups/Group//*") + \
                 self.groups_xml.xdata.xpath("//Groups/Client//*"):
             if ((el.tag != 'Group' and el.tag != 'Client') or
                 el.getchildren()):
                 continue
 
-            conditions = []
-            for parent in el.iterancestors():
-                cond = get_condition(parent)
-                if cond:
-                    conditions.append(cond)
-
             gname = el.get("name")
             if el.get("negate", "false").lower() == "true":
-                self.negated_groups[aggregate_conditions(conditions)] = \
-                    self.groups[gname]
+                rule = MetadataGroupRule(self.groups[gname],
+                                         el.iterancestors(), negate=True)
+                self.negated_groups[rule] = self.groups[gname]
+                negated.append(rule)
             else:
-                if self.groups[gname].category:
-                    conditions.append(
-                        get_category_condition(self.groups[gname].category,
-                                               gname))
-
-                self.group_membership[aggregate_conditions(conditions)] = \
-                    self.groups[gname]
+                rule = MetadataGroupRule(self.groups[gname],
+                                         el.iterancestors())
+                self.group_membership[rule] = self.groups[gname]
+                membership.append(rule)
+
+        # all membership declarations are evaluated before all
+        # negated declarations
+        self.group_plan = MetadataGroupPlan(membership + negated)
         self.states['groups.xml'] = True
 
     def HandleEvent(self, event):
         """Handle update events for data files."""
         for handles, event_handler in self.handlers.items():
             if handles(event):
-                # clear the entire cache when we get an event for any
-                # metadata file
-                self.core.metadata_cache.expire()
                 event_handler(event)
+                self._expire_metadata_cache()
 
         if False not in list(self.states.values()) and self.debug_flag:
             # check that all groups are real and complete. this is
@@ -860,6 +1221,72 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                         self.debug_log("Group %s set as nonexistent group %s" %
                                        (gname, group))
 
+    def _get_metadata_state(self):
+        """ get the data from clients.xml and groups.xml that client
+        metadata is built from, for :func:`_expire_metadata_cache` """
+        clients = dict()
+        if self.clients_xml.data is not None:
+            for client in self.clients_xml.data.findall('.//Client'):
+                clients[client.get('name').lower()] = \
+                    lxml.etree.tostring(client, with_tail=False)
+        groups = dict()
+        for name, group in self.groups.items():
+            groups[name] = (sorted(group.bundles), group.category,
+                            group.is_profile, group.is_public,
+                            group.is_private)
+        return (clients, groups, list(self.group_plan.rules), self.default)
+
+    def _expire_metadata_cache(self):
+        """ expire the cached metadata of all clients that may be
+        affected by the changes to clients.xml and groups.xml since
+        they were last read: clients whose entries in clients.xml
+        have changed, members of groups whose declarations have
+        changed, and clients that may meet the conditions of group
+        membership declarations that have been added, removed, or
+        reordered """
+        cache = self.core.metadata_cache
+        old = self._metadata_state
+        new = self._metadata_state = self._get_metadata_state()
+        if old is None or old[3] != new[3]:
+            # first read, or the default group has changed
+            cache.expire()
+            return
+
+        old_clients, old_groups, old_rules = old[:3]
+        new_clients, new_groups, new_rules = new[:3]
+        for client in set(old_clients.keys()) | set(new_clients.keys()):
+            if old_clients.get(client) != new_clients.get(client):
+                cache.expire(client)
+        for group in set(old_groups.keys()) | set(new_groups.keys()):
+            if old_groups.get(group) != new_groups.get(group):
+                cache.expire_by("groups", group)
+
+        # declarations are evaluated in order, so a declaration that
+        # has moved has changed, too
+        def rule_key(rule):
+            """ get a comparable key for a membership declaration """
+            return (rule.group.name, rule.negate, tuple(rule.conditions))
+
+        matcher = difflib.SequenceMatcher(None,
+                                          [rule_key(r) for r in old_rules],
+                                          [rule_key(r) for r in new_rules])
+        changed = []
+        for tag, ostart, oend, nstart, nend in matcher.get_opcodes():
+            if tag != 'equal':
+                changed.extend(old_rules[ostart:oend])
+                changed.extend(new_rules[nstart:nend])
+        if not changed:
+            return
+        plan = MetadataGroupPlan(changed)
+        if plan.unkeyed:
+            # a declaration that may apply to any client
+            cache.expire()
+            return
+        for group in plan.by_group:
+            cache.expire_by("groups", group)
+        for client in plan.by_client:
+            cache.expire(client)
+
     def set_profile(self, client, profile, addresspair):
         """Set group parameter for provided client."""
         self.logger.info("Asserting client %s profile to %s" %
@@ -975,27 +1402,68 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         """ set group membership based on the contents of groups.xml
         and initial group membership of this client. Returns a tuple
         of (allgroups, categories)"""
-        numgroups = -1  # force one initial pass
         if categories is None:
             categories = dict()
-        while numgroups != len(groups):
+        plan = self.group_plan
+        # declarations to evaluate in the next pass.  only
+        # declarations that the client could meet are evaluated at
+        # first, and after that, only declarations that depend on a
+        # group whose membership has changed.  declarations affected
+        # by a change are evaluated in the same pass if they come
+        # after the declaration that made the change, and in the
+        # next pass otherwise, exactly as if all declarations were
+        # evaluated in each pass.
+        pending = plan.candidates(client, groups)
+        numgroups = -1  # force one initial pass
+        while numgroups != len(groups) and pending:
             numgroups = len(groups)
-            for predicate, group in self.group_membership.items():
-                if group.name in groups:
-                    continue
-                if predicate(client, groups, categories):
-                    groups.add(group.name)
-                    if group.category:
-                        categories[group.category] = group.name
-            for predicate, group in self.negated_groups.items():
-                if group.name not in groups:
-                    continue
-                if predicate(client, groups, categories):
+            queue = list(pending)
+            heapq.heapify(queue)
+            pending = set()
+            while queue:
+                idx = heapq.heappop(queue)
+                while queue and queue[0] == idx:
+                    heapq.heappop(queue)
+                rule = plan.rules[idx]
+                group = rule.group
+                if rule.negate:
+                    if (group.name not in groups or
+                        not rule.matches(client, groups)):
+                        continue
                     groups.remove(group.name)
                     if group.category:
                         del categories[group.category]
+                else:
+                    if (group.name in groups or
+                        not rule.matches(client, groups) or
+                        (group.category and
+                         self._category_suppressed(client, group,
+                                                   categories))):
+                        continue
+                    groups.add(group.name)
+                    if group.category:
+                        categories[group.category] = group.name
+                for affected in plan.affected(group):
+                    if affected > idx:
+                        heapq.heappush(queue, affected)
+                    else:
+                        pending.add(affected)
         return (groups, categories)
 
+    def _category_suppressed(self, client, group, categories):
+        """ Return True if the client is already a member of a group
+        in the category of the given group, and so cannot be added
+        to it, False otherwise """
+        if group.category in categories:
+            if client not in group.warned:
+                self.logger.warning("%s: Group %s suppressed by category "
+                                    "%s; %s already a member of %s" %
+                                    (self.name, group.name, group.category,
+                                     client, categories[group.category]))
+                group.warned.append(client)
+            return True
+        return False
+
     def get_initial_metadata(self, client):  # pylint: disable=R0914,R0912
         """Return the metadata for a given client."""
         if False in list(self.states.values()):
@@ -1004,7 +1472,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         client = client.lower()
 
         if client in self.core.metadata_cache:
-            return self.core.metadata_cache[client]
+            try:
+                return self.core.metadata_cache[client]
+            except KeyError:
+                # expired since we checked
+                pass
 
         if client in self.aliases:
             client = self.aliases[client]
@@ -1107,8 +1579,62 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         return set([g.name for g in self.groups.values()
                     if g.category == category])
 
+    def _get_client_names_by_index(self, index, values, match_all=True):
+        """ Get the names of clients from the indexes of the core's
+        metadata cache, or None if the cache does not hold the
+        complete metadata of clients.
+
+        :param index: The name of the index to use, ``groups``,
+                      ``bundles``, or ``profile``
+        :type index: string
+        :param values: The values to look up in the index
+        :type values: list
+        :param match_all: Find clients that match all of the given
+                          values, rather than any of them
+        :type match_all: bool
+        :returns: list of client names, or None
+        """
+        if self.core.metadata_cache_mode not in ['cautious', 'aggressive']:
+            # with no caching, nothing is indexed; with initial
+            # caching, the groups added by Connector plugins are not
+            # in the indexes
+            return None
+        cache = self.core.metadata_cache
+        clients = list(self.clients)
+        if cache.max_entries and cache.max_entries < len(clients):
+            # the cache cannot hold the metadata of all clients
+            return None
+        for client in clients:
+            if client not in cache:
+                # this adds the client to the cache, and so to the
+                # indexes
+                self.core.build_metadata(client)
+        rv = None
+        for value in values:
+            found = cache.lookup(index, value)
+            if rv is None:
+                rv = found
+            elif match_all:
+                rv.intersection_update(found)
+            else:
+                rv.update(found)
+        for client in clients:
+            if client not in cache:
+                # expired while we were building the metadata of
+                # other clients
+                return None
+        if rv is None:
+            if match_all:
+                return clients
+            return []
+        return [c for c in clients if c in rv]
+
     def get_client_names_by_profiles(self, profiles):
         """ return a list of names of clients in the given profile groups """
+        rv = self._get_client_names_by_index("profile", profiles,
+                                             match_all=False)
+        if rv is not None:
+            return rv
         rv = []
         for client in list(self.clients):
             mdata = self.core.build_metadata(client)
@@ -1118,12 +1644,18 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
     def get_client_names_by_groups(self, groups):
         """ return a list of names of clients in the given groups """
+        rv = self._get_client_names_by_index("groups", groups)
+        if rv is not None:
+            return rv
         mdata = [self.core.build_metadata(client) for client in self.clients]
         return [md.hostname for md in mdata if md.groups.issuperset(groups)]
 
     def get_client_names_by_bundles(self, bundles):
         """ given a list of bundles, return a list of names of clients
         that use those bundles """
+        rv = self._get_client_names_by_index("bundles", bundles)
+        if rv is not None:
+            return rv
         mdata = [self.core.build_metadata(client) for client in self.clients]
         return [md.hostname for md in mdata if md.bundles.issuperset(bundles)]
 
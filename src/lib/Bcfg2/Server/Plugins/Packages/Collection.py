@@ -77,6 +77,7 @@ import sys
 import copy
 import logging
 import lxml.etree
+import Bcfg2.Statistics
 import Bcfg2.Server.Plugin
 from Bcfg2.Compat import any, md5  # pylint: disable=W0622
 
@@ -323,6 +324,70 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
                 return source.get_deps(self.metadata, package)
         return []
 
+    def get_closures(self):
+        """ Get the precomputed transitive dependency closures of
+        packages for this collection's client, which let
+        :func:`complete` add a package and all of its unambiguous
+        dependencies at once.
+
+        The base implementation returns the closures from
+        :func:`Bcfg2.Server.Plugins.Packages.Source.Source.get_closures`
+        for each source.  Closures are computed per source, so a
+        closure is only used if it passes the checks in
+        :func:`get_closure`.
+
+        :returns: list of tuples of dicts - For each source, in order,
+                  ``<package name>`` -> ``<list of strings>`` for the
+                  closures and frontiers, respectively, or None if the
+                  closures of that source cannot be used.  None is
+                  returned instead of the list if no closures can be
+                  used at all.
+        """
+        closures = [source.get_closures(self.metadata) for source in self]
+        if any(c is not None for c in closures):
+            return closures
+        return None
+
+    def get_closure(self, package, closures, vpkgs):
+        """ Get the closure of a single package from the closures
+        returned by :func:`get_closures`.  The closure is taken from
+        the first source that provides the package, since that is the
+        source whose dependencies :func:`get_deps` uses.  It is not
+        used if any package in it is also provided by an earlier
+        source, which would override its dependencies, or is a
+        virtual package in any source, which must be resolved by
+        :func:`complete` instead.
+
+        :param package: The name of the package
+        :type package: string
+        :param closures: The closures returned by :func:`get_closures`
+        :type closures: list
+        :param vpkgs: The virtual packages of this collection, as
+                      returned by :func:`get_vpkgs`
+        :type vpkgs: dict
+        :returns: tuple of iterables - The names of all packages in
+                  the closure, and the names of all dependencies that
+                  must still be resolved, or None if no closure can be
+                  used
+        """
+        for idx, source in enumerate(self):
+            if closures[idx] is not None and package in closures[idx][0]:
+                break
+            if source.is_package(self.metadata, package):
+                return None
+        else:
+            return None
+        closure = closures[idx][0][package]
+        earlier = self[:idx]
+        for name in closure:
+            if name in vpkgs or any(s.is_package(self.metadata, name)
+                                    for s in earlier):
+                self.debug_log("Packages: Not using closure of %s from %s: "
+                               "%s is provided elsewhere" %
+                               (package, source, name))
+                return None
+        return closure, closures[idx][1][package]
+
     def get_essential(self):
         """ Get a list of packages that are essential to the repository.
 
@@ -518,6 +583,9 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
             self.virt_pkgs[pgrps] = self.get_vpkgs()
         vpkg_cache = self.virt_pkgs[pgrps]
 
+        # precomputed closures of unambiguous dependencies, if any
+        closures = self.get_closures()
+
         # unclassified is set of unsatisfied requirements (may be pkg
         # for vpkg)
         unclassified = set(packagelist)
@@ -528,6 +596,9 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
         packages = set()
         examined = set()
         unknown = set()
+        # number of packages whose dependencies were resolved one at
+        # a time, rather than with a closure
+        misses = 0
 
         final_pass = False
         really_done = False
@@ -561,9 +632,27 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
                 # direct packages; current can be added, and all deps
                 # should be resolved
                 current = pkgs.pop()
+                if current in packages:
+                    # already added, along with its dependencies, as
+                    # part of the closure of another package
+                    continue
                 self.debug_log("Packages: handling package requirement %s" %
                                current)
                 packages.add(current)
+                closure = None
+                if closures is not None:
+                    closure = self.get_closure(current, closures, vpkg_cache)
+                if closure is not None:
+                    closure, frontier = closure
+                    packages.update(closure)
+                    examined.update(closure)
+                    newdeps = set(frontier).difference(examined)
+                    self.debug_log("Packages: Package %s added closure of %d "
+                                   "packages and requirements %s" %
+                                   (current, len(closure), newdeps))
+                    unclassified.update(newdeps)
+                    continue
+                misses += 1
                 deps = self.get_deps(current)
                 newdeps = set(deps).difference(examined)
                 if newdeps:
@@ -612,6 +701,8 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
                 final_pass = False
 
             self.filter_unknown(unknown)
+        Bcfg2.Statistics.stats.add_value(
+            "%s:closure_misses" % self.__class__.__name__, misses)
         return packages, unknown
 
 
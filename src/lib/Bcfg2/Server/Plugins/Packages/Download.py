@@ -0,0 +1,375 @@
+""" Concurrent, conditional downloads of repository metadata and GPG
+keys for the Packages plugin.
+
+Files are fetched by a bounded pool of threads.  HTTP and HTTPS
+requests are made directly with :mod:`httplib`, so that connections
+to the same host are reused for all of the files fetched in one
+batch; other URL schemes, and URLs that must go through a proxy, are
+fetched with :func:`urlopen`.
+
+Every request is conditional: the ``ETag`` and ``Last-Modified``
+headers of each downloaded file are stored next to it, in a file with
+the suffix :attr:`VALIDATORS_SUFFIX`, and are sent back as
+``If-None-Match`` and ``If-Modified-Since`` the next time the file is
+fetched.  A file is only replaced, atomically, if the server sends
+new content that differs from the local copy, so callers can tell
+whether anything has actually changed. """
+
+import os
+import sys
+import socket
+import filecmp
+import tempfile
+import threading
+from Bcfg2.Compat import httplib, urlparse, urljoin, urlopen, Request, \
+    getproxies, HTTPError, URLError, Queue, Empty, b64encode
+
+#: The suffix of the file next to each downloaded file that holds the
+#: validators (``ETag`` and ``Last-Modified`` headers) to use for
+#: conditional requests
+VALIDATORS_SUFFIX = ".validators"
+
+#: The maximum number of redirects to follow for a single URL
+MAX_REDIRECTS = 5
+
+# the size of the blocks in which downloaded data is written
+BLOCK_SIZE = 64 * 1024
+
+# the headers used as validators for conditional requests, and the
+# request headers used to send them back
+VALIDATORS = dict([("ETag", "If-None-Match"),
+                   ("Last-Modified", "If-Modified-Since")])
+
+
+def validators_file(fname):
+    """ Get the path to the file that holds the validators for the
+    given downloaded file.
+
+    :param fname: The path to the downloaded file
+    :type fname: string
+    :returns: string """
+    return fname + VALIDATORS_SUFFIX
+
+
+def read_validators(fname):
+    """ Read the validators stored for the given downloaded file.
+
+    :param fname: The path to the downloaded file
+    :type fname: string
+    :returns: dict of <header name> -> <value>; empty if the file or
+              its validators do not exist """
+    rv = dict()
+    if not os.path.exists(fname):
+        return rv
+    try:
+        data = open(validators_file(fname)).read()
+    except IOError:
+        return rv
+    for line in data.splitlines():
+        if ':' in line:
+            header, value = line.split(':', 1)
+            if header in VALIDATORS:
+                rv[header] = value.strip()
+    return rv
+
+
+def write_validators(fname, validators):
+    """ Store the validators for the given downloaded file, or remove
+    them if there are none.
+
+    :param fname: The path to the downloaded file
+    :type fname: string
+    :param validators: dict of <header name> -> <value>
+    :type validators: dict
+    :raises: IOError, OSError - If the validators cannot be written """
+    vfile = validators_file(fname)
+    validators = dict([(h, v) for h, v in validators.items() if v])
+    if validators:
+        _atomic_write(vfile, "".join(["%s: %s\n" % (h, v)
+                                      for h, v in validators.items()]))
+    elif os.path.exists(vfile):
+        os.unlink(vfile)
+
+
+def _atomic_write(fname, data):
+    """ write the given data to a temp file and rename it to fname """
+    fd, tmpfile = tempfile.mkstemp(prefix=".%s." % os.path.basename(fname),
+                                   dir=os.path.dirname(fname) or ".")
+    try:
+        os.write(fd, data.encode('UTF-8'))
+        os.close(fd)
+        os.chmod(tmpfile, 420)  # 0644
+        os.rename(tmpfile, fname)
+    except:
+        os.unlink(tmpfile)
+        raise
+
+
+class Downloader(object):
+    """ Downloads files concurrently, reusing connections to each
+    host, and only replaces files that have changed.  The Packages
+    plugin uses the module-level instance, :attr:`downloader`. """
+
+    def __init__(self, workers=4, timeout=60):
+        """
+        :param workers: The maximum number of files to download at
+                        once
+        :type workers: int
+        :param timeout: The timeout, in seconds, for network
+                        operations
+        :type timeout: int or float
+        """
+        self.workers = workers
+        self.timeout = timeout
+
+        # mapping of (<scheme>, <host>, <port>) -> list of idle
+        # connections to that host
+        self._idle = dict()
+        self._lock = threading.Lock()
+
+    def _checkout(self, key):
+        """ get an idle connection to the given host, or a new one.
+        returns a tuple of (<connection>, <True if reused>) """
+        self._lock.acquire()
+        try:
+            if self._idle.get(key):
+                return self._idle[key].pop(), True
+        finally:
+            self._lock.release()
+        if key[0] == "https":
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        return cls(key[1], key[2], timeout=self.timeout), False
+
+    def _checkin(self, key, conn):
+        """ return a connection to the pool of idle connections """
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """ Close all idle connections. """
+        self._lock.acquire()
+        try:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = dict()
+        finally:
+            self._lock.release()
+
+    def _request(self, url, headers):
+        """ make a GET request over a pooled connection, following
+        redirects.  returns a tuple of (<pool key>, <connection>,
+        <response>, <final url>) """
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            key = (parsed.scheme, parsed.hostname, parsed.port)
+            path = parsed.path or "/"
+            if parsed.query:
+                path += "?" + parsed.query
+            rheaders = dict(headers)
+            if parsed.username:
+                rheaders['Authorization'] = "Basic %s" % \
+                    b64encode("%s:%s" % (parsed.username,
+                                         parsed.password or ""))
+
+            conn, reused = self._checkout(key)
+            try:
+                conn.request("GET", path, headers=rheaders)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise URLError(sys.exc_info()[1])
+                # the server closed an idle connection; try again
+                # with a new one
+                conn, reused = self._checkout(key)
+                try:
+                    conn.request("GET", path, headers=rheaders)
+                    response = conn.getresponse()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    raise URLError(sys.exc_info()[1])
+
+            if (response.status in [301, 302, 303, 307, 308] and
+                response.getheader("Location")):
+                response.read()
+                self._checkin(key, conn)
+                url = urljoin(url, response.getheader("Location"))
+                continue
+            return key, conn, response, url
+        raise URLError("Too many redirects fetching %s" % url)
+
+    def _fetch_http(self, url, headers, outfile):
+        """ fetch a URL with httplib, writing it to outfile.  returns
+        a tuple of (<status>, <response headers>) """
+        key, conn, response, url = self._request(url, headers)
+        try:
+            if response.status == 304:
+                response.read()
+                self._checkin(key, conn)
+                return 304, dict()
+            if response.status != 200:
+                response.read()
+                raise HTTPError(url, response.status, response.reason,
+                                response.msg, None)
+            while True:
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+                outfile.write(data)
+        except:
+            conn.close()
+            raise
+        self._checkin(key, conn)
+        return 200, dict([(h, response.getheader(h)) for h in VALIDATORS])
+
+    def _fetch_urlopen(self, url, headers, outfile):
+        """ fetch a URL with urlopen, writing it to outfile.  returns
+        a tuple of (<status>, <response headers>) """
+        parsed = urlparse(url)
+        headers = dict(headers)
+        if parsed.username:
+            headers['Authorization'] = "Basic %s" % \
+                b64encode("%s:%s" % (parsed.username, parsed.password or ""))
+            url = url.replace("%s@" % parsed.netloc.rsplit("@", 1)[0], "",
+                              1)
+        try:
+            response = urlopen(Request(url, headers=headers),
+                               timeout=self.timeout)
+        except HTTPError:
+            if sys.exc_info()[1].code == 304:
+                return 304, dict()
+            raise
+        try:
+            while True:
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+                outfile.write(data)
+            info = response.info()
+            return 200, dict([(h, info.get(h)) for h in VALIDATORS])
+        finally:
+            response.close()
+
+    def fetch(self, url, fname):
+        """ Download a file, unless it has not changed since it was
+        last downloaded.
+
+        :param url: The URL to download
+        :type url: string
+        :param fname: The local path to save the file to
+        :type fname: string
+        :returns: bool - True if the local file was changed, False if
+                  it was already up to date
+        :raises: ValueError - Malformed URL
+        :raises: HTTPError - The server returned an error
+        :raises: URLError - Failure fetching URL
+        :raises: IOError, OSError - Failure writing the local file
+        """
+        parsed = urlparse(url)
+        if (not parsed.scheme or
+            (not parsed.netloc and parsed.scheme != 'file')):
+            raise ValueError("Malformed URL %s" % url)
+        headers = dict()
+        for header, value in read_validators(fname).items():
+            headers[VALIDATORS[header]] = value
+
+        fd, tmpfile = tempfile.mkstemp(prefix=".%s." %
+                                       os.path.basename(fname),
+                                       dir=os.path.dirname(fname) or ".")
+        try:
+            outfile = os.fdopen(fd, 'wb')
+            try:
+                if (parsed.scheme in ["http", "https"] and
+                    parsed.scheme not in getproxies()):
+                    status, validators = self._fetch_http(url, headers,
+                                                          outfile)
+                else:
+                    status, validators = self._fetch_urlopen(url, headers,
+                                                             outfile)
+            finally:
+                outfile.close()
+            if status == 304:
+                os.unlink(tmpfile)
+                return False
+            if (os.path.exists(fname) and
+                filecmp.cmp(tmpfile, fname, shallow=False)):
+                os.unlink(tmpfile)
+                changed = False
+            else:
+                os.chmod(tmpfile, 420)  # 0644
+                os.rename(tmpfile, fname)
+                changed = True
+        except:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            raise
+        write_validators(fname, validators)
+        return changed
+
+    def map(self, func, items):
+        """ Call a function on each of the given items, using up to
+        :attr:`workers` threads at once.
+
+        :param func: The function to call.  It is given a single item
+                     as its only argument.
+        :type func: callable
+        :param items: The items to call ``func`` on
+        :type items: list
+        :returns: list - The return value of ``func`` for each item,
+                  in order, or the exception raised by it
+        """
+        results = [None] * len(items)
+        jobs = Queue()
+        for job in enumerate(items):
+            jobs.put(job)
+
+        def worker():
+            """ run jobs until none are left """
+            while True:
+                try:
+                    idx, item = jobs.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[idx] = func(item)
+                except:  # pylint: disable=W0702
+                    results[idx] = sys.exc_info()[1]
+
+        threads = []
+        for i in range(max(1, min(self.workers, len(items))) - 1):
+            thread = threading.Thread(name="PackagesDownload%d" % i,
+                                      target=worker)
+            thread.start()
+            threads.append(thread)
+        worker()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def fetch_all(self, downloads):
+        """ Download several files concurrently with :func:`fetch`,
+        using up to :attr:`workers` threads at once.
+
+        :param downloads: A list of (<url>, <local path>) tuples
+        :type downloads: list of tuples
+        :returns: dict of <url> -> <result>, where each result is the
+                  return value of :func:`fetch`, or the exception
+                  raised by it
+        """
+        downloads = list(dict(downloads).items())
+        try:
+            results = self.map(lambda d: self.fetch(*d), downloads)
+        finally:
+            self.close()
+        return dict([(url, results[i])
+                     for i, (url, _) in enumerate(downloads)])
+
+
+#: The :class:`Downloader` used by the Packages plugin and its sources
+downloader = Downloader()
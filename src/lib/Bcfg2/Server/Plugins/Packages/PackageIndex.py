@@ -0,0 +1,467 @@
+""" A compact, memory-mappable on-disk index of package data, used by
+:class:`Bcfg2.Server.Plugins.Packages.Source.Source` objects to cache
+the data parsed from their repositories.
+
+An index holds any number of named *sets* of strings (e.g., the names
+of all packages in a source) and named *maps* of strings to lists of
+strings (e.g., the dependencies of each package).  Sets and maps are
+organized into groups, so that a source can store, for instance, one
+map of dependencies for each architecture.
+
+All strings in an index are stored once, in a sorted string table, and
+are referred to everywhere else by their position in that table.  Sets
+are stored as sorted arrays of string IDs, and maps as a sorted array
+of key IDs with an adjacency array of value IDs.  The file is
+memory-mapped the first time it is used, and lookups are done directly
+against the mapped file by binary search, so loading an index is
+nearly instantaneous, strings are only decoded when they are used, and
+the operating system can share the pages of an index among processes.
+
+The file format is:
+
+* An 8-byte magic string, ``BCFG2IDX``;
+* The format version, as a 4-byte unsigned integer;
+* The length of the table of contents, as a 4-byte unsigned integer;
+* The table of contents, a pickled dict that gives the location of
+  each section of the file, the byte order of the integers in the
+  file, and any extra data stored with the index;
+* The string table, sets, and maps, each aligned to 4 bytes.  All
+  integers are 4-byte unsigned integers in native byte order.
+"""
+
+import os
+import sys
+import mmap
+import array
+import struct
+import bisect
+import tempfile
+from Bcfg2.Compat import cPickle
+
+#: The magic string at the start of every index file
+MAGIC = "BCFG2IDX".encode('UTF-8')
+
+#: The version of the index file format.  Files with a different
+#: version are rejected, so that they are rebuilt.
+VERSION = 1
+
+# the struct format of the fixed-size header: magic, version, length
+# of the table of contents
+HEADER = "=8sII"
+
+# the typecode of an array of 4-byte unsigned integers
+if array.array('I').itemsize == 4:
+    TYPECODE = 'I'
+else:
+    TYPECODE = 'L'
+
+
+def _encode(string):
+    """ encode a string for storage in an index """
+    if isinstance(string, bytes):
+        return string
+    return string.encode('UTF-8')
+
+
+if sys.hexversion >= 0x03000000:
+    def _decode(data):
+        """ decode a string from an index """
+        return data.decode('UTF-8')
+else:
+    def _decode(data):
+        """ decode a string from an index """
+        return data
+
+
+class PackageIndex(object):
+    """ A read-only view of a package index file.  The table of
+    contents is read when the object is created, so that a missing or
+    invalid file is detected right away; the rest of the file is only
+    memory-mapped when it is first used. """
+
+    def __init__(self, fname):
+        """
+        :param fname: The path to the index file
+        :type fname: string
+        :raises: IOError - If the file cannot be read
+        :raises: ValueError - If the file is not a valid index, or was
+                 written by a different version of the index format
+        """
+        self.fname = fname
+        self._map = None
+        self._strings = None
+        self._string_offsets = None
+
+        datafile = open(fname, 'rb')
+        try:
+            header = datafile.read(struct.calcsize(HEADER))
+            if len(header) != struct.calcsize(HEADER):
+                raise ValueError("%s is not a package index" % fname)
+            magic, version, toclen = struct.unpack(HEADER, header)
+            if magic != MAGIC:
+                raise ValueError("%s is not a package index" % fname)
+            if version != VERSION:
+                raise ValueError("%s is version %s of the package index "
+                                 "format, not version %s" %
+                                 (fname, version, VERSION))
+            toc = cPickle.loads(datafile.read(toclen))
+        finally:
+            datafile.close()
+        if toc['byteorder'] != sys.byteorder:
+            raise ValueError("%s was written on a %s-endian machine" %
+                             (fname, toc['byteorder']))
+        self._toc = toc
+
+        #: Extra data stored with the index
+        self.extra = toc['extra']
+
+    def _get_map(self):
+        """ memory-map the index file, if it isn't already """
+        if self._map is None:
+            datafile = open(self.fname, 'rb')
+            try:
+                self._map = mmap.mmap(datafile.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            finally:
+                datafile.close()
+            offset, count = self._toc['strings']
+            self._string_offsets = offset
+            self._strings = offset + 4 * (count + 1)
+        return self._map
+
+    def close(self):
+        """ Unmap the index file.  It will be mapped again if it is
+        used. """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _int(self, offset, idx):
+        """ get the ``idx``'th integer from the array at ``offset`` """
+        start = offset + 4 * idx
+        return struct.unpack("=I", self._get_map()[start:start + 4])[0]
+
+    def _ints(self, offset, start, end):
+        """ get integers ``start`` through ``end`` from the array at
+        ``offset`` """
+        rv = array.array(TYPECODE)
+        if end > start:
+            data = self._get_map()[offset + 4 * start:offset + 4 * end]
+            if hasattr(rv, "frombytes"):
+                rv.frombytes(data)
+            else:
+                rv.fromstring(data)
+        return rv
+
+    def _raw_string(self, sid):
+        """ get the encoded string with the given ID """
+        mapped = self._get_map()
+        start = self._int(self._string_offsets, sid)
+        end = self._int(self._string_offsets, sid + 1)
+        return mapped[self._strings + start:self._strings + end]
+
+    def string(self, sid):
+        """ Get the string with the given ID
+
+        :param sid: The ID of the string
+        :type sid: int
+        :returns: string
+        """
+        return _decode(self._raw_string(sid))
+
+    def string_id(self, string):
+        """ Get the ID of a string
+
+        :param string: The string to look up
+        :type string: string
+        :returns: int - the ID of the string, or None if the string is
+                  not in the index
+        """
+        data = _encode(string)
+        low = 0
+        high = self._toc['strings'][1]
+        while low < high:
+            mid = (low + high) // 2
+            if self._raw_string(mid) < data:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._toc['strings'][1] and self._raw_string(low) == data:
+            return low
+        return None
+
+    def sets(self, group):
+        """ Get all sets in the given group
+
+        :param group: The name of the group
+        :type group: string
+        :returns: dict of <set name> -> :class:`IndexSet`
+        """
+        return dict([(name, IndexSet(self, offset, count))
+                     for name, (offset, count)
+                     in self._toc['sets'].get(group, dict()).items()])
+
+    def maps(self, group):
+        """ Get all maps in the given group
+
+        :param group: The name of the group
+        :type group: string
+        :returns: dict of <map name> -> :class:`IndexMap`
+        """
+        return dict([(name, IndexMap(self, *location))
+                     for name, location
+                     in self._toc['maps'].get(group, dict()).items()])
+
+    @classmethod
+    def write(cls, fname, sets=None, maps=None, extra=None):
+        """ Write a new index file.  The file is written to a
+        temporary file that is then renamed over ``fname``, so that
+        readers of an existing index are not disturbed.
+
+        :param fname: The path to the index file
+        :type fname: string
+        :param sets: A dict of <group name> -> <set name> -> <iterable
+                     of strings>
+        :type sets: dict
+        :param maps: A dict of <group name> -> <map name> -> <dict of
+                     string -> iterable of strings>
+        :type maps: dict
+        :param extra: Any extra (picklable) data to store with the
+                      index, available as :attr:`extra` when it is
+                      read
+        :raises: IOError, OSError - If the file cannot be written
+        """
+        if sets is None:
+            sets = dict()
+        if maps is None:
+            maps = dict()
+
+        # build the string table
+        strings = set()
+        for group in sets.values():
+            for members in group.values():
+                strings.update([_encode(s) for s in members])
+        for group in maps.values():
+            for mapping in group.values():
+                for key, values in mapping.items():
+                    strings.add(_encode(key))
+                    strings.update([_encode(v) for v in values])
+        strings = sorted(strings)
+        ids = dict([(s, i) for i, s in enumerate(strings)])
+
+        sections = []
+        toc = dict(byteorder=sys.byteorder, extra=extra, sets=dict(),
+                   maps=dict())
+        position = [0]
+
+        def add_section(data):
+            """ add a section of data, padded to 4 bytes, and return
+            its offset from the start of the data """
+            offset = position[0]
+            if len(data) % 4:
+                data += "\0".encode('UTF-8') * (4 - len(data) % 4)
+            sections.append(data)
+            position[0] += len(data)
+            return offset
+
+        def tobytes(arr):
+            """ get the raw data of an array """
+            if hasattr(arr, "tobytes"):
+                return arr.tobytes()
+            return arr.tostring()
+
+        offsets = array.array(TYPECODE, [0])
+        for string in strings:
+            offsets.append(offsets[-1] + len(string))
+        toc['strings'] = (add_section(tobytes(offsets) +
+                                      "".encode('UTF-8').join(strings)),
+                          len(strings))
+
+        for gname, group in sets.items():
+            toc['sets'][gname] = dict()
+            for name, members in group.items():
+                members = sorted(set([ids[_encode(s)] for s in members]))
+                toc['sets'][gname][name] = \
+                    (add_section(tobytes(array.array(TYPECODE, members))),
+                     len(members))
+
+        for gname, group in maps.items():
+            toc['maps'][gname] = dict()
+            for name, mapping in group.items():
+                keys = array.array(TYPECODE)
+                voffsets = array.array(TYPECODE, [0])
+                values = array.array(TYPECODE)
+                for key in sorted(mapping.keys(), key=_encode):
+                    keys.append(ids[_encode(key)])
+                    values.extend([ids[_encode(v)] for v in mapping[key]])
+                    voffsets.append(len(values))
+                toc['maps'][gname][name] = (add_section(tobytes(keys)),
+                                            len(keys),
+                                            add_section(tobytes(voffsets)),
+                                            add_section(tobytes(values)))
+
+        # now that the length of the table of contents is known, make
+        # all offsets absolute
+        start = [0]
+
+        def absolute(offset):
+            """ get the absolute offset of a section """
+            return start[0] + offset
+
+        def build_toc():
+            """ build the table of contents with absolute offsets """
+            rv = dict(byteorder=toc['byteorder'], extra=toc['extra'],
+                      sets=dict(), maps=dict())
+            rv['strings'] = (absolute(toc['strings'][0]), toc['strings'][1])
+            for gname, group in toc['sets'].items():
+                rv['sets'][gname] = dict(
+                    [(name, (absolute(offset), count))
+                     for name, (offset, count) in group.items()])
+            for gname, group in toc['maps'].items():
+                rv['maps'][gname] = dict(
+                    [(name, (absolute(koff), count, absolute(ooff),
+                             absolute(voff)))
+                     for name, (koff, count, ooff, voff) in group.items()])
+            return cPickle.dumps(rv, 2)
+
+        # the length of the pickled table of contents depends on the
+        # offsets in it, so iterate until it is stable
+        pickled = build_toc()
+        while True:
+            length = struct.calcsize(HEADER) + len(pickled)
+            start[0] = length + (4 - length % 4) % 4
+            new = build_toc()
+            if len(new) == len(pickled):
+                pickled = new
+                break
+            pickled = new
+        header = struct.pack(HEADER, MAGIC, VERSION, len(pickled)) + pickled
+        header += "\0".encode('UTF-8') * (start[0] - len(header))
+
+        dirname = os.path.dirname(os.path.abspath(fname))
+        fd, tmpfile = tempfile.mkstemp(prefix=".%s." % os.path.basename(fname),
+                                       dir=dirname)
+        try:
+            datafile = os.fdopen(fd, 'wb')
+            try:
+                datafile.write(header)
+                for data in sections:
+                    datafile.write(data)
+            finally:
+                datafile.close()
+            os.chmod(tmpfile, 420)  # 0644
+            os.rename(tmpfile, fname)
+        except:
+            os.unlink(tmpfile)
+            raise
+
+
+class IndexSet(object):
+    """ A read-only set of strings stored in a :class:`PackageIndex`.
+    This supports membership tests, iteration, and :func:`len`. """
+
+    def __init__(self, index, offset, count):
+        self.index = index
+        self.offset = offset
+        self.count = count
+
+    def _find(self, sid):
+        """ find the position of the given string ID in the set, or
+        None if it is not a member """
+        low = 0
+        high = self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.index._int(self.offset, mid) < sid:  # pylint: disable=W0212
+                low = mid + 1
+            else:
+                high = mid
+        if (low < self.count and
+            self.index._int(self.offset, low) == sid):  # pylint: disable=W0212
+            return low
+        return None
+
+    def __contains__(self, string):
+        sid = self.index.string_id(string)
+        return sid is not None and self._find(sid) is not None
+
+    def __iter__(self):
+        for sid in self.index._ints(self.offset, 0,  # pylint: disable=W0212
+                                    self.count):
+            yield self.index.string(sid)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "%s(%d items)" % (self.__class__.__name__, self.count)
+
+
+class IndexMap(object):
+    """ A read-only mapping of strings to lists of strings stored in
+    a :class:`PackageIndex`.  This supports the read-only parts of the
+    dict interface. """
+
+    def __init__(self, index, keys, count, offsets, values):
+        self.index = index
+        self.keys_offset = keys
+        self.count = count
+        self.offsets = offsets
+        self.values_offset = values
+        self._set = IndexSet(index, keys, count)
+
+    def _values(self, pos):
+        """ get the values for the key at the given position """
+        # pylint: disable=W0212
+        start = self.index._int(self.offsets, pos)
+        end = self.index._int(self.offsets, pos + 1)
+        return [self.index.string(sid)
+                for sid in self.index._ints(self.values_offset, start, end)]
+        # pylint: enable=W0212
+
+    def _find(self, key):
+        """ find the position of the given key, or None """
+        sid = self.index.string_id(key)
+        if sid is None:
+            return None
+        return self._set._find(sid)  # pylint: disable=W0212
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    has_key = __contains__
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos is None:
+            raise KeyError(key)
+        return self._values(pos)
+
+    def get(self, key, default=None):
+        """ get the values for the given key, or ``default`` """
+        pos = self._find(key)
+        if pos is None:
+            return default
+        return self._values(pos)
+
+    def __iter__(self):
+        return iter(self._set)
+
+    def keys(self):
+        """ get a list of all keys """
+        return list(self._set)
+
+    def items(self):
+        """ get a list of all (key, values) tuples """
+        return [(key, self._values(pos))
+                for pos, key in enumerate(self._set)]
+
+    def values(self):
+        """ get a list of the values for all keys """
+        return [self._values(pos) for pos in range(self.count)]
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "%s(%d items)" % (self.__class__.__name__, self.count)
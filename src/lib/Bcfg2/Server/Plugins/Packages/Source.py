@@ -50,8 +50,11 @@ in your ``Source`` subclass.  For an example of this kind of
 import os
 import re
 import sys
+import array
 import Bcfg2.Server.Plugin
-from Bcfg2.Compat import HTTPError, HTTPBasicAuthHandler, \
+from Bcfg2.Server.Plugins.Packages.PackageIndex import PackageIndex
+from Bcfg2.Server.Plugins.Packages.Download import downloader
+from Bcfg2.Compat import HTTPError, URLError, HTTPBasicAuthHandler, \
      HTTPPasswordMgrWithDefaultRealm, install_opener, build_opener, \
      urlopen, cPickle, md5
 
@@ -82,6 +85,169 @@ class SourceInitError(Exception):
     pass
 
 
+#: The largest dependency closure, counting both the packages in it
+#: and its unresolved dependencies, that :func:`dependency_closures`
+#: will keep.  Packages with larger closures (and packages that
+#: depend on them) are resolved one dependency at a time instead, so
+#: that densely connected repositories do not produce enormous caches.
+MAX_CLOSURE = 1000
+
+
+class _ArchMetadata(object):
+    """ A minimal stand-in for client metadata, used to look up the
+    data for a single architecture of a source when computing
+    dependency closures. """
+
+    def __init__(self, arch):
+        self.hostname = None
+        self.groups = set([arch])
+
+
+class _Names(object):
+    """ An iterable of the names with the given indexes in a list.
+    This lets dependency closures be held as compact arrays until
+    they are written to the cache. """
+    __slots__ = ['names', 'ids']
+
+    def __init__(self, names, ids):
+        self.names = names
+        self.ids = ids
+
+    def __iter__(self):
+        names = self.names
+        for idx in self.ids:
+            yield names[idx]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def dependency_closures(packages, get_deps, limit=MAX_CLOSURE):
+    """ Compute the transitive dependency closure of each of the given
+    packages, following only dependencies on other packages in the
+    set.  The dependency graph is condensed into its strongly
+    connected components, which are visited in dependency order, so
+    each closure is built only once per component from the closures
+    of the components it depends on.
+
+    :param packages: The names of the packages to compute closures
+                     for.  Dependencies on names not in this set are
+                     not followed.
+    :type packages: set of strings
+    :param get_deps: A callable that returns the direct dependencies
+                     of a package
+    :type get_deps: callable
+    :param limit: The largest closure to keep; see :attr:`MAX_CLOSURE`
+    :type limit: int
+    :returns: tuple of dicts - The first maps each package name to an
+              iterable of the names of all packages in its closure,
+              including itself; the second maps each package name to
+              an iterable of all dependencies of packages in its
+              closure that are not in ``packages``.  Packages whose
+              closures are larger than ``limit`` are omitted.
+    """
+    # pylint: disable=R0914
+    names = sorted(packages)
+    ids = dict([(name, i) for i, name in enumerate(names)])
+    others = []
+    other_ids = dict()
+    succ = []
+    external = []
+    for name in names:
+        pkg_succ = []
+        pkg_external = []
+        for dep in get_deps(name):
+            if dep in ids:
+                pkg_succ.append(ids[dep])
+            else:
+                if dep not in other_ids:
+                    other_ids[dep] = len(others)
+                    others.append(dep)
+                pkg_external.append(other_ids[dep])
+        succ.append(pkg_succ)
+        external.append(pkg_external)
+
+    # iterative Tarjan's algorithm.  components are completed in
+    # dependency order, so the closures of all components that a
+    # component depends on are always available when it is completed
+    index = [None] * len(names)
+    low = [0] * len(names)
+    onstack = [False] * len(names)
+    component = [None] * len(names)
+    stack = []
+    closures = []
+    frontiers = []
+    counter = 0
+    for root in range(len(names)):
+        if index[root] is not None:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        onstack[root] = True
+        work = [(root, iter(succ[root]))]
+        while work:
+            node, children = work[-1]
+            descended = False
+            for child in children:
+                if index[child] is None:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    onstack[child] = True
+                    work.append((child, iter(succ[child])))
+                    descended = True
+                    break
+                elif onstack[child] and index[child] < low[node]:
+                    low[node] = index[child]
+            if descended:
+                continue
+            work.pop()
+            if work and low[node] < low[work[-1][0]]:
+                low[work[-1][0]] = low[node]
+            if low[node] != index[node]:
+                continue
+
+            members = []
+            while True:
+                member = stack.pop()
+                onstack[member] = False
+                component[member] = len(closures)
+                members.append(member)
+                if member == node:
+                    break
+            closure = set(members)
+            frontier = set()
+            for member in members:
+                if len(closure) + len(frontier) > limit:
+                    break
+                frontier.update(external[member])
+                for child in succ[member]:
+                    if component[child] == len(closures):
+                        continue
+                    if closures[component[child]] is None:
+                        # too large
+                        closure = frontier = None
+                        break
+                    closure.update(closures[component[child]])
+                    frontier.update(frontiers[component[child]])
+                if closure is None:
+                    break
+            if closure is None or len(closure) + len(frontier) > limit:
+                closures.append(None)
+                frontiers.append(None)
+            else:
+                closures.append(array.array('I', sorted(closure)))
+                frontiers.append(array.array('I', sorted(frontier)))
+
+    return (dict([(name, _Names(names, closures[component[i]]))
+                  for i, name in enumerate(names)
+                  if closures[component[i]] is not None]),
+            dict([(name, _Names(others, frontiers[component[i]]))
+                  for i, name in enumerate(names)
+                  if closures[component[i]] is not None]))
+
+
 #: A regular expression used to determine the base name of a repo from
 #: its URL.  This is used when generating repo configs and by
 #: :func:`Source.get_repo_name`.  It handles `Pulp
@@ -252,6 +418,26 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
         #: :class:`Bcfg2.Server.Plugins.Packages.Collection.Collection`
         self.provides = dict()
 
+        #: A dict of ``<arch>`` -> ``<package name>`` -> ``<list of
+        #: packages>`` giving the transitive closure of the
+        #: dependencies of each package on other packages, as computed
+        #: by :func:`compute_closures`.  This will not necessarily be
+        #: populated, particularly by backends that reimplement large
+        #: portions of
+        #: :class:`Bcfg2.Server.Plugins.Packages.Collection.Collection`
+        self.closures = dict()
+
+        #: A dict of ``<arch>`` -> ``<package name>`` -> ``<list of
+        #: symbols>`` giving all dependencies in the closure of each
+        #: package in :attr:`closures` that are not themselves simple
+        #: packages (e.g., virtual packages), and so must be resolved
+        #: when the closure is used.
+        self.frontiers = dict()
+
+        # cache of the results of get_vpkgs() by architecture groups,
+        # which is reset whenever the source data changes
+        self._vpkgs = dict()
+
         #: The file (or directory) used for this source's cache data
         self.cachefile = os.path.join(self.basepath,
                                       "cache-%s" % self.cachekey)
@@ -313,23 +499,130 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
         state is handled by the package library, then this function
         does not need to be implemented.
 
+        The cache is a
+        :class:`Bcfg2.Server.Plugins.Packages.PackageIndex.PackageIndex`,
+        which is memory-mapped rather than read into memory, so
+        :attr:`pkgnames`, :attr:`deps`, and :attr:`provides` are
+        replaced with read-only views of the index.
+
         :raises: OSError - If the saved data cannot be read
-        :raises: cPickle.UnpicklingError - If the saved data is corrupt """
-        data = open(self.cachefile)
-        (self.pkgnames, self.deps, self.provides,
-         self.essentialpkgs) = cPickle.load(data)
+        :raises: ValueError - If the saved data is not a valid index """
+        index = PackageIndex(self.cachefile)
+        self.pkgnames = index.sets("pkgnames").get("all", set())
+        self.essentialpkgs = set(index.sets("essential").get("all", ()))
+        self.deps = index.maps("deps")
+        self.provides = index.maps("provides")
+        self.closures = index.maps("closures")
+        self.frontiers = index.maps("frontiers")
+        self._vpkgs = dict()
 
     def save_state(self):
         """ Save state to :attr:`cachefile`.  If caching and
         state is handled by the package library, then this function
-        does not need to be implemented. """
-        cache = open(self.cachefile, 'wb')
-        cPickle.dump((self.pkgnames, self.deps, self.provides,
-                      self.essentialpkgs), cache, 2)
-        cache.close()
+        does not need to be implemented.  Dependency closures are
+        computed with :func:`compute_closures` and saved along with
+        the rest of the data. """
+        self.closures, self.frontiers = self.compute_closures()
+        PackageIndex.write(self.cachefile,
+                           sets=dict(pkgnames=dict(all=self.pkgnames),
+                                     essential=dict(all=self.essentialpkgs)),
+                           maps=dict(deps=self.deps, provides=self.provides,
+                                     closures=self.closures,
+                                     frontiers=self.frontiers))
+        # use the index from now on, so the parsed data can be freed
+        self.load_state()
+
+    def cache_is_current(self):
+        """ Determine whether :attr:`cachefile` holds the data parsed
+        from the current copies of all of the downloaded metadata
+        files, i.e., whether it was written after all of them were
+        last changed.  It does not if parsing a new file failed, or
+        the server stopped before the file was parsed, after it had
+        been downloaded.
+
+        :returns: bool
+        """
+        try:
+            cache_mtime = os.stat(self.cachefile).st_mtime
+            for fname in self.files:
+                if os.stat(fname).st_mtime > cache_mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def clear_state(self):
+        """ Reset all data parsed from the repository, so that
+        :func:`read_files` can be called again.  This is called by
+        :func:`setup_data` before the metadata files are read, since
+        the data loaded from a cache is read-only. """
+        self.pkgnames = set()
+        self.essentialpkgs = set()
+        self.deps = dict()
+        self.provides = dict()
+        self.closures = dict()
+        self.frontiers = dict()
+        self._vpkgs = dict()
+
+    def get_arch_packages(self, arch):  # pylint: disable=W0613
+        """ Get the names of all packages in this source that are
+        available to clients of the given architecture, regardless of
+        :attr:`blacklist` and :attr:`whitelist`.  This is used by
+        :func:`compute_closures`.
+
+        :param arch: The architecture
+        :type arch: string
+        :returns: iterable of strings
+        """
+        return self.pkgnames
 
     @Bcfg2.Server.Plugin.track_statistics()
-    def setup_data(self, force_update=False):
+    def compute_closures(self):
+        """ Compute :attr:`closures` and :attr:`frontiers` for each
+        architecture of this source from the data parsed by
+        :func:`read_files`.  A package's closure includes only those
+        dependencies that are unambiguously packages, i.e., that are
+        in :func:`get_arch_packages` and are not also virtual
+        packages; those are left in its frontier, to be resolved when
+        a client's package list is completed.
+
+        :returns: tuple of dicts - ``<arch>`` -> ``<package name>`` ->
+                  ``<iterable of strings>`` for closures and
+                  frontiers, respectively
+        """
+        closures = dict()
+        frontiers = dict()
+        for arch in self.arches:
+            metadata = _ArchMetadata(arch)
+            packages = set(self.get_arch_packages(arch))
+            packages.difference_update(self.get_vpkgs(metadata).keys())
+            closures[arch], frontiers[arch] = dependency_closures(
+                packages, lambda p, m=metadata: self.get_deps(m, p))
+        return closures, frontiers
+
+    def get_closures(self, metadata):
+        """ Get the precomputed dependency closures of the packages
+        in this source for the given client, if they can be used.
+        They cannot be used if the source has a :attr:`blacklist` or
+        :attr:`whitelist`, since those are applied only at runtime,
+        or if the client does not have exactly one of the
+        architectures of this source.
+
+        :param metadata: The client metadata
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: tuple of dicts - ``<package name>`` -> ``<list of
+                  strings>`` for the closures and frontiers,
+                  respectively, or None if they cannot be used
+        """
+        if self.blacklist or self.whitelist:
+            return None
+        arches = [a for a in self.arches if a in metadata.groups]
+        if len(arches) != 1 or arches[0] not in self.closures:
+            return None
+        return self.closures[arches[0]], self.frontiers[arches[0]]
+
+    @Bcfg2.Server.Plugin.track_statistics()
+    def setup_data(self, force_update=False, downloads=None):
         """ Perform all data fetching and setup tasks.  For most
         backends, this involves downloading all metadata from the
         repository, parsing it, and caching the parsed data locally.
@@ -340,16 +633,24 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
         #. If that fails, call :func:`read_files` to read and parse
            the locally downloaded metadata files.
         #. If that fails, call :func:`update` to fetch the metadata,
-           then :func:`read_files` to parse it.
+           then :func:`read_files` to parse it.  If none of the
+           metadata has changed, and the local cache is current (see
+           :func:`cache_is_current`), it is loaded with
+           :func:`load_state` instead.
 
         Obviously with a backend that leverages repo access libraries
         to avoid downloading all metadata, many of the functions
         called by ``setup_data`` can be no-ops (or nearly so).
 
-        :param force_update: Ignore all locally cached and downloaded
-                             data and fetch the metadata anew from the
-                             upstream repository.
+        :param force_update: Ignore all locally cached data and fetch
+                             the metadata anew from the upstream
+                             repository.
         :type force_update: bool
+        :param downloads: The files given by :func:`get_downloads`
+                          and the results of downloading them, if
+                          that has already been done.  This is passed
+                          on to :func:`update`.
+        :type downloads: list of tuples
         """
         # pylint: disable=W0702
         if not force_update:
@@ -363,6 +664,7 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
                     self.logger.error("Falling back to file read")
 
                     try:
+                        self.clear_state()
                         self.read_files()
                     except:
                         err = sys.exc_info()[1]
@@ -375,7 +677,17 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
 
         if force_update:
             try:
-                self.update()
+                if (not self.update(downloads=downloads) and
+                    self.cache_is_current()):
+                    try:
+                        self.load_state()
+                        self.logger.info("Packages: %s is up to date" % self)
+                        return
+                    except:
+                        err = sys.exc_info()[1]
+                        self.logger.error("Packages: Cachefile %s load "
+                                          "failed: %s" % (self.cachefile, err))
+                self.clear_state()
                 self.read_files()
             except:
                 err = sys.exc_info()[1]
@@ -476,6 +788,8 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
         """
         agroups = ['global'] + [a for a in self.arches
                                 if a in metadata.groups]
+        if tuple(agroups) in self._vpkgs:
+            return dict(self._vpkgs[tuple(agroups)])
         vdict = dict()
         for agrp in agroups:
             if agrp not in self.provides:
@@ -487,7 +801,8 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
                     vdict[key] = set(value)
                 else:
                     vdict[key].update(value)
-        return vdict
+        self._vpkgs[tuple(agroups)] = vdict
+        return dict(vdict)
 
     def is_virtual_package(self, metadata, package):  # pylint: disable=W0613
         """ Return True if a name is a virtual package (i.e., is a
@@ -601,34 +916,65 @@ class Source(Bcfg2.Server.Plugin.Debuggable):  # pylint: disable=R0902
         unknown.difference_update(set([u for u in unknown
                                        if self.unknown_filter(u)]))
 
-    def update(self):
-        """ Download metadata from the upstream repository and cache
-        it locally.
+    def get_downloads(self):
+        """ Get the files that :func:`update` downloads.  This is
+        called once each time the metadata is updated.
+
+        :returns: list of (<url>, <local path>) tuples
+        """
+        return [(url, self.escape_url(url)) for url in self.urls]
 
+    def update(self, downloads=None):
+        """ Download metadata from the upstream repository and cache
+        it locally.  Files are downloaded concurrently, and only if
+        they have changed upstream; see
+        :mod:`Bcfg2.Server.Plugins.Packages.Download`.
+
+        :param downloads: The files given by :func:`get_downloads`,
+                          and the result of downloading each of them
+                          with
+                          :func:`Bcfg2.Server.Plugins.Packages.Download.Downloader.fetch_all`.
+                          This lets the files for many sources be
+                          downloaded at once.  If this is not given,
+                          the files are listed and downloaded here.
+        :type downloads: list of (<url>, <local path>, <result>)
+                         tuples
+        :returns: bool - True if any files were changed
         :raises: ValueError - If any URL in :attr:`urls` is malformed
         :raises: OSError - If there is an error writing the local
                  cache
         :raises: HTTPError - If there is an error fetching the remote
                  data
         """
-        for url in self.urls:
-            self.logger.info("Packages: Updating %s" % url)
-            fname = self.escape_url(url)
-            try:
-                open(fname, 'w').write(fetch_url(url))
-            except ValueError:
+        if downloads is None:
+            files = self.get_downloads()
+            results = downloader.fetch_all(files)
+            downloads = [(url, fname, results[url]) for url, fname in files]
+
+        changed = False
+        for url, fname, result in downloads:
+            if result is True:
+                self.logger.info("Packages: Updated %s" % url)
+                changed = True
+            elif result is False:
+                self.debug_log("Packages: %s is up to date" % url)
+            elif isinstance(result, HTTPError):
+                self.logger.error("Packages: Failed to fetch url %s. HTTP "
+                                  "response code=%s" % (url, result.code))
+                raise result
+            elif isinstance(result, ValueError):
                 self.logger.error("Packages: Bad url string %s" % url)
-                raise
-            except OSError:
-                err = sys.exc_info()[1]
+                raise result
+            elif isinstance(result, URLError):
+                self.logger.error("Packages: Failed to fetch url %s: %s" %
+                                  (url, result))
+                raise result
+            else:
                 self.logger.error("Packages: Could not write data from %s to "
-                                  "local cache at %s: %s" % (url, fname, err))
-                raise
-            except HTTPError:
-                err = sys.exc_info()[1]
-                self.logger.error("Packages: Failed to fetch url %s. HTTP "
-                                  "response code=%s" % (url, err.code))
-                raise
+                                  "local cache at %s: %s" %
+                                  (url, fname, result))
+                raise result
+        return changed
 
     def applies(self, metadata):
         """ Return true if this source applies to the given client,
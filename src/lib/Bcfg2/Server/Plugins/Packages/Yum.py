@@ -54,17 +54,22 @@ import os
 import re
 import sys
 import copy
+import gzip
+import time
 import errno
 import socket
+import struct
 import logging
 import lxml.etree
 from subprocess import Popen, PIPE
+import Bcfg2.Statistics
 import Bcfg2.Server.Plugin
 # pylint: disable=W0622
-from Bcfg2.Compat import StringIO, cPickle, HTTPError, URLError, \
+from Bcfg2.Compat import StringIO, HTTPError, URLError, \
     ConfigParser, any
 # pylint: enable=W0622
 from Bcfg2.Server.Plugins.Packages.Collection import Collection
+from Bcfg2.Server.Plugins.Packages.PackageIndex import PackageIndex
 from Bcfg2.Server.Plugins.Packages.Source import SourceInitError, Source, \
      fetch_url
 
@@ -99,10 +104,48 @@ RP = '{http://linux.duke.edu/metadata/rpm}'
 RPO = '{http://linux.duke.edu/metadata/repo}'
 FL = '{http://linux.duke.edu/metadata/filelists}'
 
+#: The first bytes of every gzipped file
+GZIP_MAGIC = struct.pack("BB", 0x1f, 0x8b)
+
 PULPSERVER = None
 PULPCONFIG = None
 
 
+def iterparse(fname, tag):
+    """ Parse a (possibly gzipped) XML metadata file incrementally,
+    yielding each element with the given tag as soon as it has been
+    read in full.  Each element is cleared, along with any preceding
+    siblings, as soon as the caller has finished with it, so memory
+    use is bounded by the size of a single element rather than the
+    size of the file.
+
+    Gzipped files are recognized by their contents, not their names,
+    since :func:`lxml.etree.iterparse` does not decompress them
+    itself.
+
+    :param fname: The path to the file to parse
+    :type fname: string
+    :param tag: The fully qualified tag of the elements to yield
+    :type tag: string
+    :returns: generator of lxml.etree._Element
+    """
+    source = open(fname, 'rb')
+    if source.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+        source.close()
+        source = gzip.open(fname, 'rb')
+    else:
+        source.seek(0)
+    try:
+        for _, elem in lxml.etree.iterparse(source, events=("end",),
+                                            tag=tag):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    finally:
+        source.close()
+
+
 def _setup_pulp(setup):
     """ Connect to a Pulp server and pass authentication credentials.
     This only needs to be called once, but multiple calls won't hurt
@@ -966,6 +1009,11 @@ class YumSource(Source):
                              for x in ['global'] + self.arches])
         self.needed_paths = set()
         self.file_to_arch = dict()
+
+        # the URLs of the metadata files listed in the repomd.xml of
+        # each repository, which are only fetched again by
+        # get_downloads()
+        self._urls = None
     __init__.__doc__ = Source.__init__.__doc__
 
     @property
@@ -981,28 +1029,63 @@ class YumSource(Source):
         :attr:`cachefile`.  If using the Python yum libraries, yum
         handles caching and state and this method is a no-op."""
         if not self.use_yum:
-            cache = open(self.cachefile, 'wb')
-            cPickle.dump((self.packages, self.deps, self.provides,
-                          self.filemap, self.url_map), cache, 2)
-            cache.close()
+            self.closures, self.frontiers = self.compute_closures()
+            PackageIndex.write(self.cachefile,
+                               sets=dict(packages=self.packages),
+                               maps=dict(deps=self.deps,
+                                         provides=self.provides,
+                                         filemap=self.filemap,
+                                         closures=self.closures,
+                                         frontiers=self.frontiers),
+                               extra=self.url_map)
+            self.load_state()
 
     def load_state(self):
         """ If using the builtin yum parser, load saved state from
         :attr:`cachefile`.  If using the Python yum libraries, yum
         handles caching and state and this method is a no-op."""
         if not self.use_yum:
-            data = open(self.cachefile)
-            (self.packages, self.deps, self.provides,
-             self.filemap, self.url_map) = cPickle.load(data)
+            index = PackageIndex(self.cachefile)
+            self.packages = index.sets("packages")
+            self.deps = index.maps("deps")
+            self.provides = index.maps("provides")
+            self.filemap = index.maps("filemap")
+            self.closures = index.maps("closures")
+            self.frontiers = index.maps("frontiers")
+            self.url_map = index.extra
+            self._vpkgs = dict()
+
+    def clear_state(self):
+        self.packages = dict()
+        self.deps = dict([('global', dict())])
+        self.provides = dict([('global', dict())])
+        self.filemap = dict([(x, dict())
+                             for x in ['global'] + self.arches])
+        self.closures = dict()
+        self.frontiers = dict()
+        self._vpkgs = dict()
+        self.needed_paths = set()
+    clear_state.__doc__ = Source.clear_state.__doc__
+
+    def get_arch_packages(self, arch):
+        return set(self.packages.get('global', ())).union(
+            self.packages.get(arch, ()))
+    get_arch_packages.__doc__ = Source.get_arch_packages.__doc__
 
     @property
     def urls(self):
         """ A list of URLs to the base metadata file for each
-        repository described by this source. """
-        rv = []
-        for umap in self.url_map:
-            rv.extend(self._get_urls_from_repodata(umap['url'], umap['arch']))
-        return rv
+        repository described by this source.  Listing them fetches
+        ``repomd.xml`` from each repository, so they are only listed
+        again when :func:`get_downloads` is called to update the
+        metadata. """
+        if self._urls is None:
+            rv = []
+            for umap in self.url_map:
+                rv.extend(self._get_urls_from_repodata(umap['url'],
+                                                       umap['arch']))
+            self._urls = rv
+        return self._urls
 
     def _get_urls_from_repodata(self, url, arch):
         """ When using the builtin yum parser, given the base URL of a
@@ -1072,13 +1155,9 @@ class YumSource(Source):
                 filelists.append(fname)
 
         for fname in primaries:
-            farch = self.file_to_arch[fname]
-            fdata = lxml.etree.parse(fname).getroot()
-            self.parse_primary(fdata, farch)
+            self.parse_primary(fname, self.file_to_arch[fname])
         for fname in filelists:
-            farch = self.file_to_arch[fname]
-            fdata = lxml.etree.parse(fname).getroot()
-            self.parse_filelist(fdata, farch)
+            self.parse_filelist(fname, self.file_to_arch[fname])
 
         # merge data
         sdata = list(self.packages.values())
@@ -1097,32 +1176,60 @@ class YumSource(Source):
                 self.packages[key].difference(self.packages['global'])
         self.save_state()
 
+    def _report_throughput(self, name, count, start):
+        """ report the number of packages per second read by one of
+        the metadata parsers to :attr:`Bcfg2.Statistics.stats` """
+        elapsed = time.time() - start
+        if elapsed > 0:
+            Bcfg2.Statistics.stats.add_value(
+                "%s:%s:packages_per_second" % (self.__class__.__name__,
+                                               name),
+                count / elapsed)
+
     @Bcfg2.Server.Plugin.track_statistics()
-    def parse_filelist(self, data, arch):
-        """ parse filelists.xml.gz data """
+    def parse_filelist(self, fname, arch):
+        """ parse a filelists.xml.gz file, keeping only the files in
+        :attr:`needed_paths`.  The file is streamed, so the whole
+        file list is never held in memory.
+
+        :param fname: The path to the filelists.xml.gz file
+        :type fname: string
+        :param arch: The architecture the file is for
+        :type arch: string
+        """
         if arch not in self.filemap:
             self.filemap[arch] = dict()
-        for pkg in data.findall(FL + 'package'):
-            for fentry in pkg.findall(FL + 'file'):
+        filemap = self.filemap[arch]
+        start = time.time()
+        count = 0
+        for pkg in iterparse(fname, FL + 'package'):
+            count += 1
+            pkgname = pkg.get('name')
+            for fentry in pkg.iterchildren(FL + 'file'):
                 if fentry.text in self.needed_paths:
-                    if fentry.text in self.filemap[arch]:
-                        self.filemap[arch][fentry.text].add(pkg.get('name'))
-                    else:
-                        self.filemap[arch][fentry.text] = \
-                            set([pkg.get('name')])
+                    filemap.setdefault(fentry.text, set()).add(pkgname)
+        self._report_throughput("parse_filelist", count, start)
 
     @Bcfg2.Server.Plugin.track_statistics()
-    def parse_primary(self, data, arch):
-        """ parse primary.xml.gz data """
+    def parse_primary(self, fname, arch):
+        """ parse a primary.xml.gz file.  The file is streamed, so
+        only one package is held in memory at a time.
+
+        :param fname: The path to the primary.xml.gz file
+        :type fname: string
+        :param arch: The architecture the file is for
+        :type arch: string
+        """
         if arch not in self.packages:
             self.packages[arch] = set()
         if arch not in self.deps:
             self.deps[arch] = dict()
         if arch not in self.provides:
             self.provides[arch] = dict()
-        for pkg in data.getchildren():
-            if not pkg.tag.endswith('package'):
-                continue
+        start = time.time()
+        count = 0
+        for pkg in iterparse(fname, XP + 'package'):
+            count += 1
             pkgname = pkg.find(XP + 'name').text
             self.packages[arch].add(pkgname)
 
@@ -1141,6 +1248,7 @@ class YumSource(Source):
                     if prov not in self.provides[arch]:
                         self.provides[arch][prov] = list()
                     self.provides[arch][prov].append(pkgname)
+        self._report_throughput("parse_primary", count, start)
 
     def is_package(self, metadata, package):
         arch = [a for a in self.arches if a in metadata.groups]
@@ -1200,9 +1308,17 @@ class YumSource(Source):
             Source.filter_unknown(self, unknown)
     filter_unknown.__doc__ = Source.filter_unknown.__doc__
 
-    def setup_data(self, force_update=False):
+    def get_downloads(self):
+        if self.use_yum:
+            return []
+        self._urls = None
+        return Source.get_downloads(self)
+    get_downloads.__doc__ = Source.get_downloads.__doc__
+
+    def setup_data(self, force_update=False, downloads=None):
         if not self.use_yum:
-            Source.setup_data(self, force_update=force_update)
+            Source.setup_data(self, force_update=force_update,
+                              downloads=downloads)
     setup_data.__doc__ = \
         "``setup_data`` is only used by the builtin yum parser.  " + \
         Source.setup_data.__doc__
@@ -9,10 +9,14 @@ import shutil
 import lxml.etree
 import Bcfg2.Logger
 import Bcfg2.Server.Plugin
-from Bcfg2.Compat import ConfigParser, urlopen, HTTPError
+import Bcfg2.Server.Dependencies
+from Bcfg2.Cache import Cache
+from Bcfg2.Compat import ConfigParser, HTTPError, URLError
 from Bcfg2.Server.Plugins.Packages.Collection import Collection, \
     get_collection_class
 from Bcfg2.Server.Plugins.Packages.PackagesSources import PackagesSources
+from Bcfg2.Server.Plugins.Packages.Download import downloader, \
+    validators_file
 
 #: The default path for generated yum configs
 YUM_CONFIG_DEFAULT = "/etc/yum.repos.d/bcfg2.repo"
@@ -44,6 +48,12 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
     #: and :func:`Reload`
     __rmi__ = Bcfg2.Server.Plugin.Plugin.__rmi__ + ['Refresh', 'Reload']
 
+    #: When the :mod:`Bcfg2.Server.MultiprocessingCore` is in use,
+    #: children only need to reload the data that the parent
+    #: downloaded on :func:`Refresh`, not download it all again
+    __child_rmi__ = Bcfg2.Server.Plugin.Plugin.__child_rmi__ + \
+        [('Refresh', 'Reload'), 'Reload']
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.StructureValidator.__init__(self)
@@ -58,6 +68,14 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
             self.core.setup.cfp.get("packages", "cache",
                                     default=os.path.join(self.data, 'cache'))
 
+        # configure the concurrency of metadata and key downloads
+        downloader.workers = int(
+            self.core.setup.cfp.get("packages", "download_workers",
+                                    default="4"))
+        downloader.timeout = float(
+            self.core.setup.cfp.get("packages", "download_timeout",
+                                    default="60"))
+
         #: Where Packages should store downloaded GPG key files
         self.keypath = os.path.join(self.cachepath, 'keys')
         if not os.path.exists(self.keypath):
@@ -109,6 +127,23 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         #: object when one is requested, so each entry is very
         #: short-lived -- it's purged at the end of each client run.
         self.clients = dict()
+
+        #: A :class:`Bcfg2.Cache.Cache` of the results of
+        #: :func:`Bcfg2.Server.Plugins.Packages.Collection.Collection.complete`,
+        #: so that clients that share a collection and an initial
+        #: package list do not each repeat the dependency resolution.
+        #: Keys are tuples of ``(<collection cachekey>, <relevant
+        #: groups>, <initial package list>)``; values are ``(<packages>,
+        #: <unknown>)`` tuples of frozensets.  This is None if the
+        #: cache is disabled, and it is cleared whenever the sources
+        #: are reloaded.
+        self.completions = None
+        complete_entries = int(
+            self.core.setup.cfp.get("packages", "resolver_cache_entries",
+                                    default="1000"))
+        if complete_entries:
+            self.completions = Cache(max_entries=complete_entries,
+                                     name="Packages:complete")
         # pylint: enable=C0301
 
     __init__.__doc__ = Bcfg2.Server.Plugin.Plugin.__init__.__doc__
@@ -346,7 +381,7 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         for el in to_remove:
             el.getparent().remove(el)
 
-        packages, unknown = collection.complete(base)
+        packages, unknown = self._complete(collection, base)
         if unknown:
             self.logger.info("Packages: Got %d unknown entries" % len(unknown))
             self.logger.info("Packages: %s" % list(unknown))
@@ -356,6 +391,36 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         newpkgs.sort()
         collection.packages_to_entry(newpkgs, independent)
 
+    def _complete(self, collection, base):
+        """ Get the complete list of packages and their dependencies
+        from :func:`Bcfg2.Server.Plugins.Packages.Collection.Collection.complete`,
+        using :attr:`completions` to avoid resolving the same initial
+        package list against the same collection more than once.
+
+        :param collection: The collection of sources for the client
+        :type collection: Bcfg2.Server.Plugins.Packages.Collection.Collection
+        :param base: The initial set of packages to resolve
+        :type base: set
+        :returns: tuple of sets - The complete package list and the
+                  set of unknown symbols, as returned by
+                  :func:`Bcfg2.Server.Plugins.Packages.Collection.Collection.complete`
+        """
+        if self.completions is None:
+            return collection.complete(base)
+        key = (collection.cachekey, tuple(collection.get_relevant_groups()),
+               frozenset(base))
+        result = self.completions.get(key)
+        if result is None:
+            packages, unknown = collection.complete(base)
+            if packages or not base:
+                # an empty result for a non-empty package list is
+                # most likely an error in the backend, so it is not
+                # kept
+                self.completions[key] = (frozenset(packages),
+                                         frozenset(unknown))
+            return packages, unknown
+        return set(result[0]), set(result[1])
+
     @Bcfg2.Server.Plugin.track_statistics()
     def Refresh(self):
         """ Packages.Refresh() => True|False
@@ -383,6 +448,9 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         """
         self._load_sources(force_update)
         self._load_gpg_keys(force_update)
+        # sources are not read from the repository, so changes to
+        # them could affect any client
+        Bcfg2.Server.Dependencies.graph.changed()
 
     def _load_sources(self, force_update):
         """ Load sources from the config, downloading if necessary.
@@ -402,11 +470,18 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         # clear Collection caches
         self.clients = dict()
         self.collections = dict()
+        if self.completions is not None:
+            self.completions.expire()
 
-        for source in self.sources.entries:
+        if force_update and not self.disableMetaData:
+            downloads = self._download_sources()
+        else:
+            downloads = [None] * len(self.sources.entries)
+
+        for source, source_downloads in zip(self.sources.entries, downloads):
             cachefiles.add(source.cachefile)
             if not self.disableMetaData:
-                source.setup_data(force_update)
+                source.setup_data(force_update, downloads=source_downloads)
 
         for cfile in glob.glob(os.path.join(self.cachepath, "cache-*")):
             if cfile not in cachefiles:
@@ -420,6 +495,37 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
                     self.logger.error("Packages: Could not remove cache file "
                                       "%s: %s" % (cfile, err))
 
+    def _download_sources(self):
+        """ Download the metadata for all sources at once, so that
+        metadata from many repositories is fetched concurrently.
+        Errors are reported when each source handles the results in
+        :func:`Bcfg2.Server.Plugins.Packages.Source.Source.update`.
+
+        :returns: list - For each source, a list of (<url>, <local
+                  path>, <result>) tuples, where each result is as
+                  returned by
+                  :func:`Bcfg2.Server.Plugins.Packages.Download.Downloader.fetch_all`,
+                  or None if the files of that source could not be
+                  listed
+        """
+        # listing the files for some sources requires fetching an
+        # index from the repository, so do that concurrently too
+        files = downloader.map(lambda s: s.get_downloads(),
+                               self.sources.entries)
+        downloads = []
+        for result in files:
+            if isinstance(result, list):
+                downloads.extend(result)
+        results = downloader.fetch_all(downloads)
+        rv = []
+        for result in files:
+            if isinstance(result, list):
+                rv.append([(url, fname, results[url])
+                           for url, fname in result])
+            else:
+                rv.append(None)
+        return rv
+
     def _load_gpg_keys(self, force_update):
         """ Load GPG keys from the config, downloading if necessary.
 
@@ -429,35 +535,37 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         :type force_update: bool
         """
         keyfiles = []
-        keys = []
+        downloads = []
         for source in self.sources.entries:
             for key in source.gpgkeys:
                 localfile = os.path.join(self.keypath,
                                          os.path.basename(key.rstrip("/")))
                 if localfile not in keyfiles:
                     keyfiles.append(localfile)
-                if ((force_update and key not in keys) or
-                    not os.path.exists(localfile)):
-                    self.logger.info("Packages: Downloading and parsing %s" %
-                                     key)
-                    try:
-                        open(localfile, 'w').write(urlopen(key).read())
-                        keys.append(key)
-                    except HTTPError:
-                        err = sys.exc_info()[1]
-                        self.logger.error("Packages: Error downloading %s: %s"
-                                          % (key, err))
-                    except IOError:
-                        err = sys.exc_info()[1]
-                        self.logger.error("Packages: Error writing %s to %s: "
-                                          "%s" % (key, localfile, err))
-                    except:
-                        err = sys.exc_info()[1]
-                        self.logger.error("Packages: Unknown error fetching "
-                                          "%s: %s" % (key, err))
+                    if force_update or not os.path.exists(localfile):
+                        downloads.append((key, localfile))
+
+        for key, result in downloader.fetch_all(downloads).items():
+            if result is True:
+                self.logger.info("Packages: Downloaded %s" % key)
+            elif result is False:
+                self.debug_log("Packages: %s is up to date" % key)
+            elif isinstance(result, HTTPError):
+                self.logger.error("Packages: Error downloading %s: %s" %
+                                  (key, result))
+            elif isinstance(result, (URLError, ValueError)):
+                self.logger.error("Packages: Error fetching %s: %s" %
+                                  (key, result))
+            elif isinstance(result, (IOError, OSError)):
+                self.logger.error("Packages: Error writing %s to %s: %s" %
+                                  (key, dict(downloads)[key], result))
+            else:
+                self.logger.error("Packages: Unknown error fetching %s: %s" %
+                                  (key, result))
 
+        keep = keyfiles + [validators_file(k) for k in keyfiles]
         for kfile in glob.glob(os.path.join(self.keypath, "*")):
-            if kfile not in keyfiles:
+            if kfile not in keep:
                 os.unlink(kfile)
 
     @Bcfg2.Server.Plugin.track_statistics()
@@ -6,14 +6,22 @@ import sys
 import time
 import copy
 import operator
+import tempfile
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
 
 try:
-    from django.db import models
+    from django.db import models, transaction
     HAS_DJANGO = True
 
+    try:
+        atomic = transaction.atomic  # pylint: disable=C0103
+    except AttributeError:
+        # Django < 1.6
+        atomic = transaction.commit_on_success  # pylint: disable=C0103
+
     class ProbesDataModel(models.Model,
                           Bcfg2.Server.Plugin.PluginDatabaseModel):
         """ The database model for storing probe data """
@@ -111,10 +119,12 @@ class ProbeData(str):
 
 class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
     """ Handle universal and group- and host-specific probe files """
-    ignore = re.compile("^(\.#.*|.*~|\\..*\\.(tmp|sw[px])|probed\\.xml)$")
+    ignore = re.compile("^(\.#.*|.*~|\\..*\\.(tmp|sw[px])|"
+                        "probed\\.xml(\\..*)?)$")
     probename = \
         re.compile("(.*/)?(?P<basename>\S+?)(\.(?P<mode>(?:G\d\d)|H)_\S+)?$")
     bangline = re.compile('^#!\s*(?P<interpreter>.*)$')
+    serialline = re.compile(r'^#\s*bcfg2:\s*serial\s*$', re.M)
     basename_is_regex = True
 
     def __init__(self, path, fam, encoding, plugin_name):
@@ -125,9 +135,10 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
         fam.AddMonitor(path, self)
 
     def HandleEvent(self, event):
-        """ handle events on everything but probed.xml """
+        """ handle events on everything but probed.xml and its
+        journal """
         if (event.filename != self.path and
-            not event.filename.endswith("probed.xml")):
+            not os.path.basename(event.filename).startswith("probed.xml")):
             return self.handle_event(event)
 
     def get_probe_data(self, metadata):
@@ -159,6 +170,10 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
                 probe.set('interpreter', match.group('interpreter'))
             else:
                 probe.set('interpreter', '/bin/sh')
+            if self.serialline.search(entry.data):
+                # the client must not run this probe at the same time
+                # as any other probe
+                probe.set('serial', 'true')
             ret.append(probe)
         return ret
 
@@ -183,6 +198,47 @@ class Probes(Bcfg2.Server.Plugin.Probing,
 
         self.probedata = dict()
         self.cgroups = dict()
+
+        #: If this is True, probe data is stored in probed.xml
+        #: incrementally: when a client's probe data changes, only
+        #: that client's data is appended to :attr:`journal`, which
+        #: is periodically compacted into probed.xml.  Otherwise,
+        #: all of probed.xml is rewritten every time any client
+        #: submits probe data.
+        self.use_journal = core.setup.cfp.getboolean("probes", "journal",
+                                                     default=False)
+
+        #: The number of seconds to wait after a change is appended
+        #: to the journal before compacting it, so that changes
+        #: submitted in quick succession are compacted at once
+        self.compact_interval = float(core.setup.cfp.get("probes",
+                                                         "compact_interval",
+                                                         default="60"))
+
+        #: The journal of changes to probe data that have not yet
+        #: been compacted into probed.xml
+        self.journal = os.path.join(self.data, "probed.xml.journal")
+
+        # the number of records in the journal
+        self._journal_records = 0
+
+        # mapping of <client name> -> (<probe data>, <groups>) as most
+        # recently stored, so that unchanged data is not journaled
+        self._stored = dict()
+        #: The number of seconds to wait after probe data is received
+        #: before writing it to the database, so that data received
+        #: from many clients is written at once.  If this is 0, probe
+        #: data is written as soon as it is received.
+        self.write_interval = float(core.setup.cfp.get("probes",
+                                                       "write_interval",
+                                                       default="0"))
+
+        # the names of clients whose probe data has not been written
+        # to the database yet
+        self._db_pending = set()
+        self._timer = None
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
         self.load_data()
     __init__.__doc__ = Bcfg2.Server.Plugin.DatabaseBacked.__init__.__doc__
 
@@ -191,104 +247,409 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         """ Write probe data out for use with bcfg2-info """
         if self._use_db:
             return self._write_data_db(client)
+        elif self.use_journal:
+            return self._write_data_journal(client)
         else:
             return self._write_data_xml(client)
 
-    def _write_data_xml(self, _):
+    def _client_xml(self, client):
+        """ Get the XML representation of the probe data and groups
+        of the named client, as stored in probed.xml """
+        # make a copy of probe data for this client in case it
+        # submits probe data while we're trying to write it
+        probedata = copy.copy(self.probedata[client])
+        ctag = lxml.etree.Element('Client', name=client,
+                                  timestamp=str(int(probedata.timestamp)))
+        for probe in sorted(probedata):
+            lxml.etree.SubElement(ctag, 'Probe', name=probe,
+                                  value=str(probedata[probe]))
+        for group in sorted(self.cgroups.get(client, [])):
+            lxml.etree.SubElement(ctag, "Group", name=group)
+        return ctag
+
+    def _write_data_xml(self, _, fname=None):
         """ Write received probe data to probed.xml """
+        if fname is None:
+            fname = os.path.join(self.data, 'probed.xml')
+            if os.path.exists(self.journal):
+                # the journal was in use before, so it must be
+                # compacted rather than overwritten
+                self.compact(force=True)
+                return True
         top = lxml.etree.Element("Probed")
-        for client, probed in sorted(self.probedata.items()):
-            # make a copy of probe data for this client in case it
-            # submits probe data while we're trying to write
-            # probed.xml
-            probedata = copy.copy(probed)
-            ctag = \
-                lxml.etree.SubElement(top, 'Client', name=client,
-                                      timestamp=str(int(probedata.timestamp)))
-            for probe in sorted(probedata):
-                lxml.etree.SubElement(ctag, 'Probe', name=probe,
-                                      value=str(self.probedata[client][probe]))
-            for group in sorted(self.cgroups[client]):
-                lxml.etree.SubElement(ctag, "Group", name=group)
+        for client in sorted(self.probedata.keys()):
+            top.append(self._client_xml(client))
         try:
-            datafile = open(os.path.join(self.data, 'probed.xml'), 'w')
+            datafile = open(fname, 'w')
             datafile.write(lxml.etree.tostring(
                     top, xml_declaration=False,
                     pretty_print='true').decode('UTF-8'))
+            datafile.close()
         except IOError:
             err = sys.exc_info()[1]
             self.logger.error("Failed to write probed.xml: %s" % err)
+            return False
+        return True
+
+    def _write_data_journal(self, client):
+        """ Append received probe data for a single client to the
+        probed.xml journal, if it has changed """
+        hostname = client.hostname
+        current = (dict(self.probedata[hostname]),
+                   sorted(self.cgroups.get(hostname, [])))
+        self._lock.acquire()
+        try:
+            if self._stored.get(hostname) == current:
+                return
+            record = lxml.etree.tostring(self._client_xml(hostname),
+                                         xml_declaration=False)
+            try:
+                fd = os.open(self.journal,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 420)
+                try:
+                    os.write(fd, record + "\n".encode('UTF-8'))
+                finally:
+                    os.close(fd)
+            except OSError:
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to write probe data for %s to %s: "
+                                  "%s" % (hostname, self.journal, err))
+                return
+            self._stored[hostname] = current
+            self._journal_records += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.compact_interval,
+                                              self.compact)
+                self._timer.setDaemon(True)
+                self._timer.start()
+        finally:
+            self._lock.release()
+
+    def compact(self, force=False):
+        """ Compact the probed.xml journal by writing all probe data
+        to probed.xml and removing the journal.  Unless ``force`` is
+        True, this is only done once the journal holds more records
+        than there are clients, so that the cost of rewriting
+        probed.xml is spread over at least that many client runs.
+
+        :param force: Compact the journal regardless of its size
+        :type force: bool
+        """
+        self._lock.acquire()
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not os.path.exists(self.journal):
+                return
+            if not force and self._journal_records <= len(self.probedata):
+                return
+            self.debug_log("Probes: Compacting %d records from %s" %
+                           (self._journal_records, self.journal))
+            try:
+                fd, tmpfile = tempfile.mkstemp(prefix="probed.xml.",
+                                               dir=self.data)
+                os.close(fd)
+            except OSError:
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to compact %s: %s" %
+                                  (self.journal, err))
+                return
+            if not self._write_data_xml(None, fname=tmpfile):
+                os.unlink(tmpfile)
+                return
+            try:
+                os.chmod(tmpfile, 420)
+                os.rename(tmpfile, os.path.join(self.data, 'probed.xml'))
+                os.unlink(self.journal)
+            except OSError:
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to compact %s: %s" %
+                                  (self.journal, err))
+                return
+            self._journal_records = 0
+        finally:
+            self._lock.release()
+
+    def shutdown(self):
+        """ Compact the probed.xml journal, if it is in use, or write
+        any probe data that is waiting to be written to the database """
+        Bcfg2.Server.Plugin.DatabaseBacked.shutdown(self)
+        if self._use_db:
+            self.flush_db()
+        elif self.use_journal:
+            self.compact(force=True)
 
-    @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
     def _write_data_db(self, client):
-        """ Write received probe data to the database """
-        for probe, data in self.probedata[client.hostname].items():
-            pdata = \
-                ProbesDataModel.objects.get_or_create(hostname=client.hostname,
-                                                      probe=probe)[0]
-            if pdata.data != data:
-                pdata.data = data
-                pdata.save()
-        ProbesDataModel.objects.filter(
-            hostname=client.hostname).exclude(
-            probe__in=self.probedata[client.hostname]).delete()
-
-        for group in self.cgroups[client.hostname]:
+        """ Write received probe data to the database.  If
+        :attr:`write_interval` is set, the write is deferred so that
+        data from many clients is written at once by
+        :func:`flush_db`. """
+        self._lock.acquire()
+        try:
+            self._db_pending.add(client.hostname)
+            if self.write_interval:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.write_interval,
+                                                  self._flush_db_deferred)
+                    self._timer.setDaemon(True)
+                    self._timer.start()
+                return
+        finally:
+            self._lock.release()
+        self.flush_db()
+
+    def _flush_db_deferred(self):
+        """ Write deferred probe data to the database, logging
+        (rather than raising) any errors """
+        try:
+            self.flush_db()
+        except:  # pylint: disable=W0702
+            self.logger.error("Failed to write probe data to the database: "
+                              "%s" % sys.exc_info()[1], exc_info=1)
+
+    def flush_db(self):
+        """ Write all probe data that is waiting to be written to the
+        database.  If the write fails, the data is queued to be
+        written again. """
+        self._flush_lock.acquire()
+        try:
+            self._lock.acquire()
             try:
-                ProbesGroupsModel.objects.get(hostname=client.hostname,
-                                              group=group)
-            except ProbesGroupsModel.DoesNotExist:
-                grp = ProbesGroupsModel(hostname=client.hostname,
-                                        group=group)
-                grp.save()
-        ProbesGroupsModel.objects.filter(
-            hostname=client.hostname).exclude(
-            group__in=self.cgroups[client.hostname]).delete()
-
-    def load_data(self):
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                hostnames = self._db_pending
+                self._db_pending = set()
+            finally:
+                self._lock.release()
+            if not hostnames:
+                return
+            try:
+                self._write_clients_db(hostnames)
+            except:
+                self._lock.acquire()
+                try:
+                    self._db_pending.update(hostnames)
+                finally:
+                    self._lock.release()
+                raise
+        finally:
+            self._flush_lock.release()
+
+    @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
+    def _write_clients_db(self, hostnames):
+        """ Write the probe data and groups of the given clients to
+        the database in a single transaction """
+        atomic(self._diff_clients_db)(hostnames)
+
+    def _diff_clients_db(self, hostnames):
+        """ Bring the stored probe data and groups of the given
+        clients up to date.  The stored rows for all of the clients
+        are fetched at once, and only the differences are written:
+        changed and removed rows are deleted with one query per
+        client, and new and changed rows are then inserted
+        together. """
+        hostnames = [h for h in hostnames if h in self.probedata]
+        stored_data = dict()
+        for pdata in ProbesDataModel.objects.filter(hostname__in=hostnames):
+            stored_data.setdefault(pdata.hostname, dict())[pdata.probe] = pdata
+        stored_groups = dict()
+        for pgroup in ProbesGroupsModel.objects.filter(
+                hostname__in=hostnames):
+            stored_groups.setdefault(pgroup.hostname, set()).add(pgroup.group)
+
+        new_data = []
+        new_groups = []
+        for hostname in hostnames:
+            probedata = copy.copy(self.probedata[hostname])
+            groups = list(self.cgroups.get(hostname, []))
+
+            stored = stored_data.get(hostname, dict())
+            unchanged = []
+            for probe, data in probedata.items():
+                if probe in stored and stored[probe].data == data:
+                    unchanged.append(probe)
+                else:
+                    new_data.append(ProbesDataModel(hostname=hostname,
+                                                    probe=probe, data=data))
+            if len(unchanged) != len(stored):
+                # changed rows are replaced, rather than updated one
+                # at a time
+                ProbesDataModel.objects.filter(
+                    hostname=hostname).exclude(probe__in=unchanged).delete()
+
+            stored = stored_groups.get(hostname, set())
+            for group in groups:
+                if group not in stored:
+                    stored.add(group)
+                    new_groups.append(ProbesGroupsModel(hostname=hostname,
+                                                        group=group))
+            if stored - set(groups):
+                ProbesGroupsModel.objects.filter(
+                    hostname=hostname).exclude(group__in=groups).delete()
+
+        for model, objects in [(ProbesDataModel, new_data),
+                               (ProbesGroupsModel, new_groups)]:
+            if not objects:
+                continue
+            if hasattr(model.objects, "bulk_create"):
+                model.objects.bulk_create(objects)
+            else:
+                # Django < 1.4
+                for obj in objects:
+                    obj.save()
+
+    def load_data(self, client=None):
         """ Load probe data from the appropriate backend (probed.xml
-        or the database) """
+        or the database)
+
+        :param client: Only (re)load data for the named client.  If
+                       this is None, all probe data is loaded.
+        :type client: string
+        """
         if self._use_db:
-            return self._load_data_db()
+            return self._load_data_db(client=client)
         else:
-            return self._load_data_xml()
+            return self._load_data_xml(client=client)
 
-    def _load_data_xml(self):
-        """ Load probe data from probed.xml """
+    def _load_data_xml(self, client=None):
+        """ Load probe data from probed.xml and its journal """
+        clients = []
         try:
             data = lxml.etree.parse(os.path.join(self.data, 'probed.xml'),
                                     parser=Bcfg2.Server.XMLParser).getroot()
+            if client is None:
+                clients.extend(data.getchildren())
+            else:
+                clients.extend(data.xpath("Client[@name=$name]",
+                                          name=client))
         except (IOError, lxml.etree.XMLSyntaxError):
             err = sys.exc_info()[1]
-            self.logger.error("Failed to read file probed.xml: %s" % err)
-            return
-        self.probedata = {}
-        self.cgroups = {}
-        for client in data.getchildren():
-            self.probedata[client.get('name')] = \
-                ClientProbeDataSet(timestamp=client.get("timestamp"))
-            self.cgroups[client.get('name')] = []
-            for pdata in client:
+            if not os.path.exists(self.journal):
+                self.logger.error("Failed to read file probed.xml: %s" % err)
+                return
+        if os.path.exists(self.journal):
+            clients.extend(self._read_journal(client=client))
+        if client is None:
+            self.probedata = {}
+            self.cgroups = {}
+            self._stored = {}
+        else:
+            self.probedata.pop(client, None)
+            self.cgroups.pop(client, None)
+            self._stored.pop(client, None)
+        # later records (i.e., those from the journal) replace
+        # earlier ones for the same client
+        for cdata in clients:
+            self.probedata[cdata.get('name')] = \
+                ClientProbeDataSet(timestamp=cdata.get("timestamp"))
+            self.cgroups[cdata.get('name')] = []
+            for pdata in cdata:
                 if pdata.tag == 'Probe':
-                    self.probedata[client.get('name')][pdata.get('name')] = \
+                    self.probedata[cdata.get('name')][pdata.get('name')] = \
                         ProbeData(pdata.get("value"))
                 elif pdata.tag == 'Group':
-                    self.cgroups[client.get('name')].append(pdata.get('name'))
-
-    def _load_data_db(self):
+                    self.cgroups[cdata.get('name')].append(pdata.get('name'))
+        if self.use_journal:
+            for cdata in clients:
+                name = cdata.get('name')
+                self._stored[name] = (dict(self.probedata[name]),
+                                      sorted(self.cgroups[name]))
+
+    def _read_journal(self, client=None):
+        """ Read records from the probed.xml journal
+
+        :param client: Only read records for the named client.  If
+                       this is None, all records are read.
+        :type client: string
+        :returns: list of lxml.etree._Element objects, one for each
+                  record, in the order they were written
+        """
+        rv = []
+        try:
+            lines = open(self.journal, 'rb').read().splitlines()
+        except IOError:
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to read %s: %s" % (self.journal, err))
+            return rv
+        if client is None:
+            self._journal_records = len(lines)
+            match = None
+        else:
+            match = ('name="%s"' % client).encode('UTF-8')
+        for line in lines:
+            if not line.strip() or (match is not None and match not in line):
+                continue
+            try:
+                record = lxml.etree.XML(line, parser=Bcfg2.Server.XMLParser)
+            except lxml.etree.XMLSyntaxError:
+                # a record that was only partially written, e.g.,
+                # because the server crashed
+                self.logger.warning("Skipping malformed record in %s" %
+                                    self.journal)
+                continue
+            if client is None or record.get('name') == client:
+                rv.append(record)
+        return rv
+
+    def _load_data_db(self, client=None):
         """ Load probe data from the database """
-        self.probedata = {}
-        self.cgroups = {}
-        for pdata in ProbesDataModel.objects.all():
+        if client is None:
+            self.probedata = {}
+            self.cgroups = {}
+            probedata = ProbesDataModel.objects.all()
+            groupdata = ProbesGroupsModel.objects.all()
+        else:
+            self.probedata.pop(client, None)
+            self.cgroups.pop(client, None)
+            probedata = ProbesDataModel.objects.filter(hostname=client)
+            groupdata = ProbesGroupsModel.objects.filter(hostname=client)
+        for pdata in probedata:
             if pdata.hostname not in self.probedata:
                 self.probedata[pdata.hostname] = ClientProbeDataSet(
                     timestamp=time.mktime(pdata.timestamp.timetuple()))
             self.probedata[pdata.hostname][pdata.probe] = ProbeData(pdata.data)
-        for pgroup in ProbesGroupsModel.objects.all():
+        for pgroup in groupdata:
             if pgroup.hostname not in self.cgroups:
                 self.cgroups[pgroup.hostname] = []
             self.cgroups[pgroup.hostname].append(pgroup.group)
 
+    def get_client_data(self, client):
+        """ Get the probe data and groups of a client in a form that
+        can be sent to another process and given to
+        :func:`set_client_data` there, so that it does not have to
+        wait for the data to be stored and load it.
+
+        :param client: The name of the client
+        :type client: string
+        :returns: tuple of (<timestamp>, <dict of probe name -> data>,
+                  <list of groups>), or None if there is no probe data
+                  for the client
+        """
+        if client not in self.probedata:
+            return None
+        probedata = self.probedata[client]
+        return (probedata.timestamp,
+                dict([(probe, str(data))
+                      for probe, data in probedata.items()]),
+                list(self.cgroups.get(client, [])))
+
+    def set_client_data(self, client, data):
+        """ Set the probe data and groups of a client from data
+        returned by :func:`get_client_data`.
+
+        :param client: The name of the client
+        :type client: string
+        :param data: The probe data and groups of the client
+        :type data: tuple
+        """
+        timestamp, probedata, groups = data
+        self.probedata[client] = ClientProbeDataSet(
+            [(probe, ProbeData(val)) for probe, val in probedata.items()],
+            timestamp=timestamp)
+        self.cgroups[client] = groups
+
     @Bcfg2.Server.Plugin.track_statistics()
     def GetProbes(self, meta):
         return self.probes.get_probe_data(meta)
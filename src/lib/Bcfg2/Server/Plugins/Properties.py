@@ -8,6 +8,7 @@ import copy
 import logging
 import lxml.etree
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Dependencies
 from Bcfg2.Server.Plugin import PluginExecutionError
 try:
     from Bcfg2.Encryption import ssl_decrypt, get_passphrases, \
@@ -306,6 +307,57 @@ class PropDirectoryBacked(Bcfg2.Server.Plugin.DirectoryBacked):
                 "Properties: Unknown extension %s" % fname)
 
 
+class PropertiesDict(dict):
+    """ The dict of properties files that is added to client
+    metadata.  Each properties file that is read while a client
+    configuration is being built is recorded as a dependency of the
+    entry being bound; listing the properties files records a
+    dependency on the whole Properties directory.  See
+    :mod:`Bcfg2.Server.Dependencies`. """
+
+    def __init__(self, path, *args, **kwargs):
+        """
+        :param path: The path to the Properties directory
+        :type path: string
+        """
+        dict.__init__(self, *args, **kwargs)
+        self.path = path
+
+    def __getitem__(self, key):
+        Bcfg2.Server.Dependencies.graph.record(os.path.join(self.path, key))
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        Bcfg2.Server.Dependencies.graph.record(os.path.join(self.path, key))
+        return dict.get(self, key, default)
+
+    def _record_listing(self):
+        """ Record a dependency on the whole Properties directory,
+        since the caller is looking at which properties files
+        exist. """
+        Bcfg2.Server.Dependencies.graph.record(self.path)
+
+    def __contains__(self, key):
+        self._record_listing()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._record_listing()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._record_listing()
+        return dict.keys(self)
+
+    def values(self):
+        self._record_listing()
+        return dict.values(self)
+
+    def items(self):
+        self._record_listing()
+        return dict.items(self)
+
+
 class Properties(Bcfg2.Server.Plugin.Plugin,
                  Bcfg2.Server.Plugin.Connector):
     """ The properties plugin maps property files into client metadata
@@ -323,11 +375,12 @@ class Properties(Bcfg2.Server.Plugin.Plugin,
             self.logger.error("Error while creating Properties store: %s" %
                               err)
             raise Bcfg2.Server.Plugin.PluginInitError
+        Bcfg2.Server.Dependencies.graph.track(self.data)
 
     __init__.__doc__ = Bcfg2.Server.Plugin.Plugin.__init__.__doc__
 
     def get_additional_data(self, metadata):
-        rv = dict()
+        rv = PropertiesDict(self.data)
         for fname, pfile in self.store.entries.items():
             rv[fname] = pfile.get_additional_data(metadata)
         return rv
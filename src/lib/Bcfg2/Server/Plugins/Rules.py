@@ -9,6 +9,10 @@ class Rules(Bcfg2.Server.Plugin.PrioDir):
     name = 'Rules'
     __author__ = 'bcfg-dev@mcs.anl.gov'
 
+    #: Rules only matches entries by tag and name, so the core can
+    #: cache the results of :func:`HandlesEntry`
+    handles_entry_by_name = True
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.PrioDir.__init__(self, core, datastore)
         self._regex_cache = dict()
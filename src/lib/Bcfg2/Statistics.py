@@ -1,11 +1,187 @@
 """ Module for tracking execution time statistics from the Bcfg2
 server core.  This data is exposed by
-:func:`Bcfg2.Server.Core.BaseCore.get_statistics`."""
+:func:`Bcfg2.Server.Core.BaseCore.get_statistics`.  Detailed traces of
+individual client runs are also kept by :attr:`tracer`, and are
+exposed by :func:`Bcfg2.Server.Core.BaseCore.get_traces`."""
+
+import math
+import time
+import heapq
+import threading
+from collections import deque
+
+#: The percentiles reported for each statistic, as tuples of
+#: ``(<name>, <fraction>)``
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+#: The sliding time windows reported for each statistic, as tuples
+#: of ``(<name>, <length in seconds>)``
+WINDOWS = (("1m", 60), ("5m", 300), ("1h", 3600))
+
+
+class Histogram(object):
+    """ A histogram of values in logarithmically-sized buckets, which
+    can be used to estimate percentiles in fixed memory.  Each power
+    of two is divided into :attr:`subbuckets` buckets, so the
+    estimate of any percentile is within about 5% of the true value.
+    Values smaller than :attr:`resolution` all share the first
+    bucket, and values larger than the range of the last bucket share
+    the last bucket. """
+
+    #: The smallest value that is distinguished from 0.  Values are
+    #: usually times in seconds, so this is one microsecond.
+    resolution = 1e-6
+
+    #: The number of buckets each power of two is divided into
+    subbuckets = 8
+
+    #: The total number of buckets.  With the default resolution,
+    #: this covers values up to about 12 days.
+    buckets = 40 * subbuckets + 1
+
+    def __init__(self):
+        #: A dict of ``<bucket index> -> <number of values>``.  It
+        #: never has more than :attr:`buckets` keys.
+        self.counts = dict()
+
+        #: The number of values in the histogram
+        self.count = 0
+
+        #: The sum of all values in the histogram
+        self.total = 0.0
+
+    def bucket(self, value):
+        """ Get the index of the bucket a value belongs in.
+
+        :param value: The value
+        :type value: int or float
+        :returns: int
+        """
+        if value <= self.resolution:
+            return 0
+        return min(self.buckets - 1,
+                   1 + int(math.log(value / self.resolution, 2) *
+                           self.subbuckets))
+
+    def bucket_value(self, bucket):
+        """ Get the value that represents all values in a bucket,
+        i.e., the geometric midpoint of the bucket.
+
+        :param bucket: The index of the bucket
+        :type bucket: int
+        :returns: float
+        """
+        if bucket == 0:
+            return 0.0
+        return self.resolution * 2 ** ((bucket - 0.5) / self.subbuckets)
+
+    def add(self, value):
+        """ Add a value to the histogram.
+
+        :param value: The value to add
+        :type value: int or float
+        """
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        """ Add all of the values in another histogram to this one.
+
+        :param other: The histogram to merge into this one
+        :type other: Bcfg2.Statistics.Histogram
+        """
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, fraction):
+        """ Estimate a percentile of the values in the histogram.
+
+        :param fraction: The percentile to estimate, as a fraction
+                         between 0 and 1; e.g., 0.99 for the 99th
+                         percentile
+        :type fraction: float
+        :returns: float
+        """
+        if not self.count:
+            return 0.0
+        # the rank of the value we want, counting from 1
+        rank = max(1, int(math.ceil(fraction * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts.keys()):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return self.bucket_value(bucket)
+        return self.bucket_value(max(self.counts.keys()))
+
+
+class SlidingWindow(object):
+    """ A ring of :class:`Histogram` objects, each of which covers a
+    fixed-length slot of time, that can be used to get a histogram of
+    the values added over a recent period of time. """
+
+    def __init__(self, slot_length, slots):
+        """
+        :param slot_length: The length of time covered by each slot,
+                            in seconds
+        :type slot_length: int
+        :param slots: The number of slots to keep
+        :type slots: int
+        """
+        self.slot_length = slot_length
+
+        # list of (<slot number>, <histogram>) tuples, or None for
+        # slots that have never been used
+        self.slots = [None] * slots
+
+    def add(self, value, now):
+        """ Add a value to the slot for the given time.
+
+        :param value: The value to add
+        :type value: int or float
+        :param now: The current time
+        :type now: float
+        """
+        slot = int(now // self.slot_length)
+        idx = slot % len(self.slots)
+        if self.slots[idx] is None or self.slots[idx][0] != slot:
+            self.slots[idx] = (slot, Histogram())
+        self.slots[idx][1].add(value)
+
+    def histogram(self, now, length):
+        """ Get a histogram of the values added during a recent
+        period of time.  The period covers the current slot and as
+        many whole slots before it as are needed to cover ``length``
+        seconds, so it may be up to one slot longer than requested.
+
+        :param now: The current time
+        :type now: float
+        :param length: The length of the period, in seconds.  This
+                       may not be longer than the total length of all
+                       slots.
+        :type length: int
+        :returns: tuple of (:class:`Histogram`, <length of the
+                  period covered in seconds>)
+        """
+        current = int(now // self.slot_length)
+        nslots = int(math.ceil(float(length) / self.slot_length))
+        rv = Histogram()
+        for slot in self.slots:
+            if slot is not None and 0 <= current - slot[0] < nslots:
+                rv.merge(slot[1])
+        covered = (nslots - 1) * self.slot_length + \
+            (now - current * self.slot_length)
+        return (rv, covered)
 
 
 class Statistic(object):
     """ A single named statistic, tracking minimum, maximum, and
-    average execution time, and number of invocations. """
+    average execution time, and number of invocations, along with
+    percentiles and rates over the lifetime of the statistic and over
+    each of the sliding time windows in :attr:`WINDOWS`. """
 
     def __init__(self, name, initial_value):
         """
@@ -18,8 +194,20 @@ class Statistic(object):
         self.name = name
         self.min = float(initial_value)
         self.max = float(initial_value)
-        self.ave = float(initial_value)
-        self.count = 1
+        self.ave = 0.0
+        self.count = 0
+
+        #: The time this statistic was created
+        self.created = time.time()
+
+        #: A :class:`Histogram` of all values added to this statistic
+        self.histogram = Histogram()
+
+        # recent values in 10 second slots, for windows of up to a
+        # minute, and in one minute slots, for windows of up to an
+        # hour
+        self._recent = (SlidingWindow(10, 6), SlidingWindow(60, 60))
+        self.add_value(initial_value)
 
     def add_value(self, value):
         """ Add a value to the statistic, recalculating the various
@@ -28,10 +216,14 @@ class Statistic(object):
         :param value: The value to add to this statistic
         :type value: int or float
         """
+        now = time.time()
         self.min = min(self.min, value)
         self.max = max(self.max, value)
-        self.ave = (((self.ave * (self.count - 1)) + value) / self.count)
+        self.ave = (((self.ave * self.count) + value) / (self.count + 1))
         self.count += 1
+        self.histogram.add(value)
+        for window in self._recent:
+            window.add(value, now)
 
     def get_value(self):
         """ Get a tuple of all the stats tracked on this named item.
@@ -46,12 +238,54 @@ class Statistic(object):
         """
         return (self.name, (self.min, self.max, self.ave, self.count))
 
+    def _summarize(self, histogram, length):
+        """ Get a dict of the count, rate, mean, and percentiles of
+        the values in a histogram that covers ``length`` seconds. """
+        rv = dict(count=histogram.count,
+                  rate=float(histogram.count) / max(length, 1.0),
+                  mean=0.0)
+        if histogram.count:
+            rv['mean'] = histogram.total / histogram.count
+        for pname, fraction in PERCENTILES:
+            # the estimate can never be outside the range of values
+            # that were actually seen
+            rv[pname] = min(self.max,
+                            max(self.min, histogram.percentile(fraction)))
+        return rv
+
+    def get_details(self):
+        """ Get a dict of detailed statistics for this item.  The
+        dict contains ``min``, ``max``, ``mean``, ``count``, ``rate``
+        (per second), and each of the percentiles in
+        :attr:`PERCENTILES` over the lifetime of the statistic, and a
+        ``windows`` key whose value is a dict of ``<window name> ->
+        <dict of count, rate, mean, and percentiles>`` for each of
+        the sliding windows in :attr:`WINDOWS`.
+
+        :returns: dict
+        """
+        now = time.time()
+        uptime = now - self.created
+        rv = self._summarize(self.histogram, uptime)
+        rv.update(dict(min=self.min, max=self.max, mean=self.ave,
+                       windows=dict()))
+        for wname, length in WINDOWS:
+            if length <= 60:
+                window = self._recent[0]
+            else:
+                window = self._recent[1]
+            histogram, covered = window.histogram(now, length)
+            rv['windows'][wname] = self._summarize(histogram,
+                                                   min(covered, uptime))
+        return rv
+
 
 class Statistics(object):
     """ A collection of named :class:`Statistic` objects. """
 
     def __init__(self):
         self.data = dict()
+        self.lock = threading.Lock()
 
     def add_value(self, name, value):
         """ Add a value to the named :class:`Statistic`.  This just
@@ -64,10 +298,14 @@ class Statistics(object):
         :param value: The value to add to the Statistic
         :type value: int or float
         """
-        if name not in self.data:
-            self.data[name] = Statistic(name, value)
-        else:
-            self.data[name].add_value(value)
+        self.lock.acquire()
+        try:
+            if name not in self.data:
+                self.data[name] = Statistic(name, value)
+            else:
+                self.data[name].add_value(value)
+        finally:
+            self.lock.release()
 
     def display(self):
         """ Return a dict of all :class:`Statistic` object values.
@@ -76,7 +314,280 @@ class Statistics(object):
         :func:`Statistic.get_value`. """
         return dict([value.get_value() for value in list(self.data.values())])
 
+    def display_details(self):
+        """ Return a dict of detailed values for all
+        :class:`Statistic` objects.  Keys are the statistic names, and
+        values are dicts as returned by
+        :func:`Statistic.get_details`. """
+        self.lock.acquire()
+        try:
+            return dict([(value.name, value.get_details())
+                         for value in list(self.data.values())])
+        finally:
+            self.lock.release()
+
+
+class Span(object):
+    """ A single timed operation within a :class:`Tracer` trace.
+    Spans nest, so the trace of a client run is a tree of spans. """
+    __slots__ = ['name', 'start', 'duration', 'attrs', 'children']
+
+    def __init__(self, name, attrs=None):
+        """
+        :param name: The name of the operation
+        :type name: string
+        :param attrs: Additional information about the operation
+        :type attrs: dict
+        """
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.attrs = attrs or dict()
+        self.children = []
+
+    def to_dict(self, base=None):
+        """ Get a representation of this span and all of its children
+        that can be marshalled with XML-RPC.  The returned dict
+        contains ``name``, ``start`` (in seconds after ``base``),
+        ``duration``, ``attrs``, and ``spans``, a list of the
+        children of this span in the same format.
+
+        :param base: The time that ``start`` is relative to.  By
+                     default, this is the start of this span.
+        :type base: float
+        :returns: dict
+        """
+        if base is None:
+            base = self.start
+        return dict(name=self.name,
+                    start=self.start - base,
+                    duration=self.duration or 0.0,
+                    attrs=dict([(k, str(v)) for k, v in self.attrs.items()]),
+                    spans=[c.to_dict(base) for c in self.children])
+
+    def walk(self):
+        """ Iterate over this span and all of its descendants. """
+        yield self
+        for child in self.children:
+            for span in child.walk():
+                yield span
+
+
+class Tracer(object):
+    """ Records a trace of the work done for each client run -- or,
+    more precisely, for each XML-RPC call made by a client during a
+    run -- as a tree of :class:`Span` objects.  The most recent traces
+    and the slowest traces are kept in memory.
+
+    Tracing is off unless :attr:`enabled` is set.  While it is off,
+    the only cost to callers is checking that attribute, so callers
+    on hot paths should check it before calling :func:`begin`. """
+
+    def __init__(self, recent=100, slowest=10):
+        """
+        :param recent: The number of most recent traces to keep
+        :type recent: int
+        :param slowest: The number of slowest traces to keep
+        :type slowest: int
+        """
+        #: Whether or not traces are being recorded
+        self.enabled = False
+
+        #: The number of most recent traces to keep
+        self.recent_size = recent
+
+        #: The number of slowest traces to keep
+        self.slowest_size = slowest
+
+        #: The most recent traces, as the root :class:`Span` of each,
+        #: in the order they finished
+        self.recent = deque()
+
+        # heap of (<duration>, <sequence number>, <root span>) for
+        # the slowest traces; the sequence number breaks ties
+        self._slowest = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+        # the stack of open spans in the current thread
+        self._local = threading.local()
+
+    def start(self, name, client=None):
+        """ Start a new trace in the current thread.  If tracing is
+        disabled or a trace is already being recorded in this thread,
+        this does nothing.
+
+        :param name: The name of the trace, generally the XML-RPC
+                     method being called
+        :type name: string
+        :param client: The client the trace is for, if known.  See
+                       :func:`set_client`.
+        :type client: string
+        :returns: bool - True if a trace was started, in which case
+                  the caller must call :func:`finish`
+        """
+        if not self.enabled or getattr(self._local, "stack", None):
+            return False
+        root = Span(name)
+        root.attrs['client'] = client
+        self._local.stack = [root]
+        return True
+
+    def set_client(self, client):
+        """ Set the client that the trace in the current thread is
+        for, if one is being recorded.
+
+        :param client: The client name
+        :type client: string
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            stack[0].attrs['client'] = client
+
+    def begin(self, name, **attrs):
+        """ Begin a span within the trace in the current thread.
+        Every span that is begun must be ended with :func:`end`.
+
+        :param name: The name of the span
+        :type name: string
+        :param attrs: Additional information about the span
+        :returns: :class:`Span`, or None if no trace is being
+                  recorded in this thread
+        """
+        stack = getattr(self._local, "stack", None)
+        if not stack:
+            return None
+        span = Span(name, attrs)
+        stack[-1].children.append(span)
+        stack.append(span)
+        return span
+
+    def annotate(self, **attrs):
+        """ Add information to the innermost open span in the current
+        thread, if a trace is being recorded.
+
+        :param attrs: The information to add
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            stack[-1].attrs.update(attrs)
+
+    def end(self, span):
+        """ End a span begun with :func:`begin`.  Any spans within it
+        that are still open are ended as well.
+
+        :param span: The span to end.  If this is None, nothing is
+                     done, so the return value of :func:`begin` can
+                     always be passed to this method.
+        :type span: Bcfg2.Statistics.Span
+        """
+        if span is None:
+            return
+        stack = getattr(self._local, "stack", None)
+        if not stack or span not in stack:
+            return
+        now = time.time()
+        while stack[-1] is not span:
+            child = stack.pop()
+            child.duration = now - child.start
+        stack.pop()
+        span.duration = now - span.start
+
+    def add(self, span):
+        """ Add a finished span, e.g., one recorded in another
+        process, to the innermost open span in the current thread.
+
+        :param span: The span to add
+        :type span: Bcfg2.Statistics.Span
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            stack[-1].children.append(span)
+
+    def finish(self, keep=True):
+        """ Finish the trace in the current thread.
+
+        :param keep: Keep the trace in memory so that it can be
+                     retrieved with :func:`get_traces`
+        :type keep: bool
+        :returns: :class:`Span` - The root span of the finished
+                  trace, or None if no trace was being recorded
+        """
+        stack = getattr(self._local, "stack", None)
+        if not stack:
+            return None
+        root = stack[0]
+        self.end(root)
+        self._local.stack = None
+        if keep:
+            self._lock.acquire()
+            try:
+                self.recent.append(root)
+                while len(self.recent) > self.recent_size:
+                    self.recent.popleft()
+                self._seq += 1
+                item = (root.duration, self._seq, root)
+                if len(self._slowest) < self.slowest_size:
+                    heapq.heappush(self._slowest, item)
+                elif self._slowest and item > self._slowest[0]:
+                    heapq.heapreplace(self._slowest, item)
+            finally:
+                self._lock.release()
+        return root
+
+    def _summarize(self, root, spans):
+        """ Get a dict describing a finished trace that can be
+        marshalled with XML-RPC. """
+        rv = dict(name=root.name,
+                  client=str(root.attrs.get('client')),
+                  time=root.start,
+                  duration=root.duration or 0.0)
+        if spans:
+            rv['spans'] = [c.to_dict(root.start) for c in root.children]
+            generators = dict()
+            for span in root.walk():
+                if 'generator' in span.attrs:
+                    gen = generators.setdefault(span.attrs['generator'],
+                                                dict(count=0, time=0.0))
+                    gen['count'] += 1
+                    gen['time'] += span.duration or 0.0
+            rv['generators'] = generators
+        return rv
+
+    def get_traces(self, client=None, spans=True):
+        """ Get the traces that are kept in memory.
+
+        :param client: Only get traces for the named client
+        :type client: string
+        :param spans: Include all of the spans in each trace, and a
+                      summary of the number of entries bound by and
+                      the total time spent in each generator.  If
+                      this is False, only the name, client, start
+                      time, and duration of each trace are included.
+        :type spans: bool
+        :returns: dict with two keys, ``recent`` and ``slowest``,
+                  whose values are lists of dicts describing the
+                  most recent traces (in the order they finished) and
+                  the slowest traces (slowest first)
+        """
+        self._lock.acquire()
+        try:
+            recent = list(self.recent)
+            slowest = [item[2] for item in sorted(self._slowest,
+                                                  reverse=True)]
+        finally:
+            self._lock.release()
+        if client is not None:
+            recent = [t for t in recent if t.attrs.get('client') == client]
+            slowest = [t for t in slowest if t.attrs.get('client') == client]
+        return dict(recent=[self._summarize(t, spans) for t in recent],
+                    slowest=[self._summarize(t, spans) for t in slowest])
+
 
 #: A module-level :class:`Statistics` objects used to track all
 #: execution time metrics for the server.
 stats = Statistics()  # pylint: disable=C0103
+
+#: A module-level :class:`Tracer` object used to record traces of
+#: client runs.
+tracer = Tracer()  # pylint: disable=C0103
@@ -0,0 +1,133 @@
+import os
+import sys
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Cache import *
+
+
+class TestCache(Bcfg2TestCase):
+    def test_expire(self):
+        cache = Cache()
+        cache.update(dict(a=1, b=2, c=3))
+        cache.expire("a")
+        cache.expire("d")
+        self.assertItemsEqual(cache.keys(), ["b", "c"])
+        cache.expire()
+        self.assertEqual(len(cache), 0)
+
+    def test_counters(self):
+        cache = Cache()
+        cache["a"] = 1
+        self.assertEqual(cache["a"], 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertRaises(KeyError, cache.__getitem__, "b")
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 2)
+
+    @patch("Bcfg2.Statistics.stats")
+    def test_statistics(self, mock_stats):
+        cache = Cache()
+        cache["a"] = 1
+        cache.get("a")
+        self.assertFalse(mock_stats.add_value.called)
+
+        cache = Cache(name="test")
+        cache["a"] = 1
+        cache.get("a")
+        cache.get("b")
+        self.assertItemsEqual(
+            [c[0][0] for c in mock_stats.add_value.call_args_list],
+            ["Cache:test:hit", "Cache:test:miss"])
+
+    def test_lru(self):
+        cache = Cache(max_entries=2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache.get("a")
+        cache["c"] = 3
+        self.assertItemsEqual(cache.keys(), ["a", "c"])
+        self.assertEqual(cache.evictions, 1)
+
+        cache = Cache(max_size=5)
+        cache["a"] = "aa"
+        cache["b"] = "bb"
+        cache["a"] = "aaa"
+        self.assertEqual(cache.size, 5)
+        cache["c"] = "c"
+        self.assertItemsEqual(cache.keys(), ["a", "c"])
+        self.assertEqual(cache.size, 4)
+
+    @patch("time.time")
+    def test_ttl(self, mock_time):
+        mock_time.return_value = 100
+        cache = Cache(ttl=10)
+        cache["a"] = 1
+        cache.set("b", 2, ttl=0)
+        cache.set("c", 3, ttl=20)
+        mock_time.return_value = 115
+        self.assertNotIn("a", cache)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache["b"], 2)
+        self.assertEqual(cache["c"], 3)
+        self.assertEqual(cache.expirations, 1)
+
+        mock_time.return_value = 125
+        cache.purge()
+        self.assertItemsEqual(cache.keys(), ["b"])
+        self.assertEqual(cache.expirations, 2)
+
+    def test_indexes(self):
+        cache = Cache(indexes=dict(groups=lambda v: v))
+        cache["a"] = ["g1", "g2"]
+        cache["b"] = ["g2"]
+        cache["c"] = ["g3"]
+        self.assertItemsEqual(cache.lookup("groups", "g2"), ["a", "b"])
+        self.assertItemsEqual(cache.lookup("groups", "g4"), [])
+
+        # replacing an item re-indexes it
+        cache["b"] = ["g1"]
+        self.assertItemsEqual(cache.lookup("groups", "g2"), ["a"])
+        self.assertItemsEqual(cache.lookup("groups", "g1"), ["a", "b"])
+
+        cache.expire_by("groups", "g1")
+        self.assertItemsEqual(cache.keys(), ["c"])
+        self.assertItemsEqual(cache.lookup("groups", "g1"), [])
+        cache.expire()
+        self.assertItemsEqual(cache.lookup("groups", "g3"), [])
+
+    @patch("time.time")
+    def test_dict_methods(self, mock_time):
+        mock_time.return_value = 100
+        cache = Cache(max_size=5, indexes=dict(len=lambda v: [len(v)]))
+        self.assertEqual(cache.setdefault("a", "aa"), "aa")
+        self.assertEqual(cache.setdefault("a", "xx"), "aa")
+        cache.set("b", "b", ttl=10)
+        cache["c"] = "cc"
+        self.assertEqual(cache.size, 5)
+        self.assertItemsEqual(cache.lookup("len", 2), ["a", "c"])
+
+        mock_time.return_value = 115
+        copied = cache.copy()
+        self.assertEqual(copied, dict(a="aa", c="cc"))
+        self.assertNotIsInstance(copied, Cache)
+
+        # popitem returns the least recently used item
+        self.assertEqual(cache.popitem(), ("a", "aa"))
+        self.assertItemsEqual(cache.lookup("len", 2), ["c"])
+        self.assertEqual(cache.size, 3)
+        cache.popitem()
+        cache.popitem()
+        self.assertEqual(cache.size, 0)
+        self.assertRaises(KeyError, cache.popitem)
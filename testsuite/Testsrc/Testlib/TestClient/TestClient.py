@@ -0,0 +1,268 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import threading
+import lxml.etree
+from mock import Mock, patch
+import Bcfg2.Proxy
+import Bcfg2.Client.XML
+from Bcfg2.Compat import xmlrpclib, md5
+from Bcfg2.Client.Client import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+CACHED = """<Configuration revision="1">
+  <Bundle name="base">
+    <Path name="/etc/motd" type="file">Welcome</Path>
+  </Bundle>
+</Configuration>"""
+
+CONFIG = """<Configuration revision="2">
+  <Bundle name="base">
+    <Path name="/etc/motd" type="file">Welcome back</Path>
+  </Bundle>
+</Configuration>"""
+
+
+def get_client(**setup):
+    # avoid Client.__init__, which sets up logging
+    client = object.__new__(Client)
+    client.setup = dict(probe_exit=False, probe_timeout=0, probe_workers=1)
+    client.setup.update(setup)
+    client.logger = Mock()
+    client._proxy = Mock()
+    return client
+
+
+def get_probe(name, text="", **attrs):
+    probe = lxml.etree.Element("probe", name=name, source="Probes", **attrs)
+    probe.text = text
+    return probe
+
+
+class TestClient(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, "cache.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_cached_client(self):
+        open(self.cache, 'w').write(CACHED)
+        return get_client(cache=self.cache)
+
+    def test_run_probe(self):
+        client = get_client()
+        times = dict()
+        probe = get_probe("session",
+                          "import os\nprint(os.getsid(0) == os.getpid())\n",
+                          interpreter=sys.executable)
+        rv = client.run_probe(probe, times=times)
+        self.assertEqual(rv.get("name"), "session")
+        # the probe is run in its own session, and so its own
+        # process group
+        self.assertEqual(rv.text.strip(), "True")
+        self.assertFalse(client.logger.error.called)
+        self.assertItemsEqual(times.keys(),
+                              ["probe.session.start", "probe.session.end"])
+
+    @patch("Bcfg2.Client.Client.popen_session")
+    @patch("threading.Timer")
+    @patch("os.killpg")
+    @patch("os.kill")
+    def test_run_probe_timeout(self, mock_kill, mock_killpg, mock_Timer,
+                               mock_popen_session):
+        client = get_client(probe_timeout=5)
+        proc = mock_popen_session.return_value
+        proc.pid = 1234
+        proc.wait.return_value = -9
+
+        def communicate():
+            # the timer fires while the client waits for the output
+            # of the probe
+            func = mock_Timer.call_args[0][1]
+            func(*mock_Timer.call_args[1]['args'])
+            return ("partial output", "")
+
+        proc.communicate.side_effect = communicate
+        rv = client.run_probe(get_probe("slow", "sleep 10"))
+        self.assertEqual(mock_Timer.call_args[0][0], 5)
+        self.assertTrue(mock_Timer.return_value.start.called)
+        self.assertTrue(mock_Timer.return_value.cancel.called)
+        # the probe is killed along with any children, and its
+        # partial output is not sent
+        mock_killpg.assert_called_with(1234, signal.SIGKILL)
+        self.assertFalse(mock_kill.called)
+        self.assertIsNone(rv.text)
+        client.logger.error.assert_called_with(
+            "Failed to execute probe slow: Timed out after 5 seconds")
+
+        # if the probe has not started its own process group yet, it
+        # is killed by itself
+        mock_killpg.side_effect = OSError
+        rv = client.run_probe(get_probe("slow", "sleep 10"))
+        mock_kill.assert_called_with(1234, signal.SIGKILL)
+        self.assertIsNone(rv.text)
+
+        # a probe that finishes in time is not killed
+        mock_killpg.reset_mock()
+        mock_kill.reset_mock()
+        mock_Timer.reset_mock()
+        client.logger.reset_mock()
+        proc.communicate.side_effect = None
+        proc.communicate.return_value = ("output", "")
+        proc.wait.return_value = 0
+        rv = client.run_probe(get_probe("fast", "true"))
+        self.assertEqual(rv.text, "output")
+        self.assertTrue(mock_Timer.return_value.cancel.called)
+        self.assertFalse(mock_killpg.called)
+        self.assertFalse(mock_kill.called)
+        self.assertFalse(client.logger.error.called)
+
+        # probes are not timed out if no timeout is set
+        mock_Timer.reset_mock()
+        client.setup['probe_timeout'] = 0
+        rv = client.run_probe(get_probe("fast", "true"))
+        self.assertEqual(rv.text, "output")
+        self.assertFalse(mock_Timer.called)
+
+    def test_run_probes(self):
+        probes = lxml.etree.Element("probes")
+        for i in range(12):
+            if i % 4 == 3:
+                # e.g., a probe that contains "# bcfg2: serial"
+                probes.append(get_probe("probe%d" % i, serial="true"))
+            else:
+                probes.append(get_probe("probe%d" % i))
+        lock = threading.Lock()
+        running = []
+
+        def run_probe(probe, times=None):
+            name = probe.get("name")
+            lock.acquire()
+            running.append(name)
+            log.append((name, list(running)))
+            lock.release()
+            # probes that come later finish sooner
+            time.sleep(0.005 * (12 - int(name[5:])))
+            lock.acquire()
+            running.remove(name)
+            lock.release()
+            rv = Bcfg2.Client.XML.Element("probe-data", name=name)
+            rv.text = name
+            return rv
+
+        def run_probes(client):
+            client._proxy.GetProbes.return_value = \
+                lxml.etree.tostring(probes).decode('UTF-8')
+
+            @patch.object(client, "run_probe")
+            def inner(mock_run_probe):
+                mock_run_probe.side_effect = run_probe
+                client.run_probes()
+
+            inner()
+            probedata = lxml.etree.XML(
+                client._proxy.RecvProbeData.call_args[0][0])
+            return [p.get("name") for p in probedata.findall("probe-data")]
+
+        names = ["probe%d" % i for i in range(12)]
+        serial = ["probe3", "probe7", "probe11"]
+
+        # results are sent in the order in which the probes were
+        # given, no matter what order they finish in
+        log = []
+        self.assertEqual(run_probes(get_client(probe_workers=4)), names)
+        self.assertItemsEqual([name for name, _ in log], names)
+        self.assertTrue(max([len(r) for _, r in log]) > 1)
+        # serial probes are run after all other probes, with nothing
+        # else running
+        self.assertEqual([name for name, _ in log[-3:]], serial)
+        for name, concurrent in log[-3:]:
+            self.assertEqual(concurrent, [name])
+
+        # with one worker, all probes are run one at a time
+        log = []
+        self.assertEqual(run_probes(get_client(probe_workers=1)), names)
+        self.assertEqual(log, [(name, [name]) for name in names])
+
+    def test_download_config_uncached(self):
+        client = get_client(cache=None)
+        client._proxy.GetConfig.return_value = CONFIG
+        self.assertEqual(client._download_config(), CONFIG.encode('UTF-8'))
+        client._proxy.GetConfig.assert_called_once_with()
+
+        # the cache file does not exist yet
+        client = get_client(cache=self.cache)
+        client._proxy.GetConfig.return_value = CONFIG
+        self.assertEqual(client._download_config(), CONFIG.encode('UTF-8'))
+        client._proxy.GetConfig.assert_called_once_with()
+
+    @patch("Bcfg2.Client.Client.HAS_DELTA", False)
+    def test_download_config_digest(self):
+        client = self.get_cached_client()
+        client._proxy.GetConfig.return_value = CONFIG
+        self.assertEqual(client._download_config(), CONFIG.encode('UTF-8'))
+        client._proxy.GetConfig.assert_called_once_with(
+            md5(CACHED.encode('UTF-8')).hexdigest())
+
+    @skipUnless(HAS_DELTA, "Bcfg2.Delta could not be imported, skipping")
+    def test_download_config_delta(self):
+        client = self.get_cached_client()
+        client._proxy.GetConfig.return_value = \
+            Bcfg2.Delta.make_delta(CACHED.encode('UTF-8'),
+                                   CONFIG.encode('UTF-8')).decode('UTF-8')
+        self.assertXMLEqual(lxml.etree.XML(client._download_config()),
+                            lxml.etree.XML(CONFIG))
+        client._proxy.GetConfig.assert_called_once_with(
+            md5(CACHED.encode('UTF-8')).hexdigest(), True)
+
+    @patch("Bcfg2.Client.Client.HAS_DELTA", False)
+    def test_download_config_not_modified(self):
+        client = self.get_cached_client()
+        client._proxy.GetConfig.return_value = NOT_MODIFIED
+        self.assertEqual(client._download_config(), CACHED.encode('UTF-8'))
+        self.assertEqual(client._proxy.GetConfig.call_count, 1)
+
+    @patch("Bcfg2.Client.Client.HAS_DELTA", False)
+    def test_download_config_old_server(self):
+        client = self.get_cached_client()
+        # the fault an older server returns when its GetConfig is
+        # sent a digest
+        client._proxy.GetConfig.side_effect = [
+            Bcfg2.Proxy.ProxyError(xmlrpclib.Fault(
+                1, "GetConfig() takes exactly 2 arguments (3 given)")),
+            CONFIG]
+        self.assertEqual(client._download_config(), CONFIG.encode('UTF-8'))
+        self.assertEqual(client._proxy.GetConfig.call_args_list,
+                         [((md5(CACHED.encode('UTF-8')).hexdigest(),), {}),
+                          ((), {})])
+
+    @patch("Bcfg2.Client.Client.HAS_DELTA", False)
+    def test_download_config_fault(self):
+        # other errors are not retried without the digest
+        for err in [xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                    "Server is too busy"),
+                    xmlrpclib.Fault(1, "Client client1 has no profile"),
+                    xmlrpclib.ProtocolError("https://bcfg2:6789/", 503,
+                                            "Service Unavailable", {})]:
+            client = self.get_cached_client()
+            client._proxy.GetConfig.side_effect = \
+                Bcfg2.Proxy.ProxyError(err)
+            self.assertRaises(Bcfg2.Proxy.ProxyError,
+                              client._download_config)
+            self.assertEqual(client._proxy.GetConfig.call_count, 1)
@@ -0,0 +1,115 @@
+import os
+import sys
+import lxml.etree
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Delta import *
+
+
+class TestDelta(Bcfg2TestCase):
+    old = lxml.etree.tostring(lxml.etree.XML("""
+<Configuration version="2.0" revision="1">
+  <Bundle name="changed">
+    <Path name="/etc/same" type="file">same</Path>
+    <Path name="/etc/removed" type="file">removed</Path>
+    <Service name="changed" status="on"/>
+  </Bundle>
+  <Bundle name="removed"><Package name="foo" version="1"/></Bundle>
+  <Independent name="same"><Path name="/etc/independent"/></Independent>
+</Configuration>""", parser=lxml.etree.XMLParser(remove_blank_text=True)))
+
+    new = lxml.etree.tostring(lxml.etree.XML("""
+<Configuration version="2.0" revision="2">
+  <Bundle name="added"><Package name="bar"/></Bundle>
+  <Bundle name="changed" version="2">
+    <Path name="/etc/added" type="file">added</Path>
+    <Path name="/etc/same" type="file">same</Path>
+    <Service name="changed" status="off"/>
+  </Bundle>
+  <Independent name="same"><Path name="/etc/independent"/></Independent>
+</Configuration>""", parser=lxml.etree.XMLParser(remove_blank_text=True)))
+
+    def test_make_delta(self):
+        delta = lxml.etree.XML(make_delta(self.old, self.new))
+        self.assertEqual(delta.get("base"), digest(self.old))
+        self.assertEqual(delta.get("digest"), digest(self.new))
+        self.assertEqual(delta[0].get("revision"), "2")
+        # unchanged structures and entries are not sent
+        self.assertEqual(delta.xpath("//*[@name='same']"), [])
+        self.assertEqual(delta.xpath("//*[@name='/etc/same']"), [])
+        self.assertItemsEqual([(r.get("tag"), r.get("name"))
+                               for r in delta.xpath("//Remove")],
+                              [("Bundle", "removed"),
+                               ("Path", "/etc/removed"),
+                               ("Service", "changed")])
+        self.assertItemsEqual([(a.get("index"), a[0].get("name"))
+                               for a in delta.xpath("//Add")],
+                              [("0", "added"), ("0", "/etc/added"),
+                               ("2", "changed")])
+
+    def test_make_delta_duplicates(self):
+        # duplicate entries cause the whole structure to be replaced
+        new = self.new.replace('name="/etc/added"'.encode('UTF-8'),
+                               'name="/etc/same"'.encode('UTF-8'))
+        delta = lxml.etree.XML(make_delta(self.old, new))
+        self.assertEqual(delta.xpath("//Change"), [])
+        self.assertEqual(len(delta.xpath("Add/Bundle[@name='changed']")), 1)
+        self.assertEqual(apply_delta(self.old, lxml.etree.tostring(delta)),
+                         new)
+
+        # duplicate structures mean that no delta can be built
+        new = self.new.replace('name="added"'.encode('UTF-8'),
+                               'name="changed"'.encode('UTF-8'))
+        self.assertIsNone(make_delta(self.old, new))
+
+    def test_make_delta_reordered(self):
+        old = lxml.etree.XML(self.old)
+        new = lxml.etree.XML(self.old)
+
+        # reordered entries cause the whole structure to be replaced
+        bundle = new.find("Bundle[@name='changed']")
+        bundle.append(bundle[0])
+        reordered = lxml.etree.tostring(new)
+        delta = lxml.etree.XML(make_delta(self.old, reordered))
+        self.assertEqual(delta.xpath("//Change"), [])
+        self.assertEqual(len(delta.xpath("Add/Bundle[@name='changed']")), 1)
+        self.assertEqual(apply_delta(self.old, lxml.etree.tostring(delta)),
+                         reordered)
+
+        # reordered structures mean that no delta can be built
+        new.append(new.find("Bundle"))
+        self.assertIsNone(make_delta(self.old, lxml.etree.tostring(new)))
+
+    def test_apply_delta(self):
+        delta = make_delta(self.old, self.new)
+        self.assertEqual(apply_delta(self.old, delta), self.new)
+
+        # the reverse delta can be applied too
+        self.assertEqual(apply_delta(self.new,
+                                     make_delta(self.new, self.old)),
+                         self.old)
+
+        # a delta cannot be applied to a different configuration
+        self.assertRaises(ValueError, apply_delta, self.new, delta)
+
+        # the result must match the digest of the new configuration
+        bogus = lxml.etree.XML(delta)
+        bogus.set("digest", digest(self.old))
+        self.assertRaises(ValueError, apply_delta, self.old,
+                          lxml.etree.tostring(bogus))
+
+        # operations must apply to the configuration
+        bogus = lxml.etree.XML(delta)
+        lxml.etree.SubElement(bogus, "Remove", tag="Bundle", name="bogus")
+        self.assertRaises(ValueError, apply_delta, self.old,
+                          lxml.etree.tostring(bogus))
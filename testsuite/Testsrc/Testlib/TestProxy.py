@@ -0,0 +1,141 @@
+import os
+import sys
+import errno
+import socket
+from mock import Mock, patch
+from Bcfg2.Compat import httplib, xmlrpclib
+from Bcfg2.Proxy import XMLRPCTransport, ProxyError
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+def get_response(result="result", error=None):
+    """ get a mock httplib response to an XML-RPC call.  if
+    ``error`` is given, reading the body of the response raises it """
+    response = Mock()
+    response.status = 200
+    response.reason = "OK"
+    response.msg = dict()
+    response.getheader.return_value = ""
+    data = [xmlrpclib.dumps((result,), methodresponse=True).encode('UTF-8')]
+
+    def read(size=None):
+        if error is not None:
+            raise error
+        rv = data[0][:size]
+        data[0] = data[0][size:]
+        return rv
+
+    response.read.side_effect = read
+    return response
+
+
+class TestXMLRPCTransport(Bcfg2TestCase):
+    def request(self, *attempts):
+        """ make a request with the given attempts to send it.  each
+        attempt is a tuple of (<whether the connection was reused>,
+        <error while sending the request>, <response, or error while
+        waiting for it>).  returns a tuple of (<the result or error>,
+        <the number of attempts made>, <the number of times the
+        connection was closed>) """
+        transport = XMLRPCTransport(timeout=5)
+        attempts = list(attempts)
+        made = []
+
+        def send_request(host, handler, request_body, debug):
+            reused, send_error, response = attempts.pop(0)
+            made.append(reused)
+            transport._reused = reused
+            if send_error is not None:
+                raise send_error
+            conn = Mock()
+            if isinstance(response, Exception):
+                conn.getresponse.side_effect = response
+            else:
+                conn.getresponse.return_value = response
+            return conn
+
+        @patch.object(transport, "send_request")
+        @patch.object(transport, "close")
+        def inner(mock_close, mock_send_request):
+            mock_send_request.side_effect = send_request
+            try:
+                rv = transport.request("bcfg2:6789", "/RPC2",
+                                       xmlrpclib.dumps(("client1",),
+                                                       "GetConfig"))[0]
+            except ProxyError:
+                rv = sys.exc_info()[1]
+            return rv, len(made), mock_close.call_count
+
+        return inner()
+
+    def assertRetried(self, *attempts):
+        self.assertEqual(self.request(*attempts), ("result", 2, 1))
+
+    def assertNotRetried(self, *attempts):
+        rv, made, closed = self.request(*attempts)
+        self.assertIsInstance(rv, ProxyError)
+        self.assertEqual(rv.error.errcode, 408)
+        self.assertEqual(made, 1)
+        self.assertEqual(closed, 1)
+
+    def test_request(self):
+        self.assertEqual(self.request((True, None, get_response())),
+                         ("result", 1, 0))
+        self.assertEqual(self.request((False, None, get_response())),
+                         ("result", 1, 0))
+
+    def test_request_retry(self):
+        # the request is retried on a new connection if the server
+        # closed the reused connection before it got the request
+        self.assertRetried(
+            (True, socket.error(errno.EPIPE, "Broken pipe"), None),
+            (False, None, get_response()))
+        self.assertRetried(
+            (True, None, httplib.BadStatusLine("")),
+            (False, None, get_response()))
+        self.assertRetried(
+            (True, None, socket.error(errno.ECONNRESET, "Reset by peer")),
+            (False, None, get_response()))
+
+        # the request is only retried once
+        rv, made, closed = self.request(
+            (True, None, httplib.BadStatusLine("")),
+            (False, None, httplib.BadStatusLine("")))
+        self.assertIsInstance(rv, ProxyError)
+        self.assertEqual((made, closed), (2, 2))
+
+    def test_request_no_retry(self):
+        # errors on new connections are not retried
+        self.assertNotRetried(
+            (False, socket.error(errno.ECONNREFUSED, "Refused"), None))
+        self.assertNotRetried(
+            (False, None, httplib.BadStatusLine("")))
+
+        # timeouts are not retried, since the server may still be
+        # handling the request
+        self.assertNotRetried((True, socket.timeout("timed out"), None))
+        self.assertNotRetried((True, None, socket.timeout("timed out")))
+
+        # neither are errors after the server started to respond
+        self.assertNotRetried(
+            (True, None, httplib.BadStatusLine("HTTP/1.1 2")))
+        self.assertNotRetried(
+            (True, None,
+             get_response(error=socket.error(errno.ECONNRESET,
+                                             "Reset by peer"))))
+        self.assertNotRetried(
+            (True, None, get_response(error=socket.timeout("timed out"))))
+
+        # nor other errors while waiting for the response
+        self.assertNotRetried(
+            (True, None, socket.error(errno.EHOSTUNREACH, "No route")))
@@ -0,0 +1,369 @@
+import os
+import sys
+import time
+import threading
+import lxml.etree
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+import Bcfg2.Proxy
+from Bcfg2.Cache import Cache
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Server.Dependencies import DependencyGraph
+from Bcfg2.Server.FileMonitor import FileMonitor, Event
+from Bcfg2.Server.Core import *
+from Bcfg2.Server.Plugin import PluginExecutionError
+from Bcfg2.Server.Plugins.Pkgmgr import FuzzyDict
+
+
+class TestBaseCore(Bcfg2TestCase):
+    def get_core(self, generators=None):
+        # avoid BaseCore.__init__, which needs a full server setup
+        core = object.__new__(BaseCore)
+        core.logger = Mock()
+        core.fam = Mock()
+        core.fam.generation = 0
+        if generators is None:
+            generators = []
+        core.generators = generators
+        core.generator_index = dict()
+        core.handles_entry_cache = dict()
+        core._generator_index_key = None
+        core._unindexed_entries = []
+        core._unindexed_keys = dict()
+        core._cacheable_generators = []
+        core._uncacheable_generators = []
+        return core
+
+    def get_generator(self, name, entries=None, by_name=False):
+        gen = Mock()
+        gen.name = name
+        if entries is None:
+            entries = dict()
+        gen.Entries = entries
+        gen.handles_entry_by_name = by_name
+        gen.HandlesEntry.return_value = False
+        return gen
+
+    def test__update_generator_index(self):
+        gen1 = self.get_generator("gen1", dict(Path={"/foo": Mock(),
+                                                     "/bar": Mock()}))
+        gen2 = self.get_generator("gen2", dict(Path={"/bar": Mock()},
+                                               Package={"baz": Mock()}),
+                                  by_name=True)
+        core = self.get_core([gen1, gen2])
+        core._update_generator_index()
+        self.assertItemsEqual(core.generator_index.keys(),
+                              [("Path", "/foo"), ("Path", "/bar"),
+                               ("Package", "baz")])
+        self.assertEqual(core.generator_index[("Path", "/foo")], [gen1])
+        self.assertItemsEqual(core.generator_index[("Path", "/bar")],
+                              [gen1, gen2])
+        self.assertEqual(core._cacheable_generators, [gen2])
+        self.assertEqual(core._uncacheable_generators, [gen1])
+
+        # the index is not rebuilt if nothing has changed
+        core.handles_entry_cache[("Path", "/baz")] = []
+        index = core.generator_index
+        core._update_generator_index()
+        self.assertIs(core.generator_index, index)
+        self.assertIn(("Path", "/baz"), core.handles_entry_cache)
+
+    def test__update_generator_index_generation(self):
+        gen = self.get_generator("gen", dict(Path={"/foo": Mock()}))
+        core = self.get_core([gen])
+        core._update_generator_index()
+        core.handles_entry_cache[("Path", "/baz")] = []
+
+        # handling a file monitor event rebuilds the index and
+        # expires the HandlesEntry cache, even if the Entries dicts
+        # look the same
+        gen.Entries["Path"].pop("/foo")
+        gen.Entries["Path"]["/bar"] = Mock()
+        core.fam.generation = 1
+        core._update_generator_index()
+        self.assertItemsEqual(core.generator_index.keys(),
+                              [("Path", "/bar")])
+        self.assertEqual(core.handles_entry_cache, dict())
+
+    def test__update_generator_index_entries(self):
+        gen = self.get_generator("gen", dict(Path={"/foo": Mock()}))
+        core = self.get_core([gen])
+        core._update_generator_index()
+
+        # changes to the size of an Entries dict rebuild the index
+        gen.Entries["Path"]["/bar"] = Mock()
+        core._update_generator_index()
+        self.assertItemsEqual(core.generator_index.keys(),
+                              [("Path", "/foo"), ("Path", "/bar")])
+
+        # as does replacing an Entries dict
+        gen.Entries["Path"] = {"/baz": Mock()}
+        core._update_generator_index()
+        self.assertItemsEqual(core.generator_index.keys(),
+                              [("Path", "/baz")])
+
+        # or adding a new tag
+        gen.Entries["Package"] = {"foo": Mock()}
+        core._update_generator_index()
+        self.assertItemsEqual(core.generator_index.keys(),
+                              [("Path", "/baz"), ("Package", "foo")])
+
+    @patch("Bcfg2.Server.Dependencies.graph")
+    def test__update_generator_index_expire(self, mock_graph):
+        gen1 = self.get_generator("gen1", dict(Path={"/foo": Mock()}))
+        gen2 = self.get_generator("gen2",
+                                  dict(Package=FuzzyDict(foo=Mock())))
+        core = self.get_core([gen1, gen2])
+        core._update_generator_index()
+        self.assertFalse(mock_graph.entries_changed.called)
+
+        # nothing is expired if the generators of all entries are
+        # unchanged
+        core.fam.generation = 1
+        core._update_generator_index()
+        self.assertFalse(mock_graph.entries_changed.called)
+
+        # entries that gain, lose, or change generators are expired
+        gen1.Entries["Path"]["/bar"] = Mock()
+        core._update_generator_index()
+        mock_graph.entries_changed.assert_called_with([("Path", "/bar")],
+                                                      set())
+        gen3 = self.get_generator("gen3", dict(Path={"/bar": Mock()}))
+        core.generators.append(gen3)
+        core._update_generator_index()
+        mock_graph.entries_changed.assert_called_with([("Path", "/bar")],
+                                                      set())
+        del gen1.Entries["Path"]["/foo"]
+        core._update_generator_index()
+        mock_graph.entries_changed.assert_called_with([("Path", "/foo")],
+                                                      set())
+
+        # all entries with the same tag as an unindexed Entries dict
+        # that has changed are expired
+        gen2.Entries["Package"]["bar"] = Mock()
+        core._update_generator_index()
+        mock_graph.entries_changed.assert_called_with([],
+                                                      set(["Package"]))
+
+    def test_config_cache_fam_event(self):
+        core = self.get_core()
+        core.revision = "1"
+        core.config_cache = Cache()
+        metadata = Mock()
+        metadata.hostname = "foo"
+        key = ("1", "profile", "1.3", ("group1",), ("bundle1",))
+        fam = FileMonitor()
+        graph = DependencyGraph()
+        graph.listeners.append(core._expire_dependents)
+        fam.listeners.append(graph.handled_event)
+
+        # an event handled by a plugin that does not record which
+        # files its data comes from, dispatched the way the Fam
+        # backend dispatches events, expires all cached
+        # configurations
+        core.config_cache["foo"] = (key, "config")
+        handler = Mock()
+        fam.dispatch_event(handler, Event(1, "/repo/SSHbase/ssh_host_key",
+                                          "changed"))
+        self.assertTrue(handler.HandleEvent.called)
+        self.assertEqual(fam.generation, 1)
+        self.assertIsNone(core._get_cached_config(metadata, key))
+
+        # an event that changes nothing does not
+        core.config_cache["foo"] = (key, "config")
+        handler.HandleEvent.side_effect = lambda e: graph.unchanged()
+        fam.dispatch_event(handler, Event(1, "/repo/SSHbase/ssh_host_key",
+                                          "changed"))
+        self.assertEqual(core._get_cached_config(metadata, key), "config")
+
+    def test_Bind(self):
+        handler = Mock()
+        gen1 = self.get_generator("gen1", dict(Path={"/foo": handler}))
+        gen2 = self.get_generator("gen2", by_name=True)
+        gen3 = self.get_generator("gen3")
+        core = self.get_core([gen1, gen2, gen3])
+        metadata = Mock()
+
+        # entries in the index are bound by the generator that lists
+        # them, without calling HandlesEntry
+        entry = lxml.etree.Element("Path", name="/foo")
+        self.assertEqual(core.Bind(entry, metadata), handler.return_value)
+        handler.assert_called_with(entry, metadata)
+        self.assertFalse(gen2.HandlesEntry.called)
+        self.assertFalse(gen3.HandlesEntry.called)
+
+        # other entries are handled by HandlesEntry, and the results
+        # of generators that handle entries by name are cached
+        gen2.HandlesEntry.return_value = True
+        entry = lxml.etree.Element("Path", name="/bar")
+        self.assertEqual(core.Bind(entry, metadata),
+                         gen2.HandleEntry.return_value)
+        self.assertEqual(core.handles_entry_cache[("Path", "/bar")], [gen2])
+        gen2.HandlesEntry.reset_mock()
+        gen3.HandlesEntry.reset_mock()
+        entry = lxml.etree.Element("Path", name="/bar")
+        core.Bind(entry, metadata)
+        self.assertFalse(gen2.HandlesEntry.called)
+        gen3.HandlesEntry.assert_called_with(entry, metadata)
+
+        # entries that no generator handles fail
+        gen2.HandlesEntry.return_value = False
+        entry = lxml.etree.Element("Path", name="/baz")
+        self.assertRaises(PluginExecutionError, core.Bind, entry, metadata)
+        self.assertEqual(entry.get("failure"), "no matching generator")
+        self.assertEqual(core.handles_entry_cache[("Path", "/baz")], [])
+
+    def test_Bind_unindexed(self):
+        handler = Mock()
+        gen1 = self.get_generator("gen1",
+                                  dict(Package=FuzzyDict(foo=handler)))
+        gen2 = self.get_generator("gen2")
+        core = self.get_core([gen1, gen2])
+        metadata = Mock()
+
+        core._update_generator_index()
+        self.assertEqual(core.generator_index, dict())
+        self.assertEqual(core._unindexed_entries, [(gen1, "Package")])
+
+        # names that a FuzzyDict matches are found even though they
+        # are not keys of the dict
+        entry = lxml.etree.Element("Package", name="foo:i386")
+        self.assertEqual(core.Bind(entry, metadata), handler.return_value)
+        handler.assert_called_with(entry, metadata)
+        self.assertFalse(gen2.HandlesEntry.called)
+
+        # others fall back to HandlesEntry
+        gen2.HandlesEntry.return_value = True
+        entry = lxml.etree.Element("Package", name="bar")
+        self.assertEqual(core.Bind(entry, metadata),
+                         gen2.HandleEntry.return_value)
+        gen1.HandlesEntry.assert_called_with(entry, metadata)
+        gen2.HandlesEntry.assert_called_with(entry, metadata)
+
+
+class TestServerBusy(Bcfg2TestCase):
+    def test_fault(self):
+        err = ServerBusy(7)
+        self.assertIsInstance(err, xmlrpclib.Fault)
+        self.assertEqual(err.faultCode, 503)
+        self.assertEqual(err.retry_after, 7)
+
+        # the fault survives being sent to the client
+        try:
+            xmlrpclib.loads(xmlrpclib.dumps(err))
+        except xmlrpclib.Fault:
+            fault = sys.exc_info()[1]
+            self.assertEqual(fault.faultCode, 503)
+            self.assertEqual(fault.faultString, err.faultString)
+        else:
+            self.fail("Fault was not raised")
+
+    @patch("time.sleep")
+    @patch("Bcfg2.Proxy._orig_Method.__call__")
+    def test_retry(self, mock_call, mock_sleep):
+        # clients back off for at least as long as they are told to
+        method = Bcfg2.Proxy.RetryMethod(Mock(), "GetConfig")
+        mock_call.side_effect = [ServerBusy(7), "config"]
+        self.assertEqual(method(), "config")
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 7)
+
+
+class TestAdmissionControl(Bcfg2TestCase):
+    def acquire_in_thread(self, admission, client):
+        """ call acquire() in a new thread.  returns the thread and a
+        list that the result of acquire() is appended to """
+        result = []
+
+        def inner():
+            try:
+                result.append(admission.acquire(client))
+            except ServerBusy:
+                result.append(sys.exc_info()[1])
+
+        thread = threading.Thread(target=inner)
+        thread.start()
+        return thread, result
+
+    def wait_for(self, predicate, timeout=5):
+        end = time.time() + timeout
+        while not predicate():
+            if time.time() > end:
+                self.fail("Timed out waiting for condition")
+            time.sleep(0.01)
+
+    def test_unlimited(self):
+        admission = AdmissionControl()
+        self.assertIsNone(admission.acquire("foo"))
+        self.assertIsNone(admission.acquire("bar"))
+        admission.release(None)
+        self.assertEqual(admission.running, 0)
+
+    def test_concurrency(self):
+        admission = AdmissionControl(concurrency=1, queue_size=1, timeout=10)
+        admitted = admission.acquire("foo")
+        self.assertIsNotNone(admitted)
+        self.assertEqual(admission.running, 1)
+
+        # a second request waits for the first to finish
+        thread, result = self.acquire_in_thread(admission, "bar")
+        self.wait_for(lambda: admission.waiting == 1)
+        self.assertEqual(result, [])
+
+        # a third request finds the queue full and is refused
+        self.assertRaises(ServerBusy, admission.acquire, "baz")
+
+        admission.release(admitted)
+        thread.join(5)
+        self.assertEqual(len(result), 1)
+        self.assertIsInstance(result[0], float)
+        self.assertEqual(admission.running, 1)
+        self.assertEqual(admission.waiting, 0)
+        admission.release(result[0])
+        self.assertEqual(admission.running, 0)
+
+    def test_timeout(self):
+        admission = AdmissionControl(concurrency=1, queue_size=5,
+                                     timeout=0.1)
+        admitted = admission.acquire("foo")
+        start = time.time()
+        self.assertRaises(ServerBusy, admission.acquire, "bar")
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(admission.waiting, 0)
+        self.assertEqual(admission.running, 1)
+        admission.release(admitted)
+
+    def test_retry_after(self):
+        admission = AdmissionControl(concurrency=2, queue_size=5)
+        admission.build_time = 10
+        admission.running = 2
+        admission.waiting = 2
+        self.assertEqual(admission.retry_after(), 20)
+        try:
+            admission._refuse("foo", "test")
+        except ServerBusy:
+            self.assertEqual(sys.exc_info()[1].retry_after, 20)
+
+        admission.running = 0
+        admission.waiting = 0
+        self.assertEqual(admission.retry_after(), 1)
+
+    @patch("time.time")
+    def test_build_time(self, mock_time):
+        admission = AdmissionControl(concurrency=2)
+        mock_time.return_value = 100
+        admitted = admission.acquire("foo")
+        mock_time.return_value = 106
+        admission.release(admitted)
+        self.assertAlmostEqual(admission.build_time, 0.8 + 0.2 * 6)
@@ -0,0 +1,188 @@
+import os
+import sys
+import shutil
+import tempfile
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Dependencies import *
+
+
+class TestDependencyGraph(Bcfg2TestCase):
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self.tracked = os.path.join(self.repo, "Cfg")
+        os.makedirs(os.path.join(self.tracked, "etc", "foo"))
+        self.foo = os.path.join(self.tracked, "etc", "foo", "foo")
+        open(self.foo, "w").close()
+        self.bar = os.path.join(self.tracked, "etc", "bar")
+        open(self.bar, "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.repo)
+
+    def get_graph(self):
+        graph = DependencyGraph()
+        graph.track(self.tracked)
+        self.listener = Mock()
+        graph.listeners.append(self.listener)
+        return graph
+
+    def build(self, graph, client, deps):
+        """ simulate building a client that has the given entries,
+        which depend on the given paths.  deps is a dict of
+        (<tag>, <name>) -> list of paths, with an entry of None for
+        dependencies of the client as a whole. """
+        graph.start(client)
+        for entry, paths in deps.items():
+            graph.set_entry(entry)
+            for path in paths:
+                graph.record(path)
+        graph.finish()
+
+    def test_is_tracked(self):
+        graph = self.get_graph()
+        self.assertTrue(graph.is_tracked(self.tracked))
+        self.assertTrue(graph.is_tracked(self.foo))
+        self.assertFalse(graph.is_tracked(self.repo))
+        self.assertFalse(graph.is_tracked(os.path.join(self.repo,
+                                                       "Bundler")))
+
+    def test_record(self):
+        graph = self.get_graph()
+        # nothing is recorded outside of a build
+        graph.record(self.foo)
+        self.assertEqual(graph.dependents, dict())
+
+        self.build(graph, "foo", {("Path", "/etc/foo"): [self.foo + "/"],
+                                  None: [self.bar]})
+        self.assertEqual(graph.dependents,
+                         {self.foo: set([("foo", "Path", "/etc/foo")]),
+                          self.bar: set([("foo", None, None)])})
+
+        # nothing is recorded once the build has finished
+        graph.record(os.path.join(self.tracked, "etc"))
+        self.assertNotIn(os.path.join(self.tracked, "etc"),
+                         graph.dependents)
+
+        # rebuilding a client forgets its old dependencies
+        self.build(graph, "foo", {("Path", "/etc/bar"): [self.bar]})
+        self.assertEqual(graph.dependents,
+                         {self.bar: set([("foo", "Path", "/etc/bar")])})
+
+    def test_forget(self):
+        graph = self.get_graph()
+        self.build(graph, "foo", {("Path", "/etc/foo"): [self.foo]})
+        self.build(graph, "bar", {("Path", "/etc/foo"): [self.foo],
+                                  ("Path", "/etc/bar"): [self.bar]})
+        graph.forget("bar")
+        self.assertEqual(graph.dependents,
+                         {self.foo: set([("foo", "Path", "/etc/foo")])})
+        graph.forget("baz")
+        graph.forget()
+        self.assertEqual(graph.dependents, dict())
+        graph.entries_changed([("Path", "/etc/foo")])
+        self.assertFalse(self.listener.called)
+
+    def test_changed(self):
+        graph = self.get_graph()
+        self.build(graph, "foo", {("Path", "/etc/foo"): [self.foo],
+                                  None: [os.path.join(self.tracked, "etc")]})
+        self.build(graph, "bar", {("Path", "/etc/bar"): [self.bar]})
+
+        # a change to a file invalidates the entries that depend on
+        # it, and anything that depends on its parent directories
+        graph.changed(self.foo)
+        self.listener.assert_called_with(
+            set([("foo", "Path", "/etc/foo"), ("foo", None, None)]))
+        self.assertEqual(list(graph.dependents.keys()), [self.bar])
+
+        # a change to a file nothing depends on invalidates nothing
+        self.listener.reset_mock()
+        graph.changed(os.path.join(self.tracked, "etc", "baz"))
+        self.assertFalse(self.listener.called)
+
+    def test_changed_directory(self):
+        graph = self.get_graph()
+        self.build(graph, "foo", {("Path", "/etc/foo"): [self.foo]})
+        self.build(graph, "bar", {("Path", "/etc/bar"): [self.bar]})
+
+        # a deleted directory does not produce events for the files
+        # in it, so everything below it is invalidated
+        shutil.rmtree(os.path.dirname(self.foo))
+        graph.changed(os.path.dirname(self.foo))
+        self.listener.assert_called_with(set([("foo", "Path", "/etc/foo")]))
+        self.assertEqual(list(graph.dependents.keys()), [self.bar])
+
+    def test_changed_untracked(self):
+        graph = self.get_graph()
+        self.build(graph, "foo", {("Path", "/etc/foo"): [self.foo]})
+
+        # a change to an untracked path invalidates everything
+        graph.changed(os.path.join(self.repo, "Bundler", "foo.xml"))
+        self.listener.assert_called_with(None)
+        self.assertEqual(graph.dependents, dict())
+
+        self.build(graph, "foo", {("Path", "/etc/foo"): [self.foo]})
+        self.listener.reset_mock()
+        graph.changed()
+        self.listener.assert_called_with(None)
+        self.assertEqual(graph.dependents, dict())
+
+    def test_handled_event(self):
+        graph = self.get_graph()
+        self.build(graph, "foo", {("Path", "/etc/foo"): [self.foo]})
+
+        # an event that was handled precisely invalidates only what
+        # depends on the changed path
+        graph.changed(self.foo)
+        graph.handled_event(Mock())
+        self.listener.assert_called_once_with(
+            set([("foo", "Path", "/etc/foo")]))
+
+        # as does an event that changed nothing
+        self.listener.reset_mock()
+        graph.unchanged()
+        graph.handled_event(Mock())
+        self.assertFalse(self.listener.called)
+
+        # an event that was not handled precisely invalidates
+        # everything
+        graph.handled_event(Mock())
+        self.listener.assert_called_with(None)
+
+    def test_entries_changed(self):
+        graph = self.get_graph()
+        self.build(graph, "foo", {("Path", "/etc/foo"): [],
+                                  ("Package", "foo"): []})
+        self.build(graph, "bar", {("Path", "/etc/foo"): [self.foo],
+                                  ("Path", "/etc/bar"): [self.bar]})
+
+        # entries that failed to bind, and so recorded no
+        # dependencies, are invalidated along with others
+        graph.entries_changed([("Path", "/etc/foo")])
+        self.listener.assert_called_with(
+            set([("foo", "Path", "/etc/foo"), ("bar", "Path", "/etc/foo")]))
+
+        self.listener.reset_mock()
+        graph.entries_changed([("Path", "/etc/foo")])
+        self.assertFalse(self.listener.called)
+
+        graph.entries_changed(tags=["Package"])
+        self.listener.assert_called_with(set([("foo", "Package", "foo")]))
+
+        # forgetting a client forgets its entries
+        self.listener.reset_mock()
+        graph.forget("bar")
+        graph.entries_changed([("Path", "/etc/bar")])
+        self.assertFalse(self.listener.called)
@@ -0,0 +1,399 @@
+import os
+import sys
+import ssl
+import time
+import errno
+import select
+import socket
+import threading
+from mock import Mock, MagicMock, patch, call
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from collections import deque
+from Bcfg2.Compat import Queue, xmlrpclib, b64encode
+from Bcfg2.Server.EventCore import *
+
+
+def request(body="<methodCall/>", version="HTTP/1.1", headers=None):
+    """ build an HTTP request """
+    if headers is None:
+        headers = dict()
+    headers.setdefault("Content-Length", str(len(body)))
+    lines = ["POST /RPC2 %s" % version]
+    lines.extend(["%s: %s" % h for h in headers.items()])
+    return ("\r\n".join(lines) + "\r\n\r\n" + body).encode("latin-1")
+
+
+class FakeSocket(object):
+    """ a non-blocking SSL socket that returns the given chunks of
+    data from recv(), then would block """
+    def __init__(self, chunks=None, send_size=None):
+        self.chunks = list(chunks or [])
+        self.send_size = send_size
+        self.sent = "".encode("latin-1")
+        self.closed = False
+        self.do_handshake = Mock()
+        self.getpeercert = Mock(return_value=dict(subject="foo"))
+
+    def fileno(self):
+        return 10
+
+    def recv(self, size):
+        if not self.chunks:
+            raise socket.error(errno.EAGAIN, "would block")
+        chunk = self.chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def send(self, data):
+        if self.send_size == 0:
+            raise ssl.SSLError(ssl.SSL_ERROR_WANT_WRITE, "would block")
+        if self.send_size is not None:
+            data = data[:self.send_size]
+        self.sent += data
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+
+class TestPoller(Bcfg2TestCase):
+    def _test_poller(self, poller):
+        rfd, wfd = os.pipe()
+        try:
+            poller.set(rfd)
+            self.assertEqual(poller.poll(0), [])
+            os.write(wfd, "x".encode("latin-1"))
+            self.assertEqual(poller.poll(1), [rfd])
+
+            # poll for writability instead
+            poller.set(wfd, write=True)
+            self.assertItemsEqual(poller.poll(1), [rfd, wfd])
+            poller.set(rfd, write=False)
+            poller.remove(rfd)
+            poller.remove(rfd)
+            self.assertEqual(poller.poll(1), [wfd])
+            self.assertEqual(poller.fds, {wfd: True})
+            poller.remove(wfd)
+            self.assertEqual(poller.poll(0), [])
+        finally:
+            poller.close()
+            os.close(rfd)
+            os.close(wfd)
+
+    def test_poller(self):
+        self._test_poller(Poller())
+
+    def test_select(self):
+        poller = Poller()
+        poller.close()
+        poller._poller = None
+        self._test_poller(poller)
+
+    def test_poll_eintr(self):
+        poller = Poller()
+        poller._poller = Mock()
+        poller._poller.poll.side_effect = \
+            select.error(errno.EINTR, "interrupted")
+        self.assertEqual(poller.poll(1), [])
+        poller._poller.poll.side_effect = select.error(errno.EBADF, "bad")
+        self.assertRaises(select.error, poller.poll, 1)
+
+
+class TestConnection(Bcfg2TestCase):
+    def get_conn(self, chunks=None, **kwargs):
+        return Connection(FakeSocket(chunks), ("1.2.3.4", 1234), **kwargs)
+
+    def test_handshake(self):
+        conn = self.get_conn()
+        self.assertEqual(conn.fd, 10)
+        self.assertEqual(conn.state, "handshake")
+
+        conn.sock.do_handshake.side_effect = \
+            ssl.SSLError(ssl.SSL_ERROR_WANT_WRITE, "would block")
+        conn.handle_io()
+        self.assertEqual(conn.state, "handshake")
+        self.assertTrue(conn.want_write)
+
+        conn.sock.do_handshake.side_effect = None
+        conn.handle_io()
+        self.assertEqual(conn.state, "read")
+        self.assertFalse(conn.want_write)
+        self.assertEqual(conn.cert, dict(subject="foo"))
+
+        # a failed handshake closes the connection
+        conn = self.get_conn()
+        conn.sock.do_handshake.side_effect = \
+            ssl.SSLError(ssl.SSL_ERROR_SSL, "failed")
+        conn.handle_io()
+        self.assertEqual(conn.state, "closed")
+        self.assertTrue(conn.sock.closed)
+
+    def test_read(self):
+        req = request("<methodCall>test</methodCall>",
+                      headers={"Content-Encoding": "gzip"})
+        # the request is read in several chunks, possibly split in
+        # the headers
+        conn = self.get_conn([req[:10], req[10:-5]])
+        conn.handle_io()
+        self.assertEqual(conn.state, "read")
+        self.assertIsNone(conn.body)
+        conn.sock.chunks.append(req[-5:])
+        conn.handle_io()
+        self.assertEqual(conn.state, "dispatch")
+        self.assertEqual(conn.method, "POST")
+        self.assertEqual(conn.headers["content-encoding"], "gzip")
+        self.assertEqual("".encode("latin-1").join(conn.body),
+                         "<methodCall>test</methodCall>".encode("latin-1"))
+        self.assertTrue(conn.keep_alive)
+
+    def test_read_closed(self):
+        conn = self.get_conn(["".encode("latin-1")])
+        conn.handle_io()
+        self.assertEqual(conn.state, "closed")
+
+        conn = self.get_conn([socket.error(errno.ECONNRESET, "reset")])
+        conn.handle_io()
+        self.assertEqual(conn.state, "closed")
+
+    def test_keep_alive(self):
+        conn = self.get_conn([request(version="HTTP/1.0")])
+        conn.handle_io()
+        self.assertFalse(conn.keep_alive)
+
+        conn = self.get_conn([request(
+            version="HTTP/1.0", headers={"Connection": "Keep-Alive"})])
+        conn.handle_io()
+        self.assertTrue(conn.keep_alive)
+
+        conn = self.get_conn([request(headers={"Connection": "close"})])
+        conn.handle_io()
+        self.assertFalse(conn.keep_alive)
+
+    def test_write(self):
+        # two pipelined requests in one chunk
+        conn = self.get_conn([request("first") + request("second")])
+        conn.sock.send_size = 0
+        conn.handle_io()
+        self.assertEqual(conn.state, "dispatch")
+        self.assertEqual(conn.body, ["first".encode("latin-1")])
+
+        conn.respond(200, "response".encode("latin-1"),
+                     content_type="text/xml", content_encoding="gzip")
+        self.assertEqual(conn.state, "write")
+        self.assertTrue(conn.want_write)
+        conn.handle_io()
+        self.assertEqual(conn.state, "write")
+
+        conn.sock.send_size = 10
+        conn.handle_io()
+        sent = conn.sock.sent.decode("latin-1")
+        self.assertTrue(sent.startswith("HTTP/1.1 200 OK\r\n"))
+        self.assertIn("Content-Length: 8\r\n", sent)
+        self.assertIn("Content-Encoding: gzip\r\n", sent)
+        self.assertIn("Connection: keep-alive\r\n", sent)
+        self.assertTrue(sent.endswith("\r\n\r\nresponse"))
+
+        # the next request was already read
+        self.assertEqual(conn.state, "dispatch")
+        self.assertEqual(conn.body, ["second".encode("latin-1")])
+        self.assertFalse(conn.want_write)
+
+        # errors close the connection after they are sent
+        conn.respond(500)
+        conn.handle_io()
+        self.assertEqual(conn.state, "closed")
+        self.assertIn("500 Internal Server Error",
+                      conn.sock.sent.decode("latin-1"))
+
+    def _test_error(self, data, code, **kwargs):
+        conn = self.get_conn([data], **kwargs)
+        conn.handle_io()
+        self.assertEqual(conn.state, "closed")
+        self.assertTrue(conn.sock.sent.decode("latin-1").startswith(
+            "HTTP/1.1 %d " % code))
+
+    def test_errors(self):
+        self._test_error("garbage\r\n\r\n".encode("latin-1"), 400)
+        self._test_error(("x" * (MAX_HEADER_SIZE + 1)).encode("latin-1"),
+                         400)
+        self._test_error("GET / HTTP/1.1\r\n\r\n".encode("latin-1"), 501)
+        self._test_error("POST /RPC2 HTTP/1.1\r\n\r\n".encode("latin-1"),
+                         411)
+        self._test_error(request("x" * 100), 413, max_length=10)
+
+
+class TestEventXMLRPCServer(Bcfg2TestCase):
+    def get_server(self, queue_size=10):
+        # avoid XMLRPCServer.__init__, which binds a socket
+        server = object.__new__(EventXMLRPCServer)
+        server.logger = Mock()
+        server.workers = 2
+        server.idle_timeout = 30
+        server.max_request_size = 0
+        server.compression_level = 6
+        server.compressed_responses = None
+        server.requests = Queue(queue_size)
+        server.connections = dict()
+        server._poller = Mock()
+        server._busy = 0
+        server._busy_lock = threading.Lock()
+        server._completed = deque()
+        server._wake_read, server._wake_write = os.pipe()
+        server.instance = Mock()
+        server._unmarshaled_dispatch = Mock(return_value="response")
+        return server
+
+    def tearDown(self):
+        for fd in getattr(self, "fds", []):
+            os.close(fd)
+
+    def get_conn(self, server, data=None, headers=None):
+        if data is None:
+            data = xmlrpclib.dumps(("arg", ), "method")
+        if headers is None:
+            headers = dict()
+        headers.setdefault("Authorization",
+                           "Basic %s" %
+                           b64encode("foo:bar".encode("latin-1")).decode(
+                               "latin-1"))
+        conn = Connection(FakeSocket([request(data, headers=headers)]),
+                          ("1.2.3.4", 1234))
+        conn.handle_io()
+        server.connections[conn.fd] = conn
+        return conn
+
+    def test__update(self):
+        server = self.get_server(queue_size=1)
+        self.fds = [server._wake_read, server._wake_write]
+        conn = self.get_conn(server)
+
+        # connections with a complete request are handed off to the
+        # worker threads
+        server._update(conn)
+        server._poller.remove.assert_called_with(conn.fd)
+        self.assertIs(server.requests.get_nowait()[0], conn)
+        self.assertIn(conn.fd, server.connections)
+
+        # connections waiting on I/O are polled
+        conn.state = "write"
+        conn.want_write = True
+        server._update(conn)
+        server._poller.set.assert_called_with(conn.fd, True)
+
+        # requests are refused if the queue is full
+        server.requests.put_nowait("full")
+        conn = self.get_conn(server)
+        server._update(conn)
+        self.assertEqual(conn.state, "closed")
+        self.assertIn("503", conn.sock.sent.decode("latin-1"))
+        self.assertNotIn(conn.fd, server.connections)
+
+    def test__expire(self):
+        server = self.get_server()
+        self.fds = [server._wake_read, server._wake_write]
+        conn = self.get_conn(server)
+        conn.state = "read"
+        busy = Connection(FakeSocket(), ("1.2.3.5", 1234))
+        busy.fd = 11
+        busy.state = "dispatch"
+        server.connections[busy.fd] = busy
+
+        server._expire(conn.last_active + 10)
+        self.assertEqual(conn.state, "read")
+        server._expire(conn.last_active + 31)
+        self.assertEqual(conn.state, "closed")
+        self.assertNotIn(conn.fd, server.connections)
+        # connections that are being handled are never expired
+        self.assertEqual(busy.state, "dispatch")
+
+    def test__worker(self):
+        server = self.get_server()
+        self.fds = [server._wake_read, server._wake_write]
+        conn = self.get_conn(server)
+        server._handle = Mock(return_value=(200, "response", None))
+        server.requests.put((conn, time.time()))
+        server.requests.put(None)
+        server._worker()
+        server._handle.assert_called_with(conn)
+        self.assertEqual(list(server._completed),
+                         [(conn, 200, "response", None)])
+        self.assertEqual(server._busy, 0)
+        # the event loop was woken up
+        self.assertEqual(os.read(server._wake_read, 10),
+                         "x".encode("latin-1"))
+
+    def test__handle(self):
+        server = self.get_server()
+        self.fds = [server._wake_read, server._wake_write]
+        conn = self.get_conn(server)
+        self.assertEqual(server._handle(conn), (200, "response", None))
+        server.instance.authenticate.assert_called_with(
+            conn.cert, "foo", "bar", conn.address)
+        server._unmarshaled_dispatch.assert_called_with(
+            conn.address, ("arg", ), "method")
+
+        server.instance.authenticate.return_value = False
+        conn = self.get_conn(server)
+        self.assertEqual(server._handle(conn)[0], 401)
+        server.instance.authenticate.return_value = True
+
+        conn = self.get_conn(server, headers=dict(Authorization="Basic"))
+        self.assertEqual(server._handle(conn)[0], 401)
+
+        conn = self.get_conn(server,
+                             headers={"Content-Encoding": "bzip2"})
+        self.assertEqual(server._handle(conn)[0], 415)
+
+        conn = self.get_conn(server, data="<methodCall>")
+        self.assertEqual(server._handle(conn)[0], 400)
+
+        server.max_request_size = 10
+        conn = self.get_conn(server)
+        self.assertEqual(server._handle(conn)[0], 413)
+        server.max_request_size = 0
+
+        server._unmarshaled_dispatch.side_effect = ValueError
+        conn = self.get_conn(server)
+        self.assertEqual(server._handle(conn)[0], 500)
+
+    def test__loop(self):
+        server = self.get_server()
+        self.fds = [server._wake_read, server._wake_write]
+        server.timeout = 1
+        server.socket = Mock()
+        server.socket.fileno.return_value = 3
+        server._accept = Mock()
+        conn = self.get_conn(server)
+        conn.state = "read"
+        conn.handle_io = Mock()
+
+        server._poller.poll.return_value = [3, conn.fd]
+        server._loop()
+        server._accept.assert_called_with()
+        conn.handle_io.assert_called_with()
+        server._poller.set.assert_called_with(conn.fd, False)
+
+        # completed responses are sent
+        conn.state = "dispatch"
+        conn.respond = Mock()
+        server._poller.poll.return_value = []
+        server.complete(conn, 200, "response", "gzip")
+        server.complete(conn, 500)
+        server._loop()
+        self.assertEqual(conn.respond.call_args_list,
+                         [call(200, "response", content_type="text/xml",
+                               content_encoding="gzip"),
+                          call(500)])
+        self.assertEqual(len(server._completed), 0)
@@ -0,0 +1,278 @@
+import os
+import sys
+import lxml.etree
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+import Bcfg2.Statistics
+import Bcfg2.Server.Plugin
+from Bcfg2.Compat import xmlrpclib, Queue
+from Bcfg2.Server.MultiprocessingCore import *
+from Bcfg2.Server.Plugins.Probes import Probes, ProbeData
+
+
+class TestCore(Bcfg2TestCase):
+    def get_core(self, children=2):
+        # avoid BuiltinCore.__init__, which needs a full server setup
+        core = object.__new__(Core)
+        core.setup = dict(children=children)
+        core.logger = Mock()
+        core.fam = Mock()
+        core.lock = Mock()
+        core.plugins = dict()
+        core.revision = "-1"
+        core.metadata_cache = Mock()
+        core.config_cache = Mock()
+        core.child_rmi = dict()
+        core.children = [Mock(alive=True) for i in range(children)]
+        core.available_children = Queue()
+        for child in core.children:
+            core.available_children.put(child)
+        return core
+
+    def test__broadcast(self):
+        core = self.get_core()
+        core._broadcast(("test", 1))
+        for child in core.children:
+            child.send.assert_called_with(("test", 1))
+
+    def test__relay_event(self):
+        core = self.get_core()
+        event = Mock()
+        core._relay_event(event)
+        for child in core.children:
+            child.send.assert_called_with(("event", event))
+
+    @patch("Bcfg2.Server.BuiltinCore.Core._dispatch")
+    def test__dispatch(self, mock_dispatch):
+        core = self.get_core()
+        core.child_rmi["Plugin.method"] = "Plugin.child_method"
+
+        self.assertEqual(core._dispatch("Other.method", ("a",), dict()),
+                         mock_dispatch.return_value)
+        for child in core.children:
+            self.assertFalse(child.send.called)
+
+        self.assertEqual(core._dispatch("Plugin.method", ("a",), dict()),
+                         mock_dispatch.return_value)
+        for child in core.children:
+            child.send.assert_called_with(("rmi", "Plugin.child_method",
+                                           ("a",)))
+
+    def test__call_child(self):
+        core = self.get_core(children=1)
+        child = core.children[0]
+        child.call.return_value = (True, "config", None)
+        self.assertEqual(core._call_child("GetConfig", "foo"), "config")
+        core.fam.handle_event_set.assert_called_with(core.lock)
+        child.call.assert_called_with("GetConfig", "foo", core.revision)
+        # the child is available again afterwards
+        self.assertIs(core.available_children.get_nowait(), child)
+
+        # failures in the child are reported as faults
+        core.available_children.put(child)
+        child.call.return_value = (False, "error", None)
+        self.assertRaises(xmlrpclib.Fault,
+                          core._call_child, "GetConfig", "foo")
+
+    @patch("Bcfg2.Statistics.tracer")
+    def test__call_child_trace(self, mock_tracer):
+        core = self.get_core(children=1)
+        trace = Mock()
+        core.children[0].call.return_value = (True, "config", trace)
+        core._call_child("GetConfig", "foo")
+        mock_tracer.add.assert_called_with(trace)
+
+    def test__call_child_dead(self):
+        core = self.get_core(children=2)
+        core._build = Mock(return_value=(True, "config", None))
+
+        # a child that dies is not used again, and the work is
+        # retried in another child
+        dead, live = core.children
+        core.available_children = Queue()
+        core.available_children.put(dead)
+        core.available_children.put(live)
+
+        def die(*args):
+            dead.alive = False
+            raise EOFError
+
+        dead.call.side_effect = die
+        live.call.return_value = (True, "config", None)
+        self.assertEqual(core._call_child("GetConfig", "foo"), "config")
+        live.call.assert_called_with("GetConfig", "foo", core.revision)
+        self.assertFalse(core._build.called)
+
+        # if no children are left, the work is done in the parent
+        live.alive = False
+        self.assertEqual(core._call_child("GetConfig", "foo"), "config")
+        core._build.assert_called_with("GetConfig", "foo")
+
+    @patch("Bcfg2.Statistics.tracer")
+    def test__build(self, mock_tracer):
+        mock_tracer.start.return_value = False
+        core = self.get_core()
+        core.BuildSerializedConfiguration = Mock(return_value="config")
+        core.build_metadata = Mock()
+        core._get_probes = Mock(return_value="probes")
+
+        self.assertEqual(core._build("GetConfig", "foo"),
+                         (True, "config", None))
+        core.BuildSerializedConfiguration.assert_called_with("foo")
+        self.assertEqual(core._build("GetProbes", "foo"),
+                         (True, "probes", None))
+        core._get_probes.assert_called_with(
+            core.build_metadata.return_value)
+
+        core.BuildSerializedConfiguration.side_effect = \
+            Bcfg2.Server.Plugin.MetadataConsistencyError
+        rv = core._build("GetConfig", "foo")
+        self.assertFalse(rv[0])
+
+        core.BuildSerializedConfiguration.side_effect = ValueError
+        rv = core._build("GetConfig", "foo")
+        self.assertFalse(rv[0])
+
+        # traces of the work done are returned to the parent
+        core.BuildSerializedConfiguration.side_effect = None
+        mock_tracer.start.return_value = True
+        self.assertEqual(core._build("GetConfig", "foo"),
+                         (True, "config", mock_tracer.finish.return_value))
+        mock_tracer.finish.assert_called_with(keep=False)
+
+    @patch("signal.signal")
+    def test__child_main(self, mock_signal):
+        core = self.get_core()
+        children = core.children[:]
+        core.server = Mock()
+        core._build = Mock(return_value=(True, "config", None))
+        core._reload_probe_data = Mock()
+        core.plugins["Plugin"] = Mock()
+        core.plugins["Plugin"].fail.side_effect = ValueError
+        event = Mock()
+        reader = Mock()
+        reader.recv.side_effect = [
+            ("event", event),
+            ("probedata", "foo"),
+            ("rmi", "Plugin.method", ("a", "b")),
+            ("rmi", "Plugin.fail", ()),
+            ("call", "GetConfig", "foo", "5"),
+            ("shutdown", ),
+            ("event", event)]
+        writer = Mock()
+        core._child_main(reader, writer)
+
+        # resources belonging to the parent are released
+        core.server.socket.close.assert_called_with()
+        for child in children:
+            child.close.assert_called_with()
+        self.assertEqual(core.children, [])
+        self.assertTrue(core.fam.relayed)
+
+        # messages are handled in order until shutdown
+        core.fam.handle_one_event.assert_called_once_with(event)
+        core._reload_probe_data.assert_called_with("foo")
+        core.plugins["Plugin"].method.assert_called_with("a", "b")
+        self.assertTrue(core.logger.error.called)
+        core._build.assert_called_with("GetConfig", "foo")
+        self.assertEqual(core.revision, "5")
+        writer.send.assert_called_with((True, "config", None))
+
+        # the child also exits if the parent goes away
+        reader.recv.side_effect = EOFError
+        core._child_main(reader, writer)
+
+    def test__reload_probe_data(self):
+        core = self.get_core()
+        core.plugins["Probes"] = Mock()
+        core._reload_probe_data("foo")
+        core.metadata_cache.expire.assert_called_with("foo")
+        core.config_cache.expire.assert_called_with("foo")
+        core.plugins["Probes"].load_data.assert_called_with(client="foo")
+
+        # data sent by the parent is used instead of being loaded
+        core.plugins["Probes"].reset_mock()
+        core._reload_probe_data("foo", "data")
+        core.plugins["Probes"].set_client_data.assert_called_with("foo",
+                                                                  "data")
+        self.assertFalse(core.plugins["Probes"].load_data.called)
+
+        core.config_cache = None
+        del core.plugins["Probes"]
+        core._reload_probe_data("foo")
+
+    @patch("Bcfg2.Server.BuiltinCore.Core.RecvProbeData")
+    def test_RecvProbeData(self, mock_RecvProbeData):
+        core = self.get_core()
+        core.resolve_client = Mock(return_value=("foo", None))
+        self.assertEqual(core.RecvProbeData("address", "data"),
+                         mock_RecvProbeData.return_value)
+        mock_RecvProbeData.assert_called_with(core, "address", "data")
+        for child in core.children:
+            child.send.assert_called_with(("probedata", "foo", None))
+
+        core.plugins["Probes"] = Mock()
+        core.RecvProbeData("address", "data")
+        core.plugins["Probes"].get_client_data.assert_called_with("foo")
+        for child in core.children:
+            child.send.assert_called_with(
+                ("probedata", "foo",
+                 core.plugins["Probes"].get_client_data.return_value))
+
+    @patch("Bcfg2.Server.Plugins.Probes.Probes._use_db", True)
+    @patch("Bcfg2.Server.Plugins.Probes.Probes.load_data", Mock())
+    @patch("Bcfg2.Server.BuiltinCore.Core.RecvProbeData")
+    def test_RecvProbeData_deferred_db(self, mock_RecvProbeData):
+        def get_probes():
+            pcore = MagicMock()
+            pcore.setup.cfp.get = Mock(
+                side_effect=lambda s, o, default=None:
+                    {("probes", "write_interval"): "3600"}.get((s, o),
+                                                               default))
+            return Probes(pcore, datastore)
+
+        parent = self.get_core()
+        parent.resolve_client = Mock(return_value=("foo", None))
+        parent.plugins["Probes"] = get_probes()
+        probe = lxml.etree.Element("Probe", name="os")
+        probe.text = "group:linux\nubuntu"
+        mock_RecvProbeData.side_effect = lambda core, address, data: \
+            core.plugins["Probes"].ReceiveData(Mock(hostname="foo"), data)
+        try:
+            parent.RecvProbeData("address", [probe])
+
+            # the write to the database is deferred...
+            self.assertItemsEqual(parent.plugins["Probes"]._db_pending,
+                                  ["foo"])
+            self.assertIsNotNone(parent.plugins["Probes"]._timer)
+
+            # ...but the children get the new data anyway, without
+            # reading the database
+            child = self.get_core()
+            child.plugins["Probes"] = get_probes()
+            child.plugins["Probes"].load_data.reset_mock()
+            msg = parent.children[0].send.call_args[0][0]
+            self.assertEqual(msg[0], "probedata")
+            child._reload_probe_data(*msg[1:])
+            probedata = child.plugins["Probes"].probedata["foo"]
+            self.assertEqual(probedata, dict(os="ubuntu"))
+            self.assertIsInstance(probedata["os"], ProbeData)
+            self.assertEqual(
+                probedata.timestamp,
+                parent.plugins["Probes"].probedata["foo"].timestamp)
+            self.assertEqual(child.plugins["Probes"].cgroups["foo"],
+                             ["linux"])
+            self.assertFalse(child.plugins["Probes"].load_data.called)
+        finally:
+            parent.plugins["Probes"]._timer.cancel()
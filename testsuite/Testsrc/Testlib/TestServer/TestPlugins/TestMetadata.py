@@ -2,8 +2,12 @@ import os
 import sys
 import copy
 import time
+import random
+import shutil
 import socket
+import tempfile
 import lxml.etree
+import Bcfg2.Cache
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
 from Bcfg2.Server.Plugins.Metadata import *
@@ -88,12 +92,161 @@ def get_groups_test_tree():
 </Groups>''').getroottree()
 
 
+def get_negation_test_tree():
+    return lxml.etree.XML('''
+<Groups>
+  <Group name="web" profile="true" category="role"/>
+  <Group name="db" profile="true" category="role"/>
+  <Group name="debian" category="distro"/>
+  <Group name="ubuntu" category="distro"/>
+  <Group name="lts" category="kernel"/>
+  <Group name="edge" category="kernel"/>
+  <Group name="cloud"/>
+  <Group name="web">
+    <Group name="debian"/>
+    <Group name="apache"/>
+    <Group name="ubuntu"/>
+  </Group>
+  <Group name="db">
+    <Group name="ubuntu"/>
+    <Group name="postgres"/>
+    <Client name="db2" negate="true">
+      <Group name="backup"/>
+    </Client>
+  </Group>
+  <Client name="web2">
+    <Group name="apache" negate="true"/>
+    <Group name="nginx"/>
+    <Group name="db" negate="true">
+      <Group name="ubuntu"/>
+    </Group>
+  </Client>
+  <Group name="apache">
+    <Group name="nginx" negate="true">
+      <Group name="php"/>
+      <Client name="web3">
+        <Group name="debian" negate="true"/>
+        <Group name="legacy"/>
+      </Client>
+    </Group>
+  </Group>
+  <Group name="postgres">
+    <Group name="backup" negate="true">
+      <Group name="monitoring"/>
+    </Group>
+  </Group>
+  <Group name="monitoring">
+    <Group name="web" negate="true">
+      <Group name="alerts"/>
+    </Group>
+  </Group>
+  <Client name="db3">
+    <Group name="cloud" negate="true">
+      <Group name="lts"/>
+    </Group>
+    <Group name="edge"/>
+    <Group name="postgres">
+      <Group name="cloud"/>
+    </Group>
+    <Group name="cloud">
+      <Group name="lts" negate="true"/>
+    </Group>
+  </Client>
+</Groups>''').getroottree()
+
+
+def get_random_groups_tree(rand, groups, categories, clients):
+    """ get a random groups.xml with declarations nested in Group
+    and Client tags, some of them negated """
+    root = lxml.etree.Element("Groups")
+    for name in groups:
+        attrs = dict(name=name)
+        category = rand.choice(categories + [None])
+        if category:
+            attrs['category'] = category
+        if rand.random() < 0.3:
+            attrs['profile'] = "true"
+        lxml.etree.SubElement(root, "Group", **attrs)
+
+    def add_declarations(parent, depth):
+        for _ in range(rand.randint(1, 3)):
+            if depth < 3 and rand.random() < 0.6:
+                if rand.random() < 0.3:
+                    tag, name = "Client", rand.choice(clients)
+                else:
+                    tag, name = "Group", rand.choice(groups)
+                el = lxml.etree.SubElement(parent, tag, name=name)
+                add_declarations(el, depth + 1)
+            else:
+                # declarations (i.e., tags with no children) must be
+                # Group tags
+                el = lxml.etree.SubElement(parent, "Group",
+                                           name=rand.choice(groups))
+            if rand.random() < 0.25:
+                el.set("negate", "true")
+
+    add_declarations(root, 0)
+    return root.getroottree()
+
+
+def merge_groups_per_declaration(xdata, declared, client, groups,
+                                 categories):
+    """ set group membership the way Metadata._merge_groups did before
+    groups.xml was compiled into a
+    :class:`Bcfg2.Server.Plugins.Metadata.MetadataGroupPlan`, by
+    evaluating every declaration in groups.xml on every pass until
+    membership stops changing """
+    membership = []
+    negated = []
+    for el in xdata.xpath("//Groups/Group//*") + \
+            xdata.xpath("//Groups/Client//*"):
+        if el.tag not in ['Group', 'Client'] or el.getchildren():
+            continue
+        conditions = [(p.tag, p.get("name"),
+                       p.get("negate", "false").lower() == "true")
+                      for p in el.iterancestors()
+                      if p.tag in ['Group', 'Client']]
+        if el.get("negate", "false").lower() == "true":
+            negated.append((conditions, declared[el.get("name")]))
+        else:
+            membership.append((conditions, declared[el.get("name")]))
+
+    def matches(conditions):
+        for tag, name, negate in conditions:
+            if tag == 'Group' and negate == (name in groups):
+                return False
+            elif tag == 'Client' and negate == (name == client):
+                return False
+        return True
+
+    numgroups = -1
+    while numgroups != len(groups):
+        numgroups = len(groups)
+        for conditions, group in membership:
+            if group.name in groups:
+                continue
+            if (matches(conditions) and
+                not (group.category and group.category in categories)):
+                groups.add(group.name)
+                if group.category:
+                    categories[group.category] = group.name
+        for conditions, group in negated:
+            if group.name not in groups:
+                continue
+            if matches(conditions):
+                groups.remove(group.name)
+                if group.category:
+                    del categories[group.category]
+    return (groups, categories)
+
+
 def get_metadata_object(core=None, watch_clients=False, use_db=False):
     if core is None:
         core = Mock()
         core.setup = MagicMock()
         core.metadata_cache = MagicMock()
     core.setup.cfp.getboolean = Mock(return_value=use_db)
+    core.setup.cfp.get = Mock(return_value="0")
     return Metadata(core, datastore, watch_clients=watch_clients)
 
 
@@ -199,10 +352,12 @@ if HAS_DJANGO or can_skip:
 class TestXMLMetadataConfig(TestXMLFileBacked):
     test_obj = XMLMetadataConfig
 
-    def get_obj(self, basefile="clients.xml", core=None, watch_clients=False):
+    def get_obj(self, basefile="clients.xml", core=None, watch_clients=False,
+                write_interval=0):
         self.metadata = get_metadata_object(core=core,
                                             watch_clients=watch_clients)
-        return XMLMetadataConfig(self.metadata, watch_clients, basefile)
+        return XMLMetadataConfig(self.metadata, watch_clients, basefile,
+                                 write_interval=write_interval)
 
     def test__init(self):
         xmc = self.get_obj()
@@ -326,20 +481,21 @@ class TestXMLMetadataConfig(TestXMLFileBacked):
                                                        "clients.xml"),
                                           "<test/>")
 
-    @patch('Bcfg2.Server.Plugins.Metadata.locked', Mock(return_value=False))
-    @patch('fcntl.lockf', Mock())
-    @patch('os.open')
+    @patch('tempfile.mkstemp')
     @patch('os.fdopen')
+    @patch('os.chmod')
     @patch('os.unlink')
     @patch('os.rename')
+    @patch('os.path.exists')
     @patch('os.path.islink')
     @patch('os.readlink')
-    def test_write_xml(self, mock_readlink, mock_islink, mock_rename,
-                       mock_unlink, mock_fdopen, mock_open):
+    def test_write_xml(self, mock_readlink, mock_islink, mock_exists,
+                       mock_rename, mock_unlink, mock_chmod, mock_fdopen,
+                       mock_mkstemp):
         fname = "clients.xml"
         config = self.get_obj(fname)
         fpath = os.path.join(self.metadata.data, fname)
-        tmpfile = "%s.new" % fpath
+        tmpfile = os.path.join(self.metadata.data, ".clients.xml.XXXXXX")
         linkdest = os.path.join(self.metadata.data, "client-link.xml")
 
         def reset():
@@ -347,45 +503,38 @@ class TestXMLMetadataConfig(TestXMLFileBacked):
             mock_islink.reset_mock()
             mock_rename.reset_mock()
             mock_unlink.reset_mock()
+            mock_chmod.reset_mock()
             mock_fdopen.reset_mock()
-            mock_open.reset_mock()
+            mock_mkstemp.reset_mock()
+            mock_rename.side_effect = None
+            mock_fdopen.side_effect = None
+            mock_fdopen.return_value.write.side_effect = None
+            mock_mkstemp.side_effect = None
 
         mock_islink.return_value = False
+        mock_exists.return_value = False
+        mock_mkstemp.return_value = (5, tmpfile)
 
         # basic test - everything works
         config.write_xml(fpath, get_clients_test_tree())
-        mock_open.assert_called_with(tmpfile,
-                                     os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        mock_fdopen.assert_called_with(mock_open.return_value, 'w')
-        self.assertTrue(mock_fdopen.return_value.write.called)
-        mock_islink.assert_called_with(fpath)
-        mock_rename.assert_called_with(tmpfile, fpath)
-
-        # test: clients.xml.new is locked the first time we write it
-        def rv(fname, mode):
-            mock_open.side_effect = None
-            raise OSError(17, fname)
-
-        reset()
-        mock_open.side_effect = rv
-        config.write_xml(fpath, get_clients_test_tree())
-        self.assertItemsEqual(mock_open.call_args_list,
-                              [call(tmpfile,
-                                    os.O_CREAT | os.O_EXCL | os.O_WRONLY),
-                               call(tmpfile,
-                                    os.O_CREAT | os.O_EXCL | os.O_WRONLY)])
-        mock_fdopen.assert_called_with(mock_open.return_value, 'w')
+        mock_mkstemp.assert_called_with(prefix=".clients.xml.",
+                                        dir=self.metadata.data)
+        mock_fdopen.assert_called_with(5, 'wb')
         self.assertTrue(mock_fdopen.return_value.write.called)
+        self.assertTrue(mock_fdopen.return_value.close.called)
         mock_islink.assert_called_with(fpath)
+        mock_chmod.assert_called_with(tmpfile, 420)
         mock_rename.assert_called_with(tmpfile, fpath)
 
         # test writing a symlinked clients.xml
         reset()
-        mock_open.side_effect = None
         mock_islink.return_value = True
         mock_readlink.return_value = linkdest
         config.write_xml(fpath, get_clients_test_tree())
+        mock_mkstemp.assert_called_with(prefix=".client-link.xml.",
+                                        dir=self.metadata.data)
         mock_rename.assert_called_with(tmpfile, linkdest)
+        mock_islink.return_value = False
 
         # test failure of os.rename()
         reset()
@@ -396,22 +545,104 @@ class TestXMLMetadataConfig(TestXMLFileBacked):
 
         # test failure of file.write()
         reset()
-        mock_open.return_value.write.side_effect = IOError
+        mock_fdopen.return_value.write.side_effect = IOError
         self.assertRaises(Bcfg2.Server.Plugin.MetadataRuntimeError,
                           config.write_xml, fpath, get_clients_test_tree())
         mock_unlink.assert_called_with(tmpfile)
+        self.assertFalse(mock_rename.called)
 
-        # test failure of os.open() (other than EEXIST)
+        # test failure of tempfile.mkstemp()
         reset()
-        mock_open.side_effect = OSError
+        mock_mkstemp.side_effect = OSError
         self.assertRaises(Bcfg2.Server.Plugin.MetadataRuntimeError,
                           config.write_xml, fpath, get_clients_test_tree())
+        self.assertFalse(mock_rename.called)
 
         # test failure of os.fdopen()
         reset()
         mock_fdopen.side_effect = OSError
         self.assertRaises(Bcfg2.Server.Plugin.MetadataRuntimeError,
                           config.write_xml, fpath, get_clients_test_tree())
+        self.assertFalse(mock_rename.called)
+
+    def test_write_xml_deferred(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "clients.xml")
+            open(fpath, "w").write("<Clients/>")
+            config = self.get_obj("clients.xml", write_interval=3600)
+            config.basedir = tmpdir
+            config.journal = os.path.join(tmpdir, ".clients.xml.journal")
+            config.load_xml()
+
+            # changes are journaled, but not written until flushed
+            for name in ["client1", "client2"]:
+                client = lxml.etree.SubElement(config.basedata.getroot(),
+                                               "Client", name=name,
+                                               profile="group1")
+                config.record("set", client)
+                config.write()
+            self.assertIsNotNone(config._timer)
+            self.assertEqual(
+                lxml.etree.parse(fpath).xpath("//Client"), [])
+            self.assertEqual(
+                len(open(config.journal).read().splitlines()), 2)
+
+            # replaying the journal restores the pending changes
+            config.load_xml()
+            self.assertItemsEqual(
+                [c.get("name") for c in config.xdata.xpath("//Client")],
+                ["client1", "client2"])
+
+            config.flush()
+            self.assertIsNone(config._timer)
+            self.assertFalse(os.path.exists(config.journal))
+            self.assertItemsEqual(
+                [c.get("name") for c in lxml.etree.parse(fpath).xpath(
+                    "//Client[@profile='group1']")],
+                ["client1", "client2"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_replay_journal(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "groups.xml")
+            open(fpath, "w").write("""<Groups>
+  <Group name="x"/>
+  <Group name="web"><Group name="x"/></Group>
+</Groups>""")
+            config = self.get_obj("groups.xml", write_interval=3600)
+            config.basedir = tmpdir
+            config.journal = os.path.join(tmpdir, ".groups.xml.journal")
+            config.load_xml()
+
+            # changes are made to the first matching element, as
+            # Metadata._remove_xdata and Metadata._update_xdata do
+            xpath = './/Group[@name=$name]'
+            group = config.find_xml_for_xpath(xpath, name="x")['xquery'][0]
+            group.getparent().remove(group)
+            config.record("remove", group)
+            group = config.find_xml_for_xpath(xpath, name='web"]|//*[@name="x')
+            self.assertEqual(group, dict())
+            group = config.find_xml_for_xpath(xpath, name="web")['xquery'][0]
+            group.set("public", "true")
+            config.record("set", group)
+            config.write()
+            expected = lxml.etree.tostring(config.basedata)
+
+            config.load_xml()
+            self.assertEqual(lxml.etree.tostring(config.basedata), expected)
+            for tree in [config.basedata, config.xdata]:
+                self.assertItemsEqual(
+                    [g.getparent().get("name")
+                     for g in tree.xpath("//Group[@name='x']")],
+                    ["web"])
+                self.assertEqual(tree.xpath("//Group[@public='true']/@name"),
+                                 ["web"])
+            config.flush()
+        finally:
+            shutil.rmtree(tmpdir)
 
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     @patch('lxml.etree.parse')
@@ -708,6 +939,27 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
                             new1_client)
         self.assertFalse(metadata.clients_xml.write.called)
 
+    def test_add_clients(self):
+        metadata = self.get_obj()
+        metadata.clients_xml.write = Mock()
+        metadata.clients_xml.data = \
+            lxml.etree.XML('<Clients><Client name="old"/></Clients>')
+        metadata.clients_xml.data = metadata.clients_xml.data.getroottree()
+        metadata.clients_xml.basedata = copy.copy(metadata.clients_xml.data)
+
+        rv = metadata.add_clients(dict(new1=dict(profile="group1"),
+                                       new2=dict(profile="group1"),
+                                       old=dict()))
+        # clients.xml is only written once
+        metadata.clients_xml.write.assert_called_once_with()
+        self.assertItemsEqual([c.get("name") for c in rv],
+                              ["new1", "new2", "old"])
+        for name in ["new1", "new2"]:
+            client = metadata.search_client(name,
+                                            metadata.clients_xml.base_xdata)
+            self.assertIsNotNone(client)
+            self.assertEqual(client.attrib, dict(name=name, profile="group1"))
+
     def test_update_client(self):
         metadata = self.get_obj()
         metadata.clients_xml.write_xml = Mock()
@@ -1030,6 +1282,100 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
                          (set(["group1", "group8", "group9", "group10"]),
                           dict(group1="category1")))
 
+        # client9 is a member of group8, and so of group9, but is
+        # then removed from group9 by a negated declaration
+        self.assertEqual(metadata._merge_groups("client9", set(["group5"])),
+                         (set(["group5", "group8", "group11"]), dict()))
+
+    def assertMergeGroupsUnchanged(self, xdata, clients):
+        """ assert that _merge_groups gives the same result as
+        evaluating every declaration in the given groups.xml on every
+        pass for each of the given clients, starting with no groups
+        and with each profile group """
+        metadata = self.load_groups_data(xdata=copy.deepcopy(xdata))
+        profiles = [None] + sorted(g.name for g in metadata.groups.values()
+                                   if g.is_profile)
+        for client in clients:
+            for profile in profiles:
+                groups = set()
+                categories = dict()
+                if profile:
+                    groups.add(profile)
+                    if metadata.groups[profile].category:
+                        categories[metadata.groups[profile].category] = \
+                            profile
+                expected = merge_groups_per_declaration(
+                    xdata, metadata.groups, client, set(groups),
+                    dict(categories))
+                self.assertEqual(
+                    metadata._merge_groups(client, set(groups),
+                                           categories=dict(categories)),
+                    expected,
+                    "%s with profile %s: %s != %s" %
+                    (client, profile,
+                     metadata._merge_groups(client, set(groups),
+                                            categories=dict(categories)),
+                     expected))
+
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_merge_groups_unchanged(self):
+        clients = ["client%d" % i for i in range(1, 11)]
+        self.assertMergeGroupsUnchanged(get_groups_test_tree(), clients)
+
+        clients = ["web1", "web2", "web3", "db1", "db2", "db3"]
+        self.assertMergeGroupsUnchanged(get_negation_test_tree(), clients)
+        metadata = self.load_groups_data(xdata=get_negation_test_tree())
+        # debian is the first group in the distro category that web
+        # clients are added to, so ubuntu is suppressed
+        self.assertEqual(
+            metadata._merge_groups("web1", set(["web"]),
+                                   categories=dict(role="web")),
+            (set(["web", "debian", "apache", "php"]),
+             dict(role="web", distro="debian")))
+        # web2 is removed from apache, and added to nginx instead.
+        # groups it was added to because it was in apache are kept
+        self.assertEqual(
+            metadata._merge_groups("web2", set(["web"]),
+                                   categories=dict(role="web")),
+            (set(["web", "debian", "nginx", "php"]),
+             dict(role="web", distro="debian")))
+        # all db clients but db2 get backups, and the others are
+        # monitored instead
+        self.assertEqual(
+            metadata._merge_groups("db1", set(["db"]),
+                                   categories=dict(role="db")),
+            (set(["db", "ubuntu", "postgres", "backup"]),
+             dict(role="db", distro="ubuntu")))
+        self.assertEqual(
+            metadata._merge_groups("db2", set(["db"]),
+                                   categories=dict(role="db")),
+            (set(["db", "ubuntu", "postgres", "monitoring", "alerts"]),
+             dict(role="db", distro="ubuntu")))
+        # web3 is removed from debian only after ubuntu has been
+        # suppressed, so it is in no group in the distro category
+        self.assertEqual(
+            metadata._merge_groups("web3", set(["web"]),
+                                   categories=dict(role="web")),
+            (set(["web", "apache", "php", "legacy"]), dict(role="web")))
+        # db3 is removed from lts, which lets it be added to edge,
+        # even though it was suppressed by the kernel category before
+        self.assertEqual(
+            metadata._merge_groups("db3", set(["db"]),
+                                   categories=dict(role="db")),
+            (set(["db", "ubuntu", "postgres", "backup", "cloud", "edge"]),
+             dict(role="db", distro="ubuntu", kernel="edge")))
+
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_merge_groups_unchanged_random(self):
+        rand = random.Random(2718)
+        groups = ["group%d" % i for i in range(8)]
+        categories = ["category%d" % i for i in range(3)]
+        clients = ["client%d" % i for i in range(3)]
+        for _ in range(200):
+            self.assertMergeGroupsUnchanged(
+                get_random_groups_tree(rand, groups, categories, clients),
+                clients + ["other"])
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_get_all_group_names(self):
         metadata = self.load_groups_data()
@@ -1069,6 +1415,122 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
                               [c.get("name")
                                for c in get_clients_test_tree().findall("//Client[@profile='group2']")])
 
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_get_client_names_indexed(self):
+        metadata = self.load_clients_data(metadata=self.load_groups_data())
+        metadata.core.build_metadata = Mock()
+        metadata.core.build_metadata.side_effect = \
+            lambda c: metadata.get_initial_metadata(c)
+        queries = [("by_groups", metadata.get_client_names_by_groups,
+                    [["group2"], ["group1", "group8"], ["group3"], []]),
+                   ("by_profiles", metadata.get_client_names_by_profiles,
+                    [["group2"], ["group1", "group2"], []]),
+                   ("by_bundles", metadata.get_client_names_by_bundles,
+                    [["bundle1"], ["bundle1", "bundle3"], []])]
+        expected = dict()
+        for name, func, args in queries:
+            expected[name] = [sorted(func(a)) for a in args]
+
+        metadata.core.metadata_cache_mode = "aggressive"
+        metadata.core.metadata_cache = Bcfg2.Cache.Cache(
+            indexes=dict(groups=lambda m: m.groups,
+                         bundles=lambda m: m.bundles,
+                         profile=lambda m: [m.profile]))
+
+        def build_metadata(client):
+            rv = metadata.get_initial_metadata(client)
+            metadata.core.metadata_cache[client] = rv
+            return rv
+
+        metadata.core.build_metadata.reset_mock()
+        metadata.core.build_metadata.side_effect = build_metadata
+        for name, func, args in queries:
+            self.assertEqual([sorted(func(a)) for a in args],
+                             expected[name])
+        # metadata is only built once for each client
+        self.assertEqual(metadata.core.build_metadata.call_count,
+                         len(metadata.clients))
+
+        # expired clients are rebuilt and re-indexed
+        metadata.core.metadata_cache.expire("client2")
+        metadata.core.build_metadata.reset_mock()
+        self.assertItemsEqual(metadata.get_client_names_by_groups(["group2"]),
+                              expected["by_groups"][0])
+        metadata.core.build_metadata.assert_called_once_with("client2")
+
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_expire_metadata_cache(self):
+        metadata = self.load_clients_data(metadata=self.load_groups_data())
+        cache = Bcfg2.Cache.Cache(
+            indexes=dict(groups=lambda m: m.groups,
+                         bundles=lambda m: m.bundles,
+                         profile=lambda m: [m.profile]))
+        metadata.core.metadata_cache = cache
+
+        def fill():
+            for client in metadata.clients:
+                cache[client] = metadata.get_initial_metadata(client)
+
+        def in_group(group):
+            return [c for c in metadata.clients if group in cache[c].groups]
+
+        def assertExpired(expired):
+            self.assertItemsEqual(cache.keys(),
+                                  [c for c in metadata.clients
+                                   if c not in expired])
+
+        # an event that changes nothing expires nothing
+        fill()
+        self.load_groups_data(metadata=metadata)
+        self.load_clients_data(metadata=metadata)
+        assertExpired([])
+
+        # changing a group declaration expires the members of the
+        # group
+        expired = in_group("group2")
+        groups = copy.deepcopy(get_groups_test_tree())
+        lxml.etree.SubElement(groups.find("Group[@name='group2']"),
+                              "Bundle", name="bundle4")
+        self.load_groups_data(metadata=metadata, xdata=groups)
+        self.assertNotEqual(expired, [])
+        assertExpired(expired)
+
+        # adding a membership declaration expires the clients that
+        # may meet its conditions
+        fill()
+        expired = in_group("group8")
+        groups = copy.deepcopy(groups)
+        lxml.etree.SubElement(groups.find("Group[@name='group8']"),
+                              "Group", name="group5")
+        lxml.etree.SubElement(groups.find("Client[@name='client8']"),
+                              "Group", name="group5")
+        self.load_groups_data(metadata=metadata, xdata=groups)
+        self.assertNotEqual(expired, [])
+        assertExpired(expired + ["client8"])
+
+        # changing a client expires only that client
+        fill()
+        clients = copy.deepcopy(get_clients_test_tree())
+        clients.find("Client[@name='client5']").set("profile", "group2")
+        self.load_clients_data(metadata=metadata, xdata=clients)
+        assertExpired(["client5"])
+
+        # declarations that may apply to any client, or a new default
+        # group, expire all clients
+        fill()
+        groups = copy.deepcopy(groups)
+        grp = lxml.etree.SubElement(groups.getroot(), "Group",
+                                    name="group5", negate="true")
+        lxml.etree.SubElement(grp, "Group", name="group12")
+        self.load_groups_data(metadata=metadata, xdata=groups)
+        assertExpired(metadata.clients)
+
+        fill()
+        groups = copy.deepcopy(groups)
+        groups.find("Group[@name='group5']").set("default", "true")
+        self.load_groups_data(metadata=metadata, xdata=groups)
+        assertExpired(metadata.clients)
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_merge_additional_groups(self):
         metadata = self.load_clients_data(metadata=self.load_groups_data())
@@ -1300,6 +1762,15 @@ class TestMetadataBase(TestMetadata):
                               [c.hostname
                                for c in MetadataClientModel.objects.all()])
 
+    def test_add_clients(self):
+        metadata = self.get_obj()
+        new1 = self.get_nonexistent_client(metadata)
+        new2 = self.get_nonexistent_client(metadata, prefix="newclients")
+        rv = metadata.add_clients({new1: dict(), new2: dict()})
+        self.assertItemsEqual([c.hostname for c in rv], [new1, new2])
+        self.assertIn(new1, metadata.clients)
+        self.assertIn(new2, metadata.clients)
+
     def test_update_group(self):
         pass
 
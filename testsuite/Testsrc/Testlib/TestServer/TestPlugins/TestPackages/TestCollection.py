@@ -0,0 +1,155 @@
+import os
+import sys
+import random
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Plugins.Packages.Collection import Collection
+from Bcfg2.Server.Plugins.Packages.Source import dependency_closures
+
+
+class FakeSource(object):
+    """ a source with the given dependencies and virtual packages
+    that computes closures the way
+    :func:`Bcfg2.Server.Plugins.Packages.Source.Source.compute_closures`
+    does """
+    setup = None
+    ptype = "fake"
+
+    def __init__(self, name, deps, vpkgs, limit=1000):
+        self.name = name
+        self.deps = deps
+        self.vpkgs = vpkgs
+        self.closures = dependency_closures(
+            set(deps).difference(vpkgs), deps.get, limit=limit)
+
+    def __str__(self):
+        return self.name
+
+    def is_package(self, metadata, package):
+        return package in self.deps
+
+    def get_deps(self, metadata, package):
+        return self.deps.get(package, [])
+
+    def get_vpkgs(self, metadata):
+        return self.vpkgs
+
+    def get_relevant_groups(self, metadata):
+        return []
+
+    def get_closures(self, metadata):
+        return self.closures
+
+    def filter_unknown(self, unknown):
+        pass
+
+
+def random_source(rand, name, names, symbols):
+    """ get a source that provides a random subset of ``names`` and
+    ``symbols`` """
+    pkgs = rand.sample(names, rand.randint(1, len(names)))
+    deps = dict()
+    for pkg in pkgs:
+        deps[pkg] = rand.sample(names + symbols, rand.randint(0, 3))
+    vpkgs = dict()
+    for symbol in rand.sample(symbols, rand.randint(0, len(symbols))):
+        vpkgs[symbol] = set(rand.sample(pkgs, rand.randint(1, 2)
+                                        if len(pkgs) > 1 else 1))
+    return FakeSource(name, deps, vpkgs, limit=rand.choice([5, 1000]))
+
+
+class TestCollection(Bcfg2TestCase):
+    def get_obj(self, sources):
+        return Collection(Mock(), sources, None, None, None)
+
+    def test_get_closures(self):
+        source1 = FakeSource("source1", dict(a=["b"], b=[]), dict())
+        source2 = FakeSource("source2", dict(c=[]), dict())
+        source2.closures = None
+        collection = self.get_obj([source1, source2])
+        self.assertEqual(collection.get_closures(),
+                         [source1.closures, None])
+
+        source1.closures = None
+        self.assertIsNone(collection.get_closures())
+
+    def test_get_closure(self):
+        source1 = FakeSource("source1",
+                             dict(a=["b"], b=[], c=["v"], d=[]),
+                             dict(v=set(["d"]), i=set(["d"])))
+        source2 = FakeSource("source2",
+                             dict(a=[], b=["a"], e=["b", "w"], f=["g"],
+                                  g=[], h=["i"], i=[]),
+                             dict(w=set(["g"])))
+        collection = self.get_obj([source1, source2])
+        closures = collection.get_closures()
+        vpkgs = collection.get_vpkgs()
+
+        closure, frontier = collection.get_closure("a", closures, vpkgs)
+        self.assertItemsEqual(closure, ["a", "b"])
+        self.assertItemsEqual(frontier, [])
+        closure, frontier = collection.get_closure("c", closures, vpkgs)
+        self.assertItemsEqual(closure, ["c"])
+        self.assertItemsEqual(frontier, ["v"])
+
+        # closures from later sources are used if nothing in them is
+        # provided by an earlier source
+        closure, frontier = collection.get_closure("f", closures, vpkgs)
+        self.assertItemsEqual(closure, ["f", "g"])
+        self.assertItemsEqual(frontier, [])
+
+        # b is provided by source1, so source1 provides its
+        # dependencies
+        self.assertIsNone(collection.get_closure("e", closures, vpkgs))
+        # i is a virtual package in source1
+        self.assertIsNone(collection.get_closure("h", closures, vpkgs))
+        # unknown packages have no closure
+        self.assertIsNone(collection.get_closure("x", closures, vpkgs))
+
+        # packages from a source whose closures cannot be used
+        # have no closure, even if a later source has one
+        source1.closures = None
+        closures = collection.get_closures()
+        self.assertIsNone(collection.get_closure("a", closures, vpkgs))
+
+    def test_complete_random(self):
+        """ complete() gives the same result with and without closures
+        for random sources """
+        rand = random.Random(4321)
+        names = ["pkg%d" % i for i in range(30)]
+        symbols = ["sym%d" % i for i in range(8)]
+        for _ in range(100):
+            sources = [random_source(rand, "source%d" % i, names, symbols)
+                       for i in range(rand.randint(1, 3))]
+            collection = self.get_obj(sources)
+            # names that are both packages and virtual packages are
+            # resolved in an order-dependent way if they are requested
+            # directly, so they are only reached as dependencies
+            vpkgs = collection.get_vpkgs()
+            requested = set(rand.sample([n for n in names + symbols
+                                         if n not in vpkgs or
+                                         not collection.is_package(n)],
+                                        5))
+            requested.add("unknown")
+
+            expected = collection.complete(requested)
+            if collection.get_closures() is None:
+                continue
+
+            @patch.object(Collection, "get_closures")
+            def inner(mock_get_closures):
+                mock_get_closures.return_value = None
+                return collection.complete(requested)
+
+            self.assertEqual(inner(), expected)
@@ -0,0 +1,298 @@
+import os
+import sys
+import shutil
+import socket
+import tempfile
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Compat import httplib, HTTPError, URLError
+from Bcfg2.Server.Plugins.Packages.Download import *
+
+
+def get_response(status=200, body="", headers=None):
+    """ get a mock httplib response """
+    response = Mock()
+    response.status = status
+    response.reason = "Reason"
+    data = [body.encode('UTF-8')]
+
+    def read(size=None):
+        if size is None:
+            size = len(data[0])
+        rv = data[0][:size]
+        data[0] = data[0][size:]
+        return rv
+
+    response.read.side_effect = read
+    response.getheader.side_effect = dict(headers or dict()).get
+    return response
+
+
+def get_connections(*responses):
+    """ get a mock httplib connection class.  each connection created
+    gives the next of the given lists of responses, in order """
+    responses = list(responses)
+    conns = []
+
+    def connect(host, port, timeout=None):
+        conn = Mock()
+        conn.host = host
+        conn.getresponse.side_effect = responses.pop(0)
+        conns.append(conn)
+        return conn
+
+    return Mock(side_effect=connect), conns
+
+
+class TestValidators(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "repomd.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_validators(self):
+        self.assertEqual(read_validators(self.fname), dict())
+
+        open(self.fname, 'w').write("data")
+        validators = {"ETag": '"abc"',
+                      "Last-Modified": "Mon, 01 Jun 2015 00:00:00 GMT"}
+        write_validators(self.fname, validators)
+        self.assertTrue(os.path.exists(validators_file(self.fname)))
+        self.assertEqual(read_validators(self.fname), validators)
+
+        # empty validators are not stored
+        write_validators(self.fname, {"ETag": '"def"', "Last-Modified": None})
+        self.assertEqual(read_validators(self.fname), {"ETag": '"def"'})
+
+        # validators are ignored if the file they are for is missing
+        os.unlink(self.fname)
+        self.assertEqual(read_validators(self.fname), dict())
+
+        open(self.fname, 'w').write("data")
+        write_validators(self.fname, {"ETag": None})
+        self.assertFalse(os.path.exists(validators_file(self.fname)))
+        self.assertEqual(read_validators(self.fname), dict())
+
+
+class TestDownloader(Bcfg2TestCase):
+    url = "http://example.com/repodata/repomd.xml"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "repomd.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        return Downloader(workers=2, timeout=5)
+
+    @patch("Bcfg2.Server.Plugins.Packages.Download.getproxies", dict)
+    def test_fetch(self):
+        downloader = self.get_obj()
+
+        def fetch(status, body, validators):
+            def fetch_http(url, headers, outfile):
+                if body is not None:
+                    outfile.write(body.encode('UTF-8'))
+                return status, validators
+
+            @patch.object(downloader, "_fetch_http")
+            def inner(mock_fetch_http):
+                mock_fetch_http.side_effect = fetch_http
+                rv = downloader.fetch(self.url, self.fname)
+                return rv, mock_fetch_http.call_args[0][1]
+
+            return inner()
+
+        # new file
+        self.assertEqual(fetch(200, "one", {"ETag": '"1"',
+                                            "Last-Modified": None}),
+                         (True, dict()))
+        self.assertEqual(open(self.fname).read(), "one")
+        self.assertEqual(read_validators(self.fname), {"ETag": '"1"'})
+        inode = os.stat(self.fname).st_ino
+
+        # the validators are sent with the next request.  if the file
+        # is unchanged, it is not replaced
+        self.assertEqual(fetch(200, "one", {"ETag": '"2"'}),
+                         (False, {"If-None-Match": '"1"'}))
+        self.assertEqual(os.stat(self.fname).st_ino, inode)
+        self.assertEqual(read_validators(self.fname), {"ETag": '"2"'})
+
+        # not modified
+        self.assertEqual(fetch(304, None, dict()),
+                         (False, {"If-None-Match": '"2"'}))
+        self.assertEqual(os.stat(self.fname).st_ino, inode)
+        self.assertEqual(open(self.fname).read(), "one")
+        self.assertEqual(read_validators(self.fname), {"ETag": '"2"'})
+
+        # changed file
+        self.assertEqual(fetch(200, "two", {"ETag": '"3"'})[0], True)
+        self.assertEqual(open(self.fname).read(), "two")
+        self.assertEqual(read_validators(self.fname), {"ETag": '"3"'})
+
+        self.assertItemsEqual(os.listdir(self.tmpdir),
+                              ["repomd.xml",
+                               validators_file("repomd.xml")])
+
+    @patch("Bcfg2.Server.Plugins.Packages.Download.getproxies", dict)
+    def test_fetch_errors(self):
+        downloader = self.get_obj()
+        self.assertRaises(ValueError, downloader.fetch, "repomd.xml",
+                          self.fname)
+        self.assertRaises(ValueError, downloader.fetch, "http:///repomd.xml",
+                          self.fname)
+
+        open(self.fname, 'w').write("one")
+
+        def fetch_http(url, headers, outfile):
+            outfile.write("tw".encode('UTF-8'))
+            raise URLError("connection reset")
+
+        # a failed download leaves the local file untouched
+        @patch.object(downloader, "_fetch_http")
+        def inner(mock_fetch_http):
+            mock_fetch_http.side_effect = fetch_http
+            self.assertRaises(URLError, downloader.fetch, self.url,
+                              self.fname)
+
+        inner()
+        self.assertEqual(open(self.fname).read(), "one")
+        self.assertEqual(os.listdir(self.tmpdir), ["repomd.xml"])
+
+    @patch("Bcfg2.Server.Plugins.Packages.Download.getproxies", dict)
+    def test_fetch_http(self):
+        downloader = self.get_obj()
+        fname2 = os.path.join(self.tmpdir, "primary.xml.gz")
+        fname3 = os.path.join(self.tmpdir, "other.xml")
+        mock_conn, conns = get_connections(
+            [get_response(301, headers=dict(Location="/repo/repomd.xml")),
+             get_response(200, "repomd", headers=dict(ETag='"1"')),
+             get_response(304),
+             get_response(200, "primary")],
+            [get_response(200, "other")])
+
+        @patch.object(httplib, "HTTPConnection", mock_conn)
+        def inner():
+            self.assertTrue(downloader.fetch(self.url, self.fname))
+            # a 304 response does not change the file
+            self.assertFalse(downloader.fetch(self.url, self.fname))
+            self.assertTrue(downloader.fetch(
+                "http://example.com/repo/primary.xml.gz?x=1", fname2))
+            self.assertTrue(downloader.fetch("http://mirror.example.com/o",
+                                             fname3))
+
+        inner()
+        # one connection is used for each host, and redirects are
+        # followed
+        self.assertEqual([c.host for c in conns],
+                         ["example.com", "mirror.example.com"])
+        self.assertEqual([c[0][:2] for c in conns[0].request.call_args_list],
+                         [("GET", "/repodata/repomd.xml"),
+                          ("GET", "/repo/repomd.xml"),
+                          ("GET", "/repodata/repomd.xml"),
+                          ("GET", "/repo/primary.xml.gz?x=1")])
+        self.assertEqual(conns[0].request.call_args_list[2][1]['headers'],
+                         {"If-None-Match": '"1"'})
+        self.assertEqual(open(self.fname).read(), "repomd")
+        self.assertEqual(open(fname2).read(), "primary")
+        self.assertEqual(open(fname3).read(), "other")
+
+        # idle connections are closed
+        downloader.close()
+        self.assertTrue(conns[0].close.called)
+        self.assertTrue(conns[1].close.called)
+
+    @patch("Bcfg2.Server.Plugins.Packages.Download.getproxies", dict)
+    def test_fetch_http_retry(self):
+        downloader = self.get_obj()
+        mock_conn, conns = get_connections(
+            [get_response(200, "one"), socket.error("closed")],
+            [get_response(200, "two")],
+            [socket.error("refused")])
+
+        @patch.object(httplib, "HTTPConnection", mock_conn)
+        def inner():
+            self.assertTrue(downloader.fetch(self.url, self.fname))
+            # the server closed the idle connection, so the request
+            # is retried on a new one
+            self.assertTrue(downloader.fetch(self.url + "?2", self.fname))
+            self.assertEqual(len(conns), 2)
+            self.assertTrue(conns[0].close.called)
+            self.assertEqual(open(self.fname).read(), "two")
+
+            # errors on new connections are not retried
+            downloader.close()
+            self.assertRaises(URLError, downloader.fetch, self.url + "?3",
+                              self.fname)
+            self.assertEqual(len(conns), 3)
+            self.assertTrue(conns[2].close.called)
+
+        inner()
+
+    @patch("Bcfg2.Server.Plugins.Packages.Download.getproxies", dict)
+    def test_fetch_http_error(self):
+        downloader = self.get_obj()
+        mock_conn, conns = get_connections([get_response(404, "missing")])
+
+        @patch.object(httplib, "HTTPConnection", mock_conn)
+        def inner():
+            self.assertRaises(HTTPError, downloader.fetch, self.url,
+                              self.fname)
+
+        inner()
+        self.assertFalse(os.path.exists(self.fname))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_map(self):
+        downloader = self.get_obj()
+
+        def func(item):
+            if item % 3 == 0:
+                raise ValueError(item)
+            return item * 2
+
+        results = downloader.map(func, list(range(10)))
+        self.assertEqual([r for r in results if not isinstance(r, Exception)],
+                         [2, 4, 8, 10, 14, 16])
+        self.assertEqual([r.args[0] for r in results
+                          if isinstance(r, ValueError)],
+                         [0, 3, 6, 9])
+        self.assertEqual(downloader.map(func, []), [])
+
+    def test_fetch_all(self):
+        downloader = self.get_obj()
+        error = URLError("refused")
+
+        def fetch(url, fname):
+            if url == "http://b":
+                raise error
+            return url == "http://a"
+
+        @patch.object(downloader, "fetch")
+        @patch.object(downloader, "close")
+        def inner(mock_close, mock_fetch):
+            mock_fetch.side_effect = fetch
+            self.assertEqual(
+                downloader.fetch_all([("http://a", "/a"), ("http://b", "/b"),
+                                      ("http://c", "/c"),
+                                      ("http://a", "/a")]),
+                {"http://a": True, "http://b": error, "http://c": False})
+            self.assertEqual(mock_fetch.call_count, 3)
+            mock_close.assert_called_with()
+
+        inner()
@@ -0,0 +1,176 @@
+import os
+import sys
+import shutil
+import tempfile
+from mock import patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Plugins.Packages.PackageIndex import *
+
+
+class TestPackageIndex(Bcfg2TestCase):
+    # a non-ASCII string, as bytes on python 2 and as a str on python
+    # 3; either way it must survive the round trip unchanged
+    nonascii = "caf\xc3\xa9"
+
+    sets = dict(x86_64=dict(packages=["foo", "bar", nonascii, "bar"],
+                            provides=[]),
+                noarch=dict(packages=["baz"]),
+                empty=dict())
+    maps = dict(x86_64=dict(deps=dict(foo=["bar", "libc.so.6"],
+                                      bar=[],
+                                      baz=[nonascii, "foo"]),
+                            none=dict()),
+                empty=dict())
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "index")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_index(self, **kwargs):
+        PackageIndex.write(self.fname, sets=self.sets, maps=self.maps,
+                           **kwargs)
+        return PackageIndex(self.fname)
+
+    def test_sets(self):
+        index = self.get_index(extra=dict(version="1"))
+        self.assertEqual(index.extra, dict(version="1"))
+
+        sets = index.sets("x86_64")
+        self.assertItemsEqual(sets.keys(), ["packages", "provides"])
+        packages = sets["packages"]
+        self.assertEqual(len(packages), 3)
+        self.assertItemsEqual(list(packages), ["foo", "bar", self.nonascii])
+        self.assertIn("foo", packages)
+        self.assertIn(self.nonascii, packages)
+        self.assertNotIn("baz", packages)
+        self.assertNotIn("", packages)
+        self.assertNotIn("zzz", packages)
+
+        provides = sets["provides"]
+        self.assertEqual(len(provides), 0)
+        self.assertEqual(list(provides), [])
+        self.assertNotIn("foo", provides)
+
+        self.assertItemsEqual(list(index.sets("noarch")["packages"]),
+                              ["baz"])
+        self.assertEqual(index.sets("empty"), dict())
+        self.assertEqual(index.sets("nonexistent"), dict())
+        index.close()
+
+    def test_maps(self):
+        index = self.get_index()
+        maps = index.maps("x86_64")
+        self.assertItemsEqual(maps.keys(), ["deps", "none"])
+        deps = maps["deps"]
+        self.assertEqual(len(deps), 3)
+        self.assertItemsEqual(deps.keys(), ["foo", "bar", "baz"])
+        self.assertItemsEqual(list(deps), ["foo", "bar", "baz"])
+        self.assertItemsEqual(deps.items(),
+                              self.maps["x86_64"]["deps"].items())
+        self.assertItemsEqual(deps.values(),
+                              self.maps["x86_64"]["deps"].values())
+
+        # values keep their order
+        self.assertEqual(deps["foo"], ["bar", "libc.so.6"])
+        self.assertEqual(deps["baz"], [self.nonascii, "foo"])
+        self.assertEqual(deps["bar"], [])
+        self.assertEqual(deps.get("foo"), ["bar", "libc.so.6"])
+        self.assertEqual(deps.get("bar", "default"), [])
+        self.assertIsNone(deps.get("libc.so.6"))
+        self.assertEqual(deps.get("quux", "default"), "default")
+        self.assertRaises(KeyError, deps.__getitem__, "libc.so.6")
+        self.assertIn("foo", deps)
+        self.assertNotIn(self.nonascii, deps)
+
+        none = maps["none"]
+        self.assertEqual(len(none), 0)
+        self.assertEqual(none.items(), [])
+        self.assertIsNone(none.get("foo"))
+        self.assertEqual(index.maps("empty"), dict())
+        index.close()
+
+        # the index is mapped again if it is used after it is closed
+        self.assertEqual(deps["foo"], ["bar", "libc.so.6"])
+        index.close()
+
+    def test_empty(self):
+        PackageIndex.write(self.fname)
+        index = PackageIndex(self.fname)
+        self.assertIsNone(index.extra)
+        self.assertEqual(index.sets("x86_64"), dict())
+        self.assertEqual(index.maps("x86_64"), dict())
+        self.assertIsNone(index.string_id("foo"))
+
+    def test_strings(self):
+        index = self.get_index()
+        strings = ["bar", "baz", "foo", "libc.so.6", self.nonascii]
+        ids = [index.string_id(s) for s in strings]
+        self.assertEqual(sorted(ids), list(range(len(strings))))
+        for string, sid in zip(strings, ids):
+            self.assertEqual(index.string(sid), string)
+        self.assertIsNone(index.string_id("quux"))
+        index.close()
+
+    def test_replace(self):
+        # an index that is open is not disturbed when it is replaced
+        index = self.get_index()
+        deps = index.maps("x86_64")["deps"]
+        self.assertEqual(deps["foo"], ["bar", "libc.so.6"])
+        PackageIndex.write(self.fname, sets=dict(g=dict(s=["other"])))
+        self.assertEqual(deps["foo"], ["bar", "libc.so.6"])
+        index.close()
+        self.assertEqual(list(PackageIndex(self.fname).sets("g")["s"]),
+                         ["other"])
+        self.assertEqual(os.listdir(self.tmpdir), ["index"])
+
+    def test_invalid(self):
+        self.assertRaises(IOError, PackageIndex, self.fname)
+
+        # a file that is too short
+        open(self.fname, "wb").write(MAGIC)
+        self.assertRaises(ValueError, PackageIndex, self.fname)
+
+        # wrong magic
+        self.get_index()
+        data = open(self.fname, "rb").read()
+        open(self.fname, "wb").write("BCFG2XXX".encode('UTF-8') +
+                                     data[len(MAGIC):])
+        self.assertRaises(ValueError, PackageIndex, self.fname)
+
+    def test_wrong_version(self):
+        @patch("Bcfg2.Server.Plugins.Packages.PackageIndex.VERSION",
+               VERSION + 1)
+        def inner():
+            PackageIndex.write(self.fname, sets=self.sets)
+            self.assertItemsEqual(PackageIndex(self.fname).sets("noarch"),
+                                  ["packages"])
+
+        inner()
+        self.assertRaises(ValueError, PackageIndex, self.fname)
+
+    def test_wrong_byteorder(self):
+        self.get_index()
+        if sys.byteorder == "little":
+            other = "big"
+        else:
+            other = "little"
+
+        @patch("sys.byteorder", other)
+        def inner():
+            self.assertRaises(ValueError, PackageIndex, self.fname)
+
+        inner()
@@ -0,0 +1,155 @@
+import os
+import sys
+import shutil
+import random
+import tempfile
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Plugins.Packages.Source import *
+
+
+def random_graph(rand, size):
+    """ get a random dependency graph of ``size`` packages, with
+    dependencies on packages and on names outside the graph """
+    names = ["pkg%d" % i for i in range(size)]
+    others = ["other%d" % i for i in range(size // 4 + 1)]
+    deps = dict()
+    for name in names:
+        deps[name] = rand.sample(names + others, rand.randint(0, 3))
+    return deps
+
+
+def plain_closure(deps, package):
+    """ get the closure and frontier of a package by walking the
+    graph """
+    closure = set([package])
+    frontier = set()
+    todo = [package]
+    while todo:
+        for dep in deps[todo.pop()]:
+            if dep not in deps:
+                frontier.add(dep)
+            elif dep not in closure:
+                closure.add(dep)
+                todo.append(dep)
+    return closure, frontier
+
+
+class TestDependencyClosures(Bcfg2TestCase):
+    def test_empty(self):
+        self.assertEqual(dependency_closures(set(), lambda p: []),
+                         (dict(), dict()))
+
+    def test_cycle(self):
+        deps = dict(a=["b"], b=["c", "x"], c=["a"], d=["a", "y"])
+        closures, frontiers = dependency_closures(set(deps), deps.get)
+        self.assertItemsEqual(closures['a'], ["a", "b", "c"])
+        self.assertItemsEqual(frontiers['a'], ["x"])
+        self.assertItemsEqual(closures['d'], ["a", "b", "c", "d"])
+        self.assertItemsEqual(frontiers['d'], ["x", "y"])
+
+    def test_random(self):
+        rand = random.Random(1234)
+        for _ in range(100):
+            deps = random_graph(rand, rand.randint(1, 40))
+            limit = rand.choice([5, 10, 1000])
+            closures, frontiers = dependency_closures(set(deps), deps.get,
+                                                      limit=limit)
+            for name in deps:
+                closure, frontier = plain_closure(deps, name)
+                if len(closure) + len(frontier) > limit:
+                    self.assertNotIn(name, closures)
+                    self.assertNotIn(name, frontiers)
+                else:
+                    self.assertItemsEqual(closures[name], closure)
+                    self.assertItemsEqual(frontiers[name], frontier)
+
+
+class TestSource(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = [os.path.join(self.tmpdir, "Packages.gz"),
+                      os.path.join(self.tmpdir, "Sources.gz")]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        # avoid Source.__init__, which needs a full source definition
+        source = object.__new__(Source)
+        source.logger = Mock()
+        source.cachefile = os.path.join(self.tmpdir, "cache-key")
+        source.rawurl = "http://example.com/debian/"
+        return source
+
+    def touch(self, fname, mtime):
+        open(fname, 'w').close()
+        os.utime(fname, (mtime, mtime))
+
+    def test_cache_is_current(self):
+        source = self.get_obj()
+
+        @patch.object(Source, "files", self.files)
+        def inner():
+            self.assertFalse(source.cache_is_current())
+            for fname in self.files:
+                self.touch(fname, 1000)
+            self.assertFalse(source.cache_is_current())
+            self.touch(source.cachefile, 1000)
+            self.assertTrue(source.cache_is_current())
+
+            # a file downloaded after the cache was written
+            self.touch(self.files[1], 1001)
+            self.assertFalse(source.cache_is_current())
+
+            self.touch(source.cachefile, 1002)
+            self.assertTrue(source.cache_is_current())
+            os.unlink(self.files[0])
+            self.assertFalse(source.cache_is_current())
+
+        inner()
+
+    def test_setup_data_unchanged(self):
+        source = self.get_obj()
+        for fname in self.files:
+            self.touch(fname, 1000)
+        self.touch(source.cachefile, 1001)
+
+        @patch.object(Source, "files", self.files)
+        @patch.object(source, "update")
+        @patch.object(source, "load_state")
+        @patch.object(source, "clear_state")
+        @patch.object(source, "read_files")
+        def inner(mock_read_files, mock_clear_state, mock_load_state,
+                  mock_update):
+            mock_update.return_value = False
+
+            # nothing has changed, and the cache was written after
+            # the files were downloaded, so the cache is loaded
+            source.setup_data(force_update=True, downloads=["downloads"])
+            mock_update.assert_called_with(downloads=["downloads"])
+            mock_load_state.assert_called_with()
+            self.assertFalse(mock_read_files.called)
+
+            # a file was downloaded, but the cache was not rebuilt
+            # from it, e.g., because the server was stopped, so the
+            # files are read even though nothing has changed since
+            mock_load_state.reset_mock()
+            self.touch(self.files[0], 1002)
+            source.setup_data(force_update=True)
+            self.assertFalse(mock_load_state.called)
+            mock_clear_state.assert_called_with()
+            mock_read_files.assert_called_with()
+
+        inner()
@@ -0,0 +1,139 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Plugins.Packages.Yum import *
+
+PRIMARY = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common"
+          xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="3">
+  <package type="rpm">
+    <name>bash</name>
+    <arch>x86_64</arch>
+    <format>
+      <rpm:provides>
+        <rpm:entry name="bash"/>
+        <rpm:entry name="/bin/sh"/>
+      </rpm:provides>
+      <rpm:requires>
+        <rpm:entry name="glibc"/>
+        <rpm:entry name="/etc/nsswitch.conf"/>
+      </rpm:requires>
+    </format>
+  </package>
+  <package type="rpm">
+    <name>glibc</name>
+    <arch>x86_64</arch>
+    <format>
+      <rpm:provides>
+        <rpm:entry name="glibc"/>
+        <rpm:entry name="libc.so.6"/>
+      </rpm:provides>
+    </format>
+  </package>
+  <package type="rpm">
+    <name>dash</name>
+    <arch>x86_64</arch>
+    <format>
+      <rpm:provides>
+        <rpm:entry name="/bin/sh"/>
+      </rpm:provides>
+      <rpm:requires>
+        <rpm:entry name="libc.so.6"/>
+      </rpm:requires>
+    </format>
+  </package>
+</metadata>
+"""
+
+FILELISTS = """<?xml version="1.0" encoding="UTF-8"?>
+<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="2">
+  <package pkgid="1" name="glibc" arch="x86_64">
+    <file>/etc/nsswitch.conf</file>
+    <file>/lib64/libc.so.6</file>
+  </package>
+  <package pkgid="2" name="nss" arch="x86_64">
+    <file>/etc/nsswitch.conf</file>
+    <file type="dir">/etc</file>
+  </package>
+</filelists>
+"""
+
+
+class TestYumSource(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        # avoid YumSource.__init__, which needs a full source
+        # definition
+        source = object.__new__(YumSource)
+        source.packages = dict()
+        source.deps = dict([('global', dict())])
+        source.provides = dict([('global', dict())])
+        source.filemap = dict()
+        source.needed_paths = set()
+        return source
+
+    def write(self, name, data, compress=True):
+        fname = os.path.join(self.tmpdir, name)
+        if compress:
+            outfile = gzip.open(fname, 'wb')
+        else:
+            outfile = open(fname, 'wb')
+        outfile.write(data.encode('UTF-8'))
+        outfile.close()
+        return fname
+
+    def test_parse_primary(self):
+        source = self.get_obj()
+        source.parse_primary(self.write("primary.xml.gz", PRIMARY),
+                             "x86_64")
+        self.assertItemsEqual(source.packages['x86_64'],
+                              ["bash", "glibc", "dash"])
+        self.assertEqual(source.deps['x86_64'],
+                         dict(bash=set(["glibc", "/etc/nsswitch.conf"]),
+                              glibc=set(),
+                              dash=set(["libc.so.6"])))
+        self.assertEqual(source.provides['x86_64'],
+                         {"bash": ["bash"],
+                          "/bin/sh": ["bash", "dash"],
+                          "glibc": ["glibc"],
+                          "libc.so.6": ["glibc"]})
+        self.assertEqual(source.needed_paths, set(["/etc/nsswitch.conf"]))
+
+    def test_parse_filelist(self):
+        source = self.get_obj()
+        source.needed_paths = set(["/etc/nsswitch.conf", "/usr/bin/missing"])
+        source.parse_filelist(self.write("filelists.xml.gz", FILELISTS),
+                              "x86_64")
+        self.assertEqual(source.filemap,
+                         dict(x86_64={"/etc/nsswitch.conf":
+                                          set(["glibc", "nss"])}))
+
+    def test_compression(self):
+        # files are decompressed based on their contents, not their
+        # names
+        source = self.get_obj()
+        source.parse_primary(self.write("primary.xml", PRIMARY), "x86_64")
+        source.parse_primary(self.write("primary.xml.gz", PRIMARY,
+                                        compress=False), "i386")
+        self.assertItemsEqual(source.packages['x86_64'],
+                              ["bash", "glibc", "dash"])
+        self.assertEqual(source.packages['i386'], source.packages['x86_64'])
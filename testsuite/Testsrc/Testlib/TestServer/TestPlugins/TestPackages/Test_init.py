@@ -0,0 +1,171 @@
+import os
+import sys
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Cache import Cache
+from Bcfg2.Compat import URLError
+from Bcfg2.Server.Plugins.Packages import *
+
+
+class TestPackages(Bcfg2TestCase):
+    def get_obj(self, completions=True):
+        # avoid Packages.__init__, which sets up sources, downloads,
+        # and keys
+        packages = object.__new__(Packages)
+        packages.core = MagicMock()
+        packages.logger = Mock()
+        packages.cachepath = os.path.join(datastore, "nonexistent")
+        packages.sources = Mock()
+        packages.sources.entries = []
+        packages.collections = dict()
+        packages.clients = dict()
+        if completions:
+            packages.completions = Cache(max_entries=10)
+        else:
+            packages.completions = None
+        return packages
+
+    def get_collection(self, cachekey="key", groups=None):
+        collection = Mock()
+        collection.cachekey = cachekey
+        if groups is None:
+            groups = ["group1"]
+        collection.get_relevant_groups.return_value = groups
+        collection.complete.side_effect = \
+            lambda base: (set(base) | set(["dep"]), set(["unknown"]))
+        return collection
+
+    def test__complete(self):
+        packages = self.get_obj()
+        collection = self.get_collection()
+        expected = (set(["foo", "bar", "dep"]), set(["unknown"]))
+        self.assertEqual(packages._complete(collection, set(["foo", "bar"])),
+                         expected)
+        collection.complete.assert_called_once_with(set(["foo", "bar"]))
+
+        # the same package list is resolved from the cache, and the
+        # result can be modified without changing the cache
+        collection.complete.reset_mock()
+        packages.completions.hits = 0
+        packages_, unknown = packages._complete(collection,
+                                                set(["bar", "foo"]))
+        self.assertEqual((packages_, unknown), expected)
+        self.assertFalse(collection.complete.called)
+        self.assertEqual(packages.completions.hits, 1)
+        packages_.add("baz")
+        unknown.clear()
+        self.assertEqual(packages._complete(collection, set(["foo", "bar"])),
+                         expected)
+
+        # a different package list, collection, or set of relevant
+        # groups is resolved again
+        packages._complete(collection, set(["foo"]))
+        packages._complete(self.get_collection(cachekey="other"),
+                           set(["foo", "bar"]))
+        packages._complete(self.get_collection(groups=["group2"]),
+                           set(["foo", "bar"]))
+        self.assertEqual(len(packages.completions), 4)
+
+    def test__complete_empty(self):
+        packages = self.get_obj()
+        collection = self.get_collection()
+
+        # an empty result for a non-empty package list is not cached
+        collection.complete.side_effect = None
+        collection.complete.return_value = (set(), set(["foo"]))
+        for i in range(2):
+            self.assertEqual(packages._complete(collection, set(["foo"])),
+                             (set(), set(["foo"])))
+        self.assertEqual(collection.complete.call_count, 2)
+        self.assertEqual(len(packages.completions), 0)
+
+        # but an empty result for an empty package list is
+        collection.complete.reset_mock()
+        collection.complete.return_value = (set(), set())
+        for i in range(2):
+            self.assertEqual(packages._complete(collection, set()),
+                             (set(), set()))
+        collection.complete.assert_called_once_with(set())
+
+    def test__complete_disabled(self):
+        packages = self.get_obj(completions=False)
+        collection = self.get_collection()
+        for i in range(2):
+            self.assertEqual(packages._complete(collection, set(["foo"])),
+                             (set(["foo", "dep"]), set(["unknown"])))
+        self.assertEqual(collection.complete.call_count, 2)
+
+    @patch("Bcfg2.Server.Dependencies.graph")
+    @patch("Bcfg2.Server.Plugins.Packages.Packages._load_gpg_keys")
+    def test__load_config(self, mock_load_gpg_keys, mock_graph):
+        packages = self.get_obj()
+        packages.core.setup.cfp.getboolean.return_value = False
+        collection = self.get_collection()
+        packages._complete(collection, set(["foo"]))
+        self.assertEqual(len(packages.completions), 1)
+
+        # reloading the sources clears the cache
+        packages._load_config()
+        self.assertEqual(len(packages.completions), 0)
+        mock_load_gpg_keys.assert_called_with(False)
+        mock_graph.changed.assert_called_with()
+
+        collection.complete.reset_mock()
+        packages._complete(collection, set(["foo"]))
+        collection.complete.assert_called_once_with(set(["foo"]))
+
+    @patch("Bcfg2.Server.Plugins.Packages.downloader.fetch_all")
+    def test__download_sources(self, mock_fetch_all):
+        packages = self.get_obj()
+        error = URLError("refused")
+        source1 = Mock()
+        source1.get_downloads.return_value = [("http://a", "/a"),
+                                              ("http://b", "/b")]
+        source2 = Mock()
+        source2.get_downloads.side_effect = error
+        source3 = Mock()
+        source3.get_downloads.return_value = [("http://c", "/c")]
+        packages.sources.entries = [source1, source2, source3]
+        mock_fetch_all.return_value = {"http://a": True, "http://b": False,
+                                       "http://c": error}
+
+        # the files of all sources are downloaded at once, and each
+        # source gets the results for its own files
+        self.assertEqual(packages._download_sources(),
+                         [[("http://a", "/a", True),
+                           ("http://b", "/b", False)],
+                          None,
+                          [("http://c", "/c", error)]])
+        self.assertItemsEqual(mock_fetch_all.call_args[0][0],
+                              [("http://a", "/a"), ("http://b", "/b"),
+                               ("http://c", "/c")])
+
+    @patch("Bcfg2.Server.Plugins.Packages.Packages._download_sources")
+    def test__load_sources(self, mock_download_sources):
+        packages = self.get_obj()
+        packages.core.setup.cfp.getboolean.return_value = True
+        source1 = Mock()
+        source2 = Mock()
+        packages.sources.entries = [source1, source2]
+        mock_download_sources.return_value = [["downloads1"], None]
+
+        packages._load_sources(True)
+        source1.setup_data.assert_called_with(True, downloads=["downloads1"])
+        source2.setup_data.assert_called_with(True, downloads=None)
+
+        mock_download_sources.reset_mock()
+        packages._load_sources(False)
+        self.assertFalse(mock_download_sources.called)
+        source1.setup_data.assert_called_with(False, downloads=None)
+        source2.setup_data.assert_called_with(False, downloads=None)
@@ -1,6 +1,8 @@
 import os
 import sys
 import time
+import shutil
+import tempfile
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
@@ -87,7 +89,8 @@ class TestProbeData(Bcfg2TestCase):
 class TestProbeSet(TestEntrySet):
     test_obj = ProbeSet
     basenames = ["test", "_test", "test-test"]
-    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml"]
+    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml",
+              "probed.xml.journal"]
     bogus_names = ["test.py"]
 
     def get_obj(self, path=datastore, fam=None, encoding=None,
@@ -162,7 +165,7 @@ group-specific"""
         p3 = Mock()
         p3.specific = Bcfg2.Server.Plugin.Specificity(all=True)
         p3.name = "barprobe"
-        p3.data = "#! /usr/bin/env python"
+        p3.data = "#! /usr/bin/env python\n# bcfg2: serial\n"
         matching.append(p3)
 
         p4 = Mock()
@@ -187,9 +190,11 @@ group-specific"""
             if probe.get("name") == "fooprobe":
                 self.assertIn("group-specific", probe.text)
                 self.assertEqual(probe.get("interpreter"), "/bin/bash")
+                self.assertIsNone(probe.get("serial"))
             elif probe.get("name") == "barprobe":
                 self.assertEqual(probe.get("interpreter"),
                                  "/usr/bin/env python")
+                self.assertEqual(probe.get("serial"), "true")
             elif probe.get("name") == "bazprobe":
                 self.assertIsNotNone(probe.get("interpreter"))
             else:
@@ -236,6 +241,8 @@ text
         core = MagicMock()
         core.setup.cfp.getboolean = Mock()
         core.setup.cfp.getboolean.return_value = use_db
+        core.setup.cfp.get = Mock(side_effect=lambda s, o, default=None:
+                                  default)
         if load_data is None:
             load_data = MagicMock()
         # we have to patch load_data() in a funny way because
@@ -344,6 +351,59 @@ text
             self.assertIsNotNone(ydata.get("value"))
             self.assertItemsEqual(test_data, yaml.load(ydata.get("value")))
 
+    def test__write_data_journal(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            probes = self.get_probes_object(use_db=False)
+            probes.data = tmpdir
+            probes.journal = os.path.join(tmpdir, "probed.xml.journal")
+            probes.use_journal = True
+            probes.compact_interval = 3600
+            probes.probedata = self.get_test_probedata()
+            probes.cgroups = self.get_test_cgroups()
+
+            for cname in probes.probedata.keys():
+                client = Mock()
+                client.hostname = cname
+                probes._write_data_journal(client)
+            self.assertEqual(len(open(probes.journal).readlines()), 2)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir,
+                                                         "probed.xml")))
+            self.assertIsNotNone(probes._timer)
+
+            # unchanged probe data is not written again
+            probes._write_data_journal(client)
+            self.assertEqual(len(open(probes.journal).readlines()), 2)
+
+            # changed probe data is appended
+            probes.cgroups["foo.example.com"] = ["new-group"]
+            client.hostname = "foo.example.com"
+            probes._write_data_journal(client)
+            self.assertEqual(len(open(probes.journal).readlines()), 3)
+
+            # probe data can be loaded from the journal alone
+            probes.probedata = dict()
+            probes.cgroups = dict()
+            probes._load_data_xml()
+            self.assertItemsEqual(probes.probedata, self.get_test_probedata())
+            self.assertEqual(probes.cgroups["foo.example.com"], ["new-group"])
+            self.assertEqual(probes._journal_records, 3)
+
+            # the journal is compacted into probed.xml
+            probes.compact()
+            self.assertIsNone(probes._timer)
+            self.assertFalse(os.path.exists(probes.journal))
+            probes.probedata = dict()
+            probes.cgroups = dict()
+            probes._load_data_xml(client="foo.example.com")
+            self.assertItemsEqual(
+                probes.probedata["foo.example.com"],
+                self.get_test_probedata()["foo.example.com"])
+            self.assertEqual(probes.cgroups, {"foo.example.com":
+                                              ["new-group"]})
+        finally:
+            shutil.rmtree(tmpdir)
+
     @skipUnless(HAS_DJANGO, "Django not found, skipping")
     def test__write_data_db(self):
         syncdb(TestProbesDB)
@@ -396,13 +456,88 @@ text
         pgroups = ProbesGroupsModel.objects.filter(hostname=cname).all()
         self.assertEqual(len(pgroups), len(probes.cgroups[cname]))
 
+    @skipUnless(HAS_DJANGO, "Django not found, skipping")
+    def test__write_data_db_queries(self):
+        syncdb(TestProbesDB)
+        from django.db import connection
+        probes = self.get_probes_object(use_db=True)
+        probes.probedata = self.get_test_probedata()
+        probes.cgroups = self.get_test_cgroups()
+        client = Mock()
+        client.hostname = "foo.example.com"
+        probes._write_data_db(client)
+
+        def count_queries(probes_changed):
+            for probe in probes_changed:
+                probes.probedata[client.hostname][probe] = \
+                    ProbeData(probes.probedata[client.hostname][probe] + "x")
+            connection.use_debug_cursor = True
+            connection.force_debug_cursor = True
+            try:
+                start = len(connection.queries)
+                probes._write_data_db(client)
+                return len(connection.queries) - start
+            finally:
+                connection.use_debug_cursor = False
+                connection.force_debug_cursor = False
+
+        # the number of queries does not depend on the number of
+        # changed probes
+        self.assertEqual(count_queries(["text"]),
+                         count_queries(["text", "xml", "multiline"]))
+
+        pdata = dict((p.probe, p.data) for p in
+                     ProbesDataModel.objects.filter(hostname=client.hostname))
+        self.assertEqual(pdata,
+                         dict((p, str(d)) for p, d in
+                              probes.probedata[client.hostname].items()))
+
+    @patch("Bcfg2.Server.Plugins.Probes.Probes._write_clients_db")
+    def test__write_data_db_deferred(self, mock_write_clients_db):
+        probes = self.get_probes_object(use_db=True)
+        probes.write_interval = 3600
+        for cname in ["foo.example.com", "bar.example.com"]:
+            client = Mock()
+            client.hostname = cname
+            probes._write_data_db(client)
+        self.assertFalse(mock_write_clients_db.called)
+        self.assertIsNotNone(probes._timer)
+
+        # data from all clients is written at once
+        probes.flush_db()
+        self.assertIsNone(probes._timer)
+        mock_write_clients_db.assert_called_once_with(
+            set(["foo.example.com", "bar.example.com"]))
+
+        # nothing left to write
+        mock_write_clients_db.reset_mock()
+        probes.flush_db()
+        self.assertFalse(mock_write_clients_db.called)
+
+        # failed writes are retried
+        probes._write_data_db(client)
+        mock_write_clients_db.side_effect = Exception
+        self.assertRaises(Exception, probes.flush_db)
+        mock_write_clients_db.side_effect = None
+        mock_write_clients_db.reset_mock()
+        probes.flush_db()
+        mock_write_clients_db.assert_called_once_with(
+            set(["bar.example.com"]))
+
+        # without write_interval, data is written immediately
+        probes.write_interval = 0
+        mock_write_clients_db.reset_mock()
+        probes._write_data_db(client)
+        mock_write_clients_db.assert_called_once_with(
+            set(["bar.example.com"]))
+
     @skipUnless(HAS_DJANGO, "Django not found, skipping")
     @patch("Bcfg2.Server.Plugins.Probes.Probes._load_data_db", Mock())
     @patch("Bcfg2.Server.Plugins.Probes.Probes._load_data_xml", Mock())
     def test_load_data_xml(self):
         probes = self.get_probes_object(use_db=False)
         probes.load_data()
-        probes._load_data_xml.assert_any_call()
+        probes._load_data_xml.assert_any_call(client=None)
         self.assertFalse(probes._load_data_db.called)
 
     @skipUnless(HAS_DJANGO, "Django not found, skipping")
@@ -411,7 +546,7 @@ text
     def test_load_data_db(self):
         probes = self.get_probes_object(use_db=True)
         probes.load_data()
-        probes._load_data_db.assert_any_call()
+        probes._load_data_db.assert_any_call(client=None)
         self.assertFalse(probes._load_data_xml.called)
 
     @patch("%s.open" % builtins)
@@ -437,6 +572,16 @@ text
         self.assertItemsEqual(probes.probedata, self.get_test_probedata())
         self.assertItemsEqual(probes.cgroups, self.get_test_cgroups())
 
+        # reload data for a single client
+        probes.probedata = dict(bar=ClientProbeDataSet())
+        probes.cgroups = dict(bar=[])
+        probes._load_data_xml(client="foo.example.com")
+        self.assertItemsEqual(probes.probedata, ["bar", "foo.example.com"])
+        self.assertItemsEqual(probes.probedata["foo.example.com"],
+                              self.get_test_probedata()["foo.example.com"])
+        self.assertEqual(probes.cgroups["foo.example.com"],
+                         self.get_test_cgroups()["foo.example.com"])
+
     @skipUnless(HAS_DJANGO, "Django not found, skipping")
     def test__load_data_db(self):
         syncdb(TestProbesDB)
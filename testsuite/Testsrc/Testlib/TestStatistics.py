@@ -0,0 +1,221 @@
+import os
+import sys
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Statistics import *
+
+
+class TestHistogram(Bcfg2TestCase):
+    def assertClose(self, estimate, value):
+        self.assertLessEqual(abs(estimate - value), value * 0.05,
+                             "%s is not within 5%% of %s" % (estimate, value))
+
+    def test_percentile(self):
+        hist = Histogram()
+        self.assertEqual(hist.percentile(0.5), 0.0)
+
+        for i in range(1, 1001):
+            hist.add(i / 1000.0)
+        self.assertEqual(hist.count, 1000)
+        self.assertClose(hist.total, 500.5)
+        self.assertClose(hist.percentile(0.5), 0.5)
+        self.assertClose(hist.percentile(0.9), 0.9)
+        self.assertClose(hist.percentile(0.99), 0.99)
+        self.assertClose(hist.percentile(0), 0.001)
+        self.assertClose(hist.percentile(1), 1.0)
+        self.assertLessEqual(len(hist.counts), Histogram.buckets)
+
+    def test_bucket(self):
+        hist = Histogram()
+        self.assertEqual(hist.bucket(0), 0)
+        self.assertEqual(hist.bucket(hist.resolution / 2), 0)
+        self.assertEqual(hist.bucket(10 ** 9), hist.buckets - 1)
+        self.assertEqual(hist.bucket_value(0), 0.0)
+        # buckets increase monotonically
+        buckets = [hist.bucket(2 ** (i / 4.0) * hist.resolution)
+                   for i in range(100)]
+        self.assertEqual(buckets, sorted(buckets))
+
+        hist.add(0)
+        hist.add(10 ** 9)
+        self.assertEqual(hist.percentile(0.5), 0.0)
+        self.assertGreater(hist.percentile(1), 10 ** 5)
+
+    def test_merge(self):
+        hist1 = Histogram()
+        hist2 = Histogram()
+        for i in range(1, 101):
+            hist1.add(i / 100.0)
+            hist2.add(i)
+        hist1.merge(hist2)
+        self.assertEqual(hist1.count, 200)
+        self.assertClose(hist1.total, 5050 + 50.5)
+        self.assertClose(hist1.percentile(0.25), 0.5)
+        self.assertClose(hist1.percentile(0.75), 50)
+
+
+class TestSlidingWindow(Bcfg2TestCase):
+    def test_histogram(self):
+        window = SlidingWindow(10, 6)
+        window.add(1, 1000)
+        window.add(2, 1015)
+        window.add(3, 1059)
+
+        hist, covered = window.histogram(1059, 60)
+        self.assertEqual(hist.count, 3)
+        self.assertEqual(covered, 59)
+
+        # only whole slots that overlap the period are included
+        hist, covered = window.histogram(1059, 20)
+        self.assertEqual(hist.count, 1)
+        self.assertEqual(covered, 19)
+
+    def test_expiry(self):
+        window = SlidingWindow(10, 6)
+        window.add(1, 1000)
+        window.add(2, 1015)
+
+        # values older than the period are not included
+        hist, covered = window.histogram(1065, 60)
+        self.assertEqual(hist.count, 1)
+        hist, covered = window.histogram(1200, 60)
+        self.assertEqual(hist.count, 0)
+
+        # a slot that is reused is emptied first
+        window.add(3, 1060)
+        self.assertEqual(window.histogram(1060, 60)[0].count, 2)
+        self.assertEqual(window.histogram(1060, 10)[0].count, 1)
+
+
+class TestStatistic(Bcfg2TestCase):
+    @patch("time.time")
+    def test_get_details(self, mock_time):
+        mock_time.return_value = 1000
+        stat = Statistic("test", 1.0)
+        mock_time.return_value = 1200
+        stat.add_value(3.0)
+        mock_time.return_value = 1300
+        stat.add_value(2.0)
+        self.assertEqual(stat.get_value(), ("test", (1.0, 3.0, 2.0, 3)))
+
+        details = stat.get_details()
+        self.assertEqual(details['count'], 3)
+        self.assertEqual(details['min'], 1.0)
+        self.assertEqual(details['max'], 3.0)
+        self.assertEqual(details['mean'], 2.0)
+        self.assertAlmostEqual(details['rate'], 3 / 300.0)
+        self.assertAlmostEqual(details['p50'], 2.0, delta=0.1)
+        # percentiles never fall outside the range of values seen
+        self.assertEqual(details['p999'], 3.0)
+
+        self.assertItemsEqual(details['windows'].keys(),
+                              [w[0] for w in WINDOWS])
+        self.assertEqual(details['windows']['1m']['count'], 1)
+        self.assertEqual(details['windows']['1m']['mean'], 2.0)
+        self.assertEqual(details['windows']['5m']['count'], 2)
+        self.assertEqual(details['windows']['1h']['count'], 3)
+
+        # old values drop out of the windows
+        mock_time.return_value = 1400
+        details = stat.get_details()
+        self.assertEqual(details['windows']['1m']['count'], 0)
+        self.assertEqual(details['windows']['1m']['rate'], 0)
+        self.assertEqual(details['count'], 3)
+
+
+class TestTracer(Bcfg2TestCase):
+    def get_tracer(self, **kwargs):
+        tracer = Tracer(**kwargs)
+        tracer.enabled = True
+        return tracer
+
+    def test_disabled(self):
+        tracer = Tracer()
+        self.assertFalse(tracer.start("GetConfig", "foo"))
+        self.assertIsNone(tracer.begin("Bind"))
+        tracer.annotate(generator="Cfg")
+        tracer.end(None)
+        self.assertIsNone(tracer.finish())
+        self.assertEqual(tracer.get_traces(),
+                         dict(recent=[], slowest=[]))
+
+    def test_trace(self):
+        tracer = self.get_tracer()
+        self.assertTrue(tracer.start("GetConfig"))
+        # traces do not nest
+        self.assertFalse(tracer.start("GetProbes"))
+        tracer.set_client("foo")
+
+        bind = tracer.begin("Bind", entry="Path:/etc/foo")
+        tracer.annotate(generator="Cfg")
+        inner = tracer.begin("Inner")
+        # ending a span ends all spans within it
+        tracer.end(bind)
+        self.assertIsNotNone(inner.duration)
+        tracer.end(inner)
+
+        remote = Span("Remote")
+        remote.duration = 1.0
+        tracer.add(remote)
+
+        root = tracer.finish()
+        self.assertEqual(root.name, "GetConfig")
+        self.assertEqual(root.attrs['client'], "foo")
+        self.assertIsNotNone(root.duration)
+        self.assertEqual(root.children, [bind, remote])
+        self.assertEqual(bind.children, [inner])
+        self.assertEqual([s.name for s in root.walk()],
+                         ["GetConfig", "Bind", "Inner", "Remote"])
+        self.assertEqual(bind.attrs, dict(entry="Path:/etc/foo",
+                                          generator="Cfg"))
+
+        span = root.to_dict()
+        self.assertEqual(span['start'], 0)
+        self.assertEqual(span['spans'][0]['name'], "Bind")
+        self.assertEqual(span['spans'][0]['spans'][0]['name'], "Inner")
+        self.assertEqual(span['spans'][1]['duration'], 1.0)
+
+        traces = tracer.get_traces()
+        self.assertEqual(len(traces['recent']), 1)
+        trace = traces['recent'][0]
+        self.assertEqual(trace['client'], "foo")
+        self.assertEqual(trace['generators']['Cfg']['count'], 1)
+        self.assertEqual(len(trace['spans']), 2)
+        self.assertNotIn('spans', tracer.get_traces(spans=False)['recent'][0])
+
+        # a new trace can be started once the last is finished
+        self.assertTrue(tracer.start("GetProbes"))
+        self.assertIsNotNone(tracer.finish(keep=False))
+        self.assertEqual(len(tracer.get_traces()['recent']), 1)
+
+    @patch("time.time")
+    def test_recent_slowest(self, mock_time):
+        tracer = self.get_tracer(recent=3, slowest=2)
+        durations = [5, 1, 7, 2, 3, 6, 4]
+        for i, duration in enumerate(durations):
+            mock_time.return_value = 100 * i
+            tracer.start("GetConfig", "client%d" % i)
+            mock_time.return_value = 100 * i + duration
+            tracer.finish()
+
+        traces = tracer.get_traces(spans=False)
+        self.assertEqual([t['client'] for t in traces['recent']],
+                         ["client4", "client5", "client6"])
+        self.assertEqual([t['duration'] for t in traces['slowest']], [7, 6])
+
+        traces = tracer.get_traces(client="client5")
+        self.assertEqual(len(traces['recent']), 1)
+        self.assertEqual(len(traces['slowest']), 1)
+        self.assertEqual(tracer.get_traces(client="client0"),
+                         dict(recent=[], slowest=[]))